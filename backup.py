@@ -11,19 +11,40 @@ import argparse  # Get, and parse incoming arguments from the execution of the s
 import time  # Used to get the current date to apend to logs in pretty format
 import datetime  # Used to do file date calculations
 import os  # Used to grab the config files that will be parsed.
-import shutil  # Imported to allow easy copy operation
+import getpass  # Used to get the user running the job, even when there is no terminal (cron)
+import signal  # Used to stop the WAL archiver cleanly
+import threading  # Used to tell the WAL archiver to stop
 import smtplib  # Library needed to send the email report
 from email.mime.text import MIMEText  # Extra libraries to set the mimetype of the message
 
 # Import Nimbus class libraries
-from libs.parseconf import ParseConf  # Class to parse the referenced config file.
+from libs.parseconf import ParseConf, thaw  # Class to parse the referenced config file.
 from libs.jobselect import module_select  # FN to grab information about the passed in job module.
-
-# Import backup job modules:
-from modules.gitlab import gitlab_backup_job  # This imports the gitlab backup job.
-from modules.postgres import postgres_backup_job  # This imports the gitlab backup job.
-from modules.mysql import mysql_backup_job  # This imports the gitlab backup job.
-from modules.jenkins import jenkins_backup_job  # This imports the gitlab backup job.
+from libs.jobselect import wal_select  # FN to grab the WAL archiver of the passed in job module.
+from libs.fanout import FileSink, fan_out  # Used to copy the backup to all remote directories.
+from libs.fanout import pending_copies  # Used to finish the copies that an earlier run broke off.
+from libs.fanout import split_volumes, fan_out_volumes  # Used to copy split archives in parallel.
+from libs.fanout import VOLUME_NAME, MAX_PARALLEL_VOLUMES  # Used to tell the volumes apart.
+from libs.compression import get_volume_size  # Used to read the volume size of the archive.
+from libs.chunkstore import ChunkStoreSink  # Used to copy the backup to chunkstore directories.
+from libs.objectstore import OBJECT_STORE_TYPES, open_bucket  # Used to reach the object stores.
+from libs.retention import sweep  # Used to apply the retention period of each directory.
+from libs.inventory import inventory, format_inventory  # Used to list the backup directories.
+from libs.scheduler import load_jobs, run_all, job_lock, LOCK_DIR  # Used to run many jobs.
+from libs.verify import write_sidecar, verify  # Used to record and check the archive checksums.
+from libs.metrics import Metrics  # Used to record the timings and sizes of each phase.
+from libs.throttle import ResourcePolicy  # Used to keep the backup from starving the database.
+from libs.history import history_path, run_record, append_history  # Used to keep the run history.
+from libs.history import load_history, estimate, window_seconds  # Used to estimate the next run.
+from libs.history import free_space, freed_space, SPACE_MARGIN  # Used to check the destinations.
+from libs.inventory import human_size  # Used to print the estimated sizes.
+from libs.walarchive import ship_wal, copy_wal, sweep_wal  # Used to archive and expire the WAL.
+from libs.walarchive import find_start_marker  # Used to copy the WAL start of base backups.
+
+# The backup job modules are imported by module_select, only the selected job is loaded.
+
+# The logfile is written through a buffer of this size, rather than a write per line.
+LOG_BUFSIZE = 64 * 1024
 
 '''
 ***************************************************************************
@@ -32,14 +53,52 @@ Define Global Functions Used for all Backup Job types.
 '''
 
 
-def write_log(string):
+def write_log(logfile, string):
     """The purpose of this function is simply to allow an easy way to write to the logfile."""
+    # The logfile stays open for the whole run, so the lines are buffered instead of the
+    # file being opened and closed again for every line.
     try:
-        logfile = open(LOGFILE, 'a+')
         logfile.write(string)
-        logfile.close()
-    except IOError:
-        raise SystemError('ERROR: ' + LOGFILE + ' does not exist!')
+    except (IOError, ValueError):
+        raise SystemError('ERROR: ' + logfile.name + ' could not be written!')
+
+
+def copy_report(result):
+    """This function describes a finished copy for the logfile"""
+    resumed = ""
+    if result['resumed_bytes']:
+        resumed = "resumed after " + str(result['resumed_bytes']) + " bytes, "
+    return (result['path'] + " copied (" + str(result['bytes']) + " bytes, " + resumed +
+            str(result['stored_bytes']) + " bytes stored in " +
+            "{0:.1f}".format(result['seconds']) + " sec, " +
+            "{0:.1f}".format(result['throughput']) + " MB/s)\n")
+
+
+def backup_location(directory):
+    """This function returns the path of a backup directory, or the bucket of an object store"""
+    if directory.type in OBJECT_STORE_TYPES:
+        return open_bucket(directory)
+    return directory.full_path
+
+
+def destination_sinks(backup_dirs, locations, archive_name):
+    """This function returns a (directory, sink) pair for each of the remote backup directories"""
+    sinks = []
+    for directory, location in zip(backup_dirs, locations):
+        if directory.type == "chunkstore":
+            sinks.append((directory, ChunkStoreSink(directory.label, directory.full_path,
+                                                    archive_name)))
+        elif directory.type in OBJECT_STORE_TYPES:
+            sinks.append((directory, location.sink(directory.label, archive_name)))
+        elif directory.type != "local":
+            sinks.append((directory, FileSink(directory.label, directory.full_path +
+                                              archive_name)))
+    return sinks
+
+
+def log_writer(logfile):
+    """This function returns a function that writes a line of command output to the logfile"""
+    return lambda line: write_log(logfile, line + "\n")
 
 '''
 ***************************************************************************
@@ -57,301 +116,693 @@ The full path location of the config file that holds the options
 for the backup job that you would like to run.
 (/root/backup/mygitserver.ini)
 """
+CONFIG_DIR_DESC = """
+Run every config file in this directory in a single process. Each config
+must set "backup_job", and may set "priority" (higher runs first) and "host".
+"""
+MAX_PARALLEL_DESC = """
+The maximum number of jobs to run at the same time with --config-dir.
+"""
+MAX_PER_HOST_DESC = """
+The maximum number of jobs to run against the same host with --config-dir.
+"""
+LOCK_DIR_DESC = """
+The directory that holds the lock file of each job, so that runs of the
+same job never overlap.
+"""
+VERIFY_DESC = """
+Re-hash every archive copy in the backup directories of the config
+against its checksum sidecar and report the copies that do not match.
+"""
+ESTIMATE_DESC = """
+Estimate the duration, archive size and destination space of the next run
+from the run history, and warn when a destination will run out of space or
+the job will not fit its backup_window. Works with -c or --config-dir.
+"""
+WAL_DESC = """
+Run the WAL archiver of the job until it is stopped, streaming the WAL of
+the database into the wal directory of every backup directory.
+"""
+ARCHIVE_WAL_DESC = """
+Archive a single WAL file and exit, for the archive_command of postgres:
+backup.py -b postgres -c /etc/nimbus/postgres.ini --archive-wal %%p
+"""
+DRY_RUN_DESC = """
+Only report the files that the retention sweep would remove,
+without removing anything or running the backup job.
+"""
 VERSION_FILE_DESC = """
 NIMBUS MODULAR BACKUP UTILITY:
 VERSION: VERSION-NUMBER
 """
 
+
+def job_cap(value):
+    """This function parses a concurrency cap, a cap below 1 would never let a job start"""
+    cap = int(value)
+    if cap < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got " + value)
+    return cap
+
+
 # Parse input arguments #
 PARSE = argparse.ArgumentParser(description='NIMBUS is a modular backup utility \
                                 designed to backup many different type of applications')
-PARSE.add_argument('-b', '--backup', help=BACKUP_JOB_DESC, required=True)
-PARSE.add_argument('-c', '--config', help=CONFIG_FILE_DESC, required=True)
+PARSE.add_argument('-b', '--backup', help=BACKUP_JOB_DESC)
+PARSE.add_argument('-c', '--config', help=CONFIG_FILE_DESC)
+PARSE.add_argument('-d', '--config-dir', help=CONFIG_DIR_DESC)
+PARSE.add_argument('--max-parallel', help=MAX_PARALLEL_DESC, type=job_cap, default=4)
+PARSE.add_argument('--max-per-host', help=MAX_PER_HOST_DESC, type=job_cap, default=1)
+PARSE.add_argument('--lock-dir', help=LOCK_DIR_DESC, default=LOCK_DIR)
+PARSE.add_argument('-n', '--dry-run', help=DRY_RUN_DESC, action='store_true')
+PARSE.add_argument('--verify', help=VERIFY_DESC, action='store_true')
+PARSE.add_argument('--estimate', '--plan', help=ESTIMATE_DESC, action='store_true')
+PARSE.add_argument('--wal', help=WAL_DESC, action='store_true')
+PARSE.add_argument('--archive-wal', help=ARCHIVE_WAL_DESC, metavar='WAL_FILE')
 PARSE.add_argument('-v', '--version', action='version',
                    version='VERSION-NUMBER', help=VERSION_FILE_DESC)
-ARGS = PARSE.parse_args()
-
-# Show Argument Values #
-print('\n')
-print("Backup Job: %s" % ARGS.backup)
-print("Config File: %s" % ARGS.config)
-print('\n')
-
-# Make the backup argument upper case so that we can evaluate what job we need to run.
-# Take the Job named passed in via the -b statement and send it to the jobselector class.
-# This will get information such as the App Name and Actual Function to run for the backup.
-BACKUP_JOB = ARGS.backup.upper()
-CONFIG_FILE = ARGS.config
-APP, JOB = module_select(BACKUP_JOB)
 
 '''
 ***************************************************************************
-Set Global Variables and Parse the config file
+Define the Backup Job Run.
 ***************************************************************************
 '''
 
-# Define Global Variables
-# FILEDATE = time.strftime("%Y-%m-%d %H:%M:%S")
-USER = os.getlogin()
-FILEDATE = datetime.datetime.today()
-DISPLAYDATE = time.strftime("%a %B %d, %Y")
-MAIL_SUBJECT = APP + ' Backup Report - ' + DISPLAYDATE
-LOGFILEDIR = '/var/log/nimbus'
-LOGFILE = LOGFILEDIR + '/' + APP.lower() + '_backup.log'
-LOCALDIR = None
-
-# Check to ensure that the config file actually exists.
-if os.path.isfile(CONFIG_FILE):
-    # Instanciate ParseConfig Object
-    CONF = ParseConf(CONFIG_FILE)
-    # OBJ = dir(CONF)
-    # print(OBJ)
-
-    # Print out the configuration
-    CONF.print_header()
-    CONF.print_backup_dirs()
-    CONF.print_mail_sender()
-    CONF.print_mail_recipients()
-    CONF.print_module_args()
-    CONF.print_footer()
-
-else:
-    print("Specified configuration file does not exist. Please check the path and try again!\n")
-    raise SystemExit(" ERROR: Specified Configuration File Not Found")
 
-'''
-***************************************************************************
-Set Local Dir Location
-***************************************************************************
-'''
-# Make sure all of the directory locations actually exist.. If they dont' then crate them
-print("Checking backup directory paths: ")
-print("---------------------------------")
-for directory in CONF.backup_dirs():
-    dir_name = directory.get('directory')
-    path = directory.get('path')
-    dir_type = directory.get('type')
-
-    # Setup the local backup directory
-    if LOCALDIR is None:
-        if dir_type == "local":
-            LOCALDIR = path + dir_name
-            print("INFO: " + LOCALDIR + " directory location set!\n")
-        else:
-            print()
-            raise SystemExit("ERROR: At least one directory in the configuration \
-                             must be set to type 'local'!")
+def run_backup(backup_job, config_file, dry_run=False, log_name=None):
+    """This function runs a single backup job from its config file and returns the payload."""
+    # ***************************************************************************
+    # Select the Job Module, Set the Job Variables and Parse the config file
+    # ***************************************************************************
+
+    # Show Argument Values #
+    print('\n')
+    print("Backup Job: %s" % backup_job)
+    print("Config File: %s" % config_file)
+    print('\n')
+
+    # Make the backup argument upper case so that we can evaluate what job we need to run.
+    # Take the Job named passed in via the -b statement and send it to the jobselector class.
+    # This will get information such as the App Name and Actual Function to run for the backup.
+    app, job = module_select(backup_job.upper())
+
+    # Define Job Variables
+    # filedate = time.strftime("%Y-%m-%d %H:%M:%S")
+    user = getpass.getuser()
+    filedate = datetime.datetime.today()
+    displaydate = time.strftime("%a %B %d, %Y")
+    mail_subject = app + ' Backup Report - ' + displaydate
+    logfiledir = '/var/log/nimbus'
+    if log_name is None:
+        log_name = app.lower()
+    logfile_path = logfiledir + '/' + log_name + '_backup.log'
+    localdir = None
+
+    # Check to ensure that the config file actually exists.
+    if os.path.isfile(config_file):
+        # Instanciate ParseConfig Object
+        conf = ParseConf(config_file)
+        # OBJ = dir(conf)
+        # print(OBJ)
+
+        # Print out the configuration
+        conf.print_header()
+        conf.print_backup_dirs()
+        conf.print_mail_sender()
+        conf.print_mail_recipients()
+        conf.print_module_args()
+        conf.print_compression()
+        conf.print_resource_policy()
+        conf.print_footer()
 
-'''
-***************************************************************************
-Instansiate the Logfile
-***************************************************************************
-'''
+    else:
+        print("Specified configuration file does not exist. Please check the path and try again!\n")
+        raise SystemExit(" ERROR: Specified Configuration File Not Found")
+
+    # ***************************************************************************
+    # Set Local Dir Location
+    # ***************************************************************************
+    # Make sure all of the directory locations actually exist.. If they dont' then crate them
+    print("Checking backup directory paths: ")
+    print("---------------------------------")
+    for directory in conf.backup_dirs():
+        # Setup the local backup directory
+        if localdir is None:
+            if directory.type == "local":
+                localdir = directory.full_path
+                print("INFO: " + localdir + " directory location set!\n")
+            else:
+                print()
+                raise SystemExit("ERROR: At least one directory in the configuration \
+                                 must be set to type 'local'!")
+
+    # ***************************************************************************
+    # Instansiate the Logfile
+    # ***************************************************************************
+
+    # Start the log file, clearing the contents in the event that the file already exists
+    # Check to ensure that the path exists
+    if not os.path.isdir(logfiledir):
+        try:
+            os.makedirs(logfiledir)
+        except (FileNotFoundError, PermissionError) as error:
+            raise SystemError("WARNING: " + logfiledir + " could not be created")
 
-# Start the log file, clearing the contents in the event that the file already exists
-# Check to ensure that the path exists
-if not os.path.isdir(LOGFILEDIR):
     try:
-        os.makedirs(LOGFILEDIR)
+        logfile = open(logfile_path, 'w', buffering=LOG_BUFSIZE)
     except (FileNotFoundError, PermissionError) as error:
-        raise SystemError("WARNING: " + LOGFILEDIR + " could not be created")
-
-try:
-    open(LOGFILE, 'w').close()
-except (FileNotFoundError, PermissionError) as error:
-    raise SystemError("WARNING: " + LOGFILEDIR + " not found!")
-
-# Print the subject Line
-write_log('Subject: ' + MAIL_SUBJECT + '\n\n\n')
-
-'''
-***************************************************************************
-Perform a clean up on the directories according to your the parsed retention policy
-***************************************************************************
-'''
-# Write Log header
-write_log("Cleaning files according to set retention:\n")
-write_log("============================================================\n\n")
-
-# Keep a counter and print the number of files removed vs number of files deleted
-DELETED_FILES = 0
-KEPT_FILES = 0
-
-# Cycle through each directory in the list
-for directory in CONF.backup_dirs():
-    dir_name = directory.get('directory')
-    path = directory.get('path')
-    retention = directory.get('retention_days')
-    filepath = path + dir_name + "/"
-
-    # For each file in each directory, run a time date check and remove any files
-    # that are older then the retention period.
-    for file_name in os.listdir(filepath):
-        file_create_date = datetime.datetime.fromtimestamp(os.path.getmtime(filepath + file_name))
-        file_age = FILEDATE - file_create_date
-
-        # If the file is greater then the set retention, then remove the file.
-        if file_age.days > int(retention):
-            # print(path + file + " - " + str(file_age.days) + " days old - File removed!")
-            write_log(filepath + file_name + " removed (" + str(file_age.days) + " days old)\n")
-            try:
-                os.remove(filepath + file_name)
-                # print("Deleting File")
-                # print(filepath + file_name)
-                DELETED_FILES += 1
-                # print(DELETED_FILES)
-            except OSError as err:
-                print("OS error: {0}".format(err))
-                raise SystemExit(filepath + file_name + " could not be removed.")
+        raise SystemError("WARNING: " + logfiledir + " not found!")
+
+    # Record the timings and sizes of each phase next to the logfile.
+    metrics_conf = conf.metrics()
+    metrics = Metrics(log_name, metrics_conf.get('log', logfiledir + '/' + log_name +
+                                                 '_metrics.jsonl'),
+                      metrics_conf.get('textfile_dir'))
+
+    # Print the subject Line
+    write_log(logfile, 'Subject: ' + mail_subject + '\n\n\n')
+
+    # Lower the priority of this run before it does any work, everything it starts inherits it.
+    resource_policy = ResourcePolicy(conf.resource_policy())
+    applied_policy = resource_policy.apply()
+    if applied_policy:
+        write_log(logfile, "Resource policy: " + ", ".join(applied_policy) + "\n\n")
+
+    # ***************************************************************************
+    # Perform a clean up on the directories according to your the parsed retention policy
+    # ***************************************************************************
+    # Write Log header
+    write_log(logfile, "Cleaning files according to set retention:\n")
+    write_log(logfile, "============================================================\n\n")
+
+    # Keep a counter and print the number of files removed vs number of files deleted
+    deleted_files = 0
+    kept_files = 0
+
+    # Sweep all of the directories at once, removing the files older then the retention period.
+    # Object stores are swept, listed and written through their API rather than a mount.
+    locations = [backup_location(directory) for directory in conf.backup_dirs()]
+    with metrics.phase('retention'):
+        retention_results = sweep([(location if directory.type in OBJECT_STORE_TYPES
+                                    else location + "/", directory.retention_days,
+                                    directory.type)
+                                   for directory, location in zip(conf.backup_dirs(), locations)],
+                                  filedate, dry_run)
+        # The WAL of a directory is kept from the first segment of its oldest base backup on.
+        wal_results = [sweep_wal(location, [os.path.basename(file_path)
+                                            for file_path, _ in result['removed']], dry_run)
+                       for directory, location, result in zip(conf.backup_dirs(), locations,
+                                                              retention_results)
+                       if directory.type != "chunkstore"]
+
+    for result in retention_results:
+        for file_path, file_days in result['removed']:
+            if dry_run:
+                print(file_path + " would be removed (" + str(file_days) + " days old)")
+            write_log(logfile, file_path + (" would be" if dry_run else "") + " removed (" +
+                      str(file_days) + " days old)\n")
+        deleted_files += len(result['removed']) - len(result['errors'])
+        kept_files += result['kept']
+
+        if result['chunks'] is not None:
+            write_log(logfile, result['path'] + ": " + str(result['chunks'][0]) +
+                      " unreferenced chunks" + (" would be" if dry_run else "") + " removed (" +
+                      str(result['chunks'][1]) + " bytes)\n")
+
+        for file_path, error in result['errors']:
+            print("OS error: {0}".format(error))
+            raise SystemExit(file_path + " could not be removed.")
+
+    for result in wal_results:
+        for file_path in result['removed']:
+            if dry_run:
+                print(file_path + " would be removed (not needed by any base backup)")
+            write_log(logfile, file_path + (" would be" if dry_run else "") +
+                      " removed (not needed by any base backup)\n")
+        deleted_files += len(result['removed']) - len(result['errors'])
+
+        for file_path, error in result['errors']:
+            print("OS error: {0}".format(error))
+            raise SystemExit(file_path + " could not be removed.")
+
+    # A dry run only reports what the retention sweep would remove.
+    if dry_run:
+        print("\nDry run: " + str(deleted_files) + " files would be removed, " + str(kept_files) +
+              " files would be kept.")
+        logfile.close()
+        return None
+
+    # ***************************************************************************
+    # Run the backup job
+    # ***************************************************************************
+    # Write Log header
+    write_log(logfile, "Performing backup operation:\n")
+    write_log(logfile, "============================================================\n\n")
+
+    # Start the timer so we can time how long the backup module takes to complete
+    job_start = datetime.datetime.now()
+
+    # Set the logging variable, and execute the backup job.
+    compression = conf.compression()
+    with metrics.phase('job') as measured, resource_policy:
+        archive_name, job_log = job(localdir, filedate, conf.module_args(),
+                                    compression=compression, metrics=metrics,
+                                    limiter=resource_policy.limiter, log=log_writer(logfile))
+        measured['bytes_out'] = os.path.getsize(localdir + archive_name)
+    write_log(logfile, job_log + "\n\n")
+    write_log(logfile, "Archive " + archive_name.lstrip("/") + " written with " +
+              str(compression.get('codec', 'gz')) + " compression.\n")
+
+    # Look at the end time and then print the delta
+    job_end = datetime.datetime.now()
+
+    elapsed_time = job_end - job_start
+    days = elapsed_time.days
+    hours = elapsed_time.seconds // 3600
+    minutes = (elapsed_time.seconds % 3600) // 60
+    seconds = (elapsed_time.seconds % 60)
+    backup_time = (str(days) + " days, " + str(hours) + " hours, " + str(minutes) + " min, " +
+                   str(seconds) + " sec")
+
+    write_log(logfile, "Backup module completed and took: " + backup_time + "\n\n\n")
+    print("Job module took: " + backup_time + "\n")
+
+    # ***************************************************************************
+    # Copy the backups to the remote directories
+    # ***************************************************************************
+    write_log(logfile, "Copying Files from local directory to all remote directories\n")
+    write_log(logfile, "============================================================\n\n")
+
+    # Read the backup file from the local directory once, and write it to each of the
+    # remote backup locations at the same time.
+    print("Copying backup from local directory to all included remote directories...")
+    print("-------------------------------------------------------------------------\n")
+    kept_files += len([directory for directory in conf.backup_dirs() if directory.type == "local"])
+    sinks = destination_sinks(conf.backup_dirs(), locations, archive_name)
+
+    # A split archive goes out as numbered volumes that are copied in parallel. Chunk stores
+    # already store it in chunks, so they still get the whole archive.
+    volume_size = get_volume_size(compression)
+    volume_paths = None
+    if volume_size is not None:
+        volume_paths = split_volumes(localdir + archive_name, volume_size)
+        write_log(logfile, "Archive split into " + str(len(volume_paths)) + " volumes of up to " +
+                  str(volume_size) + " bytes.\n")
+        sinks = [(directory, sink) for directory, sink in sinks if directory.type == "chunkstore"]
+
+    def volume_sinks(volume_name):
+        """This function returns the sinks of a single volume"""
+        return [sink for directory, sink in destination_sinks(conf.backup_dirs(), locations,
+                                                              "/" + volume_name)
+                if directory.type != "chunkstore"]
 
+    try:
+        with metrics.phase('copy') as measured, resource_policy:
+            if volume_paths is None:
+                checksum, copy_results = fan_out(localdir + archive_name,
+                                                 [sink for _, sink in sinks],
+                                                 limiter=resource_policy.limiter)
+            else:
+                checksum, copy_results = fan_out_volumes(
+                    localdir + archive_name, volume_paths, [sink for _, sink in sinks],
+                    volume_sinks, int(compression.get('max_parallel_volumes',
+                                                      MAX_PARALLEL_VOLUMES)),
+                    limiter=resource_policy.limiter)
+            measured['bytes_in'] = os.path.getsize(localdir + archive_name)
+            measured['bytes_out'] = sum(result['stored_bytes'] for result in copy_results
+                                        if result['error'] is None)
+    except OSError as err:
+        print("OS error: {0}".format(err))
+        raise SystemExit(localdir + archive_name + " could not be read.")
+
+    # Record the checksum next to the local archive, the copies got theirs from the fan out.
+    write_sidecar(localdir + archive_name, checksum)
+
+    # Only the destinations that actually failed are marked as failed.
+    failed_copies = []
+    write_log(logfile, "sha256: " + checksum + "\n")
+    if resource_policy.governor is not None:
+        write_log(logfile, "Adaptive throttling backed off " +
+                  str(resource_policy.governor.backoffs) + " times, slowest probe took " +
+                  "{0:.1f}".format(resource_policy.governor.slowest * 1000) + " ms\n")
+    for result in copy_results:
+        metrics.record('copy', result['seconds'], None, result['bytes'], result['stored_bytes'],
+                       destination=result['label'])
+        if result['error'] is None:
+            kept_files += 1
+            write_log(logfile, copy_report(result))
         else:
-            # print("Saving File")
-            # print(filepath + file_name)
-            KEPT_FILES += 1
-            # print(KEPT_FILES)
-            # print("File Saved!: ")
-            # print(path + dir_name + "/" + file_name + " - " + str(file_age.days) + " days old")
+            failed_copies.append(result['path'])
+            print("OS error: {0}".format(result['error']))
+            write_log(logfile, "ERROR: " + result['path'] + " could not be copied: " +
+                      result['error'] + "\n")
+
+    # A base backup marks the first WAL segment it needs next to the WAL of every directory.
+    marker_path = find_start_marker(localdir, archive_name)
+    if marker_path is not None:
+        for result in copy_wal(marker_path, conf.backup_dirs(), locations):
+            if result['error'] is not None:
+                failed_copies.append(result['path'])
+                write_log(logfile, "ERROR: " + result['path'] + " could not be copied: " +
+                          result['error'] + "\n")
+
+    # Finish the copies that an earlier run broke off, while their archives are still local.
+    resumed_sinks = {}
+    for directory in conf.backup_dirs():
+        if directory.type in ("local", "chunkstore") or directory.type in OBJECT_STORE_TYPES:
+            continue
+        for pending_archive in pending_copies(directory.full_path):
+            if os.path.isfile(localdir + "/" + pending_archive):
+                resumed_sinks.setdefault(pending_archive, []).append(
+                    FileSink(directory.label, directory.full_path + "/" + pending_archive))
+    for pending_archive, pending_sinks in sorted(resumed_sinks.items()):
+        with resource_policy:
+            _, resumed_results = fan_out(localdir + "/" + pending_archive, pending_sinks,
+                                         limiter=resource_policy.limiter)
+        for result in resumed_results:
+            if result['error'] is None:
+                write_log(logfile, "Earlier copy " + copy_report(result))
+            else:
+                failed_copies.append(result['path'])
+                write_log(logfile, "ERROR: The earlier copy " + result['path'] +
+                          " could not be finished: " + result['error'] + "\n")
+        # A volume was only kept locally until its copies were finished.
+        if VOLUME_NAME.search(pending_archive) and \
+                all(result['error'] is None for result in resumed_results):
+            os.remove(localdir + "/" + pending_archive)
+    write_log(logfile, "\n\n")
+
+    # ***************************************************************************
+    # Print the log report
+    # ***************************************************************************
+    # Go to All of the backup directories and list out the contents of the dirctories.
+    print("Print out directory content reports...")
+    print("--------------------------------------\n")
+
+    # Write the number of files removed/retained in the logfile
+    write_log(logfile, str(deleted_files) +
+              " files exceeded the retention period and have been removed.\n")
+    write_log(logfile, str(kept_files) +
+              " files are within the retention period and have been saved.\n\n")
+
+    with metrics.phase('inventory'):
+        dir_inventories = inventory(locations)
+    for dir_inventory in dir_inventories:
+        # Write Log Header
+        write_log(logfile, "Files inventory of " + dir_inventory['path'] + " folder:\n")
+        write_log(logfile, "============================================================\n")
+        write_log(logfile, format_inventory(dir_inventory))
+        write_log(logfile, "\n\n")
+
+    # ***************************************************************************
+    # Print summary and email the report.
+    # ***************************************************************************
+    write_log(logfile, "Backup Script completed at " + time.strftime("%H:%M:%S") + \
+              " on " + displaydate + " " + " by " + user + ".\n")
+    print("Backup Script completed at " + time.strftime("%H:%M:%S") + \
+          " on " + displaydate + " by " + user + ".\n")
+
+    # ***************************************************************************
+    # Send the listed administrators notification that the backup job has completed.
+    # ***************************************************************************
+    # Open a plain text file for reading.  For this example, assume that
+    # the text file contains only ASCII characters.
+    logfile.close()
+    with open(logfile_path) as log:
+        # Create a text/plain message to send and to append to the json payload
+        log_content = log.read()
+        msg = MIMEText(log_content)
+        log.close()
+
+    # me == the sender's email address
+    # you == the recipient's email address
+    msg['Subject'] = mail_subject
+    msg['From'] = conf.mail_sender()
+    msg['To'] = conf.mail_recipients()
+
+    # Send the message via our own SMTP server.
+    with metrics.phase('mail') as measured:
+        sendmail = smtplib.SMTP('localhost')
+        sendmail.send_message(msg)
+        sendmail.quit()
+        measured['bytes_out'] = len(log_content)
+
+    # ***************************************************************************
+    # Create a JSON payload to send to the Sybok Service if configured.
+    # ***************************************************************************
+
+    # Define dict for payload and for size.
+    backup_size = []
+    payload = []
+
+    # Get the size of the backup files, chunk stores report the bytes they actually stored
+    backup_size.append({'file_path': localdir + archive_name,
+                        'file_size': os.path.getsize(localdir + archive_name)})
+    for result in copy_results:
+        if result['error'] is None:
+            backup_size.append({'file_path': result['path'], 'file_size': result['stored_bytes']})
+
+    payload.append({"user": user, "last_run": filedate, "backup_size": backup_size,
+                    "backup_log": log_content, "backup_time": backup_time,
+                    "compression": thaw(compression), "checksum": checksum,
+                    "copy_results": copy_results, "inventory": dir_inventories,
+                    "metrics": metrics.records})
+    print(payload)
+
+    # Write out the phase metrics, the run only failed if one of the copies did.
+    metrics.close(success=not failed_copies)
+
+    # Keep the duration and sizes of the run, the estimates of the next runs are based on them.
+    append_history(history_path(log_name, metrics_conf),
+                   run_record(log_name, archive_name, time.time() - metrics.started,
+                              os.path.getsize(localdir + archive_name), metrics.records,
+                              not failed_copies))
+
+    # Exit with an error if any of the remote copies failed, now that the others are done.
+    if failed_copies:
+        raise SystemExit(" ERROR: " + archive_name + " could not be copied to: " +
+                         ", ".join(failed_copies))
+
+    return payload
 
-'''
-***************************************************************************
-Run the backup job
-***************************************************************************
-'''
-# Write Log header
-write_log("Performing backup operation:\n")
-write_log("============================================================\n\n")
-
-# Start the timer so we can time how long the backup module takes to complete
-JOB_START = datetime.datetime.now()
-
-# Set the logging variable, and execute the backup job.
-ARCHIVE_NAME, JOB_LOG = JOB(LOCALDIR, FILEDATE, CONF.module_args())
-write_log(JOB_LOG + "\n\n")
-
-# Look at the end time and then print the delta
-JOB_END = datetime.datetime.now()
-
-ELAPSED_TIME = JOB_END - JOB_START
-DAYS = ELAPSED_TIME.days
-HOURS = ELAPSED_TIME.seconds // 3600
-MIN = (ELAPSED_TIME.seconds % 3600) // 60
-SEC = (ELAPSED_TIME.seconds % 60)
-TIME = (str(DAYS) + " days, " + str(HOURS) + " hours, " + str(MIN) + " min, " + str(SEC) + " sec")
-
-write_log("Backup module completed and took: " + TIME + "\n\n\n")
-print("Job module took: " + TIME + "\n")
-
-'''
-***************************************************************************
-Copy the backups to the remote directories
-***************************************************************************
-'''
-write_log("Copying Files from local directory to all remote directories\n")
-write_log("============================================================\n\n")
-
-# For each of the listed directories, copy the backup file from the local directory
-# to each of the backup locations.
-print("Copying backup from local directory to all included remote directories...")
-print("-------------------------------------------------------------------------\n")
-for directory in CONF.backup_dirs():
-    dir_name = directory.get('directory')
-    path = directory.get('path')
-    dir_type = directory.get('type')
-
-    if dir_type != "local":
-        try:
-            shutil.copy2(LOCALDIR + "/" + ARCHIVE_NAME, path + dir_name + "/")
-            KEPT_FILES += 1
-        except OSError as err:
-            print("OS error: {0}".format(err))
-            raise SystemExit(
-                LOCALDIR + ARCHIVE_NAME +
-                " could not be copied to the specified directory.")
-    else:
-        KEPT_FILES += 1
-
-'''
-***************************************************************************
-Print the log report
-***************************************************************************
-'''
-# Go to All of the backup directories and list out the contents of the dirctories.
-print("Print out directory content reports...")
-print("--------------------------------------\n")
-
-# Write the number of files removed/retained in the logfile
-write_log(str(DELETED_FILES) + " files exceeded the retention period and have been removed.\n")
-write_log(str(KEPT_FILES) + " files are within the retention period and have been saved.\n\n")
-
-for directory in CONF.backup_dirs():
-    dir_name = directory.get('directory')
-    path = directory.get('path')
-    # Write Log Header
-    write_log("Files inventory of " + path + dir_name + " folder:\n")
-    write_log("============================================================\n")
-    for file_name in os.listdir(path + dir_name):
-        report_cmd = "ls -lah " + path + dir_name + "| grep " + file_name + \
-        " | awk '{print $9,\t$5,\t$6,$7,$8}'"
-
-        execute_ls = os.popen(report_cmd)
-        report = execute_ls.read()
-        execute_ls.close()
-        write_log(report)
-
-    write_log("\n\n")
-
-'''
-***************************************************************************
-Print summary and email the report.
-***************************************************************************
-'''
-write_log("Backup Script completed at " + time.strftime("%H:%M:%S") + \
-          " on " + DISPLAYDATE + " " + " by " + USER + ".\n")
-print("Backup Script completed at " + time.strftime("%H:%M:%S") + \
-      " on " + DISPLAYDATE + " by " + USER + ".\n")
-
-'''
-***************************************************************************
-Send the listed administrators notification that the backup job has completed.
-***************************************************************************
-'''
-# Open a plain text file for reading.  For this example, assume that
-# the text file contains only ASCII characters.
-with open(LOGFILE) as log:
-    # Create a text/plain message to send and to append to the json payload
-    MSG = MIMEText(log.read())
-    LOG_CONTENT = log.read()
-    log.close()
-
-# me == the sender's email address
-# you == the recipient's email address
-MSG['Subject'] = MAIL_SUBJECT
-MSG['From'] = CONF.mail_sender()
-MSG['To'] = CONF.mail_recipients()
-
-# Send the message via our own SMTP server.
-SENDMAIL = smtplib.SMTP('localhost')
-SENDMAIL.send_message(MSG)
-SENDMAIL.quit()
 
 '''
 ***************************************************************************
-Create a JSON payload to send to the Sybok Service if configured.
+Run a single job, or every job in a config directory.
 ***************************************************************************
 '''
 
-# Define dict for payload and for size.
-BACKUP_SIZE = []
-PAYLOAD = []
-
-# Get the size of the backup files
-for directory in CONF.backup_dirs():
-    dir_name = directory.get('directory')
-    path = directory.get('path') + dir_name + ARCHIVE_NAME
-    size = os.path.getsize(path)
-    BACKUP_SIZE.append({'file_path': path, 'file_size': size})
 
-
-PAYLOAD.append({"user": USER, "last_run": FILEDATE, "backup_size": BACKUP_SIZE, \
-                "backup_log": LOG_CONTENT, "backup_time": TIME})
-print(PAYLOAD)
+def run_verify(config_file):
+    """This function verifies every archive copy in the backup directories of a config."""
+    conf = ParseConf(config_file)
+    dir_paths = [backup_location(directory) for directory in conf.backup_dirs()]
+
+    print("Verifying archive copies...")
+    print("---------------------------\n")
+    results = verify(dir_paths)
+    bad_copies = [result for result in results if result['status'] != 'ok']
+    for result in results:
+        print(result['path'] + ": " + result['status'])
+
+    print("\n" + str(len(results)) + " copies verified, " + str(len(bad_copies)) + " failed.")
+    if bad_copies:
+        raise SystemExit(" ERROR: " + str(len(bad_copies)) + " archive copies failed verification")
+
+
+def run_estimate(backup_job, config_file, log_name=None):
+    """This function estimates the next run of a job from its history, returning its warnings."""
+    app, _ = module_select(backup_job.upper())
+    if log_name is None:
+        log_name = app.lower()
+    conf = ParseConf(config_file)
+    path = history_path(log_name, conf.metrics())
+
+    print("Estimate for " + log_name + ":")
+    print("------------------------------\n")
+    estimates = [(kind, estimate(load_history(path, kind=kind)))
+                 for kind in ('full', 'incremental')]
+    estimates = [(kind, job_estimate) for kind, job_estimate in estimates
+                 if job_estimate is not None]
+    if not estimates:
+        print("No successful runs in " + path + " yet, there is nothing to estimate from.\n")
+        return []
+
+    for kind, job_estimate in estimates:
+        print("Next " + kind + " run (from the last " + str(job_estimate['runs']) + "):")
+        print("\tduration: " + str(datetime.timedelta(seconds=int(job_estimate['seconds']))))
+        print("\tarchive size: " + human_size(job_estimate['archive_bytes']))
+        for database, database_estimate in sorted(job_estimate['databases'].items()):
+            print("\t" + database + ": " +
+                  str(datetime.timedelta(seconds=int(database_estimate['seconds'] or 0))) + ", " +
+                  human_size(int(database_estimate['bytes'] or 0)))
+
+    # Check the largest and longest of the runs, whichever kind comes next.
+    warnings = []
+    seconds = max(job_estimate['seconds'] for _, job_estimate in estimates)
+    archive_bytes = max(job_estimate['archive_bytes'] for _, job_estimate in estimates)
+    ratios = estimates[0][1]['destinations']
+    if conf.backup_window():
+        window = window_seconds(conf.backup_window())
+        print("Backup window: " + conf.backup_window() + " (" +
+              str(datetime.timedelta(seconds=window)) + ")")
+        if seconds > window:
+            warnings.append(log_name + " is estimated to take " +
+                            str(datetime.timedelta(seconds=int(seconds))) +
+                            ", longer than its backup window " + conf.backup_window())
+
+    # The retention sweep runs before the copy, so count what it would free.
+    locations = [backup_location(directory) for directory in conf.backup_dirs()]
+    sweep_results = sweep([(location if directory.type in OBJECT_STORE_TYPES else location + "/",
+                            directory.retention_days, directory.type)
+                           for directory, location in zip(conf.backup_dirs(), locations)],
+                          datetime.datetime.today(), dry_run=True)
+    print("Destination space:")
+    for directory, result in zip(conf.backup_dirs(), sweep_results):
+        needed = int(archive_bytes * ratios.get(directory.label, 1.0))
+        # The local directory briefly holds the volumes next to a split archive.
+        if directory.type == "local" and get_volume_size(conf.compression()) is not None:
+            needed = needed * 2
+        if directory.type in OBJECT_STORE_TYPES:
+            print("\t" + directory.label + ": needs " + human_size(needed) +
+                  " (object store, no space limit)")
+            continue
+        free = free_space(directory.full_path)
+        freed = freed_space(file_path for file_path, _ in result['removed'])
+        if result['chunks'] is not None:
+            freed += result['chunks'][1]
+        print("\t" + directory.label + ": needs " + human_size(needed) + ", " +
+              (human_size(free) if free is not None else "unknown") + " free, " +
+              human_size(freed) + " freed by retention")
+        if free is not None and free + freed < needed * SPACE_MARGIN:
+            warnings.append(directory.label + " (" + directory.full_path + ") needs " +
+                            human_size(needed) + " but only has " + human_size(free + freed) +
+                            " after retention")
+
+    for warning in warnings:
+        print("WARNING: " + warning)
+    print("")
+    return warnings
+
+
+def run_wal(backup_job, config_file, wal_file=None):
+    """This function archives the WAL of a job, a single file or continuously until stopped."""
+    _, job = wal_select(backup_job.upper())
+    conf = ParseConf(config_file)
+    backup_dirs = conf.backup_dirs()
+    localdir = None
+    for directory in backup_dirs:
+        if directory.type == "local":
+            localdir = directory.full_path
+            break
+    if localdir is None:
+        raise SystemExit("ERROR: At least one directory in the configuration must be set to "
+                         "type 'local'!")
+
+    locations = [backup_location(directory) for directory in backup_dirs]
+    compression = conf.compression()
+    resource_policy = ResourcePolicy(conf.resource_policy())
+    resource_policy.apply()
+
+    def ship(file_path):
+        """This function archives a single WAL file, returning whether every copy succeeded"""
+        try:
+            _, results = ship_wal(file_path, localdir, backup_dirs, locations, compression,
+                                  resource_policy.limiter)
+        except (OSError, SystemError) as err:
+            print("ERROR: " + file_path + " could not be archived: " + str(err))
+            return False
+        failed_copies = [result for result in results if result['error'] is not None]
+        for result in failed_copies:
+            print("ERROR: " + result['path'] + " could not be copied: " + result['error'])
+        return not failed_copies
+
+    # Postgres keeps the WAL file and runs the archive_command again until it exits with 0.
+    if wal_file is not None:
+        with resource_policy:
+            if not ship(wal_file):
+                raise SystemExit(" ERROR: " + wal_file + " could not be archived")
+        return None
+
+    # Otherwise run until stopped, the last of the WAL is copied out on the way down.
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    with resource_policy:
+        job_log = job(localdir, conf.module_args(), ship, stop, log=print)
+    print(job_log)
+    return job_log
+
+
+def run_scheduled_job(job, dry_run, lock_dir):
+    """This function runs a job loaded from the config directory while holding its lock."""
+    with job_lock(job['name'], lock_dir):
+        return run_backup(job['backup_job'], job['config'], dry_run, job['name'])
+
+
+def main():
+    """This function parses the arguments and runs either a single job or a config directory."""
+    args = PARSE.parse_args()
+
+    # Estimate the next runs instead of running them, failing if any of them will not fit.
+    if args.estimate:
+        if args.config_dir:
+            warnings = []
+            for job in load_jobs(args.config_dir):
+                warnings.extend(run_estimate(job['backup_job'], job['config'], job['name']))
+        elif args.backup is None or args.config is None:
+            PARSE.error("-b/--backup and -c/--config, or --config-dir, are required with "
+                        "--estimate")
+        else:
+            warnings = run_estimate(args.backup, args.config)
+        if warnings:
+            raise SystemExit(" ERROR: " + str(len(warnings)) + " estimate warnings")
+        return
+
+    # Archive the WAL of a job instead of backing it up.
+    if args.wal or args.archive_wal:
+        if args.backup is None or args.config is None:
+            PARSE.error("-b/--backup and -c/--config are required with --wal and --archive-wal")
+        if args.archive_wal:
+            run_wal(args.backup, args.config, args.archive_wal)
+        else:
+            job_name = os.path.splitext(os.path.basename(args.config))[0]
+            with job_lock(job_name + '_wal', args.lock_dir):
+                run_wal(args.backup, args.config)
+        return
+
+    # Run every job in the config directory with the global and per host caps.
+    if args.config_dir:
+        jobs = load_jobs(args.config_dir)
+        results = run_all(jobs, lambda job: run_scheduled_job(job, args.dry_run, args.lock_dir),
+                          args.max_parallel, args.max_per_host)
+
+        print("Scheduler summary:")
+        print("------------------")
+        for job in jobs:
+            result = results[job['name']]
+            print(job['name'] + ": " + result['status'] +
+                  (" - " + result['error'] if 'error' in result else ""))
+        failed = [name for name, result in results.items() if result['status'] == 'failed']
+        if failed:
+            raise SystemExit(" ERROR: The following jobs failed: " + ", ".join(failed))
+        return
+
+    # Verify the archive copies of a config instead of running the backup.
+    if args.verify:
+        if args.config is None:
+            PARSE.error("-c/--config is required with --verify")
+        run_verify(args.config)
+        return
+
+    # Otherwise run the single job given with -b and -c.
+    if args.backup is None or args.config is None:
+        PARSE.error("-b/--backup and -c/--config are required unless --config-dir is used")
+
+    job_name = os.path.splitext(os.path.basename(args.config))[0]
+    with job_lock(job_name, args.lock_dir):
+        run_backup(args.backup, args.config, args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
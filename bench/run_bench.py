@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Benchmark:				Backup phase benchmark
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This script will run the backup jobs against the stand-in dump
+                        tools for a range of dataset sizes and destination counts, time
+                        every phase of the backup run, and save the results as JSON so
+                        that a later run can be compared against them.
+***************************************************************************
+"""
+
+# Define all modules that this script will utilize
+import os  # Used to build the benchmark directories
+import sys  # Used to find the nimbus libraries
+import json  # Used to write and read the results
+import time  # Used to time the phases
+import shutil  # Used to clean up between runs
+import smtplib  # Replaced by a local stand-in so that no mail is sent
+import argparse  # Get, and parse incoming arguments from the execution of the script
+import platform  # Used to record the machine the benchmark ran on
+import statistics  # Used to take the median of repeated runs
+import contextlib  # Used to silence the output of the backup runs
+import subprocess  # Used to record the git revision that was benchmarked
+
+# Make the nimbus libraries importable when the script is run from the bench directory.
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+# Import Nimbus class libraries
+import backup  # The backup run that is being benchmarked
+import modules.postgres  # Their archive writers are timed separately from the dumps
+import modules.mysql
+import modules.gitlab
+from bench.s3standin import S3StandIn, ACCESS_KEY, SECRET_KEY  # Stands in for an S3 object store
+
+# Phases reported for every run, in the order that backup.py runs them.
+PHASES = ('retention', 'dump', 'archive', 'copy', 'inventory', 'mail')
+STAND_INS = ('pg_dump', 'pg_dumpall', 'psql', 'mysqldump', 'gitlab-rake')
+
+'''
+***************************************************************************
+Get Passed Arguments and Build the Help feature.
+***************************************************************************
+'''
+PARSE = argparse.ArgumentParser(description='Benchmark the phases of the nimbus backup run \
+                                against stand-in dump tools')
+PARSE.add_argument('-j', '--jobs', default='postgres,mysql,gitlab',
+                   help='Comma separated backup jobs to benchmark')
+PARSE.add_argument('-s', '--scales', default='1,100,1000',
+                   help='Comma separated dataset sizes, as copies of the booktown database')
+PARSE.add_argument('-d', '--destinations', default='1,3',
+                   help='Comma separated numbers of remote backup directories')
+PARSE.add_argument('--s3', action='store_true',
+                   help='Add a destination on a stand-in S3 object store to every run')
+PARSE.add_argument('-c', '--codec', default='gz', help='Archive compression codec')
+PARSE.add_argument('-r', '--repeat', type=int, default=3,
+                   help='Runs per combination, the median of each phase is reported')
+PARSE.add_argument('-w', '--work-dir', default='/tmp/nimbus_bench',
+                   help='Scratch directory for the backup directories')
+PARSE.add_argument('-m', '--module-args', default='{}',
+                   help='Extra module_args as JSON, e.g. {"stream_dumps": true}')
+PARSE.add_argument('-o', '--output', default='bench_results.json',
+                   help='Where to write the JSON results')
+PARSE.add_argument('--compare', help='Earlier JSON results to compare this run against')
+PARSE.add_argument('--threshold', type=float, default=10.0,
+                   help='Percentage a phase may slow down before --compare fails')
+
+
+class PhaseTimer(object):
+    """This class adds up the time spent in each phase of a backup run"""
+
+    def __init__(self):
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        """This function adds time to a phase"""
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def wrap(self, phase, func):
+        """This function returns func, timing every call into the phase"""
+        def timed(*args, **kwargs):
+            """This function times a single call"""
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(phase, time.perf_counter() - start)
+        return timed
+
+    def wrap_class(self, phase, cls):
+        """This function returns a subclass of cls that times itself from creation to close"""
+        timer = self
+
+        class Timed(cls):
+            """This class times an archive writer from creation to close"""
+
+            def __init__(self, *args, **kwargs):
+                self.bench_start = time.perf_counter()
+                cls.__init__(self, *args, **kwargs)
+
+            def close(self):
+                """This function closes the writer and records how long it was open"""
+                try:
+                    return cls.close(self)
+                finally:
+                    timer.add(phase, time.perf_counter() - self.bench_start)
+        return Timed
+
+
+class StandInSMTP(object):
+    """This class stands in for the SMTP server, it only renders the message"""
+
+    def __init__(self, host=''):
+        self.host = host
+
+    def send_message(self, msg):
+        """This function renders the message the way smtplib would before sending it"""
+        return len(msg.as_bytes())
+
+    def quit(self):
+        """There is no connection to close"""
+        pass
+
+
+def install_stand_ins(bin_dir):
+    """This function links the stand-in script under the name of each dump tool"""
+    os.makedirs(bin_dir, exist_ok=True)
+    for tool in STAND_INS:
+        tool_path = os.path.join(bin_dir, tool)
+        if not os.path.lexists(tool_path):
+            os.symlink(os.path.join(BENCH_DIR, 'standin.py'), tool_path)
+    os.chmod(os.path.join(BENCH_DIR, 'standin.py'), 0o755)
+
+
+def write_config(run_dir, bin_dir, job, destinations, codec, extra_args, s3_endpoint=None):
+    """This function writes the config of a single benchmark run"""
+    backup_dirs = [{'label': 'bench_local', 'directory': job, 'path': run_dir + '/local',
+                    'retention_days': '1', 'type': 'local'}]
+    for destination in range(destinations):
+        backup_dirs.append({'label': 'bench_remote' + str(destination), 'directory': job,
+                            'path': run_dir + '/remote' + str(destination),
+                            'retention_days': '7', 'type': 'filesystem'})
+    if s3_endpoint is not None:
+        backup_dirs.append({'label': 'bench_s3', 'directory': job, 'path': 's3://bench/nimbus',
+                            'retention_days': '7', 'type': 's3', 'endpoint': s3_endpoint,
+                            'access_key_id': ACCESS_KEY, 'secret_access_key': SECRET_KEY})
+
+    # Point the modules at the stand-in tools and at config files inside the run directory.
+    config_file = os.path.join(run_dir, 'config')
+    with open(config_file, 'w') as settings:
+        settings.write("bench\n")
+    module_args = {
+        'postgres': {'pg_dump': bin_dir + '/pg_dump', 'pg_dumpall': bin_dir + '/pg_dumpall',
+                     'psql': bin_dir + '/psql', 'pg_hba': config_file, 'pg_conf': config_file,
+                     'max_parallel_dumps': 2,
+                     'db_list': ['booktown', 'books', 'authors']},
+        'mysql': {'mysqldump': bin_dir + '/mysqldump', 'my_cnf': config_file,
+                  'db_list': ['booktown', 'books', 'authors']},
+        'gitlab': {'gitlab_rake': bin_dir + '/gitlab-rake', 'gitlab_config': config_file,
+                   'gitlab_backup_path': run_dir + '/gitlab'},
+    }[job]
+    module_args.update(extra_args)
+    os.makedirs(run_dir + '/gitlab', exist_ok=True)
+
+    config_path = os.path.join(run_dir, job + '.ini')
+    with open(config_path, 'w') as config:
+        json.dump({'backup_directories': backup_dirs, 'mail_sender': 'bench@localhost',
+                   'mail_recipients': 'bench@localhost', 'compression': {'codec': codec},
+                   'module_args': module_args}, config, indent=4)
+    return config_path
+
+
+def run_once(job, config_path):
+    """This function runs a single backup with every phase timed, and returns the timings"""
+    timer = PhaseTimer()
+    module_select = backup.module_select
+    patched = [(backup, 'sweep', timer.wrap('retention', backup.sweep)),
+               (backup, 'fan_out', timer.wrap('copy', backup.fan_out)),
+               (backup, 'write_sidecar', timer.wrap('copy', backup.write_sidecar)),
+               (backup, 'inventory', timer.wrap('inventory', backup.inventory)),
+               (backup, 'module_select', lambda backup_job: (
+                   module_select(backup_job)[0],
+                   timer.wrap('job', module_select(backup_job)[1]))),
+               (smtplib, 'SMTP', StandInSMTP),
+               (StandInSMTP, 'send_message', timer.wrap('mail', StandInSMTP.send_message))]
+    for module in (modules.postgres, modules.mysql, modules.gitlab):
+        patched.append((module, 'ArchiveWriter',
+                        timer.wrap_class('archive', module.ArchiveWriter)))
+        if hasattr(module, 'StreamingTar'):
+            patched.append((module, 'StreamingTar',
+                            timer.wrap_class('archive', module.StreamingTar)))
+
+    originals = [(target, name, getattr(target, name)) for target, name, _ in patched]
+    for target, name, replacement in patched:
+        setattr(target, name, replacement)
+    try:
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = backup.run_backup(job, config_path, log_name='bench_' + job)
+        total = time.perf_counter() - start
+    finally:
+        for target, name, original in originals:
+            setattr(target, name, original)
+
+    # The archive is written inside the job, so the dump phase is the rest of the job. Streamed
+    # dumps are written straight into the archive, so their archive time includes the dumps.
+    phases = dict((phase, timer.phases.get(phase, 0.0)) for phase in PHASES)
+    phases['dump'] = max(timer.phases.get('job', 0.0) - phases['archive'], 0.0)
+    archive_bytes = result[0]['backup_size'][0]['file_size']
+    return {'phases': phases, 'total': total, 'archive_bytes': archive_bytes}
+
+
+def run_bench(args):
+    """This function runs every combination of job, scale and destination count"""
+    bin_dir = os.path.join(args.work_dir, 'bin')
+    install_stand_ins(bin_dir)
+    extra_args = json.loads(args.module_args)
+    results = []
+    s3_root = os.path.join(args.work_dir, 's3')
+    s3_server = S3StandIn(s3_root).start() if args.s3 else None
+    for job in args.jobs.split(','):
+        for scale in [int(scale) for scale in args.scales.split(',')]:
+            os.environ['NIMBUS_BENCH_SCALE'] = str(scale)
+            for destinations in [int(count) for count in args.destinations.split(',')]:
+                runs = []
+                for _ in range(args.repeat):
+                    run_dir = os.path.join(args.work_dir, 'run')
+                    shutil.rmtree(run_dir, ignore_errors=True)
+                    shutil.rmtree(s3_root, ignore_errors=True)
+                    os.makedirs(run_dir)
+                    os.environ['NIMBUS_BENCH_GITLAB_PATH'] = run_dir + '/gitlab'
+                    config_path = write_config(run_dir, bin_dir, job, destinations, args.codec,
+                                               extra_args,
+                                               s3_server.endpoint if s3_server else None)
+                    runs.append(run_once(job, config_path))
+
+                summary = {'job': job, 'scale': scale, 'destinations': destinations,
+                           'codec': args.codec, 'module_args': extra_args, 's3': args.s3,
+                           'archive_bytes': runs[-1]['archive_bytes'],
+                           'total': statistics.median(run['total'] for run in runs),
+                           'phases': dict((phase, statistics.median(run['phases'][phase]
+                                                                    for run in runs))
+                                          for phase in PHASES),
+                           'runs': runs}
+                results.append(summary)
+                print(format_result(summary))
+    shutil.rmtree(os.path.join(args.work_dir, 'run'), ignore_errors=True)
+    if s3_server is not None:
+        s3_server.shutdown()
+        shutil.rmtree(s3_root, ignore_errors=True)
+    return results
+
+
+def format_result(result):
+    """This function renders one benchmark result as a single line"""
+    return ("{job:<9} scale {scale:<6} dests {destinations:<3} total {total:8.3f}s  ".format(
+        **result) + "  ".join(phase + " " + "{0:.3f}".format(result['phases'][phase])
+                              for phase in PHASES))
+
+
+def git_revision():
+    """This function returns the git revision that was benchmarked, if there is one"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """This function compares the results to a baseline, returning the phases that regressed"""
+    regressions = []
+    previous = dict(((result['job'], result['scale'], result['destinations'], result['codec']),
+                     result) for result in baseline['results'])
+    for result in results:
+        key = (result['job'], result['scale'], result['destinations'], result['codec'])
+        if key not in previous:
+            continue
+        for phase in PHASES + ('total',):
+            before = previous[key]['total'] if phase == 'total' else \
+                previous[key]['phases'][phase]
+            after = result['total'] if phase == 'total' else result['phases'][phase]
+            if before <= 0:
+                continue
+            change = (after - before) / before * 100
+            print("{0:<9} scale {1:<6} dests {2:<3} {3:<10} {4:8.3f}s -> {5:8.3f}s "
+                  "({6:+.1f}%)".format(key[0], key[1], key[2], phase, before, after, change))
+            # Tiny phases are mostly noise, only flag the ones that take real time.
+            if change > threshold and after - before > 0.05:
+                regressions.append((key, phase, change))
+    return regressions
+
+
+def main():
+    """This function runs the benchmark and writes the results."""
+    args = PARSE.parse_args()
+    results = run_bench(args)
+    with open(args.output, 'w') as output:
+        json.dump({'revision': git_revision(), 'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+                   'python': platform.python_version(), 'machine': platform.platform(),
+                   'cpus': os.cpu_count(), 'results': results}, output, indent=4)
+    print("Results written to " + args.output)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline), args.threshold)
+        if regressions:
+            raise SystemExit(" ERROR: " + str(len(regressions)) + " phases are more than " +
+                             str(args.threshold) + "% slower than " + args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Benchmark:				Stand-in S3 object store
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This script stands in for an S3 compatible object store in the
+                        benchmarks. It keeps the objects as files under a directory and
+                        answers the part of the API that nimbus uses, checking the request
+                        signatures and the payload and part checksums like the real thing.
+***************************************************************************
+"""
+
+# Define all modules that this script will utilize
+import os  # Used to store the objects as files
+import hmac  # Used to check the request signatures
+import time  # Used to date the listings
+import uuid  # Used to name the multipart uploads
+import base64  # Used to check the checksums
+import shutil  # Used to clean up the multipart uploads
+import hashlib  # Used to check the payloads and to compute the etags
+import argparse  # Get, and parse incoming arguments from the execution of the script
+import threading  # Used to serve in the background of the benchmark
+import urllib.parse  # Used to read the keys and the query strings
+import xml.etree.ElementTree as ElementTree  # Used to read the request bodies
+from xml.sax.saxutils import escape  # Used to write the keys into the listings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # Used to serve the API
+
+# The credentials that the stand-in accepts.
+ACCESS_KEY = 'nimbus'
+SECRET_KEY = 'nimbus-stand-in'
+REGION = 'us-east-1'
+NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+UPLOAD_DIR = '.uploads'
+MAX_KEYS = 1000
+
+
+def signature(secret_key, date, region, string_to_sign):
+    """This function signs a string with the signing key of the date and region"""
+    key = ('AWS4' + secret_key).encode()
+    for part in (date, region, 's3', 'aws4_request'):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    """This class answers a single request to the stand-in object store"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        """The requests are not logged"""
+        del format, args
+
+    def send(self, status, body=b'', headers=None):
+        """This function sends a response with its body"""
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def error(self, status, code, message):
+        """This function sends an error response in the format of the API"""
+        self.send(status, ('<?xml version="1.0" encoding="UTF-8"?><Error><Code>' + code +
+                           '</Code><Message>' + escape(message) + '</Message></Error>').encode(),
+                  {'Content-Type': 'application/xml'})
+
+    def check_signature(self, path, query, body):
+        """This function checks the signature and payload hash of the request"""
+        authorization = self.headers.get('Authorization', '')
+        fields = dict(field.strip().split('=', 1) for field in
+                      authorization[len('AWS4-HMAC-SHA256 '):].split(','))
+        if not authorization.startswith('AWS4-HMAC-SHA256 ') or 'Signature' not in fields:
+            return "The request is not signed"
+        access_key, date, region, _, _ = fields['Credential'].split('/')
+        if access_key != ACCESS_KEY:
+            return "The access key is not known"
+        payload_hash = self.headers.get('x-amz-content-sha256', '')
+        if payload_hash != hashlib.sha256(body).hexdigest():
+            return "The payload does not match x-amz-content-sha256"
+
+        signed_headers = fields['SignedHeaders'].split(';')
+        canonical_request = "\n".join([
+            self.command, path,
+            '&'.join(urllib.parse.quote(name, safe='~') + '=' +
+                     urllib.parse.quote(value, safe='~') for name, value in sorted(query)),
+            ''.join(name + ':' + ' '.join(self.headers.get(name, '').split()) + "\n"
+                    for name in signed_headers),
+            fields['SignedHeaders'], payload_hash])
+        string_to_sign = "\n".join(['AWS4-HMAC-SHA256', self.headers.get('x-amz-date', ''),
+                                    '/'.join([date, region, 's3', 'aws4_request']),
+                                    hashlib.sha256(canonical_request.encode()).hexdigest()])
+        if not hmac.compare_digest(signature(SECRET_KEY, date, region, string_to_sign),
+                                   fields['Signature']):
+            return "The request signature does not match"
+        return None
+
+    def handle_request(self):
+        """This function reads and checks a request and hands it to the matching action"""
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            fail = server.fail_every and server.requests % server.fail_every == 0
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if fail:
+            return self.error(503, 'SlowDown', "Please reduce your request rate")
+
+        path, _, raw_query = self.path.partition('?')
+        query = urllib.parse.parse_qsl(raw_query, keep_blank_values=True)
+        problem = self.check_signature(path, query, body)
+        if problem is not None:
+            return self.error(403, 'SignatureDoesNotMatch', problem)
+        checksum = self.headers.get('x-amz-checksum-sha256')
+        if checksum is not None and \
+                base64.b64encode(hashlib.sha256(body).digest()).decode() != checksum:
+            return self.error(400, 'BadDigest', "The x-amz-checksum-sha256 does not match")
+
+        bucket, _, key = urllib.parse.unquote(path).lstrip('/').partition('/')
+        query = dict(query)
+        bucket_path = os.path.join(server.root, bucket)
+        os.makedirs(bucket_path, exist_ok=True)
+        if not key:
+            if self.command == 'GET' and query.get('list-type') == '2':
+                return self.list_objects(bucket_path, query)
+            if self.command == 'POST' and 'delete' in query:
+                return self.delete_objects(bucket_path, body)
+            return self.error(400, 'NotImplemented', "The stand-in does not do that")
+        if '..' in key.split('/'):
+            return self.error(400, 'InvalidArgument', "Keys can not leave the bucket")
+        object_path = os.path.join(bucket_path, key)
+
+        if self.command == 'POST' and 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            os.makedirs(os.path.join(server.root, UPLOAD_DIR, upload_id))
+            return self.send(200, ('<InitiateMultipartUploadResult xmlns="' + NAMESPACE +
+                                   '"><Key>' + escape(key) + '</Key><UploadId>' + upload_id +
+                                   '</UploadId></InitiateMultipartUploadResult>').encode())
+        if 'uploadId' in query:
+            return self.multipart(object_path, query, body, checksum)
+        if self.command == 'PUT':
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            with open(object_path + '.part', 'wb') as object_file:
+                object_file.write(body)
+            os.replace(object_path + '.part', object_path)
+            return self.send(200, headers={'ETag': '"' + hashlib.md5(body).hexdigest() + '"'})
+        if not os.path.isfile(object_path):
+            return self.error(404, 'NoSuchKey', "The specified key does not exist")
+        if self.command == 'DELETE':
+            os.remove(object_path)
+            return self.send(204)
+        with open(object_path, 'rb') as object_file:
+            return self.send(200, object_file.read())
+
+    def multipart(self, object_path, query, body, checksum):
+        """This function uploads, completes or aborts the parts of a multipart upload"""
+        upload_path = os.path.join(self.server.root, UPLOAD_DIR, query['uploadId'])
+        if not os.path.isdir(upload_path):
+            return self.error(404, 'NoSuchUpload', "The upload does not exist")
+        if self.command == 'PUT':
+            with open(os.path.join(upload_path, query['partNumber']), 'wb') as part_file:
+                part_file.write(body)
+            with open(os.path.join(upload_path, query['partNumber'] + '.sha256'), 'w') as sums:
+                sums.write(checksum or '')
+            return self.send(200, headers={'ETag': '"' + hashlib.md5(body).hexdigest() + '"'})
+        if self.command == 'DELETE':
+            shutil.rmtree(upload_path)
+            return self.send(204)
+
+        # Complete the upload, every part has to be there with its etag and checksum.
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        with open(object_path + '.part', 'wb') as object_file:
+            for number, part in enumerate(ElementTree.fromstring(body), 1):
+                fields = dict((child.tag.rsplit('}', 1)[-1], child.text) for child in part)
+                part_path = os.path.join(upload_path, fields['PartNumber'])
+                if int(fields['PartNumber']) != number or not os.path.isfile(part_path):
+                    os.remove(object_path + '.part')
+                    return self.error(400, 'InvalidPart', "Part " + str(number) + " is missing")
+                with open(part_path, 'rb') as part_file:
+                    data = part_file.read()
+                with open(part_path + '.sha256') as sums:
+                    stored_checksum = sums.read()
+                if fields.get('ETag') != '"' + hashlib.md5(data).hexdigest() + '"' or \
+                        fields.get('ChecksumSHA256') != stored_checksum:
+                    os.remove(object_path + '.part')
+                    return self.error(400, 'InvalidPart', "Part " + str(number) + " differs")
+                object_file.write(data)
+        os.replace(object_path + '.part', object_path)
+        shutil.rmtree(upload_path)
+        return self.send(200, ('<CompleteMultipartUploadResult xmlns="' + NAMESPACE +
+                               '"></CompleteMultipartUploadResult>').encode())
+
+    def list_objects(self, bucket_path, query):
+        """This function lists the objects under a prefix, a page at a time"""
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter')
+        keys = []
+        for dir_path, _, file_names in os.walk(bucket_path):
+            for file_name in file_names:
+                key = os.path.relpath(os.path.join(dir_path, file_name), bucket_path)
+                if key.startswith(prefix) and not key.endswith('.part') and \
+                        not (delimiter and delimiter in key[len(prefix):]):
+                    keys.append(key)
+        keys.sort()
+        start = keys.index(query['continuation-token']) if query.get('continuation-token') \
+            in keys else 0
+        page = keys[start:start + int(query.get('max-keys', MAX_KEYS))]
+        truncated = start + len(page) < len(keys)
+
+        contents = ''
+        for key in page:
+            stat = os.stat(os.path.join(bucket_path, key))
+            contents += ('<Contents><Key>' + escape(key) + '</Key><LastModified>' +
+                         time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(stat.st_mtime)) +
+                         '</LastModified><Size>' + str(stat.st_size) + '</Size></Contents>')
+        self.send(200, ('<ListBucketResult xmlns="' + NAMESPACE + '"><Prefix>' + escape(prefix) +
+                        '</Prefix><KeyCount>' + str(len(page)) + '</KeyCount><IsTruncated>' +
+                        str(truncated).lower() + '</IsTruncated>' + contents +
+                        ('<NextContinuationToken>' + escape(keys[start + len(page)]) +
+                         '</NextContinuationToken>' if truncated else '') +
+                        '</ListBucketResult>').encode())
+
+    def delete_objects(self, bucket_path, body):
+        """This function deletes a batch of objects"""
+        if self.headers.get('Content-MD5') != base64.b64encode(hashlib.md5(body).digest()).decode():
+            return self.error(400, 'InvalidDigest', "The Content-MD5 does not match")
+        for element in ElementTree.fromstring(body):
+            if element.tag.rsplit('}', 1)[-1] == 'Object':
+                key = element.find('Key').text
+                if os.path.isfile(os.path.join(bucket_path, key)):
+                    os.remove(os.path.join(bucket_path, key))
+        return self.send(200, ('<DeleteResult xmlns="' + NAMESPACE + '"></DeleteResult>').encode())
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = handle_request
+
+
+class S3StandIn(ThreadingHTTPServer):
+    """This class serves the stand-in object store from a directory"""
+    daemon_threads = True
+
+    def __init__(self, root, port=0, fail_every=0):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), S3Handler)
+        self.root = root
+        self.fail_every = fail_every
+        self.requests = 0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @property
+    def endpoint(self):
+        """This function returns the endpoint to put in the backup directory settings"""
+        return 'http://127.0.0.1:' + str(self.server_address[1])
+
+    def start(self):
+        """This function serves the requests in a background thread"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+if __name__ == '__main__':
+    PARSE = argparse.ArgumentParser(description='Serve a stand-in S3 compatible object store')
+    PARSE.add_argument('-d', '--directory', default='/tmp/nimbus_s3',
+                       help='Directory that the buckets are kept in')
+    PARSE.add_argument('-p', '--port', type=int, default=9000, help='Port to listen on')
+    PARSE.add_argument('--fail-every', type=int, default=0,
+                       help='Answer every Nth request with a 503, to exercise the retries')
+    ARGS = PARSE.parse_args()
+    SERVER = S3StandIn(ARGS.directory, ARGS.port, ARGS.fail_every)
+    print("Serving " + ARGS.directory + " on " + SERVER.endpoint + " (access key " + ACCESS_KEY +
+          ", secret key " + SECRET_KEY + ")")
+    SERVER.serve_forever()
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Benchmark:				Stand-in dump tools
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This script stands in for pg_dump, pg_dumpall, psql, mysqldump and
+                        gitlab-rake in the benchmarks. It is linked under the name of the
+                        tool it replaces, and writes the booktown test database scaled up
+                        NIMBUS_BENCH_SCALE times instead of talking to a real server.
+***************************************************************************
+"""
+
+# Define all modules that this script will utilize
+import os  # Used to read the settings and write the dump files
+import sys  # Used to write the dumps to stdout
+import gzip  # Used to compress the dump files like the real tools do
+import time  # Used to name the gitlab backup like gitlab-rake does
+import shutil  # Used to clean up after the gitlab backup tar is written
+import zlib  # Used to compress the custom format dumps
+import tarfile  # Used to write the gitlab backup tar
+
+# The dataset and its scale are set by the benchmark harness.
+SQL_FILE = os.environ.get('NIMBUS_BENCH_SQL', os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), '..', 'conf', 'testconfs',
+    'booktown_test_pgdb.sql'))
+SCALE = int(os.environ.get('NIMBUS_BENCH_SCALE', '1'))
+GITLAB_PATH = os.environ.get('NIMBUS_BENCH_GITLAB_PATH', '/var/opt/gitlab/backups')
+GITLAB_REPOSITORIES = 8
+ROLES = "CREATE ROLE manager;\nALTER ROLE manager WITH NOSUPERUSER INHERIT LOGIN;\n"
+
+
+def dataset():
+    """This function yields the test database SCALE times, with a header per copy"""
+    with open(SQL_FILE, 'rb') as sql_file:
+        sql = sql_file.read()
+    for copy in range(SCALE):
+        yield ("-- nimbus benchmark copy " + str(copy) + "\n").encode()
+        yield sql
+
+
+def write_dataset(fileobj):
+    """This function writes the scaled test database to a file object"""
+    for block in dataset():
+        fileobj.write(block)
+
+
+def pg_dump(argv):
+    """This function stands in for pg_dump in the plain, custom and directory formats"""
+    if '-Fd' in argv:
+        # Directory format: a table of contents and gzipped data files, like pg_dump -Fd.
+        dump_dir = argv[argv.index('-f') + 1]
+        os.makedirs(dump_dir)
+        with open(os.path.join(dump_dir, 'toc.dat'), 'wb') as toc:
+            toc.write(b'PGDMP nimbus benchmark table of contents\n')
+        with gzip.open(os.path.join(dump_dir, '3001.dat.gz'), 'wb') as data:
+            write_dataset(data)
+    elif '-Fc' in argv:
+        # Custom format: a header followed by zlib compressed data, like pg_dump -Fc.
+        sys.stdout.buffer.write(b'PGDMP')
+        compressor = zlib.compressobj(6)
+        for block in dataset():
+            sys.stdout.buffer.write(compressor.compress(block))
+        sys.stdout.buffer.write(compressor.flush())
+    else:
+        write_dataset(sys.stdout.buffer)
+
+
+def pg_dumpall(argv):
+    """This function stands in for pg_dumpall --globals-only"""
+    del argv
+    sys.stdout.write(ROLES)
+
+
+def psql(argv):
+    """This function stands in for psql, queries return no rows and restores are read in full"""
+    if '-c' not in argv:
+        while sys.stdin.buffer.read(1024 * 1024):
+            pass
+
+
+def mysqldump(argv):
+    """This function stands in for mysqldump"""
+    del argv
+    write_dataset(sys.stdout.buffer)
+
+
+def gitlab_rake(argv):
+    """This function stands in for gitlab-rake gitlab:backup:create"""
+    backup_id = str(int(time.time())) + "_nimbus_benchmark"
+    skip = []
+    for arg in argv:
+        if arg.startswith('SKIP='):
+            skip = arg[len('SKIP='):].split(',')
+    staging = os.path.join(GITLAB_PATH, 'db')
+    if 'db' not in skip:
+        os.makedirs(staging, exist_ok=True)
+        with gzip.open(os.path.join(staging, 'database.sql.gz'), 'wb') as database:
+            write_dataset(database)
+
+    # A few repositories, so the incremental mode has more than one file to compare.
+    repositories = os.path.join(GITLAB_PATH, 'repositories')
+    if 'repositories' not in skip:
+        os.makedirs(repositories, exist_ok=True)
+        for repository in range(GITLAB_REPOSITORIES):
+            with open(os.path.join(repositories, 'project' + str(repository) + '.bundle'),
+                      'wb') as bundle:
+                bundle.write(os.urandom(64 * 1024 * SCALE // GITLAB_REPOSITORIES + 1))
+    with open(os.path.join(GITLAB_PATH, 'backup_information.yml'), 'w') as information:
+        information.write(":backup_created_at: " + time.strftime("%Y-%m-%d %H:%M:%S") + "\n")
+        if skip:
+            information.write(":skipped: " + ",".join(skip) + "\n")
+
+    if 'tar' in skip:
+        return
+    backup_tar = os.path.join(GITLAB_PATH, backup_id + '_gitlab_backup.tar')
+    with tarfile.open(backup_tar, 'w') as tar:
+        for name in ('db', 'repositories', 'backup_information.yml'):
+            tar.add(os.path.join(GITLAB_PATH, name), arcname=name)
+    shutil.rmtree(staging)
+    shutil.rmtree(repositories)
+    os.unlink(os.path.join(GITLAB_PATH, 'backup_information.yml'))
+
+
+TOOLS = {
+    'pg_dump': pg_dump,
+    'pg_dumpall': pg_dumpall,
+    'psql': psql,
+    'mysqldump': mysqldump,
+    'gitlab-rake': gitlab_rake,
+}
+
+
+if __name__ == '__main__':
+    TOOL = os.path.basename(sys.argv[0])
+    if TOOL not in TOOLS:
+        raise SystemExit(" ERROR: " + TOOL + " is not a stand-in tool, link this script as one"
+                         " of: " + ", ".join(sorted(TOOLS)))
+    TOOLS[TOOL](sys.argv[1:])
@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Chunk Store class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This library will split backup archives into content defined
+                        chunks and store each unique chunk only once, along with a small
+                        manifest per archive that can be used to reassemble it.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import os  # Used to read and write the chunk store
+import json  # Used to read and write the manifests
+import fcntl  # Used to keep the garbage collection away from the copies in progress
+import hashlib  # Used to address the chunks by content
+import contextlib  # Used to hold the store lock for the garbage collection
+
+# Chunk size limits. The average chunk size is set by the length of the boundary pattern.
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+MANIFEST_EXTENSION = '.chunks.json'
+CHUNK_DIR = 'chunks'
+
+# Copies hold this lock shared from the first chunk until their manifest is written, and the
+# garbage collection holds it exclusively. Chunks that a copy wrote or found in the store but
+# has not listed in a manifest yet are so never collected from under it.
+LOCK_NAME = '.lock'
+
+# Every byte value is mapped to a pseudo random bit. A chunk boundary is placed wherever the
+# bits of the last 20 bytes spell out BOUNDARY, which happens once per MiB of random data on
+# average, and depends only on the content so boundaries realign after an insert or delete.
+# The mapping and the search are done with bytes.translate and bytes.find, so the scan runs
+# at C speed rather than byte by byte in Python.
+BIT_TABLE = bytes.maketrans(bytes(range(256)), bytes(
+    ord('0') + (hashlib.sha256(b'nimbus' + bytes([value])).digest()[0] & 1)
+    for value in range(256)))
+BOUNDARY = b'01101001100101101001'
+
+
+def find_boundary(data, min_size=MIN_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+    """This function returns the length of the first chunk in data, or None if it needs more"""
+    if len(data) <= min_size:
+        return None
+    window = data[min_size - len(BOUNDARY):max_size].translate(BIT_TABLE)
+    index = window.find(BOUNDARY)
+    if index != -1:
+        return min_size + index
+    if len(data) >= max_size:
+        return max_size
+    return None
+
+
+def chunk_path(store_path, chunk_id):
+    """This function returns the path of a chunk inside the store"""
+    return os.path.join(store_path, CHUNK_DIR, chunk_id[:2], chunk_id)
+
+
+def manifest_path(store_path, archive_name):
+    """This function returns the path of the manifest of an archive inside the store"""
+    return os.path.join(store_path, archive_name.lstrip('/') + MANIFEST_EXTENSION)
+
+
+def lock_store(store_path, exclusive=False):
+    """This function locks the chunk store, returning the open lock file"""
+    chunk_root = os.path.join(store_path, CHUNK_DIR)
+    os.makedirs(chunk_root, exist_ok=True)
+    lock_file = open(os.path.join(chunk_root, LOCK_NAME), 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    except OSError:
+        lock_file.close()
+        raise
+    return lock_file
+
+
+def known_chunks(store_path):
+    """This function lists every chunk already in the store with one listing per bucket"""
+    chunks = set()
+    chunk_root = os.path.join(store_path, CHUNK_DIR)
+    if not os.path.isdir(chunk_root):
+        return chunks
+    for bucket in os.scandir(chunk_root):
+        if bucket.is_dir():
+            for entry in os.scandir(bucket.path):
+                if not entry.name.endswith('.part'):
+                    chunks.add(entry.name)
+    return chunks
+
+
+class ChunkStoreSink(object):
+    """This class stores the archive in a chunk store, writing only the chunks it lacks"""
+
+    def __init__(self, label, store_path, archive_name):
+        self.label = label
+        self.store_path = store_path
+        self.archive_name = archive_name.lstrip('/')
+        self.dest_path = manifest_path(store_path, archive_name)
+        self.buffer = bytearray()
+        self.chunks = []
+        self.known = set()
+        self.size = 0
+        self.stored_bytes = 0
+        self.checksum = hashlib.sha256()
+        self.lock_file = None
+
+    def open(self, source_path):
+        """This function locks the store and loads the list of chunks already in it"""
+        del source_path
+        self.lock_file = lock_store(self.store_path)
+        self.known = known_chunks(self.store_path)
+
+    def unlock(self):
+        """This function lets the garbage collection at the store again"""
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def store_chunk(self, chunk):
+        """This function writes a chunk to the store unless it is already there"""
+        chunk_id = hashlib.sha256(chunk).hexdigest()
+        if chunk_id not in self.known:
+            path = chunk_path(self.store_path, chunk_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.part', 'wb') as chunk_file:
+                chunk_file.write(chunk)
+            os.replace(path + '.part', path)
+            self.known.add(chunk_id)
+            self.stored_bytes += len(chunk)
+        self.chunks.append([chunk_id, len(chunk)])
+
+    def write(self, block):
+        """This function chunks the incoming blocks of the archive"""
+        self.checksum.update(block)
+        self.size += len(block)
+        self.buffer += block
+        while True:
+            boundary = find_boundary(self.buffer)
+            if boundary is None:
+                break
+            self.store_chunk(bytes(self.buffer[:boundary]))
+            del self.buffer[:boundary]
+
+    def close(self, source_path, checksum):
+        """This function stores the last chunk and writes the manifest of the archive"""
+        del checksum
+        if self.buffer:
+            self.store_chunk(bytes(self.buffer))
+            self.buffer = bytearray()
+
+        manifest = {'archive': self.archive_name, 'size': self.size,
+                    'sha256': self.checksum.hexdigest(), 'chunks': self.chunks}
+        with open(self.dest_path + '.part', 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        stat = os.stat(source_path)
+        os.utime(self.dest_path + '.part', (stat.st_atime, stat.st_mtime))
+        os.replace(self.dest_path + '.part', self.dest_path)
+        self.unlock()
+
+    def abort(self):
+        """This function drops the manifest of a failed archive, leaving its chunks to the gc"""
+        self.buffer = bytearray()
+        try:
+            if os.path.exists(self.dest_path + '.part'):
+                os.remove(self.dest_path + '.part')
+        except OSError:
+            pass
+        self.unlock()
+
+
+def reassemble(store_path, archive_name, fileobj):
+    """This function rebuilds an archive from its manifest, verifying it on the way"""
+    with open(manifest_path(store_path, archive_name)) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    checksum = hashlib.sha256()
+    for chunk_id, size in manifest['chunks']:
+        with open(chunk_path(store_path, chunk_id), 'rb') as chunk_file:
+            chunk = chunk_file.read()
+        if len(chunk) != size or hashlib.sha256(chunk).hexdigest() != chunk_id:
+            raise SystemError(" ERROR: Chunk " + chunk_id + " of " + archive_name +
+                              " is corrupt.")
+        checksum.update(chunk)
+        fileobj.write(chunk)
+
+    if checksum.hexdigest() != manifest['sha256']:
+        raise SystemError(" ERROR: " + archive_name + " does not match its manifest checksum.")
+    return manifest['size']
+
+
+def collect_garbage(store_path, dry_run=False, removed_manifests=()):
+    """This function removes every chunk that is no longer referenced by a manifest"""
+    # Wait for the copies to the store that are under way, they have no manifest yet.
+    if not os.path.isdir(store_path):
+        return 0, 0
+    with contextlib.closing(lock_store(store_path, exclusive=True)):
+        return sweep_chunks(store_path, dry_run, removed_manifests)
+
+
+def sweep_chunks(store_path, dry_run, removed_manifests):
+    """This function removes the unreferenced chunks while the store is locked"""
+    referenced = set()
+    for entry in os.scandir(store_path):
+        if entry.path in removed_manifests:
+            continue
+        if entry.is_file() and entry.name.endswith(MANIFEST_EXTENSION):
+            with open(entry.path) as manifest_file:
+                referenced.update(chunk_id for chunk_id, _ in json.load(manifest_file)['chunks'])
+
+    removed_chunks = 0
+    removed_bytes = 0
+    chunk_root = os.path.join(store_path, CHUNK_DIR)
+    if not os.path.isdir(chunk_root):
+        return removed_chunks, removed_bytes
+    for bucket in os.scandir(chunk_root):
+        if not bucket.is_dir():
+            continue
+        for entry in os.scandir(bucket.path):
+            if entry.name not in referenced:
+                removed_bytes += entry.stat().st_size
+                if not dry_run:
+                    os.remove(entry.path)
+                removed_chunks += 1
+
+    return removed_chunks, removed_bytes
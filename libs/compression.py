@@ -0,0 +1,373 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Compression class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This library will handle the compression codecs that the backup
+                        modules use when they write their archives, and read them back.
+                        Gzip archives can be compressed on several cores at once.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import os  # Used to keep the archive from adding itself
+import gzip  # Used by the gz codec
+import zlib  # Used to compress the blocks of the parallel gz codec
+import time  # Used to stamp the parallel gz header
+import struct  # Used to write the parallel gz header and trailer
+import bz2  # Used by the bz2 codec
+import lzma  # Used by the xz codec
+import tarfile  # Used to write the archives
+import subprocess  # Used to run the external compressors
+from collections import deque  # Used to write the compressed blocks back in order
+from concurrent.futures import ThreadPoolExecutor  # Used to compress the blocks in parallel
+
+# Import Nimbus class libraries
+from libs.throttle import throttled, RATE_UNITS  # Used to pace the writes and read sizes
+
+# Supported codecs. The builtin codecs are handled by tarfile, the others are piped through
+# an external compressor that has to be installed on the backup host.
+CODECS = {
+    'gz': {'extension': '.gz', 'level': 6, 'max_level': 9},
+    'bz2': {'extension': '.bz2', 'level': 9, 'max_level': 9},
+    'xz': {'extension': '.xz', 'level': 6, 'max_level': 9},
+    'zstd': {'extension': '.zst', 'level': 3, 'max_level': 19,
+             'command': 'zstd -q -T0 -{level} -c', 'decompress_command': 'zstd -q -d -c'},
+    'lz4': {'extension': '.lz4', 'level': 1, 'max_level': 12,
+            'command': 'lz4 -q -{level} -c', 'decompress_command': 'lz4 -q -d -c'},
+    'none': {'extension': '', 'level': None, 'max_level': None},
+}
+
+# The gz codec compresses blocks of PARALLEL_BLOCK_SIZE on a thread pool when it has more than
+# one thread, zlib releases the GIL while it compresses. Each block is primed with the last
+# DICTIONARY_SIZE bytes of the one before and ends on a byte boundary, which is how pigz does
+# it, so the output is a single ordinary gzip stream.
+PARALLEL_BLOCK_SIZE = 1024 * 1024
+DICTIONARY_SIZE = 32 * 1024
+
+
+def get_codec(compression=None):
+    """This function returns the codec name and level from a compression setting"""
+    if compression is None:
+        compression = {}
+    elif isinstance(compression, str):
+        compression = {'codec': compression}
+
+    codec = str(compression.get('codec', 'gz')).lower()
+    if codec not in CODECS:
+        raise SystemExit(" ERROR: Unknown compression codec '" + codec + "', valid codecs are: "
+                         + ", ".join(sorted(CODECS)))
+
+    # The none codec has no levels, so a level left over from another codec is ignored.
+    level = compression.get('level', CODECS[codec]['level'])
+    if CODECS[codec]['max_level'] is None:
+        level = None
+    if level is not None:
+        level = int(level)
+        if level < 1 or level > CODECS[codec]['max_level']:
+            raise SystemExit(" ERROR: Compression level " + str(level) + " is not valid for "
+                             + codec)
+
+    return codec, level
+
+
+def get_threads(compression=None):
+    """This function returns how many threads compress the archive, 0 means one per usable CPU"""
+    if not compression or isinstance(compression, str):
+        compression = {}
+    threads = int(compression.get('threads', 0))
+    if threads < 0:
+        raise SystemExit(" ERROR: Compression threads must be 0 (one per CPU) or more")
+    if threads == 0:
+        # Only count the CPUs that the resource policy left this run.
+        threads = len(os.sched_getaffinity(0))
+    return threads
+
+
+def get_volume_size(compression=None):
+    """This function returns the size of the archive volumes in bytes, None means one file"""
+    if not compression or isinstance(compression, str):
+        return None
+    volume_size = compression.get('volume_size')
+    if volume_size is None or volume_size == '':
+        return None
+    volume_size = str(volume_size).strip().upper()
+    if volume_size.endswith('B'):
+        volume_size = volume_size[:-1]
+    multiplier = 1
+    if volume_size and volume_size[-1] in RATE_UNITS:
+        multiplier = RATE_UNITS[volume_size[-1]]
+        volume_size = volume_size[:-1]
+    try:
+        volume_size = int(float(volume_size) * multiplier)
+    except ValueError:
+        raise SystemExit(" ERROR: '" + str(compression.get('volume_size')) + "' is not a valid "
+                         "volume size, use bytes with an optional K, M or G suffix")
+    if volume_size <= 0:
+        raise SystemExit(" ERROR: The volume size must be greater than zero")
+    return volume_size
+
+
+def member_extension(compression=None):
+    """This function returns the file extension added by the codec"""
+    codec, _ = get_codec(compression)
+    return CODECS[codec]['extension']
+
+
+def archive_extension(compression=None):
+    """This function returns the extension of a tar archive written with the codec"""
+    return '.tar' + member_extension(compression)
+
+
+def member_pipeline(dump_argv, compression=None):
+    """This function pipes a dump argv through the codec if it uses an external compressor"""
+    codec, level = get_codec(compression)
+    pipeline = [dump_argv]
+    if 'command' in CODECS[codec]:
+        pipeline.append(CODECS[codec]['command'].format(level=level).split())
+    return pipeline
+
+
+def name_codec(file_name):
+    """This function works out the codec of an archive or member from its file name"""
+    for codec, settings in CODECS.items():
+        if settings['extension'] and file_name.endswith(settings['extension']):
+            return codec
+    return 'none'
+
+
+def strip_extension(file_name):
+    """This function removes the codec extension from an archive or member name"""
+    extension = CODECS[name_codec(file_name)]['extension']
+    if extension:
+        return file_name[:-len(extension)]
+    return file_name
+
+
+def restore_command(restore_argv, file_name):
+    """This function pipes a member through the external decompressor ahead of a restore"""
+    codec = name_codec(file_name)
+    pipeline = [restore_argv]
+    if 'decompress_command' in CODECS[codec]:
+        pipeline.insert(0, CODECS[codec]['decompress_command'].split())
+    return pipeline
+
+
+def member_reader(fileobj, file_name):
+    """This function wraps a file object so that data read from it is decompressed"""
+    codec = name_codec(file_name)
+    if codec == 'gz':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    elif codec == 'bz2':
+        return bz2.BZ2File(fileobj, mode='rb')
+    elif codec == 'xz':
+        return lzma.LZMAFile(fileobj, mode='rb')
+
+    # External codecs are decompressed by restore_command, and none means none.
+    return fileobj
+
+
+class PassThrough(object):
+    """This class writes through to a file object without ever closing it"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        """This function writes the data to the underlying file object"""
+        return self.fileobj.write(data)
+
+    def close(self):
+        """The underlying file object belongs to the caller, so there is nothing to close"""
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def compress_block(block, dictionary, level, last):
+    """This function deflates a single block of a parallel gz stream"""
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # A sync flush ends the block on a byte boundary, so the blocks can simply be joined.
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last
+                                                         else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipFile(object):
+    """This class writes a gzip stream whose blocks are compressed on a thread pool"""
+
+    def __init__(self, fileobj, level, threads, block_size=PARALLEL_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.dictionary = b''
+        self.crc = 0
+        self.size = 0
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.fileobj.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, int(time.time()), 0, 3))
+
+    def submit(self, block, last=False):
+        """This function hands a block to the pool, writing out the blocks that are done"""
+        self.pending.append(self.executor.submit(compress_block, block, self.dictionary,
+                                                 self.level, last))
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.dictionary = block[-DICTIONARY_SIZE:]
+        # Keep a couple of blocks per thread in flight, so the memory used stays bounded.
+        while len(self.pending) > self.threads * 2:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        """This function compresses the data once a whole block has been written"""
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        """This function compresses the last block and writes the gzip trailer"""
+        if self.executor is None:
+            return
+        try:
+            self.submit(bytes(self.buffer), last=True)
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            self.fileobj.write(struct.pack('<II', self.crc, self.size & 0xffffffff))
+        finally:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def member_writer(fileobj, name, compression=None):
+    """This function wraps a file object so that data written to it is compressed by the codec"""
+    codec, level = get_codec(compression)
+    if codec == 'gz' and get_threads(compression) > 1:
+        return ParallelGzipFile(fileobj, level, get_threads(compression))
+    elif codec == 'gz':
+        return gzip.GzipFile(filename=name, mode='wb', fileobj=fileobj, compresslevel=level)
+    elif codec == 'bz2':
+        return bz2.BZ2File(fileobj, mode='wb', compresslevel=level)
+    elif codec == 'xz':
+        return lzma.LZMAFile(fileobj, mode='wb', preset=level)
+
+    # External codecs are already compressed by member_pipeline, and none means none.
+    return PassThrough(fileobj)
+
+
+class ArchiveWriter(object):
+    """This class writes a tar archive using the configured compression codec"""
+
+    def __init__(self, tar_path, compression=None, limiter=None):
+        self.tar_path = os.path.abspath(tar_path)
+        self.codec, self.level = get_codec(compression)
+        self.outfile = None
+        self.process = None
+        self.compressor = None
+        threads = get_threads(compression)
+
+        if 'command' in CODECS[self.codec]:
+            # Pipe an uncompressed tar stream into the external compressor.
+            self.outfile = open(self.tar_path, 'wb')
+            compress_cmd = CODECS[self.codec]['command'].format(level=self.level)
+            try:
+                self.process = subprocess.Popen(compress_cmd.split(), stdin=subprocess.PIPE,
+                                                stdout=self.outfile)
+            except FileNotFoundError:
+                self.outfile.close()
+                raise SystemError(" ERROR: " + compress_cmd.split()[0] + " is not installed!")
+            # The compressor writes the file itself, so the rate limit paces what it is fed.
+            self.tar = tarfile.open(fileobj=throttled(self.process.stdin, limiter), mode='w|')
+        else:
+            self.outfile = open(self.tar_path, 'wb')
+            fileobj = throttled(self.outfile, limiter)
+            if self.codec == 'none':
+                self.tar = tarfile.open(fileobj=fileobj, mode='w')
+            elif self.codec == 'gz' and threads > 1:
+                self.compressor = ParallelGzipFile(fileobj, self.level, threads)
+                self.tar = tarfile.open(fileobj=self.compressor, mode='w|')
+            elif self.codec == 'xz':
+                self.tar = tarfile.open(fileobj=fileobj, mode='w:xz', preset=self.level)
+            else:
+                self.tar = tarfile.open(fileobj=fileobj, mode='w:' + self.codec,
+                                        compresslevel=self.level)
+
+    def add(self, name, arcname=None, recursive=True):
+        """This function adds a file or directory to the archive, skipping the archive itself"""
+        if os.path.abspath(name) == self.tar_path:
+            return
+        self.tar.add(name, arcname=arcname, recursive=recursive)
+
+    def close(self):
+        """This function finishes the archive and waits for the external compressor"""
+        self.tar.close()
+        if self.process is not None:
+            self.process.stdin.close()
+            return_code = self.process.wait()
+            self.outfile.close()
+            if return_code != 0:
+                raise SystemError(" ERROR: " + self.codec + " failed to compress "
+                                  + self.tar_path)
+        else:
+            if self.compressor is not None:
+                self.compressor.close()
+            self.outfile.close()
+
+
+class ArchiveReader(object):
+    """This class reads a tar archive stream member by member, whatever its codec"""
+
+    def __init__(self, fileobj, archive_name):
+        self.archive_name = archive_name
+        self.codec = name_codec(archive_name)
+        self.process = None
+
+        if 'decompress_command' in CODECS[self.codec]:
+            # Read an uncompressed tar stream out of the external decompressor.
+            decompress_cmd = CODECS[self.codec]['decompress_command']
+            try:
+                self.process = subprocess.Popen(decompress_cmd.split(), stdin=fileobj,
+                                                stdout=subprocess.PIPE)
+            except FileNotFoundError:
+                raise SystemError(" ERROR: " + decompress_cmd.split()[0] + " is not installed!")
+            self.tar = tarfile.open(fileobj=self.process.stdout, mode='r|')
+        else:
+            self.tar = tarfile.open(fileobj=fileobj, mode='r|*')
+
+    def members(self):
+        """This function yields the members in archive order, each one is read only once"""
+        for member in self.tar:
+            yield member
+
+    def extractfile(self, member):
+        """This function returns a file object for the data of the current member"""
+        return self.tar.extractfile(member)
+
+    def close(self):
+        """This function closes the archive and waits for the external decompressor"""
+        self.tar.close()
+        if self.process is not None:
+            # Drain the padding after the end of archive marker so the decompressor can finish.
+            while self.process.stdout.read(1024 * 1024):
+                pass
+            self.process.stdout.close()
+            return_code = self.process.wait()
+            if return_code != 0:
+                raise SystemError(" ERROR: " + self.codec + " failed to decompress "
+                                  + self.archive_name)
@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Fan Out class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This library will read a backup archive once and write it to all
+                        of the remote backup directories at the same time, computing the
+                        archive checksum in the same pass. Copies to mounted directories
+                        are checkpointed, so that a copy that broke off can be resumed.
+                        Archives can also be split into volumes that are copied in parallel.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import os  # Used to rename the finished copies into place
+import re  # Used to tell the volumes apart from the archives
+import json  # Used to read and write the copy checkpoints
+import time  # Used to time each of the copies and back off between retries
+import queue  # Used to hand the blocks to each of the destination writers
+import shutil  # Used to copy the file metadata to the finished copies
+import hashlib  # Used to checksum the archive while it is read
+import threading  # Used to run a writer per destination
+from concurrent.futures import ThreadPoolExecutor  # Used to copy the volumes in parallel
+
+# Import Nimbus class libraries
+from libs.verify import write_sidecar  # Used to write the checksum sidecar next to each copy
+
+# Size of each block read from the archive, and how many blocks a destination may lag behind.
+BLOCK_SIZE = 4 * 1024 * 1024
+QUEUE_DEPTH = 8
+
+# Copies are made durable and checkpointed every CHECKPOINT_SIZE bytes. A write that fails is
+# retried from the last checkpoint, and a copy that still fails is kept for the next run.
+PART_EXTENSION = '.part'
+CHECKPOINT_EXTENSION = '.ckpt'
+CHECKPOINT_SIZE = 64 * 1024 * 1024
+COPY_RETRIES = 3
+RETRY_BACKOFF = 1.0
+
+# Volumes are named after their archive with a numbered suffix, like split -d does, so that
+# cat archive.tar.gz.* rebuilds the archive.
+VOLUME_SUFFIX = '.{0:03d}'
+VOLUME_NAME = re.compile(r'\.\d{3,}$')
+MAX_PARALLEL_VOLUMES = 4
+
+# Handed to the writers instead of the end of the archive when the archive could not be read.
+READ_FAILED = object()
+
+
+class FileSink(object):
+    """This class writes the archive to a destination path through a checkpointed temporary file"""
+
+    def __init__(self, label, dest_path):
+        self.label = label
+        self.dest_path = dest_path
+        self.part_path = dest_path + PART_EXTENSION
+        self.checkpoint_path = self.part_path + CHECKPOINT_EXTENSION
+        self.fileobj = None
+        self.source = None
+        self.source_path = None
+        self.position = 0
+        self.saved_offset = 0
+        self.resume_offset = 0
+        self.resumed_bytes = 0
+        self.chunks = []
+        self.resume_chunks = []
+        self.chunk_hash = hashlib.sha256()
+
+    def load_checkpoint(self):
+        """This function returns the offset that a broken off copy of the same archive reached"""
+        try:
+            with open(self.checkpoint_path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            offset = int(checkpoint['offset'])
+            if checkpoint['source'] != self.source or os.path.getsize(self.part_path) < offset:
+                return 0
+            chunks = checkpoint['chunks'][:offset // CHECKPOINT_SIZE]
+            # Read the last chunk back, so a copy that was cut off mid write starts before it.
+            if chunks:
+                with open(self.part_path, 'rb') as part_file:
+                    part_file.seek((len(chunks) - 1) * CHECKPOINT_SIZE)
+                    if hashlib.sha256(part_file.read(CHECKPOINT_SIZE)).hexdigest() != chunks[-1]:
+                        chunks.pop()
+        except (OSError, ValueError, KeyError, TypeError):
+            return 0
+        self.resume_chunks = chunks
+        return len(chunks) * CHECKPOINT_SIZE
+
+    def save_checkpoint(self):
+        """This function makes the copy so far durable and records how far it got"""
+        self.fileobj.flush()
+        os.fsync(self.fileobj.fileno())
+        with open(self.checkpoint_path + '.tmp', 'w') as checkpoint_file:
+            json.dump({'source': self.source, 'offset': len(self.chunks) * CHECKPOINT_SIZE,
+                       'chunks': self.chunks}, checkpoint_file)
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+        self.saved_offset = len(self.chunks) * CHECKPOINT_SIZE
+
+    def reopen(self, offset):
+        """This function opens the temporary file and cuts it back to offset"""
+        if self.fileobj is not None:
+            try:
+                self.fileobj.close()
+            except OSError:
+                pass
+        self.fileobj = open(self.part_path, 'r+b' if offset else 'wb')
+        self.fileobj.truncate(offset)
+        self.fileobj.seek(offset)
+
+    def open(self, source_path):
+        """This function opens the temporary file, resuming a copy of the same archive"""
+        # The archive is the same one if its name, size and date all match.
+        stat = os.stat(source_path)
+        self.source = [os.path.basename(source_path), stat.st_size, stat.st_mtime]
+        self.source_path = source_path
+        self.resume_offset = self.load_checkpoint()
+        self.resumed_bytes = self.resume_offset
+        self.saved_offset = self.resume_offset
+        self.reopen(self.resume_offset)
+
+    def refill(self):
+        """This function goes back to the last checkpoint and copies up to the current block"""
+        self.reopen(self.saved_offset)
+        with open(self.source_path, 'rb') as source:
+            source.seek(self.saved_offset)
+            self.fileobj.write(source.read(max(self.position - self.saved_offset, 0)))
+
+    def retry(self, action, *args):
+        """This function retries a write, refilling what was lost from the source archive"""
+        for attempt in range(COPY_RETRIES + 1):
+            try:
+                return action(*args)
+            except OSError:
+                if attempt == COPY_RETRIES:
+                    raise
+                time.sleep(RETRY_BACKOFF * 2 ** attempt)
+                try:
+                    self.refill()
+                except OSError:
+                    pass
+        return None
+
+    def write_piece(self, piece):
+        """This function writes a piece of a block to the temporary file"""
+        self.fileobj.write(piece)
+
+    def write(self, block):
+        """This function writes a block of the archive, checkpointing at every chunk"""
+        view = memoryview(block)
+        while view:
+            piece = view[:CHECKPOINT_SIZE - self.position % CHECKPOINT_SIZE]
+            view = view[len(piece):]
+            self.chunk_hash.update(piece)
+            # Whatever the resumed copy already holds is only hashed, to check it at the end
+            # of its chunk.
+            if self.position >= self.resume_offset:
+                self.retry(self.write_piece, piece)
+            self.position += len(piece)
+            if self.position % CHECKPOINT_SIZE == 0:
+                self.end_chunk()
+
+    def end_chunk(self):
+        """This function checks a resumed chunk against the archive, or checkpoints a new one"""
+        digest = self.chunk_hash.hexdigest()
+        self.chunk_hash = hashlib.sha256()
+        index = len(self.chunks)
+        self.chunks.append(digest)
+        if self.position <= self.resume_offset:
+            if digest == self.resume_chunks[index]:
+                return
+            # The archive differs from the resumed copy here, so copy the rest of it after all.
+            self.resume_offset = self.resumed_bytes = self.saved_offset = index * CHECKPOINT_SIZE
+            self.retry(self.refill)
+        self.retry(self.save_checkpoint)
+
+    def sync(self):
+        """This function makes the whole copy durable"""
+        self.fileobj.flush()
+        os.fsync(self.fileobj.fileno())
+
+    def close(self, source_path, checksum):
+        """This function moves the finished copy into place with its sidecar and metadata"""
+        self.retry(self.sync)
+        self.fileobj.close()
+        shutil.copystat(source_path, self.part_path)
+        os.replace(self.part_path, self.dest_path)
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        write_sidecar(self.dest_path, checksum)
+
+    def abort(self):
+        """This function keeps the checkpointed part of a failed copy for the next run"""
+        try:
+            if self.fileobj is not None:
+                self.fileobj.close()
+            if not os.path.exists(self.checkpoint_path) and os.path.exists(self.part_path):
+                os.remove(self.part_path)
+        except OSError:
+            pass
+
+
+def pending_copies(dest_dir):
+    """This function lists the archives whose copy to a directory broke off at a checkpoint"""
+    suffix = PART_EXTENSION + CHECKPOINT_EXTENSION
+    try:
+        with os.scandir(dest_dir) as entries:
+            return sorted(entry.name[:-len(suffix)] for entry in entries
+                          if entry.name.endswith(suffix))
+    except OSError:
+        return []
+
+
+def sink_worker(sink, source_path, blocks, result, digest):
+    """This function feeds the blocks of the archive to a single destination"""
+    start = time.time()
+    block = b''
+    try:
+        sink.open(source_path)
+        while True:
+            block = blocks.get()
+            if block is None or block is READ_FAILED:
+                break
+            sink.write(block)
+            result['bytes'] += len(block)
+        # A copy of an archive that was not read to the end must never be moved into place.
+        if block is READ_FAILED or digest['sha256'] is None:
+            raise SystemError(" ERROR: " + source_path + " could not be read to the end.")
+        sink.close(source_path, digest['sha256'])
+    except (OSError, SystemError) as err:
+        result['error'] = str(err)
+        sink.abort()
+    finally:
+        # Keep draining the queue so that a failed destination never stalls the others.
+        while block is not None and block is not READ_FAILED:
+            block = blocks.get()
+        result['seconds'] = time.time() - start
+
+
+def fan_out(source_path, sinks, block_size=BLOCK_SIZE, limiter=None):
+    """This function reads the archive once and writes it to every sink concurrently"""
+    checksum = hashlib.sha256()
+    digest = {'sha256': None}
+    results = []
+    workers = []
+    queues = []
+
+    for sink in sinks:
+        result = {'label': sink.label, 'path': sink.dest_path, 'bytes': 0,
+                  'seconds': 0.0, 'throughput': 0.0, 'error': None}
+        blocks = queue.Queue(maxsize=QUEUE_DEPTH)
+        worker = threading.Thread(target=sink_worker,
+                                  args=(sink, source_path, blocks, result, digest))
+        worker.start()
+        results.append(result)
+        workers.append(worker)
+        queues.append(blocks)
+
+    # Read the archive once, hashing it and handing every block to every destination.
+    end = READ_FAILED
+    try:
+        with open(source_path, 'rb') as source:
+            while True:
+                block = source.read(block_size)
+                if not block:
+                    break
+                # The rate limit paces the read, and so every destination along with it.
+                if limiter is not None:
+                    limiter.consume(len(block))
+                checksum.update(block)
+                for blocks in queues:
+                    blocks.put(block)
+        # The whole archive has been read, so the writers can record its checksum.
+        digest['sha256'] = checksum.hexdigest()
+        end = None
+    finally:
+        for blocks in queues:
+            blocks.put(end)
+        for worker in workers:
+            worker.join()
+
+    # Work out the throughput of each of the destinations in MB/s, and how much each stored.
+    for sink, result in zip(sinks, results):
+        result['stored_bytes'] = getattr(sink, 'stored_bytes', result['bytes'])
+        result['resumed_bytes'] = getattr(sink, 'resumed_bytes', 0)
+        if result['seconds'] > 0:
+            result['throughput'] = result['bytes'] / result['seconds'] / (1024 * 1024)
+
+    return digest['sha256'], results
+
+
+def volume_path(archive_path, index):
+    """This function returns the path of a volume of an archive, counting from 1"""
+    return archive_path + VOLUME_SUFFIX.format(index)
+
+
+def copy_range(source, dest, offset, length):
+    """This function copies part of a file, letting the kernel do it where it can"""
+    copied = 0
+    try:
+        while copied < length:
+            count = os.copy_file_range(source.fileno(), dest.fileno(), length - copied,
+                                       offset + copied)
+            if count == 0:
+                break
+            copied += count
+        return
+    except (AttributeError, OSError):
+        # Older kernels and some filesystems cannot, so copy the rest the usual way.
+        pass
+    source.seek(offset + copied)
+    dest.seek(copied)
+    remaining = length - copied
+    while remaining > 0:
+        block = source.read(min(BLOCK_SIZE, remaining))
+        if not block:
+            break
+        dest.write(block)
+        remaining -= len(block)
+
+
+def split_volumes(source_path, volume_size):
+    """This function splits an archive into numbered volumes next to it, returning their paths"""
+    size = os.path.getsize(source_path)
+    volume_paths = []
+    with open(source_path, 'rb') as source:
+        for offset in range(0, max(size, 1), volume_size):
+            dest_path = volume_path(source_path, len(volume_paths) + 1)
+            with open(dest_path, 'wb') as dest:
+                copy_range(source, dest, offset, min(volume_size, size - offset))
+            # Each volume is its own source, so a broken off copy can be resumed like an archive.
+            shutil.copystat(source_path, dest_path)
+            volume_paths.append(dest_path)
+    return volume_paths
+
+
+def fan_out_volumes(source_path, volume_paths, sinks, volume_sinks,
+                    max_parallel_volumes=MAX_PARALLEL_VOLUMES, limiter=None):
+    """This function copies the volumes of an archive concurrently, each to its own sinks"""
+    # The whole archive is still read once, for its checksum and for the sinks that need all of
+    # it. volume_sinks returns the sinks of a single volume from its file name.
+    with ThreadPoolExecutor(max_workers=max_parallel_volumes + 1) as executor:
+        whole = executor.submit(fan_out, source_path, sinks, limiter=limiter)
+        volumes = [executor.submit(fan_out, path, volume_sinks(os.path.basename(path)),
+                                   limiter=limiter)
+                   for path in volume_paths]
+        checksum, results = whole.result()
+        for path, volume in zip(volume_paths, volumes):
+            _, volume_results = volume.result()
+            results.extend(volume_results)
+            # The local volume is only kept while one of its copies still has to be finished.
+            if all(result['error'] is None for result in volume_results):
+                os.remove(path)
+    return checksum, results
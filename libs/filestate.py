@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				File State class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This library will record the path, size, mtime and hash of every
+                        file in a directory tree, so that incremental backups can work out
+                        which files changed or were removed since the last run. Trees that
+                        are too large to hash are tracked per directory instead.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import os  # Used to walk the directory tree
+import json  # Used to read and write the manifest
+import fnmatch  # Used to match the excluded paths
+import hashlib  # Used to hash the files
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED  # Used to scan in parallel
+
+# Size of the buffer used when hashing files.
+HASH_BUFSIZE = 1024 * 1024
+
+
+def load_manifest(manifest_path):
+    """This function loads the manifest of the previous run, or an empty one"""
+    if not os.path.isfile(manifest_path):
+        return {'last_full': None, 'files': {}}
+    try:
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError) as err:
+        print("WARNING: " + manifest_path + " could not be read ({0}), ".format(err) +
+              "a full backup will be taken.")
+        return {'last_full': None, 'files': {}}
+
+
+def save_manifest(manifest_path, manifest):
+    """This function atomically writes the manifest of the current run"""
+    manifest_dir = os.path.dirname(manifest_path)
+    if manifest_dir and not os.path.isdir(manifest_dir):
+        os.makedirs(manifest_dir)
+    with open(manifest_path + '.part', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_path + '.part', manifest_path)
+
+
+def hash_file(file_path):
+    """This function returns the sha256 of a file"""
+    checksum = hashlib.sha256()
+    with open(file_path, 'rb') as source:
+        for block in iter(lambda: source.read(HASH_BUFSIZE), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def scan_tree(root, previous=None, exclude=(), workers=8):
+    """This function returns {relative path: {size, mtime, sha256}} for every file in root"""
+    if previous is None:
+        previous = {}
+    files = {}
+    to_hash = []
+
+    for dir_path, _, file_names in os.walk(root):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            rel_path = os.path.relpath(file_path, root)
+            if rel_path in exclude or os.path.islink(file_path):
+                continue
+            stat = os.stat(file_path)
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+            # Only files whose size or mtime moved need to be hashed again.
+            known = previous.get(rel_path)
+            if known and known['size'] == entry['size'] and known['mtime'] == entry['mtime']:
+                entry['sha256'] = known['sha256']
+            else:
+                to_hash.append(rel_path)
+            files[rel_path] = entry
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        digests = executor.map(hash_file, [os.path.join(root, rel_path) for rel_path in to_hash])
+        for rel_path, digest in zip(to_hash, digests):
+            files[rel_path]['sha256'] = digest
+
+    return files
+
+
+def diff_files(previous, current):
+    """This function returns the sorted lists of changed or new files, and of deleted files"""
+    changed = sorted(rel_path for rel_path, entry in current.items()
+                     if previous.get(rel_path, {}).get('sha256') != entry['sha256'])
+    deleted = sorted(set(previous) - set(current))
+    return changed, deleted
+
+
+def excluded(rel_path, is_dir, patterns):
+    """This function tells if a path matches one of the exclude patterns"""
+    # A pattern ending in / only matches directories, and * also matches across directories.
+    for pattern in patterns:
+        if pattern.endswith('/'):
+            if is_dir and fnmatch.fnmatchcase(rel_path, pattern.rstrip('/')):
+                return True
+        elif fnmatch.fnmatchcase(rel_path, pattern):
+            return True
+    return False
+
+
+def scan_directory(root, rel_dir, exclude):
+    """This function lists a single directory, returning its files, sub directories and signature"""
+    files = []
+    subdirs = []
+    size = 0
+    newest = 0.0
+    dir_path = os.path.join(root, rel_dir) if rel_dir else root
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if excluded(rel_path, is_dir, exclude):
+                continue
+            if is_dir:
+                subdirs.append(rel_path)
+                continue
+            # Symlinks are kept as links, so they are never followed out of the tree.
+            stat = entry.stat(follow_symlinks=False)
+            files.append(entry.name)
+            size += stat.st_size
+            newest = max(newest, stat.st_mtime)
+    # The directory mtime moves when a file is added, removed or renamed, the rest when one is
+    # written to.
+    signature = [os.stat(dir_path).st_mtime, len(files), size, newest]
+    return rel_dir, sorted(files), subdirs, signature
+
+
+def scan_dirs(root, exclude=(), workers=8):
+    """This function lists a directory tree with several directories read at once"""
+    # Returns {relative directory: {'files': [names], 'signature': [...]}}. Each directory is
+    # read with a single scandir, and the sub directories are handed out as they are found,
+    # which keeps slow or remote disks busy on trees with a great many small files.
+    dirs = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set([executor.submit(scan_directory, root, '', exclude)])
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    rel_dir, files, subdirs, signature = future.result()
+                except FileNotFoundError:
+                    # Removed while it was being scanned, so it is simply not in this backup.
+                    continue
+                dirs[rel_dir] = {'files': files, 'signature': signature}
+                for subdir in subdirs:
+                    pending.add(executor.submit(scan_directory, root, subdir, exclude))
+    return dirs
+
+
+def diff_dirs(previous, current):
+    """This function returns the sorted lists of changed or new directories, and of deleted ones"""
+    changed = sorted(rel_dir for rel_dir, entry in current.items()
+                     if previous.get(rel_dir) != entry['signature'])
+    deleted = sorted(set(previous) - set(current))
+    return changed, deleted
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				History class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This library will keep the duration and sizes of every backup run
+                        as a JSON lines history per job, and estimate the duration, archive
+                        size and destination space of the next run from it.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import os  # Used to read the history and the destination sizes
+import json  # Used to read and write the history
+import shutil  # Used to read the free space of the destinations
+
+# The history sits next to the logfile unless the metrics settings name another file.
+HISTORY_DIR = '/var/log/nimbus'
+
+# How many of the latest successful runs the estimate is based on, and how much room to leave
+# on a destination on top of the estimated size.
+HISTORY_RUNS = 10
+SPACE_MARGIN = 1.1
+
+# The fields of every metrics record, anything else is a label such as database=.
+RECORD_FIELDS = frozenset(('time', 'job', 'phase', 'wall_seconds', 'cpu_seconds', 'bytes_in',
+                           'bytes_out'))
+
+
+def history_path(job_name, metrics_settings=None):
+    """This function returns the history file of a job"""
+    if metrics_settings and metrics_settings.get('history'):
+        return str(metrics_settings['history'])
+    return os.path.join(HISTORY_DIR, job_name + '_history.jsonl')
+
+
+def run_record(job_name, archive_name, seconds, archive_bytes, records, success):
+    """This function builds the history record of a run from its metrics records"""
+    # Records without labels are the phases of the run itself, dumps and copies are kept apart.
+    phases = {}
+    databases = {}
+    destinations = {}
+    for record in records:
+        if record['phase'] == 'dump' and 'database' in record:
+            databases[record['database']] = {'seconds': record['wall_seconds'],
+                                             'bytes': record['bytes_out']}
+        elif record['phase'] == 'copy' and 'destination' in record:
+            destinations[record['destination']] = {'seconds': record['wall_seconds'],
+                                                   'stored_bytes': record['bytes_out']}
+        elif set(record) <= RECORD_FIELDS:
+            phases[record['phase']] = phases.get(record['phase'], 0) + record['wall_seconds']
+    return {'job': job_name, 'archive': archive_name.lstrip('/'),
+            'kind': 'incremental' if '_incr' in archive_name else 'full',
+            'success': bool(success), 'seconds': seconds, 'archive_bytes': archive_bytes,
+            'phases': phases, 'databases': databases, 'destinations': destinations}
+
+
+def append_history(path, record):
+    """This function appends the record of a run to the history of the job"""
+    history_dir = os.path.dirname(path)
+    if history_dir and not os.path.isdir(history_dir):
+        os.makedirs(history_dir)
+    with open(path, 'a') as history:
+        history.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def load_history(path, runs=HISTORY_RUNS, kind=None):
+    """This function returns the latest successful runs of a job, oldest first"""
+    history = []
+    try:
+        with open(path) as history_file:
+            for line in history_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A run that was cut off mid write leaves half a line behind.
+                    continue
+                if record.get('success') and (kind is None or record.get('kind') == kind):
+                    history.append(record)
+    except FileNotFoundError:
+        return []
+    return history[-runs:]
+
+
+def trend(values):
+    """This function extrapolates the next value of a series with a least squares line"""
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    # A couple of runs are not enough for a trend, so just use the latest one.
+    if len(values) < 3:
+        return values[-1]
+    count = len(values)
+    mean_x = (count - 1) / 2.0
+    mean_y = sum(values) / float(count)
+    slope = sum((index - mean_x) * (value - mean_y) for index, value in enumerate(values)) / \
+        sum((index - mean_x) ** 2 for index in range(count))
+    # Never predict less than the smallest run seen, a shrinking job does not shrink forever.
+    return max(mean_y + slope * (count - mean_x), min(values))
+
+
+def estimate(history):
+    """This function estimates the duration and sizes of the next run from its history"""
+    if not history:
+        return None
+    databases = {}
+    for name in set(name for record in history for name in record.get('databases', {})):
+        runs = [record['databases'][name] for record in history
+                if name in record.get('databases', {})]
+        databases[name] = {'seconds': trend([run['seconds'] for run in runs]),
+                           'bytes': trend([run['bytes'] for run in runs])}
+    # Destinations that store less than the archive, like chunk stores, keep their ratio.
+    destinations = {}
+    for label in set(label for record in history for label in record.get('destinations', {})):
+        ratios = [record['destinations'][label]['stored_bytes'] / float(record['archive_bytes'])
+                  for record in history if label in record.get('destinations', {}) and
+                  record['archive_bytes'] and
+                  record['destinations'][label]['stored_bytes'] is not None]
+        destinations[label] = sum(ratios) / len(ratios) if ratios else 1.0
+    return {'runs': len(history), 'seconds': trend([record['seconds'] for record in history]),
+            'archive_bytes': int(trend([record['archive_bytes'] for record in history])),
+            'databases': databases, 'destinations': destinations}
+
+
+def estimated_seconds(path):
+    """This function returns the estimated duration of the next full run of a job, 0 if unknown"""
+    job_estimate = estimate(load_history(path, kind='full'))
+    if job_estimate is None:
+        return 0
+    return job_estimate['seconds']
+
+
+def window_seconds(backup_window):
+    """This function returns the length of a HH:MM-HH:MM backup window, which may wrap midnight"""
+    try:
+        start, end = [int(part.split(':')[0]) * 3600 + int(part.split(':')[1]) * 60
+                      for part in str(backup_window).split('-')]
+    except (ValueError, IndexError):
+        raise SystemExit(" ERROR: '" + str(backup_window) + "' is not a valid backup window, "
+                         "use HH:MM-HH:MM")
+    return (end - start) % (24 * 3600) or 24 * 3600
+
+
+def free_space(dir_path):
+    """This function returns the free bytes of a mounted destination, or None if unknown"""
+    try:
+        return shutil.disk_usage(dir_path).free
+    except OSError:
+        return None
+
+
+def freed_space(file_paths):
+    """This function returns how many bytes the retention sweep would free"""
+    freed = 0
+    for file_path in file_paths:
+        try:
+            freed += os.path.getsize(file_path)
+        except OSError:
+            pass
+    return freed
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Inventory class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This library will build the file inventory of each backup directory
+                        for the report, with one directory listing per backup directory.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import os  # Used to list the backup directories
+import math  # Used to round the human readable sizes like ls does
+import time  # Used to format the file dates like ls does
+from concurrent.futures import ThreadPoolExecutor  # Used to list the directories in parallel
+
+# Import Nimbus class libraries
+from libs.objectstore import Bucket  # Used to list object store directories through their API
+
+# Files older than this many seconds show the year instead of the time, like ls does.
+SIX_MONTHS = 60 * 60 * 24 * 182
+
+
+def human_size(size):
+    """This function formats a size the way ls -h does (4.0K, 12K, 1.5M...)"""
+    if size < 1024:
+        return str(size)
+    for unit in ('K', 'M', 'G', 'T', 'P'):
+        size = size / 1024.0
+        if size < 10:
+            return "{0:.1f}{1}".format(math.ceil(size * 10) / 10, unit)
+        if size < 1024 or unit == 'P':
+            return str(int(math.ceil(size))) + unit
+    return str(size)
+
+
+def display_date(mtime, now=None):
+    """This function formats a file date the way ls -l does"""
+    if now is None:
+        now = time.time()
+    if abs(now - mtime) > SIX_MONTHS:
+        return time.strftime("%b %e  %Y", time.localtime(mtime))
+    return time.strftime("%b %e %H:%M", time.localtime(mtime))
+
+
+def directory_inventory(dir_path):
+    """This function lists a backup directory once, returning the files, sizes and dates"""
+    files = []
+    if isinstance(dir_path, Bucket):
+        # Object stores have no directories, the listing already has the sizes and dates.
+        files = [{'name': listed['name'], 'size': listed['size'], 'mtime': listed['mtime'],
+                  'is_dir': False} for listed in dir_path.list()]
+        dir_path = dir_path.path
+    else:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                stat = entry.stat()
+                files.append({'name': entry.name, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                              'is_dir': entry.is_dir()})
+    files.sort(key=lambda file_info: file_info['name'])
+
+    return {'path': dir_path, 'files': files, 'total_files': len(files),
+            'total_bytes': sum(file_info['size'] for file_info in files)}
+
+
+def inventory(dir_paths):
+    """This function builds the inventory of each of the backup directories concurrently"""
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        return list(executor.map(directory_inventory, dir_paths))
+
+
+def format_inventory(dir_inventory):
+    """This function renders a directory inventory as the human readable report table"""
+    now = time.time()
+    lines = []
+    for file_info in dir_inventory['files']:
+        lines.append(file_info['name'] + "\t" + human_size(file_info['size']) + "\t" +
+                     display_date(file_info['mtime'], now))
+    lines.append(str(dir_inventory['total_files']) + " files, " +
+                 human_size(dir_inventory['total_bytes']) + " total")
+    return "\n".join(lines) + "\n"
@@ -5,31 +5,109 @@ Script:                 Nimbus Intermixed Modular Back Up Script
 Library:				Job Selector class
 Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
 Description:            This function will handle Returning an object that contains
-                        information about the module to run
+                        information about the module to run, importing only the module
+                        of the selected job when it is asked for.
 ***************************************************************************
 """
 
-# Import backup job modules:
-from modules.gitlab import gitlab_backup_job  # This imports the gitlab backup job.
-from modules.postgres import postgres_backup_job  # This imports the gitlab backup job.
-from modules.mysql import mysql_backup_job  # This imports the gitlab backup job.
-from modules.jenkins import jenkins_backup_job  # This imports the gitlab backup job.
+# Define all modules that this library will utilize
+import importlib  # Used to import the module of the selected job on demand
+import importlib.util  # Used to find job modules dropped into the modules directory
+
+# Entry point group that installed packages use to add their own backup modules.
+ENTRY_POINT_GROUP = 'nimbus.modules'
+
+# The bundled backup modules, by job name. Nothing is imported until a job is selected.
+MODULES = {
+    'GITLAB': {'name': 'Gitlab', 'module': 'modules.gitlab', 'archive_prefix': 'gitlab_'},
+    'POSTGRES': {'name': 'PostgreSQL', 'module': 'modules.postgres',
+                 'archive_prefix': 'postgres_'},
+    'MYSQL': {'name': 'MySQL', 'module': 'modules.mysql', 'archive_prefix': 'mysql_'},
+    'MARIADB': {'name': 'MySQL', 'module': 'modules.mysql', 'archive_prefix': 'mysql_',
+                'prefix': 'mysql'},
+    'JENKINS': {'name': 'Jenkins', 'module': 'modules.jenkins', 'archive_prefix': 'jenkins_'},
+}
+
+
+def register_module(backup_job, module_name, module_path, archive_prefix=None, prefix=None):
+    """This function adds a backup module to the registry without importing it"""
+    # The module is expected to define <prefix>_backup_job, <prefix>_restore_job if it can
+    # restore and <prefix>_wal_job if it can archive WAL, prefix defaults to the lower case
+    # job name.
+    if archive_prefix is None:
+        archive_prefix = backup_job.lower() + '_'
+    if prefix is None:
+        prefix = backup_job.lower()
+    MODULES[backup_job.upper()] = {'name': module_name, 'module': module_path,
+                                   'archive_prefix': archive_prefix, 'prefix': prefix}
+
+
+def entry_point_module(backup_job):
+    """This function registers a module that an installed package provides as an entry point"""
+    # Only looked at when the job is not already known, reading the metadata is not free.
+    from importlib.metadata import entry_points
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+        if entry_point.name.upper() == backup_job:
+            register_module(backup_job, entry_point.name.title(),
+                            entry_point.value.split(':', 1)[0].strip())
+            return True
+    return False
+
+
+def find_module(backup_job):
+    """This function returns the registry entry of a job, discovering new modules as needed"""
+    if backup_job not in MODULES:
+        # A module dropped into the modules directory is found by its file name.
+        module_path = 'modules.' + backup_job.lower()
+        if backup_job.isidentifier() and importlib.util.find_spec(module_path) is not None:
+            register_module(backup_job, backup_job.title(), module_path)
+        elif not entry_point_module(backup_job):
+            return None
+    return MODULES[backup_job]
+
+
+def load_function(entry, action):
+    """This function imports the module of a job and returns one of its job functions"""
+    prefix = entry.get('prefix') or entry['module'].rsplit('.', 1)[-1]
+    try:
+        module = importlib.import_module(entry['module'])
+    except ImportError as err:
+        raise SystemExit(" ERROR: The " + entry['name'] + " module could not be loaded: " +
+                         str(err))
+    return getattr(module, prefix + '_' + action + '_job', None)
+
 
 def module_select(backup_job):
     """This function will select the module name and function name from the given input"""
-    if backup_job == 'GITLAB':
-        module_name = 'Gitlab'
-        run_module = gitlab_backup_job
-    elif backup_job == 'POSTGRES':
-        module_name = 'PostgreSQL'
-        run_module = postgres_backup_job
-    elif backup_job == 'MYSQL' or backup_job == 'MARIADB':
-        module_name = 'MySQL'
-        run_module = mysql_backup_job
-    elif backup_job == 'JENKINS':
-        module_name = 'Jenkins'
-        run_module = jenkins_backup_job
-    else:
+    entry = find_module(backup_job)
+    run_module = None
+    if entry is not None:
+        run_module = load_function(entry, 'backup')
+    if run_module is None:
         raise SystemExit(" ERROR: You have identified an Undefined Backup Job.. Please try again")
 
-    return (module_name, run_module)
+    return (entry['name'], run_module)
+
+
+def restore_select(backup_job):
+    """This function will select the module name, restore function and archive name prefix"""
+    entry = find_module(backup_job)
+    run_module = None
+    if entry is not None:
+        run_module = load_function(entry, 'restore')
+    if run_module is None:
+        raise SystemExit(" ERROR: There is no restore for this Backup Job.. Please try again")
+
+    return (entry['name'], run_module, entry['archive_prefix'])
+
+
+def wal_select(backup_job):
+    """This function will select the module name and the function that archives its WAL"""
+    entry = find_module(backup_job)
+    run_module = None
+    if entry is not None:
+        run_module = load_function(entry, 'wal')
+    if run_module is None:
+        raise SystemExit(" ERROR: This Backup Job has no WAL archiving.. Please try again")
+
+    return (entry['name'], run_module)
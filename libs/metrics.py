@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Metrics class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This library will record the wall time, CPU time and bytes in and
+                        out of each phase of a backup run, and write them as a buffered
+                        JSON lines log and a Prometheus textfile collector file.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import os  # Used to read the CPU times and replace the textfile atomically
+import json  # Used to write the JSON lines log
+import time  # Used to time the phases
+import threading  # Used to record phases from the dump worker threads
+import contextlib  # Used to build the phase context manager
+
+
+def cpu_seconds():
+    """This function returns the CPU time used by this process and its finished children"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def path_size(path):
+    """This function returns the size of a file, or of every file in a directory tree"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, file_name))
+               for root, _, files in os.walk(path) for file_name in files)
+
+
+def prometheus_labels(labels):
+    """This function renders a dict of labels in the Prometheus text format"""
+    return "{" + ",".join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') +
+                          '"' for name, value in sorted(labels.items())) + "}"
+
+
+class Metrics(object):
+    """This class collects the phase records of a single backup run"""
+
+    def __init__(self, job_name, log_path=None, textfile_dir=None):
+        self.job_name = job_name
+        self.log_path = log_path
+        self.textfile_dir = textfile_dir
+        self.records = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def record(self, phase, wall=None, cpu=None, bytes_in=None, bytes_out=None, **labels):
+        """This function adds a finished phase, labels such as database= tell them apart"""
+        record = {'time': time.strftime("%Y-%m-%dT%H:%M:%S"), 'job': self.job_name,
+                  'phase': phase, 'wall_seconds': wall, 'cpu_seconds': cpu,
+                  'bytes_in': bytes_in, 'bytes_out': bytes_out}
+        record.update(labels)
+        with self.lock:
+            self.records.append(record)
+        return record
+
+    @contextlib.contextmanager
+    def phase(self, phase, **labels):
+        """This function times the body of a with block as a phase"""
+        # The yielded dict sets bytes_in and bytes_out, and can replace the process wide cpu
+        # time, which also counts the phases that run alongside this one, with an exact one.
+        measured = {'bytes_in': None, 'bytes_out': None, 'cpu': None}
+        wall_start = time.perf_counter()
+        cpu_start = cpu_seconds()
+        try:
+            yield measured
+        finally:
+            if measured['cpu'] is None:
+                measured['cpu'] = cpu_seconds() - cpu_start
+            self.record(phase, time.perf_counter() - wall_start, measured['cpu'],
+                        measured['bytes_in'], measured['bytes_out'], **labels)
+
+    def write_log(self):
+        """This function appends every record to the JSON lines log in a single write"""
+        if self.log_path is None:
+            return
+        with self.lock:
+            lines = "".join(json.dumps(record, sort_keys=True) + "\n" for record in self.records)
+        with open(self.log_path, 'a') as log:
+            log.write(lines)
+
+    def write_textfile(self, success):
+        """This function atomically replaces the Prometheus textfile of the job"""
+        if self.textfile_dir is None:
+            return
+        if not os.path.isdir(self.textfile_dir):
+            print("WARNING: " + self.textfile_dir + " does not exist, no metrics textfile written")
+            return
+        lines = []
+        samples = (('wall_seconds', 'nimbus_phase_wall_seconds', 'Wall time of the phase.'),
+                   ('cpu_seconds', 'nimbus_phase_cpu_seconds', 'CPU time of the phase.'),
+                   ('bytes_in', 'nimbus_phase_bytes_in', 'Bytes read by the phase.'),
+                   ('bytes_out', 'nimbus_phase_bytes_out', 'Bytes written by the phase.'))
+        with self.lock:
+            records = list(self.records)
+        for field, metric, description in samples:
+            lines.append("# HELP " + metric + " " + description)
+            lines.append("# TYPE " + metric + " gauge")
+            for record in records:
+                if record[field] is None:
+                    continue
+                # Prometheus reserves the job label for the scrape target, so it becomes backup.
+                labels = dict((name.replace('job', 'backup'), value)
+                              for name, value in record.items()
+                              if name not in ('time', 'wall_seconds', 'cpu_seconds', 'bytes_in',
+                                              'bytes_out') and value is not None)
+                lines.append(metric + prometheus_labels(labels) + " " + str(record[field]))
+
+        job_labels = prometheus_labels({'backup': self.job_name})
+        lines.append("# HELP nimbus_backup_success Whether the last backup run succeeded.")
+        lines.append("# TYPE nimbus_backup_success gauge")
+        lines.append("nimbus_backup_success" + job_labels + " " + str(int(bool(success))))
+        lines.append("# HELP nimbus_backup_last_run_timestamp_seconds When the last run ended.")
+        lines.append("# TYPE nimbus_backup_last_run_timestamp_seconds gauge")
+        lines.append("nimbus_backup_last_run_timestamp_seconds" + job_labels + " " +
+                     str(int(time.time())))
+        lines.append("# HELP nimbus_backup_duration_seconds Wall time of the last run.")
+        lines.append("# TYPE nimbus_backup_duration_seconds gauge")
+        lines.append("nimbus_backup_duration_seconds" + job_labels + " " +
+                     "{0:.3f}".format(time.time() - self.started))
+
+        # The collector may read the file at any time, so never let it see a partial file.
+        textfile = os.path.join(self.textfile_dir, 'nimbus_' + self.job_name + '.prom')
+        with open(textfile + '.tmp', 'w') as prom:
+            prom.write("\n".join(lines) + "\n")
+        os.replace(textfile + '.tmp', textfile)
+
+    def close(self, success=True):
+        """This function writes the log and the textfile once the run is over"""
+        self.write_log()
+        self.write_textfile(success)
+
+
+@contextlib.contextmanager
+def phase(metrics, phase_name, **labels):
+    """This function times a phase for the modules, whose metrics argument is optional"""
+    if metrics is None:
+        yield {'bytes_in': None, 'bytes_out': None, 'cpu': None}
+    else:
+        with metrics.phase(phase_name, **labels) as measured:
+            yield measured
+
+
+def record(metrics, phase_name, wall=None, cpu=None, bytes_in=None, bytes_out=None, **labels):
+    """This function records a finished phase for the modules, whose metrics are optional"""
+    if metrics is not None:
+        metrics.record(phase_name, wall, cpu, bytes_in, bytes_out, **labels)
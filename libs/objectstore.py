@@ -0,0 +1,430 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Object Store class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This library will talk to S3 compatible object stores through
+                        their HTTP API directly. Archives are uploaded as multipart uploads
+                        with several parts in flight and a SHA256 checksum on every part,
+                        and the buckets are listed and cleaned up through the API as well.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import os  # Used to read the credentials from the environment and size the archives
+import hmac  # Used to sign the requests
+import time  # Used to back off between retries
+import base64  # Used to encode the checksums the way the API expects them
+import hashlib  # Used to hash the request bodies and the parts
+import datetime  # Used to date the requests and read the object dates
+import threading  # Used to keep a connection per thread and bound the parts in flight
+import http.client  # Used to send the requests
+import urllib.parse  # Used to encode the object keys and the query strings
+import xml.etree.ElementTree as ElementTree  # Used to read the API responses
+from xml.sax.saxutils import escape  # Used to write the keys into the request bodies
+from concurrent.futures import ThreadPoolExecutor  # Used to upload the parts in parallel
+
+# Backup directory types that are object stores rather than mounted paths.
+OBJECT_STORE_TYPES = ('s3',)
+
+# Parts are at least PART_SIZE, and grown for large archives so that no more than MAX_PARTS
+# are needed. The API does not accept parts under MIN_PART_SIZE, except for the last one.
+PART_SIZE = 16 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+MAX_PARALLEL_PARTS = 4
+
+# Requests that fail on the network or with a server error are sent again, after a backoff.
+MAX_ATTEMPTS = 4
+RETRY_BACKOFF = 0.5
+TIMEOUT = 60
+
+# Keys are listed and deleted up to 1000 at a time, the most a single request allows.
+DELETE_BATCH = 1000
+EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+READ_SIZE = 1024 * 1024
+
+
+def parse_location(location):
+    """This function splits an s3://bucket/prefix location into the bucket and key prefix"""
+    parsed = urllib.parse.urlsplit(location)
+    if parsed.scheme != 's3' or not parsed.netloc:
+        raise SystemExit(" ERROR: " + location + " is not an s3://bucket/prefix location")
+    prefix = parsed.path.strip('/')
+    return parsed.netloc, prefix + '/' if prefix else ''
+
+
+def sha256_checksum(data):
+    """This function returns the SHA256 of data as hex for the signature and base64 for the API"""
+    digest = hashlib.sha256(data).digest()
+    return digest.hex(), base64.b64encode(digest).decode()
+
+
+def query_string(query):
+    """This function encodes a query string the way the signature expects it"""
+    return '&'.join(urllib.parse.quote(name, safe='~') + '=' + urllib.parse.quote(value, safe='~')
+                    for name, value in sorted(query.items()))
+
+
+def local_name(tag):
+    """This function strips the XML namespace off of a tag"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def children(element, name):
+    """This function returns the child elements with the given name, in any namespace"""
+    return [child for child in element if local_name(child.tag) == name]
+
+
+def child_text(element, name, default=None):
+    """This function returns the text of the first child element with the given name"""
+    for child in children(element, name):
+        return child.text or ''
+    return default
+
+
+def parse_date(value):
+    """This function turns an ISO 8601 date of the API into a timestamp"""
+    value = value.rstrip('Z').split('.')[0]
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S').replace(
+        tzinfo=datetime.timezone.utc).timestamp()
+
+
+class S3Client(object):
+    """This class sends signed requests to the API of an S3 compatible object store"""
+
+    def __init__(self, endpoint, bucket, region='us-east-1', access_key=None, secret_key=None,
+                 session_token=None):
+        # Buckets are addressed by path (endpoint/bucket/key), which every S3 compatible
+        # store supports, and the credentials fall back to the usual AWS variables.
+        parsed = urllib.parse.urlsplit(endpoint)
+        if parsed.scheme not in ('http', 'https') or not parsed.netloc:
+            raise SystemExit(" ERROR: " + str(endpoint) + " is not an http(s) endpoint")
+        self.secure = parsed.scheme == 'https'
+        self.host = parsed.netloc
+        self.base_path = parsed.path.rstrip('/')
+        self.bucket = bucket
+        self.region = region
+        self.access_key = access_key or os.environ.get('AWS_ACCESS_KEY_ID')
+        self.secret_key = secret_key or os.environ.get('AWS_SECRET_ACCESS_KEY')
+        self.session_token = session_token or os.environ.get('AWS_SESSION_TOKEN')
+        if not self.access_key or not self.secret_key:
+            raise SystemExit(" ERROR: No credentials were found for the " + bucket + " bucket")
+        self.local = threading.local()
+
+    def connection(self):
+        """This function returns the connection of the calling thread, opening it if needed"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            if self.secure:
+                conn = http.client.HTTPSConnection(self.host, timeout=TIMEOUT)
+            else:
+                conn = http.client.HTTPConnection(self.host, timeout=TIMEOUT)
+            self.local.conn = conn
+        return conn
+
+    def reset(self):
+        """This function drops the connection of the calling thread after an error"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def sign(self, method, path, query, headers, payload_hash):
+        """This function adds the AWS signature version 4 headers to a request"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        scope = now.strftime('%Y%m%d') + '/' + self.region + '/s3/aws4_request'
+        headers['Host'] = self.host
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = payload_hash
+        if self.session_token:
+            headers['x-amz-security-token'] = self.session_token
+
+        signed = dict((name.lower(), ' '.join(str(value).split()))
+                      for name, value in headers.items()
+                      if name.lower() == 'host' or name.lower().startswith('x-amz-'))
+        signed_headers = ';'.join(sorted(signed))
+        canonical_request = "\n".join([
+            method, path,
+            query_string(query),
+            ''.join(name + ':' + signed[name] + "\n" for name in sorted(signed)),
+            signed_headers, payload_hash])
+        string_to_sign = "\n".join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                    hashlib.sha256(canonical_request.encode()).hexdigest()])
+
+        key = ('AWS4' + self.secret_key).encode()
+        for part in (now.strftime('%Y%m%d'), self.region, 's3', 'aws4_request'):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers['Authorization'] = ('AWS4-HMAC-SHA256 Credential=' + self.access_key + '/' +
+                                    scope + ', SignedHeaders=' + signed_headers +
+                                    ', Signature=' + signature)
+
+    def request(self, method, key=None, query=None, headers=None, body=b'', payload_hash=None,
+                stream=False):
+        """This function sends a signed request, retrying network and server errors"""
+        path = self.base_path + '/' + urllib.parse.quote(self.bucket, safe='')
+        if key is not None:
+            path = path + '/' + urllib.parse.quote(key, safe='/~')
+        query = dict((name, str(value)) for name, value in (query or {}).items())
+        url = path
+        if query:
+            url = path + '?' + query_string(query)
+        if payload_hash is None:
+            payload_hash = hashlib.sha256(body).hexdigest() if body else EMPTY_SHA256
+
+        error = None
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+            request_headers = dict(headers or {})
+            self.sign(method, path, query, request_headers, payload_hash)
+            try:
+                conn = self.connection()
+                conn.request(method, url, body=body or None, headers=request_headers)
+                response = conn.getresponse()
+                if response.status >= 500:
+                    error = str(response.status) + " " + response.reason + ": " + \
+                        response.read().decode('utf-8', 'replace')
+                    continue
+                if stream and response.status < 300:
+                    return response
+                data = response.read()
+            except (OSError, http.client.HTTPException) as err:
+                self.reset()
+                error = str(err)
+                continue
+            if response.status >= 300:
+                raise SystemError(" ERROR: " + method + " " + self.bucket + "/" + str(key or '') +
+                                  " failed with " + str(response.status) + " " +
+                                  response.reason + ": " + data.decode('utf-8', 'replace'))
+            return response, data
+        raise SystemError(" ERROR: " + method + " " + self.bucket + "/" + str(key or '') +
+                          " failed after " + str(MAX_ATTEMPTS) + " attempts: " + str(error))
+
+    def put_object(self, key, body):
+        """This function uploads a small object in a single request, with its checksum"""
+        payload_hash, checksum = sha256_checksum(body)
+        self.request('PUT', key, headers={'x-amz-checksum-sha256': checksum}, body=body,
+                     payload_hash=payload_hash)
+
+    def get_object(self, key):
+        """This function returns the response of an object for streaming its body"""
+        return self.request('GET', key, stream=True)
+
+    def create_multipart_upload(self, key):
+        """This function starts a multipart upload and returns its upload id"""
+        _, data = self.request('POST', key, query={'uploads': ''},
+                               headers={'x-amz-checksum-algorithm': 'SHA256'})
+        return child_text(ElementTree.fromstring(data), 'UploadId')
+
+    def upload_part(self, key, upload_id, part_number, body):
+        """This function uploads one part of a multipart upload and returns its etag and checksum"""
+        payload_hash, checksum = sha256_checksum(body)
+        response, _ = self.request('PUT', key, query={'partNumber': part_number,
+                                                      'uploadId': upload_id},
+                                   headers={'x-amz-checksum-sha256': checksum}, body=body,
+                                   payload_hash=payload_hash)
+        return response.getheader('ETag'), checksum
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        """This function puts the uploaded parts together into the object"""
+        body = ('<CompleteMultipartUpload>' + ''.join(
+            '<Part><PartNumber>' + str(part_number) + '</PartNumber><ETag>' + escape(etag) +
+            '</ETag><ChecksumSHA256>' + checksum + '</ChecksumSHA256></Part>'
+            for part_number, etag, checksum in parts) + '</CompleteMultipartUpload>').encode()
+        _, data = self.request('POST', key, query={'uploadId': upload_id}, body=body)
+        # The API can report a failure in the body of a 200 response to this request.
+        result = ElementTree.fromstring(data)
+        if local_name(result.tag) == 'Error':
+            raise SystemError(" ERROR: " + self.bucket + "/" + key + " could not be completed: " +
+                              str(child_text(result, 'Message')))
+
+    def abort_multipart_upload(self, key, upload_id):
+        """This function throws away the parts of an unfinished multipart upload"""
+        self.request('DELETE', key, query={'uploadId': upload_id})
+
+    def list_objects(self, prefix):
+        """This function lists the objects directly under a prefix, a page at a time"""
+        objects = []
+        query = {'list-type': '2', 'prefix': prefix, 'delimiter': '/'}
+        while True:
+            _, data = self.request('GET', query=query)
+            result = ElementTree.fromstring(data)
+            for content in children(result, 'Contents'):
+                objects.append({'key': child_text(content, 'Key'),
+                                'size': int(child_text(content, 'Size', '0')),
+                                'mtime': parse_date(child_text(content, 'LastModified'))})
+            token = child_text(result, 'NextContinuationToken')
+            if child_text(result, 'IsTruncated') != 'true' or not token:
+                return objects
+            query['continuation-token'] = token
+
+    def delete_objects(self, keys):
+        """This function deletes up to 1000 objects, returning the ones that were not deleted"""
+        body = ('<Delete><Quiet>true</Quiet>' + ''.join(
+            '<Object><Key>' + escape(key) + '</Key></Object>' for key in keys) +
+                '</Delete>').encode()
+        _, data = self.request('POST', query={'delete': ''}, body=body, headers={
+            'Content-MD5': base64.b64encode(hashlib.md5(body).digest()).decode()})
+        return [(child_text(error, 'Key'), child_text(error, 'Message'))
+                for error in children(ElementTree.fromstring(data), 'Error')]
+
+
+class Bucket(object):
+    """This class is a backup directory in an object store, a key prefix inside of a bucket"""
+
+    def __init__(self, client, prefix, part_size=PART_SIZE, max_parallel_parts=MAX_PARALLEL_PARTS):
+        self.client = client
+        self.prefix = prefix
+        self.part_size = max(int(part_size), MIN_PART_SIZE)
+        self.max_parallel_parts = max(int(max_parallel_parts), 1)
+        self.path = 's3://' + client.bucket + '/' + prefix
+
+    def url(self, name):
+        """This function returns the location of an object of the backup directory"""
+        return self.path + name.lstrip('/')
+
+    def list(self):
+        """This function lists the objects of the backup directory with their sizes and dates"""
+        objects = self.client.list_objects(self.prefix)
+        for listed in objects:
+            listed['name'] = listed['key'][len(self.prefix):]
+        return objects
+
+    def delete(self, names):
+        """This function deletes objects of the backup directory, returning those that failed"""
+        errors = []
+        keys = [self.prefix + name.lstrip('/') for name in names]
+        for index in range(0, len(keys), DELETE_BATCH):
+            try:
+                errors.extend((self.path + key[len(self.prefix):], message) for key, message
+                              in self.client.delete_objects(keys[index:index + DELETE_BATCH]))
+            except SystemError as err:
+                errors.extend((self.path + key[len(self.prefix):], str(err))
+                              for key in keys[index:index + DELETE_BATCH])
+        return errors
+
+    def read(self, name):
+        """This function reads a small object of the backup directory, like a sidecar"""
+        _, data = self.client.request('GET', self.prefix + name.lstrip('/'))
+        return data
+
+    def hash(self, name):
+        """This function streams an object of the backup directory through SHA256"""
+        checksum = hashlib.sha256()
+        response = self.client.get_object(self.prefix + name.lstrip('/'))
+        try:
+            while True:
+                block = response.read(READ_SIZE)
+                if not block:
+                    break
+                checksum.update(block)
+        finally:
+            response.close()
+            self.client.reset()
+        return checksum.hexdigest()
+
+    def sink(self, label, archive_name):
+        """This function returns the sink that uploads an archive to the backup directory"""
+        return S3Sink(label, self, archive_name)
+
+    def subdirectory(self, name):
+        """This function returns a directory under the backup directory, a longer key prefix"""
+        return Bucket(self.client, self.prefix + name.strip('/') + '/', self.part_size,
+                      self.max_parallel_parts)
+
+
+def open_bucket(directory):
+    """This function opens the bucket of an object store backup directory from the settings"""
+    options = directory.options
+    bucket, prefix = parse_location(directory.path)
+    region = options.get('region', 'us-east-1')
+    client = S3Client(options.get('endpoint', 'https://s3.' + region + '.amazonaws.com'), bucket,
+                      region, options.get('access_key_id'), options.get('secret_access_key'))
+    return Bucket(client, prefix + directory.directory.strip('/') + '/',
+                  options.get('part_size', PART_SIZE),
+                  options.get('max_parallel_parts', MAX_PARALLEL_PARTS))
+
+
+class S3Sink(object):
+    """This class uploads the archive to an object store as a parallel multipart upload"""
+
+    def __init__(self, label, bucket, archive_name):
+        self.label = label
+        self.bucket = bucket
+        self.client = bucket.client
+        self.key = bucket.prefix + archive_name.lstrip('/')
+        self.dest_path = bucket.url(archive_name)
+        self.part_size = bucket.part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.executor = None
+        self.in_flight = None
+
+    def open(self, source_path):
+        """This function sizes the parts so that the whole archive fits in the part limit"""
+        size = os.path.getsize(source_path)
+        self.part_size = max(self.part_size, -(-size // MAX_PARTS))
+        # A part that is waiting for a free upload slot holds up the fan out, which bounds
+        # the memory used to part_size times the number of parts in flight.
+        self.in_flight = threading.BoundedSemaphore(self.bucket.max_parallel_parts)
+        self.executor = ThreadPoolExecutor(max_workers=self.bucket.max_parallel_parts)
+
+    def upload(self, part_number, body):
+        """This function uploads a single part and frees its upload slot"""
+        try:
+            etag, checksum = self.client.upload_part(self.key, self.upload_id, part_number, body)
+            return part_number, etag, checksum
+        finally:
+            self.in_flight.release()
+
+    def send_part(self, body):
+        """This function hands a full part to the upload workers"""
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(self.key)
+        # Stop feeding parts as soon as one of them failed.
+        for part in self.parts:
+            if part.done() and part.exception() is not None:
+                raise part.exception()
+        self.in_flight.acquire()
+        self.parts.append(self.executor.submit(self.upload, len(self.parts) + 1, body))
+
+    def write(self, block):
+        """This function collects the blocks of the archive into parts"""
+        self.buffer += block
+        while len(self.buffer) >= self.part_size:
+            self.send_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def close(self, source_path, checksum):
+        """This function finishes the upload and writes the checksum sidecar next to it"""
+        if self.upload_id is None:
+            # A small archive goes up in a single request.
+            self.client.put_object(self.key, bytes(self.buffer))
+        else:
+            if self.buffer:
+                self.send_part(bytes(self.buffer))
+            self.executor.shutdown(wait=True)
+            self.client.complete_multipart_upload(self.key, self.upload_id,
+                                                  [part.result() for part in self.parts])
+            self.upload_id = None
+        self.buffer = bytearray()
+        self.executor.shutdown(wait=True)
+        self.client.put_object(self.key + '.sha256', (checksum + "  " +
+                                                      os.path.basename(source_path) +
+                                                      "\n").encode())
+
+    def abort(self):
+        """This function throws away the uploaded parts of a failed upload"""
+        self.buffer = bytearray()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        if self.upload_id is not None:
+            try:
+                self.client.abort_multipart_upload(self.key, self.upload_id)
+            except SystemError:
+                pass
@@ -5,30 +5,220 @@ Script:                 Nimbus Intermixed Modular Back Up Script
 Library:				Config Parse class
 Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
 Description:            This class will handle parsing the included configuration
-                        file and returning a config object.
+                        file and returning a config object. The file is read, checked
+                        and normalized once, and the result can not be changed after.
 ***************************************************************************
 """
 
+# Define all modules that this library will utilize
+import os  # Used to check the physical settings file location and the backup directories
+import re  # Used to check the backup window
+import json  # Used to parse the json config file
+import types  # Used to hand out read only views of the settings
+from collections import namedtuple  # Used to build the read only backup directory records
+from concurrent.futures import ThreadPoolExecutor  # Used to check the backup directories at once
+
+# Import Nimbus class libraries
+from libs.objectstore import OBJECT_STORE_TYPES  # Used to tell object stores from paths
+
+# How many backup directories are checked at the same time, each may be a slow network mount.
+DIRECTORY_CHECK_WORKERS = 8
+
+# Settings of a backup directory that every type has, the rest are options of its type.
+DIRECTORY_KEYS = ('label', 'directory', 'path', 'retention_days', 'type')
+
+# The window a job has to fit in, it may wrap past midnight (22:00-04:00).
+BACKUP_WINDOW = re.compile(r'^([01]\d|2[0-3]):[0-5]\d-([01]\d|2[0-3]):[0-5]\d$')
+
+
+def freeze(value):
+    """This function turns parsed JSON into read only mappings and tuples"""
+    if isinstance(value, dict):
+        return types.MappingProxyType(dict((key, freeze(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    """This function turns the read only settings back into plain dicts and lists"""
+    if isinstance(value, types.MappingProxyType):
+        return dict((key, thaw(item)) for key, item in value.items())
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+class BackupDir(namedtuple('BackupDir', 'label directory path retention_days type options')):
+    """This class holds a single validated backup directory from the settings file"""
+    __slots__ = ()
+
+    @property
+    def full_path(self):
+        """This function returns the path of the backup directory itself"""
+        return self.path + self.directory
+
+
+def check_directory(full_path):
+    """This function makes sure that a backup directory exists, returning a warning if not"""
+    if os.path.isdir(full_path):
+        return None
+    try:
+        os.makedirs(full_path)
+    except OSError:
+        return "WARNING: " + full_path + " could not be created"
+    return None
+
 
 class ParseConf(object):
     """This class will parse the config file and send the variables to the main application"""
-    json = __import__('json')  # Used to parse the json config file
-    pyos = __import__('os')  # Used to check the physical settings file location
-    sys = __import__('sys')  # Used to system exit functions on error
+    __slots__ = ('configfile', 'backup_directories', 'mail_sender_address',
+                 'mail_recipient_list', 'module_arg_list', 'compression_settings',
+                 'metrics_settings', 'resource_policy_settings', 'backup_window_setting',
+                 'frozen')
 
     def __init__(self, config):
         self.configfile = config
-        self.server_config = None
-
-        if self.pyos.path.isfile(self.configfile):
-            with open(self.configfile, encoding='utf-8') as self.config_file:
-                self.server_config = self.json.loads(self.config_file.read())
-                self.config_file.close()
+        if os.path.isfile(self.configfile):
+            try:
+                with open(self.configfile, encoding='utf-8') as config_file:
+                    server_config = json.loads(config_file.read())
+            except ValueError as err:
+                raise SystemExit(" ERROR: " + self.configfile + " is not valid JSON: " + str(err))
         else:
             print("Specified configuration file does not exist.")
             print("Please check the path and try again!\n")
             raise SystemExit(" ERROR: Specified Configuration File Not Found")
 
+        # Check the whole file first, so that every mistake is reported at once.
+        errors = []
+        if not isinstance(server_config, dict):
+            raise SystemExit(" ERROR: " + self.configfile + " must hold a JSON object")
+        self.backup_directories = self.parse_backup_dirs(server_config, errors)
+        self.mail_sender_address = self.parse_string(server_config, 'mail_sender', 'root', errors)
+        self.mail_recipient_list = self.parse_recipients(server_config, errors)
+        self.module_arg_list = self.parse_object(server_config, 'module_args', errors)
+
+        # A plain string is treated as the codec name.
+        compression = server_config.get('compression', {'codec': 'gz'})
+        if isinstance(compression, str):
+            compression = {'codec': compression}
+        if not isinstance(compression, dict):
+            errors.append("compression must be a codec name or an object")
+            compression = {}
+        self.compression_settings = freeze(compression)
+
+        # The metrics JSON lines log is on by default and the textfile is opt in.
+        self.metrics_settings = self.parse_object(server_config, 'metrics', errors)
+        # The job runs at full speed without a resource policy.
+        self.resource_policy_settings = self.parse_object(server_config, 'resource_policy',
+                                                          errors)
+
+        # The estimate warns when a run will not fit this HH:MM-HH:MM window.
+        self.backup_window_setting = self.parse_string(server_config, 'backup_window', '', errors)
+        if self.backup_window_setting and not BACKUP_WINDOW.match(self.backup_window_setting):
+            errors.append("backup_window must be given as HH:MM-HH:MM")
+
+        if errors:
+            raise SystemExit(" ERROR: " + self.configfile + " is not valid:\n\t" +
+                             "\n\t".join(errors))
+
+        # Make sure that all of the backup directories exist, checking them all at once.
+        if self.backup_directories:
+            with ThreadPoolExecutor(max_workers=min(DIRECTORY_CHECK_WORKERS,
+                                                    len(self.backup_directories))) as executor:
+                for warning in executor.map(check_directory, [
+                        directory.full_path for directory in self.backup_directories
+                        if directory.type not in OBJECT_STORE_TYPES]):
+                    if warning is not None:
+                        print(warning)
+        self.frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, 'frozen', False):
+            raise AttributeError("The settings of " + self.configfile + " can not be changed")
+        object.__setattr__(self, name, value)
+
+    @staticmethod
+    def parse_string(server_config, setting, default, errors):
+        """This function checks a setting that has to be a string"""
+        value = server_config.get(setting, default)
+        if not isinstance(value, str):
+            errors.append(setting + " must be a string")
+            return default
+        return value
+
+    @staticmethod
+    def parse_recipients(server_config, errors):
+        """This function checks the mail recipients, a string or a list that is joined into one"""
+        value = server_config.get('mail_recipients', 'root')
+        if isinstance(value, list) and value and all(isinstance(item, str) for item in value):
+            return ", ".join(value)
+        if not isinstance(value, str):
+            errors.append("mail_recipients must be a string or a list of strings")
+            return 'root'
+        return value
+
+    @staticmethod
+    def parse_object(server_config, setting, errors):
+        """This function checks a setting that has to be an object, it defaults to empty"""
+        value = server_config.get(setting, {})
+        if not isinstance(value, dict):
+            errors.append(setting + " must be an object")
+            return freeze({})
+        return freeze(value)
+
+    @staticmethod
+    def parse_backup_dirs(server_config, errors):
+        """This function checks and normalizes the backup directories in the settings file"""
+        if 'backup_directories' not in server_config:
+            errors.append("backup_directories is not defined")
+            return ()
+        directory_list = server_config['backup_directories']
+        if not isinstance(directory_list, list) or not directory_list:
+            errors.append("backup_directories must be a list with at least one directory")
+            return ()
+
+        backup_dirs = []
+        for index, directory in enumerate(directory_list):
+            where = "backup_directories[" + str(index) + "]"
+            if not isinstance(directory, dict):
+                errors.append(where + " must be an object")
+                continue
+            # Make sure that all of the required keys exist in the passed dictionary object. An
+            # empty directory is the root of the mount, but the path has to be set.
+            missing = [key for key in ('path', 'directory') if key not in directory]
+            if 'path' in directory and not directory['path']:
+                missing.append('path')
+            if missing:
+                errors.append(where + " is missing " + ", ".join(missing))
+                continue
+
+            path = str(directory['path'])
+            if not path.endswith('/'):
+                path = path + "/"
+            dir_type = str(directory.get('type', 'filesystem'))
+            # Object stores are given as s3://bucket/prefix, along with their endpoint.
+            if dir_type in OBJECT_STORE_TYPES and not path.startswith(dir_type + '://'):
+                errors.append(where + " path must be a " + dir_type + "://bucket/prefix location")
+                continue
+            try:
+                retention_days = int(directory.get('retention_days', 3))
+            except (TypeError, ValueError):
+                errors.append(where + " retention_days must be a number of days")
+                continue
+            if retention_days < 0:
+                errors.append(where + " retention_days can not be negative")
+                continue
+
+            backup_dirs.append(BackupDir(label=str(directory.get('label', directory['directory'])),
+                                         directory=str(directory['directory']), path=path,
+                                         retention_days=retention_days, type=dir_type,
+                                         options=freeze(dict(
+                                             (key, value) for key, value in directory.items()
+                                             if key not in DIRECTORY_KEYS))))
+        return tuple(backup_dirs)
+
     def print_header(self):
         """This function simply prints the header of the config settings"""
         print('\n')
@@ -38,119 +228,80 @@ class ParseConf(object):
         print('-----------------------------------')
 
     def backup_dirs(self):
-        """This function assigns the backup directories in the settings file"""
-        # Load list of backup directories
-        if 'backup_directories' in self.server_config:
-            directory_list = self.server_config['backup_directories']
-            # Verify that the directories exist, and if not...create them
-            for directory in directory_list:
-                # Make sure that all of the required keys exist in the passed dictionary object.
-                if 'directory' in directory.keys():
-                    dir_name = directory.get('directory')
-                    dir_name = str(dir_name)
-                else:
-                    directory['directory'] = None
-
-                if 'path' in directory.keys():
-                    path = directory.get('path')
-
-                    if not path.endswith('/'):
-                        path = path + "/"
-                        directory['path'] = path
-
-                    # if dir_name is not None and dir_name != "":
-                    #     path = path + dir_name + "/"
-                    #     directory['path'] = path
-
-                if 'label' in directory.keys():
-                    label = directory.get('label')
-                    label = str(label)
-                else:
-                    directory['label'] = None
-
-                if 'retention_days' in directory.keys():
-                    retention_days = directory.get('retention_days')
-                    retention_days = int(retention_days)
-                else:
-                    directory['retention_days'] = 3
-
-                if 'type' in directory.keys():
-                    dir_type = directory.get('type')
-                    dir_type = str(dir_type)
-                else:
-                    directory['retention_days'] = 'filesystem'
-
-                # Check to ensure that the path exists
-                if not self.pyos.path.isdir(path + dir_name):
-                    try:
-                        self.pyos.makedirs(path + dir_name)
-                    except FileNotFoundError:
-                        print("WARNING: " + path + dir_name + "could not be created")
-        else:
-            directory_list = '[{"directory": "Not Defined", "path": "Not Defined", '\
-            '"retention_days": "Not Defined", "type": "Not Defined"}]'
-        return directory_list
+        """This function returns the backup directories in the settings file"""
+        return self.backup_directories
 
     def print_backup_dirs(self):
         """This function prints all of the backup directories on the screen at run time"""
         # Print the list of backup directories defined in the global variable DIRECTORY_LIST
         print('Backup Directories:')
-        directory_list = self.backup_dirs()
-        for directory in directory_list:
-            print('\t' + directory.get('label') + ': ')
-            print('\t\t' + 'directory: ' + directory.get('directory'))
-            print('\t\t' + 'path: ' + directory.get('path'))
-            print('\t\t' + 'retention(days): ' + directory.get('retention_days'))
-            print('\t\t' + 'type: ' + directory.get('type'))
+        for directory in self.backup_directories:
+            print('\t' + directory.label + ': ')
+            print('\t\t' + 'directory: ' + directory.directory)
+            print('\t\t' + 'path: ' + directory.path)
+            print('\t\t' + 'retention(days): ' + str(directory.retention_days))
+            print('\t\t' + 'type: ' + directory.type)
+            if 'endpoint' in directory.options:
+                print('\t\t' + 'endpoint: ' + str(directory.options['endpoint']))
 
     def module_args(self):
-        """This function parses the included module arguments"""
-        # Load the binary executable location
-        if 'module_args' in self.server_config:
-            module_arg_list = str(self.server_config['module_args'])
-            module_arg_list = module_arg_list.replace("'", "\"")
-        else:
-            module_arg_list = None
-
-        return module_arg_list
+        """This function returns the included module arguments"""
+        return self.module_arg_list
 
     def print_module_args(self):
         """This funtion prints all of the included module arguments at run time"""
-        # Print mail sender config
-        module_arg_list = self.json.loads(self.module_args())
         print("Module Arguments:")
-        for arg, value in module_arg_list.items():
-            print('\t' + str(arg) + ': ' + str(value))
+        for arg, value in self.module_arg_list.items():
+            print('\t' + str(arg) + ': ' + str(thaw(value)))
+
+    def compression(self):
+        """This function returns the archive compression codec and level from the settings file"""
+        return self.compression_settings
+
+    def print_compression(self):
+        """This function prints the archive compression settings at run time"""
+        compression = self.compression_settings
+        print("Archive Compression: " + str(compression.get('codec', 'gz')) +
+              " (level: " + str(compression.get('level', 'default')) + ", threads: " +
+              str(compression.get('threads', 'one per CPU')) + ")")
+        if compression.get('volume_size') is not None:
+            print("Archive Volumes: " + str(compression['volume_size']) + " (" +
+                  str(compression.get('max_parallel_volumes', 4)) + " copied at once)")
+
+    def metrics(self):
+        """This function returns the metrics settings from the settings file"""
+        return self.metrics_settings
+
+    def backup_window(self):
+        """This function returns the HH:MM-HH:MM window the job has to fit in, or an empty string"""
+        return self.backup_window_setting
+
+    def resource_policy(self):
+        """This function returns the priority, CPU and rate limits of the job from the settings"""
+        return self.resource_policy_settings
+
+    def print_resource_policy(self):
+        """This function prints the resource policy of the job at run time"""
+        if self.resource_policy_settings:
+            print("Resource Policy:")
+            for setting, value in self.resource_policy_settings.items():
+                print('\t' + str(setting) + ': ' + str(thaw(value)))
 
     def mail_sender(self):
-        """This function sets up the mail send user from the settings file"""
-        # Load mail sender config
-        if 'mail_sender' in self.server_config:
-            mail_sender = self.server_config['mail_sender']
-        else:
-            mail_sender = 'root'
-        return mail_sender
+        """This function returns the mail send user from the settings file"""
+        return self.mail_sender_address
 
     def print_mail_sender(self):
         """This function prints the mail send user included in the settings file"""
-        # Print mail sender config
-        mail_sender = self.mail_sender()
-        print("Using Mail Sender: " + str(mail_sender))
+        print("Using Mail Sender: " + str(self.mail_sender_address))
 
     def mail_recipients(self):
-        """This function sets up the mail recipients listed in the settings file"""
-        # Load mail recipients config
-        if 'mail_recipients' in self.server_config:
-            mail_recipients = self.server_config['mail_recipients']
-        else:
-            mail_recipients = 'root'
-        return mail_recipients
+        """This function returns the mail recipients listed in the settings file"""
+        return self.mail_recipient_list
 
     def print_mail_recipients(self):
         """This function prints the mail recipients listed in the settings file"""
-        # Print mail recipients config
-        mail_recipients = self.mail_recipients()
-        print("Using Mail Recipients: " + str(mail_recipients))
+        print("Using Mail Recipients: " + str(self.mail_recipient_list))
 
     def print_footer(self):
         """This function prints the footer of the settings at run time"""
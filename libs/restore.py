@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Restore class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This library will find the copies of an archive in the backup
+                        directories, pick the fastest reachable one, and stream its
+                        members into the restore commands of the backup modules. Copies
+                        that were split into volumes are read back as a single stream.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import os  # Used to find the archive copies and write the extracted members
+import re  # Used to read the database and date out of the member names
+import json  # Used to read the chunk store manifests
+import time  # Used to time the replica probes
+import shutil  # Used to copy the members into the restore commands
+import threading  # Used to feed chunk store archives through a pipe
+import subprocess  # Used to run the restore commands
+from concurrent.futures import ThreadPoolExecutor  # Used to probe the copies in parallel
+
+# Import Nimbus class libraries
+from libs.chunkstore import manifest_path, chunk_path, reassemble  # Used to read chunk stores
+from libs.chunkstore import MANIFEST_EXTENSION  # Used to list the archives of chunk stores
+from libs.compression import ArchiveReader, member_reader  # Used to read the archives
+from libs.compression import restore_command, strip_extension  # Used to read the members
+from libs.fanout import volume_path, VOLUME_NAME  # Used to find the volumes of split copies
+
+# How much of each copy is read to find the fastest one, and the copy buffer size.
+PROBE_BYTES = 1024 * 1024
+COPY_BUFSIZE = 1024 * 1024
+
+# Archive and dump names end in the run date, incremental archives are marked with _incr.
+ARCHIVE_NAME = r'^{prefix}(?P<date>\d{{4}}-\d{{2}}-\d{{2}}_\d{{2}}-\d{{2}}-\d{{2}})' \
+               r'(?P<incr>_incr)?\.tar'
+DUMP_NAME = re.compile(r'^(?P<database>.+)-\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}'
+                       r'\.(?P<format>sql|dump|dir)$')
+
+
+def list_archives(backup_dirs, prefix):
+    """This function lists the archives of a module found in any backup directory, oldest first"""
+    pattern = re.compile(ARCHIVE_NAME.format(prefix=re.escape(prefix)))
+    archives = set()
+    for directory in backup_dirs:
+        dir_path = directory.full_path
+        if not os.path.isdir(dir_path):
+            continue
+        for entry in os.scandir(dir_path):
+            name = entry.name
+            if directory.type == 'chunkstore':
+                if not name.endswith(MANIFEST_EXTENSION):
+                    continue
+                name = name[:-len(MANIFEST_EXTENSION)]
+            # The volumes of a split copy are listed as the archive they make up.
+            name = VOLUME_NAME.sub('', name)
+            if pattern.match(name) and not name.endswith(('.part', '.ckpt', '.spool', '.sha256')):
+                archives.add(name)
+    return sorted(archives, key=lambda name: pattern.match(name).group('date'))
+
+
+def restore_chain(archives, archive_name, prefix):
+    """This function returns the full archive and the incrementals needed to restore an archive"""
+    pattern = re.compile(ARCHIVE_NAME.format(prefix=re.escape(prefix)))
+    if archive_name not in archives:
+        raise SystemExit(" ERROR: " + archive_name + " was not found in any backup directory.")
+
+    chain = []
+    for name in archives[:archives.index(archive_name) + 1]:
+        if pattern.match(name).group('incr') is None:
+            chain = []
+        chain.append(name)
+    if pattern.match(chain[0]).group('incr') is not None:
+        raise SystemExit(" ERROR: No full backup was found before " + archive_name + ".")
+    return chain
+
+
+def find_volumes(replica_path):
+    """This function lists the volumes of a split copy in order, or None if there are none"""
+    volume_paths = []
+    while os.path.isfile(volume_path(replica_path, len(volume_paths) + 1)):
+        volume_paths.append(volume_path(replica_path, len(volume_paths) + 1))
+    return volume_paths or None
+
+
+def find_replicas(backup_dirs, archive_name):
+    """This function lists every backup directory that holds a copy of the archive"""
+    replicas = []
+    for directory in backup_dirs:
+        dir_path = directory.full_path
+        volume_paths = None
+        if directory.type == 'chunkstore':
+            replica_path = manifest_path(dir_path, archive_name)
+        else:
+            replica_path = os.path.join(dir_path, archive_name.lstrip('/'))
+            if not os.path.isfile(replica_path):
+                volume_paths = find_volumes(replica_path)
+        if os.path.isfile(replica_path) or volume_paths is not None:
+            replicas.append({'label': directory.label, 'type': directory.type,
+                             'store_path': dir_path, 'path': replica_path, 'seconds': None,
+                             'volumes': volume_paths})
+    return replicas
+
+
+def probe_replica(replica):
+    """This function times the read of the start of a copy, or returns None if it is unreachable"""
+    start = time.monotonic()
+    try:
+        if replica['type'] == 'chunkstore':
+            # The chunks are where the data comes from, so read the first one as well.
+            with open(replica['path']) as manifest_file:
+                chunks = json.load(manifest_file)['chunks']
+            probe_path = replica['path']
+            if chunks:
+                probe_path = chunk_path(replica['store_path'], chunks[0][0])
+        elif replica['volumes'] is not None:
+            probe_path = replica['volumes'][0]
+        else:
+            probe_path = replica['path']
+        with open(probe_path, 'rb') as probe_file:
+            probe_file.read(PROBE_BYTES)
+    except (OSError, ValueError, KeyError):
+        return None
+    return time.monotonic() - start
+
+
+def select_replica(replicas):
+    """This function probes all of the copies at once and returns the fastest reachable one"""
+    if not replicas:
+        raise SystemExit(" ERROR: The archive was not found in any backup directory.")
+    with ThreadPoolExecutor(max_workers=len(replicas)) as executor:
+        probes = list(executor.map(probe_replica, replicas))
+    for replica, seconds in zip(replicas, probes):
+        replica['seconds'] = seconds
+
+    reachable = [replica for replica in replicas if replica['seconds'] is not None]
+    if not reachable:
+        raise SystemExit(" ERROR: None of the copies of the archive could be read.")
+    return min(reachable, key=lambda replica: replica['seconds'])
+
+
+class ChunkStoreReader(object):
+    """This class streams an archive out of a chunk store through a pipe"""
+
+    def __init__(self, store_path, archive_name):
+        self.archive_name = archive_name
+        self.error = None
+        read_fd, write_fd = os.pipe()
+        self.fileobj = os.fdopen(read_fd, 'rb')
+        self.thread = threading.Thread(target=self.feed,
+                                       args=(store_path, os.fdopen(write_fd, 'wb')))
+        self.thread.start()
+
+    def feed(self, store_path, writer):
+        """This function reassembles the archive into the write end of the pipe"""
+        try:
+            with writer:
+                reassemble(store_path, self.archive_name, writer)
+        except (OSError, SystemError) as err:
+            self.error = err
+
+    def fileno(self):
+        """This function returns the read end of the pipe, so it can feed a decompressor"""
+        return self.fileobj.fileno()
+
+    def read(self, size=-1):
+        """This function reads the reassembled archive"""
+        return self.fileobj.read(size)
+
+    def close(self):
+        """This function closes the pipe and reports a chunk that failed verification"""
+        # Drain whatever the reader left behind so the feed thread is never stuck on a write.
+        while self.fileobj.read(COPY_BUFSIZE):
+            pass
+        self.fileobj.close()
+        self.thread.join()
+        if self.error is not None:
+            raise SystemError(" ERROR: " + self.archive_name + " could not be reassembled: " +
+                              str(self.error))
+
+
+class VolumeReader(ChunkStoreReader):
+    """This class streams the volumes of a split copy through a pipe, one after the other"""
+
+    def feed(self, volume_paths, writer):
+        """This function joins the volumes into the write end of the pipe"""
+        try:
+            with writer:
+                for path in volume_paths:
+                    with open(path, 'rb') as volume:
+                        shutil.copyfileobj(volume, writer, COPY_BUFSIZE)
+        except OSError as err:
+            self.error = err
+
+
+def open_replica(replica, archive_name):
+    """This function opens a copy of an archive for reading"""
+    if replica['type'] == 'chunkstore':
+        return ChunkStoreReader(replica['store_path'], archive_name)
+    if replica['volumes'] is not None:
+        return VolumeReader(replica['volumes'], archive_name)
+    return open(replica['path'], 'rb')
+
+
+def read_archives(backup_dirs, archive_names):
+    """This function opens each archive from its fastest copy in turn, yielding its reader"""
+    for archive_name in archive_names:
+        replica = select_replica(find_replicas(backup_dirs, archive_name))
+        print("Reading " + archive_name + " from " + str(replica['label']) + " (" +
+              replica['path'] + ", probe took " +
+              "{0:.1f}".format(replica['seconds'] * 1000) + " ms)")
+        source = open_replica(replica, archive_name)
+        archive = ArchiveReader(source, archive_name)
+        try:
+            yield archive
+        finally:
+            try:
+                archive.close()
+            finally:
+                source.close()
+
+
+def dump_member(member_name):
+    """This function returns the database, dump format and directory entry of a dump member"""
+    parts = member_name.split('/')
+    for index, part in enumerate(parts):
+        if index == len(parts) - 1:
+            part = strip_extension(part)
+        match = DUMP_NAME.match(part)
+        if match and (match.group('format') == 'dir') != (index == len(parts) - 1):
+            return match.group('database'), match.group('format'), "/".join(parts[index + 1:])
+    return None, None, None
+
+
+def pipe_member(fileobj, member_name, restore_argv):
+    """This function decompresses a member on the fly into the stdin of a restore command"""
+    # The commands are run without a shell, as the database names come from the archive.
+    pipeline = restore_command(restore_argv, member_name)
+    processes = []
+    for index, argv in enumerate(pipeline):
+        processes.append(subprocess.Popen(
+            argv, stdin=processes[-1].stdout if processes else subprocess.PIPE,
+            stdout=subprocess.PIPE if index < len(pipeline) - 1 else None))
+        if index > 0:
+            # Only the next command reads it, so it sees the end of the input.
+            processes[-2].stdout.close()
+    feed = processes[0].stdin
+    try:
+        with member_reader(fileobj, member_name) as member:
+            shutil.copyfileobj(member, feed, COPY_BUFSIZE)
+    except BrokenPipeError:
+        # The restore command stopped reading, its return code says why.
+        pass
+    finally:
+        try:
+            feed.close()
+        except BrokenPipeError:
+            pass
+    return_codes = [process.wait() for process in processes]
+    return next((return_code for return_code in return_codes if return_code != 0), 0)
+
+
+def pipe_file(file_path, restore_argv):
+    """This function pipes a member that was extracted to disk into a restore command"""
+    with open(file_path, 'rb') as fileobj:
+        return pipe_member(fileobj, file_path, restore_argv)
+
+
+def run_command(restore_argv):
+    """This function runs a restore command that reads its own input"""
+    return subprocess.call(restore_argv)
+
+
+def extract_member(fileobj, target_root, member_path):
+    """This function writes a member to disk as it is, for the tools that need a real file"""
+    target_root = os.path.abspath(target_root)
+    target_path = os.path.normpath(os.path.join(target_root, member_path))
+    if not target_path.startswith(target_root + os.sep):
+        raise SystemError(" ERROR: " + member_path + " would be extracted outside of " +
+                          target_root)
+    target_dir = os.path.dirname(target_path)
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    with open(target_path, 'wb') as target:
+        shutil.copyfileobj(fileobj, target, COPY_BUFSIZE)
+    return target_path
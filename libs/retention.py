@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Retention class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This library will remove the files that are older than the
+                        retention period of each backup directory. The directories are
+                        swept in parallel and the deletes are batched in the background.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import os  # Used to scan the directories and remove the files
+import datetime  # Used to do file date calculations
+from concurrent.futures import ThreadPoolExecutor  # Used to sweep the directories in parallel
+
+# Import Nimbus class libraries
+from libs.chunkstore import collect_garbage  # Used to clean up chunkstore directories
+from libs.objectstore import Bucket  # Used to sweep object store directories through their API
+from libs.walarchive import WAL_DIR  # Used to leave the WAL to its own retention
+
+# How many directories are swept at once, and how many files each delete task removes.
+SWEEP_WORKERS = 4
+DELETE_WORKERS = 4
+DELETE_BATCH = 64
+
+
+def delete_batch(file_paths):
+    """This function removes a batch of files, returning the ones that could not be removed"""
+    errors = []
+    for file_path in file_paths:
+        try:
+            os.remove(file_path)
+        except OSError as err:
+            errors.append((file_path, str(err)))
+    return errors
+
+
+def sweep_bucket(bucket, retention_days, filedate, dry_run):
+    """This function sweeps an object store directory with a listing and batched deletes"""
+    result = {'path': bucket.path, 'removed': [], 'kept': 0, 'errors': [], 'chunks': None}
+    for listed in bucket.list():
+        file_age = filedate - datetime.datetime.fromtimestamp(listed['mtime'])
+        if file_age.days > int(retention_days):
+            result['removed'].append((bucket.url(listed['name']), file_age.days))
+        else:
+            result['kept'] += 1
+
+    # The bucket deletes up to a thousand objects per request, so there is no need for the pool.
+    if not dry_run and result['removed']:
+        result['errors'] = bucket.delete([file_path[len(bucket.path):]
+                                          for file_path, _ in result['removed']])
+    return result
+
+
+def sweep_directory(filepath, retention_days, dir_type, filedate, dry_run, delete_pool):
+    """This function sweeps a single backup directory"""
+    if isinstance(filepath, Bucket):
+        return sweep_bucket(filepath, retention_days, filedate, dry_run)
+
+    result = {'path': filepath, 'removed': [], 'kept': 0, 'errors': [], 'chunks': None}
+
+    # A single scandir pass, the stat of each entry is cached on the entry itself.
+    with os.scandir(filepath) as entries:
+        for entry in entries:
+            # Chunk stores keep their chunks in a sub directory that is garbage collected below,
+            # and the WAL is kept for as long as the base backups that need it.
+            if (dir_type == "chunkstore" or entry.name == WAL_DIR) and entry.is_dir():
+                continue
+            file_create_date = datetime.datetime.fromtimestamp(entry.stat().st_mtime)
+            file_age = filedate - file_create_date
+
+            # If the file is greater then the set retention, then remove the file.
+            if file_age.days > int(retention_days):
+                result['removed'].append((entry.path, file_age.days))
+            else:
+                result['kept'] += 1
+
+    # Hand the expired files to the delete workers in batches.
+    if not dry_run:
+        expired = [file_path for file_path, _ in result['removed']]
+        batches = [delete_pool.submit(delete_batch, expired[index:index + DELETE_BATCH])
+                   for index in range(0, len(expired), DELETE_BATCH)]
+        for batch in batches:
+            result['errors'].extend(batch.result())
+
+    # Once the expired manifests are gone, drop the chunks that no backup references anymore.
+    if dir_type == "chunkstore":
+        result['chunks'] = collect_garbage(filepath, dry_run,
+                                           set(file_path for file_path, _ in result['removed']))
+
+    return result
+
+
+def sweep(directories, filedate, dry_run=False):
+    """This function sweeps a list of (filepath or bucket, retention_days, dir_type) concurrently"""
+    with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as delete_pool:
+        with ThreadPoolExecutor(max_workers=SWEEP_WORKERS) as sweep_pool:
+            futures = [sweep_pool.submit(sweep_directory, filepath, retention_days, dir_type,
+                                         filedate, dry_run, delete_pool)
+                       for filepath, retention_days, dir_type in directories]
+            results = [future.result() for future in futures]
+
+    return results
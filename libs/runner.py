@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Command Runner class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This library will run the external commands of the backup modules
+                        from argv lists, several at a time on an asyncio loop. Each command
+                        runs in its own process group with an optional timeout, and its
+                        output is streamed into the job log line by line as it arrives.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import os  # Used to signal the process groups and reap the commands with their CPU time
+import time  # Used to time the commands
+import shlex  # Used to show the commands in the log the way a shell would take them
+import signal  # Used to stop the commands on a timeout or cancel
+import asyncio  # Used to wait on the commands and their output at the same time
+import subprocess  # Used to start the commands
+import collections  # Used to keep the last lines of output of each command
+from concurrent.futures import ThreadPoolExecutor  # Used to run the output consumers
+
+# Output is read in blocks of this size, and only the last lines of each command are kept.
+READ_SIZE = 64 * 1024
+TAIL_LINES = 20
+MAX_LINE = 4096
+
+# How long a stopped command gets to exit after SIGTERM before it gets SIGKILL.
+KILL_GRACE = 10
+POLL_INTERVAL = 0.05
+
+
+def command_line(commands):
+    """This function shows a pipeline of argv lists as a shell command line"""
+    return " | ".join(" ".join(shlex.quote(str(arg)) for arg in argv) for argv in commands)
+
+
+def failed(result):
+    """This function tells if a command failed or timed out"""
+    return result['timed_out'] or result['returncode'] != 0
+
+
+def describe(result):
+    """This function describes how a command ended, with its last lines of output if it failed"""
+    if result['timed_out']:
+        status = "timed out after " + "{0:.0f}".format(result['seconds']) + "s"
+    elif result['returncode'] != 0:
+        status = "failed with exit code " + str(result['returncode'])
+    else:
+        return "completed in " + "{0:.1f}".format(result['seconds']) + "s"
+    return status + ": " + result['command'] + "\n" + "\n".join(result['output'])
+
+
+async def read_lines(stream, emit):
+    """This function hands a pipe to emit line by line, cutting over long lines"""
+    partial = b''
+    while True:
+        block = await stream.read(READ_SIZE)
+        if not block:
+            break
+        lines = (partial + block).split(b'\n')
+        partial = lines.pop()
+        # A line without an end is never held onto without bound.
+        if len(partial) > MAX_LINE:
+            lines.append(partial[:MAX_LINE])
+            partial = b''
+        for line in lines:
+            emit(line)
+    if partial:
+        emit(partial)
+
+
+async def read_all(stream):
+    """This function reads a pipe to the end, for the small outputs of queries"""
+    blocks = []
+    while True:
+        block = await stream.read(READ_SIZE)
+        if not block:
+            return b''.join(blocks)
+        blocks.append(block)
+
+
+async def open_pipe(pipe):
+    """This function attaches the read end of a pipe to the running loop"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=READ_SIZE)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    return reader
+
+
+async def wait_exit(process):
+    """This function waits for a command to exit and returns its own CPU time"""
+    # Reaping the command here rather than in asyncio keeps its resource usage.
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        pidfd = None
+
+    if pidfd is not None:
+        exited = loop.create_future()
+        loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+        _, status, usage = os.wait4(process.pid, 0)
+    else:
+        while True:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            await asyncio.sleep(POLL_INTERVAL)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return usage.ru_utime + usage.ru_stime
+
+
+def signal_groups(processes, signum):
+    """This function signals the process group of every command that is still running"""
+    for process in processes:
+        if process.returncode is None:
+            try:
+                os.killpg(process.pid, signum)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+
+async def stop(processes, pending):
+    """This function stops the commands, giving them KILL_GRACE to exit before SIGKILL"""
+    signal_groups(processes, signal.SIGTERM)
+    _, pending = await asyncio.wait(pending, timeout=KILL_GRACE)
+    if pending:
+        signal_groups(processes, signal.SIGKILL)
+        _, pending = await asyncio.wait(pending, timeout=KILL_GRACE)
+    # Whatever is left is output held open by something outside of the process groups.
+    for task in pending:
+        task.cancel()
+
+
+def start(commands, stdout, env, cwd):
+    """This function starts a pipeline of commands, each in a process group of its own"""
+    processes = []
+    previous = subprocess.DEVNULL
+    try:
+        for index, argv in enumerate(commands):
+            last = index == len(commands) - 1
+            try:
+                process = subprocess.Popen([str(arg) for arg in argv], stdin=previous,
+                                           stdout=stdout if last else subprocess.PIPE,
+                                           stderr=subprocess.PIPE, env=env, cwd=cwd,
+                                           start_new_session=True)
+            except FileNotFoundError:
+                raise SystemError(" ERROR: " + str(argv[0]) + " is not installed!")
+            finally:
+                if previous is not subprocess.DEVNULL:
+                    previous.close()
+            processes.append(process)
+            previous = process.stdout
+    except BaseException:
+        signal_groups(processes, signal.SIGKILL)
+        for process in processes:
+            process.wait()
+        raise
+    return processes
+
+
+async def run_async(commands, stdout=None, consume=None, capture=False, timeout=None,
+                    log=None, label=None, env=None, cwd=None):
+    """This function runs a command, or a pipeline of commands, and returns how it went"""
+    # commands is an argv list, or a list of argv lists that are piped into each other. The
+    # last stdout goes to a file path or object, to consume(pipe) in a worker thread, into the
+    # result with capture, or otherwise into the log along with every stderr.
+    if commands and isinstance(commands[0], (str, bytes, os.PathLike)):
+        commands = [commands]
+    if env is not None:
+        env = dict(os.environ, **env)
+    loop = asyncio.get_running_loop()
+    result = {'command': command_line(commands), 'returncode': None, 'cpu': 0.0,
+              'seconds': 0.0, 'timed_out': False, 'output': [], 'stdout': None,
+              'consumed': None}
+    tail = collections.deque(maxlen=TAIL_LINES)
+
+    def emit(line):
+        """This function logs a line of output and keeps it for the error report"""
+        line = line.decode('utf-8', 'replace').rstrip('\r')
+        tail.append(line)
+        if label is not None:
+            line = label + ": " + line
+        if log is not None:
+            log(line)
+        else:
+            print(line)
+
+    stdout_file = None
+    if isinstance(stdout, (str, os.PathLike)):
+        stdout_file = stdout = open(stdout, 'wb')
+    elif stdout is None:
+        stdout = subprocess.PIPE
+
+    start_time = time.monotonic()
+    try:
+        processes = start(commands, stdout, env, cwd)
+    finally:
+        if stdout_file is not None:
+            stdout_file.close()
+
+    waiters = [asyncio.ensure_future(wait_exit(process)) for process in processes]
+    tasks = list(waiters)
+    try:
+        for process in processes:
+            tasks.append(asyncio.ensure_future(read_lines(await open_pipe(process.stderr),
+                                                          emit)))
+        last = processes[-1]
+        if consume is not None:
+            consumer = asyncio.ensure_future(loop.run_in_executor(None, consume, last.stdout))
+            tasks.append(consumer)
+        elif capture:
+            consumer = asyncio.ensure_future(read_all(await open_pipe(last.stdout)))
+            tasks.append(consumer)
+        elif last.stdout is not None:
+            tasks.append(asyncio.ensure_future(read_lines(await open_pipe(last.stdout), emit)))
+    except BaseException:
+        await stop(processes, tasks)
+        raise
+
+    # Wait for everything to finish, unless the timeout passes or something breaks first.
+    pending = set(tasks)
+    deadline = None if timeout is None else loop.time() + float(timeout)
+    try:
+        while pending:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                result['timed_out'] = True
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining,
+                                               return_when=asyncio.FIRST_EXCEPTION)
+            if any(not task.cancelled() and task.exception() is not None for task in done):
+                break
+    except asyncio.CancelledError:
+        await stop(processes, pending)
+        raise
+    if pending:
+        await stop(processes, pending)
+
+    try:
+        if consume is not None or capture:
+            # A consumer that broke is reported as is, after its commands are stopped.
+            result['consumed'] = consumer.result() if consumer.done() else None
+    finally:
+        if consume is not None:
+            last.stdout.close()
+    if capture and result['consumed'] is not None:
+        result['stdout'] = result['consumed'].decode('utf-8', 'replace')
+
+    # The pipeline fails with the first command that failed, like set -o pipefail.
+    result['seconds'] = time.monotonic() - start_time
+    result['cpu'] = sum(waiter.result() for waiter in waiters
+                        if waiter.done() and not waiter.cancelled())
+    result['returncode'] = next((process.returncode for process in processes
+                                 if process.returncode != 0), 0)
+    result['output'] = list(tail)
+    return result
+
+
+async def run_all_async(calls, max_parallel=1):
+    """This function runs a list of run_async keyword arguments, max_parallel at a time"""
+    max_parallel = max(int(max_parallel), 1)
+    semaphore = asyncio.Semaphore(max_parallel)
+    # Every running command may have a consumer blocked on its pipe, so give each a thread.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max_parallel))
+
+    async def bounded(call):
+        """This function runs a single command once there is room for it"""
+        async with semaphore:
+            return await run_async(**call)
+
+    return await asyncio.gather(*(bounded(call) for call in calls))
+
+
+def run(commands, **kwargs):
+    """This function runs a command from synchronous code, see run_async for the arguments"""
+    return asyncio.run(run_async(commands, **kwargs))
+
+
+def run_many(calls, max_parallel=1):
+    """This function runs several commands at once from synchronous code, results in order"""
+    return asyncio.run(run_all_async(calls, max_parallel))
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Scheduler class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This library will load a directory of job configs and run them
+                        in a single process, honouring a global concurrency cap, per host
+                        caps and job priorities, with a lock file per job. Jobs of the same
+                        priority start longest first, going by their run history.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import os  # Used to find the config files and lock files
+import json  # Used to read the job settings out of each config file
+import fcntl  # Used to lock each job so that runs of the same job never overlap
+import threading  # Used to run the jobs concurrently
+import contextlib  # Used to build the job lock context manager
+
+# Import Nimbus class libraries
+from libs.history import history_path, estimated_seconds  # Used to start the longest jobs first
+
+# Config file extensions picked up from the config directory.
+CONFIG_EXTENSIONS = ('.ini', '.conf', '.json')
+LOCK_DIR = '/var/run/nimbus'
+
+
+class JobLocked(Exception):
+    """This exception is raised when another run of the same job holds its lock"""
+    pass
+
+
+@contextlib.contextmanager
+def job_lock(job_name, lock_dir=LOCK_DIR):
+    """This function holds an exclusive lock file for a job while it runs"""
+    if not os.path.isdir(lock_dir):
+        os.makedirs(lock_dir)
+    lock_path = os.path.join(lock_dir, job_name + '.lock')
+    lock_file = open(lock_path, 'a+')
+    try:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise JobLocked(job_name + " is already running (" + lock_path + ")")
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(os.getpid()) + "\n")
+        lock_file.flush()
+        yield lock_path
+    finally:
+        lock_file.close()
+
+
+def job_host(server_config):
+    """This function works out which host a job puts its load on"""
+    if 'host' in server_config:
+        return str(server_config['host'])
+    module_args = server_config.get('module_args', {})
+    for host_arg in ('pg_host', 'mysql_host'):
+        if host_arg in module_args:
+            return str(module_args[host_arg])
+    return 'localhost'
+
+
+def load_jobs(config_dir):
+    """This function loads every job config in a directory, highest priority and longest first"""
+    jobs = []
+    for file_name in sorted(os.listdir(config_dir)):
+        config_file = os.path.join(config_dir, file_name)
+        if not file_name.endswith(CONFIG_EXTENSIONS) or not os.path.isfile(config_file):
+            continue
+        try:
+            with open(config_file, encoding='utf-8') as config:
+                server_config = json.loads(config.read())
+        except ValueError as err:
+            print("WARNING: " + config_file + " skipped, it is not valid JSON ({0})".format(err))
+            continue
+        if 'backup_job' not in server_config:
+            print("WARNING: " + config_file + " skipped, it does not set 'backup_job'")
+            continue
+
+        try:
+            priority = int(server_config.get('priority', 0))
+        except (TypeError, ValueError):
+            print("WARNING: " + config_file + " skipped, its 'priority' is not a number")
+            continue
+
+        job_name = os.path.splitext(file_name)[0]
+        metrics_settings = server_config.get('metrics', {})
+        if not isinstance(metrics_settings, dict):
+            metrics_settings = {}
+        jobs.append({'name': job_name, 'config': config_file,
+                     'backup_job': str(server_config['backup_job']),
+                     'priority': priority,
+                     'host': job_host(server_config),
+                     'estimate': estimated_seconds(history_path(job_name, metrics_settings))})
+
+    # Higher priorities run first, then the longest jobs so that they do not finish last. The
+    # sort is stable, so jobs without a history keep their file order after the others.
+    jobs.sort(key=lambda job: (-job['priority'], -job['estimate']))
+    return jobs
+
+
+def run_all(jobs, run_job, max_parallel=4, max_per_host=1):
+    """This function runs the jobs with a global and a per host concurrency cap"""
+    # A cap below 1 would leave every job waiting for a slot that never frees up.
+    if max_parallel < 1 or max_per_host < 1:
+        raise SystemExit(" ERROR: max_parallel and max_per_host must be at least 1.")
+    pending = list(jobs)
+    running = {}
+    results = {}
+    condition = threading.Condition()
+
+    def worker(job):
+        """This function runs a single job and frees its slot when it is done"""
+        try:
+            results[job['name']] = {'status': 'ok', 'result': run_job(job)}
+        except JobLocked as err:
+            results[job['name']] = {'status': 'skipped', 'error': str(err)}
+        except BaseException as err:  # Jobs report their errors with SystemExit
+            results[job['name']] = {'status': 'failed', 'error': str(err)}
+        with condition:
+            running[job['host']] -= 1
+            condition.notify_all()
+
+    threads = []
+    with condition:
+        while pending:
+            # Start the highest priority job whose host still has room.
+            busy = sum(running.values())
+            startable = [job for job in pending
+                         if running.get(job['host'], 0) < max_per_host]
+            if busy >= max_parallel or not startable:
+                condition.wait()
+                continue
+            job = startable[0]
+            pending.remove(job)
+            running[job['host']] = running.get(job['host'], 0) + 1
+            print("Scheduler: starting " + job['name'] + " (" + job['backup_job'] +
+                  " on " + job['host'] + ", priority " + str(job['priority']) + ")")
+            thread = threading.Thread(target=worker, args=(job,))
+            thread.start()
+            threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return results
@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Streaming Tar class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This class will write a tar archive straight into the local
+                        backup directory, piping the output of the dump tools through
+                        the compressor and into the archive without a /tmp staging copy.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import os  # Used to stat and remove the spool files
+import time  # Used to stamp the streamed archive members
+import shutil  # Used to copy the streams into the archive
+import tarfile  # Used to build the tar headers of the archive members
+import threading  # Used to serialize writes into the archive
+
+# Import Nimbus class libraries
+from libs.compression import member_pipeline, member_writer  # Used to compress the members
+from libs.metrics import record  # Used to record the time and size of each dump
+from libs.runner import run_many  # Used to run the dumps in parallel
+from libs.throttle import throttled  # Used to hold the archive writes to the rate limit
+
+# Size of the buffer used when copying the streams.
+COPY_BUFSIZE = 1024 * 1024
+
+
+class CountingReader(object):
+    """This class counts the bytes read from a stream"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        """This function reads from the stream, adding up what was read"""
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class StreamingTar(object):
+    """This class writes a tar archive whose members can be streamed in without a known size"""
+
+    def __init__(self, tar_path, limiter=None):
+        self.tar_path = tar_path
+        self.lock = threading.Lock()
+        try:
+            self.fileobj = throttled(open(self.tar_path, 'wb'), limiter)
+        except OSError as err:
+            print("OS error: {0}".format(err))
+            raise SystemError(" ERROR: " + tar_path + " could not be created.")
+
+    @staticmethod
+    def header(arcname, size, mtime, mode=0o644):
+        """This function builds the tar header block(s) of a regular file member"""
+        info = tarfile.TarInfo(arcname)
+        info.size = size
+        info.mtime = mtime
+        info.mode = mode
+        # The GNU format stores huge sizes in place, so the header length never depends on size.
+        return info.tobuf(tarfile.GNU_FORMAT, tarfile.ENCODING, 'surrogateescape')
+
+    def pad(self, size):
+        """This function pads the current member up to the next tar block"""
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+    def add_stream(self, arcname, stream, compression=None):
+        """This function compresses a stream into a new member, then patches in the final size"""
+        mtime = int(time.time())
+        header_offset = self.fileobj.tell()
+        placeholder = self.header(arcname, 0, mtime)
+        self.fileobj.write(placeholder)
+        data_offset = self.fileobj.tell()
+
+        # Compress the stream directly into the archive.
+        with member_writer(self.fileobj, os.path.basename(arcname), compression) as member:
+            shutil.copyfileobj(stream, member, COPY_BUFSIZE)
+
+        size = self.fileobj.tell() - data_offset
+        self.pad(size)
+        end_offset = self.fileobj.tell()
+
+        # Now that the size is known, rewrite the header in place.
+        self.fileobj.seek(header_offset)
+        self.fileobj.write(self.header(arcname, size, mtime))
+        self.fileobj.seek(end_offset)
+        return size
+
+    def add_file(self, file_path, arcname):
+        """This function copies an existing file into a new member of the archive"""
+        stat = os.stat(file_path)
+        self.fileobj.write(self.header(arcname, stat.st_size, int(stat.st_mtime),
+                                       stat.st_mode & 0o7777))
+        with open(file_path, 'rb') as source:
+            shutil.copyfileobj(source, self.fileobj, COPY_BUFSIZE)
+        self.pad(stat.st_size)
+
+    def close(self):
+        """This function writes the end of archive marker and closes the archive"""
+        self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        remainder = self.fileobj.tell() % tarfile.RECORDSIZE
+        if remainder:
+            self.fileobj.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+        self.fileobj.close()
+
+
+def dump_consumer(archive, job_log_header, arcname, compression=None):
+    """This function returns the consumer that writes the stdout of a dump into the archive"""
+
+    def consume(pipe):
+        """This function streams the dump into a member, returning the bytes in and out"""
+        if job_log_header is not None:
+            print(job_log_header)
+        dump_output = CountingReader(pipe)
+
+        # If nobody else is writing to the archive, stream straight into it. Otherwise compress
+        # the dump into a spool file next to the archive and splice it in once it is complete.
+        if archive.lock.acquire(blocking=False):
+            try:
+                bytes_out = archive.add_stream(arcname, dump_output, compression)
+            finally:
+                archive.lock.release()
+        else:
+            spool_path = archive.tar_path + "." + os.path.basename(arcname) + ".spool"
+            with open(spool_path, 'wb') as spool:
+                with member_writer(spool, os.path.basename(arcname), compression) as member:
+                    shutil.copyfileobj(dump_output, member, COPY_BUFSIZE)
+            bytes_out = os.path.getsize(spool_path)
+            with archive.lock:
+                archive.add_file(spool_path, arcname)
+            os.remove(spool_path)
+        return dump_output.bytes_read, bytes_out
+
+    return consume
+
+
+def stream_dumps(archive, dump_list, max_parallel_dumps=1, compression=None, metrics=None,
+                 timeout=None, log=None, env=None):
+    """This function streams a list of (job_log_header, dump_argv, arcname, database) dumps"""
+    results = run_many([{'commands': member_pipeline(dump_argv, compression),
+                         'consume': dump_consumer(archive, job_log_header, arcname, compression),
+                         'timeout': timeout, 'log': log, 'label': database, 'env': env}
+                        for job_log_header, dump_argv, arcname, database in dump_list],
+                       max_parallel_dumps)
+
+    for (_, _, _, database), result in zip(dump_list, results):
+        bytes_in, bytes_out = result['consumed'] or (None, None)
+        record(metrics, 'dump', result['seconds'], result['cpu'], bytes_in, bytes_out,
+               database=database)
+
+    return [(job_log_header, result) for (job_log_header, _, _, _), result
+            in zip(dump_list, results)]
@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Throttle class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This library will apply the resource policy of a job, lowering the
+                        CPU and I/O priority of the backup, pinning it to a set of CPUs and
+                        holding the archive writes and copies to a number of bytes per
+                        second, optionally backing off further when the database slows down.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import os  # Used to set the nice value and the CPU affinity
+import time  # Used to pace the writes and time the latency probes
+import shlex  # Used to split a probe command given as a string
+import threading  # Used to share the rate limit between threads and run the probe thread
+import subprocess  # Used to run ionice and to discard the output of the latency probe
+
+# Import Nimbus class libraries
+from libs.runner import run  # Used to run the latency probe with a timeout
+
+# The ionice scheduling classes, by the names used in the config file.
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+# Suffixes accepted on rates, "50M" is 50 MiB per second.
+RATE_UNITS = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+
+# How the adaptive mode backs off when the probe is slow, and recovers when it is fast again.
+BACKOFF_FACTOR = 0.5
+RECOVER_FACTOR = 1.5
+
+
+def parse_rate(rate):
+    """This function turns a rate such as 50M into bytes per second, None means unlimited"""
+    if rate is None or rate == '':
+        return None
+    rate = str(rate).strip().upper()
+    if rate.endswith('B'):
+        rate = rate[:-1]
+    multiplier = 1
+    if rate and rate[-1] in RATE_UNITS:
+        multiplier = RATE_UNITS[rate[-1]]
+        rate = rate[:-1]
+    try:
+        rate = int(float(rate) * multiplier)
+    except ValueError:
+        raise SystemExit(" ERROR: '" + str(rate) + "' is not a valid rate, use bytes per second"
+                         " with an optional K, M or G suffix")
+    if rate <= 0:
+        raise SystemExit(" ERROR: Rates in the resource policy must be greater than zero")
+    return rate
+
+
+def parse_cpus(cpus):
+    """This function turns a CPU list such as "0-3,6" or [0, 1] into a set of CPU numbers"""
+    if isinstance(cpus, int):
+        return {cpus}
+    if isinstance(cpus, list):
+        return set(int(cpu) for cpu in cpus)
+    cpu_set = set()
+    for part in str(cpus).split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpu_set.update(range(int(first), int(last) + 1))
+        elif part:
+            cpu_set.add(int(part))
+    return cpu_set
+
+
+class RateLimiter(object):
+    """This class is a token bucket shared by every writer of a job"""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.bytes_total = 0
+
+    def set_rate(self, rate):
+        """This function changes the rate, None lets the writes through at full speed"""
+        with self.lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, 0.0)
+            self.updated = time.monotonic()
+
+    def consume(self, size):
+        """This function takes size bytes out of the bucket, sleeping until they are paid for"""
+        with self.lock:
+            self.bytes_total += size
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            # The bucket holds at most a second worth of bytes, so idle time is not banked.
+            self.tokens = min(float(self.rate), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        # The debt is shared, so concurrent writers queue up behind each other.
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThrottledFile(object):
+    """This class paces the writes to a file object through a rate limiter"""
+
+    def __init__(self, fileobj, limiter):
+        self.fileobj = fileobj
+        self.limiter = limiter
+
+    def write(self, data):
+        """This function waits for the rate limiter, then writes the data"""
+        self.limiter.consume(len(data))
+        return self.fileobj.write(data)
+
+    def __getattr__(self, name):
+        # Everything else, such as tell, seek and close, goes straight to the file.
+        return getattr(self.fileobj, name)
+
+
+def throttled(fileobj, limiter):
+    """This function wraps a file object in the rate limiter, if there is one"""
+    if limiter is None:
+        return fileobj
+    return ThrottledFile(fileobj, limiter)
+
+
+class LatencyGovernor(object):
+    """This class runs a probe query in the background and slows the job down when it is slow"""
+
+    def __init__(self, limiter, probe_command, threshold_ms=50, interval=5, min_rate=None,
+                 max_rate=None):
+        self.limiter = limiter
+        # The probe is run without a shell, a string is split the way a shell would split it.
+        if isinstance(probe_command, str):
+            probe_command = shlex.split(probe_command)
+        if not probe_command:
+            raise SystemExit(" ERROR: The probe_command of the adaptive resource policy is empty")
+        self.probe_command = [str(arg) for arg in probe_command]
+        self.threshold = float(threshold_ms) / 1000
+        self.interval = float(interval)
+        # A probe that never returns would stop the governor, so it is given up on in time.
+        self.timeout = max(self.interval, self.threshold * 2)
+        self.min_rate = min_rate if min_rate is not None else 1024 * 1024
+        self.max_rate = max_rate
+        self.backoffs = 0
+        self.slowest = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def probe(self):
+        """This function times a single run of the probe query, None if it failed"""
+        try:
+            # The output of the probe is of no interest, only how long it took and if it worked.
+            result = run(self.probe_command, stdout=subprocess.DEVNULL, timeout=self.timeout,
+                         log=lambda line: None)
+        except SystemError:
+            return None
+        if result['timed_out']:
+            # The probe was killed, a database that slow is well past the threshold.
+            return result['seconds']
+        if result['returncode'] != 0:
+            return None
+        return result['seconds']
+
+    def run(self):
+        """This function probes every interval, halving the rate while the probe is too slow"""
+        last_bytes = self.limiter.bytes_total
+        last_time = time.monotonic()
+        while not self.stopped.wait(self.interval):
+            latency = self.probe()
+            now = time.monotonic()
+            # What the job actually managed over the interval, to back off from full speed.
+            observed = (self.limiter.bytes_total - last_bytes) / max(now - last_time, 0.001)
+            last_bytes, last_time = self.limiter.bytes_total, now
+            if latency is None:
+                continue
+            self.slowest = max(self.slowest, latency)
+
+            rate = self.limiter.rate
+            if latency > self.threshold:
+                if rate is None:
+                    rate = max(observed, self.min_rate)
+                self.limiter.set_rate(max(int(rate * BACKOFF_FACTOR), self.min_rate))
+                self.backoffs += 1
+            elif rate is not None and latency < self.threshold / 2:
+                rate = int(rate * RECOVER_FACTOR)
+                if self.max_rate is not None:
+                    rate = min(rate, self.max_rate)
+                elif rate > observed * 2:
+                    # The limit no longer holds the job back, so let it run at full speed.
+                    rate = None
+                self.limiter.set_rate(rate)
+
+    def start(self):
+        """This function starts probing"""
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """This function stops probing"""
+        self.stopped.set()
+        self.thread.join()
+
+
+def set_ionice(ionice_class, ionice_level=None):
+    """This function sets the I/O scheduling class of the calling thread with ionice"""
+    if isinstance(ionice_class, str) and not ionice_class.isdigit():
+        if ionice_class.lower() not in IONICE_CLASSES:
+            raise SystemExit(" ERROR: Unknown ionice class '" + ionice_class + "', valid classes"
+                             " are: " + ", ".join(sorted(IONICE_CLASSES)))
+        ionice_class = IONICE_CLASSES[ionice_class.lower()]
+    ionice_cmd = ['ionice', '-c', str(ionice_class)]
+    # The idle class has no levels.
+    if ionice_level is not None and int(ionice_class) != IONICE_CLASSES['idle']:
+        ionice_cmd += ['-n', str(ionice_level)]
+    # ionice works on thread ids, so only this thread and what it starts from now on change.
+    ionice_cmd += ['-p', str(threading.get_native_id())]
+    try:
+        return subprocess.call(ionice_cmd, stderr=subprocess.DEVNULL) == 0
+    except FileNotFoundError:
+        return False
+
+
+class ResourcePolicy(object):
+    """This class applies the resource_policy settings of a job"""
+
+    def __init__(self, policy=None):
+        if policy is None:
+            policy = {}
+        self.nice = policy.get('nice')
+        self.ionice_class = policy.get('ionice_class')
+        self.ionice_level = policy.get('ionice_level')
+        self.cpu_affinity = policy.get('cpu_affinity')
+        self.rate_limit = parse_rate(policy.get('rate_limit'))
+        self.adaptive = policy.get('adaptive')
+        self.limiter = None
+        self.governor = None
+        if self.rate_limit is not None or self.adaptive:
+            self.limiter = RateLimiter(self.rate_limit)
+        if self.adaptive:
+            if 'probe_command' not in self.adaptive:
+                raise SystemExit(" ERROR: The adaptive resource policy needs a probe_command")
+            self.governor = LatencyGovernor(self.limiter, self.adaptive['probe_command'],
+                                            self.adaptive.get('threshold_ms', 50),
+                                            self.adaptive.get('interval', 5),
+                                            parse_rate(self.adaptive.get('min_rate')),
+                                            self.rate_limit)
+
+    def apply(self):
+        """This function lowers the priority of the calling thread, returning what was set"""
+        # On Linux the nice value, I/O class and affinity are per thread, and the threads and
+        # processes the job starts inherit them, so concurrent jobs can each have their own.
+        applied = []
+        if self.nice is not None:
+            try:
+                os.setpriority(os.PRIO_PROCESS, 0, int(self.nice))
+                applied.append("nice " + str(self.nice))
+            except PermissionError:
+                print("WARNING: nice " + str(self.nice) + " could not be set")
+        if self.ionice_class is not None:
+            if set_ionice(self.ionice_class, self.ionice_level):
+                applied.append("ionice " + str(self.ionice_class) +
+                               ("" if self.ionice_level is None else " " + str(self.ionice_level)))
+            else:
+                print("WARNING: ionice " + str(self.ionice_class) + " could not be set")
+        if self.cpu_affinity is not None:
+            try:
+                cpus = parse_cpus(self.cpu_affinity)
+                os.sched_setaffinity(0, cpus)
+                applied.append("cpus " + ",".join(str(cpu) for cpu in sorted(cpus)))
+            except (OSError, ValueError):
+                print("WARNING: CPU affinity " + str(self.cpu_affinity) + " could not be set")
+        if self.rate_limit is not None:
+            applied.append("rate limit " + str(self.rate_limit) + " bytes/s")
+        if self.governor is not None:
+            applied.append("adaptive above " + str(self.adaptive.get('threshold_ms', 50)) + " ms")
+        return applied
+
+    def __enter__(self):
+        """This function starts the latency probe of the adaptive mode for a with block"""
+        if self.governor is not None:
+            self.governor.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        """This function stops the latency probe at the end of the with block"""
+        if self.governor is not None:
+            self.governor.stop()
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Verify class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This library will write the checksum sidecar of each backup archive,
+                        and re-hash every copy in the backup directories in parallel to find
+                        the copies that no longer match their sidecar.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import os  # Used to find the sidecars in the backup directories
+import mmap  # Used to hash the archives without copying them through python buffers
+import hashlib  # Used to hash the archives
+from concurrent.futures import ThreadPoolExecutor  # Used to hash the archives in parallel
+
+# Import Nimbus class libraries
+from libs.chunkstore import MANIFEST_EXTENSION, reassemble  # Used to verify chunk stores
+from libs.objectstore import Bucket  # Used to verify the copies in object stores
+
+# Sidecars use the sha256sum format so that they can also be checked by hand.
+SIDECAR_EXTENSION = '.sha256'
+HASH_SLICE = 64 * 1024 * 1024
+VERIFY_WORKERS = 8
+
+
+def write_sidecar(archive_path, checksum):
+    """This function writes the checksum sidecar of an archive, matching its mtime"""
+    sidecar_path = archive_path + SIDECAR_EXTENSION
+    with open(sidecar_path, 'w') as sidecar:
+        sidecar.write(checksum + "  " + os.path.basename(archive_path) + "\n")
+    if os.path.exists(archive_path):
+        stat = os.stat(archive_path)
+        os.utime(sidecar_path, (stat.st_atime, stat.st_mtime))
+    return sidecar_path
+
+
+def read_sidecar(sidecar_path):
+    """This function returns the checksum recorded in a sidecar"""
+    with open(sidecar_path) as sidecar:
+        return sidecar.read().split()[0]
+
+
+def hash_archive(archive_path):
+    """This function hashes an archive through a memory map, in slices that release the GIL"""
+    checksum = hashlib.sha256()
+    with open(archive_path, 'rb') as archive:
+        if os.fstat(archive.fileno()).st_size == 0:
+            return checksum.hexdigest()
+        with mmap.mmap(archive.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, len(mapped), HASH_SLICE):
+                    checksum.update(view[offset:offset + HASH_SLICE])
+            finally:
+                view.release()
+    return checksum.hexdigest()
+
+
+class NullWriter(object):
+    """This class throws away the data of a reassembled archive"""
+
+    def write(self, data):
+        """This function discards the data"""
+        return len(data)
+
+
+def verify_copy(archive_path, expected, bucket=None):
+    """This function re-hashes a single copy and compares it to its expected checksum"""
+    result = {'path': archive_path, 'expected': expected, 'actual': None, 'status': 'ok'}
+    try:
+        if bucket is not None:
+            # Object store copies are streamed back out of the bucket and hashed on the way.
+            result['path'] = bucket.url(archive_path)
+            result['actual'] = bucket.hash(archive_path)
+            if result['actual'] != expected:
+                result['status'] = 'mismatch'
+        elif archive_path.endswith(MANIFEST_EXTENSION):
+            # Chunk stores check every chunk and the whole archive while reassembling it.
+            store_path = os.path.dirname(archive_path)
+            archive_name = os.path.basename(archive_path)[:-len(MANIFEST_EXTENSION)]
+            reassemble(store_path, archive_name, NullWriter())
+        elif not os.path.exists(archive_path):
+            result['status'] = 'missing'
+        else:
+            result['actual'] = hash_archive(archive_path)
+            if result['actual'] != expected:
+                result['status'] = 'mismatch'
+    except (OSError, SystemError, ValueError) as err:
+        result['status'] = 'error: ' + str(err)
+    return result
+
+
+def find_bucket_copies(bucket):
+    """This function lists every archive copy in an object store that has a sidecar"""
+    names = set(listed['name'] for listed in bucket.list())
+    copies = []
+    for name in sorted(names):
+        if name.endswith(SIDECAR_EXTENSION):
+            archive_name = name[:-len(SIDECAR_EXTENSION)]
+            expected = bucket.read(name).decode().split()[0]
+            if archive_name in names:
+                copies.append((archive_name, expected, bucket))
+            else:
+                # A sidecar without its archive is reported as missing, like on a filesystem.
+                copies.append((bucket.url(archive_name), expected, None))
+    return copies
+
+
+def find_copies(dir_paths):
+    """This function lists every archive copy that has a sidecar or a chunk store manifest"""
+    copies = []
+    for dir_path in dir_paths:
+        if isinstance(dir_path, Bucket):
+            copies.extend(find_bucket_copies(dir_path))
+            continue
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.name.endswith(SIDECAR_EXTENSION):
+                    copies.append((entry.path[:-len(SIDECAR_EXTENSION)], read_sidecar(entry.path),
+                                   None))
+                elif entry.name.endswith(MANIFEST_EXTENSION):
+                    copies.append((entry.path, None, None))
+    return copies
+
+
+def verify(dir_paths, workers=VERIFY_WORKERS):
+    """This function re-hashes every copy in the backup directories in parallel"""
+    copies = find_copies(dir_paths)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(verify_copy, archive_path, expected, bucket)
+                   for archive_path, expected, bucket in copies]
+        return [future.result() for future in futures]
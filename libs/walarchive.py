@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				WAL Archive class
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This library will compress the WAL files of a database and copy
+                        them to the wal sub directory of every backup directory, either one
+                        at a time from an archive_command or continuously from a WAL
+                        receiver. WAL is kept for as long as a base backup still needs it.
+***************************************************************************
+"""
+
+# Define all modules that this library will utilize
+import io  # Used to read the WAL files back out of object stores
+import os  # Used to find, compress and remove the WAL files
+import re  # Used to read the segment names
+import time  # Used to pace the WAL receiver loop
+import signal  # Used to stop the WAL receiver cleanly
+import shutil  # Used to copy the WAL files through the codecs
+import subprocess  # Used to run the WAL receiver and the external compressors
+
+# Import Nimbus class libraries
+from libs.compression import CODECS, get_codec, name_codec  # Used to pick the WAL codec
+from libs.compression import member_writer, member_reader, member_extension  # Used to compress
+from libs.fanout import FileSink, fan_out, VOLUME_NAME, PART_EXTENSION  # Used to copy the WAL
+from libs.objectstore import Bucket  # Used to reach the wal directory of object stores
+from libs.verify import write_sidecar, SIDECAR_EXTENSION  # Used to checksum the local WAL copy
+
+# The WAL of a backup directory is kept in a sub directory, so the archive listings, retention
+# sweeps and restores of the backup directory itself never see it.
+WAL_DIR = 'wal'
+
+# WAL file names are the timeline followed by the log and segment number, all in hex. Across
+# timelines the last 16 digits still only go up, so they are what retention compares.
+SEGMENT_NAME = re.compile(r'^(?P<timeline>[0-9A-F]{8})(?P<position>[0-9A-F]{16})')
+HISTORY_NAME = re.compile(r'^[0-9A-F]{8}\.history$')
+PARTIAL_EXTENSION = '.partial'
+
+# Every base backup leaves a marker next to the WAL, named after its archive and the first
+# segment it needs: postgres_<date>.tar.gz.<segment>.start
+START_EXTENSION = '.start'
+
+# How often the receiver spool is checked for finished WAL files, how often the segment that
+# is still being written is copied as well, and how long to wait before restarting a receiver.
+POLL_INTERVAL = 1.0
+PARTIAL_INTERVAL = 60
+RESTART_BACKOFF = 5.0
+COPY_BUFSIZE = 1024 * 1024
+
+
+def wal_location(location):
+    """This function returns the wal directory of a backup directory path or bucket"""
+    if isinstance(location, Bucket):
+        return location.subdirectory(WAL_DIR)
+    return os.path.join(location, WAL_DIR)
+
+
+def wal_sinks(backup_dirs, locations, file_name):
+    """This function returns the sinks that copy a WAL file to the remote backup directories"""
+    sinks = []
+    for directory, location in zip(backup_dirs, locations):
+        # Each WAL file is unique and already compressed, chunk stores would gain nothing.
+        if directory.type in ("local", "chunkstore"):
+            continue
+        wal_path = wal_location(location)
+        if isinstance(wal_path, Bucket):
+            sinks.append(wal_path.sink(directory.label, "/" + file_name))
+            continue
+        try:
+            os.makedirs(wal_path, exist_ok=True)
+        except OSError:
+            # The copy itself reports the directory that can't be reached.
+            pass
+        sinks.append(FileSink(directory.label, os.path.join(wal_path, file_name)))
+    return sinks
+
+
+def compress_wal(file_path, target_path, compression=None):
+    """This function compresses a WAL file into target_path, through a temporary file"""
+    codec, level = get_codec(compression)
+    part_path = target_path + PART_EXTENSION
+    with open(file_path, 'rb') as source, open(part_path, 'wb') as target:
+        if 'command' in CODECS[codec]:
+            compress_cmd = CODECS[codec]['command'].format(level=level).split()
+            if subprocess.call(compress_cmd, stdin=source, stdout=target) != 0:
+                raise SystemError(" ERROR: " + file_path + " could not be compressed with " +
+                                  codec)
+        else:
+            with member_writer(target, os.path.basename(file_path), compression) as writer:
+                shutil.copyfileobj(source, writer, COPY_BUFSIZE)
+        target.flush()
+        os.fsync(target.fileno())
+    os.replace(part_path, target_path)
+    return target_path
+
+
+def decompress_wal(fileobj, file_name, target_path):
+    """This function decompresses a WAL copy into target_path, through a temporary file"""
+    codec = name_codec(file_name)
+    part_path = target_path + PART_EXTENSION
+    with open(part_path, 'wb') as target:
+        if 'decompress_command' in CODECS[codec]:
+            if subprocess.run(CODECS[codec]['decompress_command'].split(), input=fileobj.read(),
+                              stdout=target).returncode != 0:
+                raise SystemError(" ERROR: " + file_name + " could not be decompressed with " +
+                                  codec)
+        else:
+            with member_reader(fileobj, file_name) as reader:
+                shutil.copyfileobj(reader, target, COPY_BUFSIZE)
+        target.flush()
+        os.fsync(target.fileno())
+    os.replace(part_path, target_path)
+    return target_path
+
+
+def copy_wal(local_path, backup_dirs, locations, limiter=None):
+    """This function copies a file of the local wal directory to the remote backup directories"""
+    checksum, results = fan_out(local_path, wal_sinks(backup_dirs, locations,
+                                                      os.path.basename(local_path)),
+                                limiter=limiter)
+    write_sidecar(local_path, checksum)
+    return results
+
+
+def ship_wal(file_path, localdir, backup_dirs, locations, compression=None, limiter=None):
+    """This function compresses a WAL file into the local wal directory and copies it out"""
+    wal_dir = wal_location(localdir)
+    if not os.path.isdir(wal_dir):
+        os.makedirs(wal_dir)
+    file_name = os.path.basename(file_path)
+    local_path = compress_wal(file_path, os.path.join(wal_dir, file_name +
+                                                      member_extension(compression)),
+                              compression)
+    results = copy_wal(local_path, backup_dirs, locations, limiter)
+
+    # Once a segment is finished, the local copy of it that was taken while it was still being
+    # written is of no more use. The remote ones go with the WAL retention.
+    partial_path = os.path.join(wal_dir, file_name + PARTIAL_EXTENSION +
+                                member_extension(compression))
+    if SEGMENT_NAME.match(file_name) and not file_name.endswith(PARTIAL_EXTENSION) and \
+            all(result['error'] is None for result in results):
+        for stale_path in (partial_path, partial_path + SIDECAR_EXTENSION):
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+    return local_path, results
+
+
+def write_start_marker(localdir, archive_name, segment):
+    """This function records the first WAL segment that a base backup needs"""
+    wal_dir = wal_location(localdir)
+    if not os.path.isdir(wal_dir):
+        os.makedirs(wal_dir)
+    marker_path = os.path.join(wal_dir, archive_name.lstrip('/') + '.' + segment +
+                               START_EXTENSION)
+    open(marker_path, 'w').close()
+    return marker_path
+
+
+def find_start_marker(localdir, archive_name):
+    """This function returns the WAL start marker of a base backup, or None if it has none"""
+    wal_dir = wal_location(localdir)
+    prefix = archive_name.lstrip('/') + '.'
+    for name in list_names(wal_dir):
+        if name.startswith(prefix) and name.endswith(START_EXTENSION):
+            return os.path.join(wal_dir, name)
+    return None
+
+
+def list_names(location):
+    """This function lists the file names of a backup directory or its wal directory"""
+    if isinstance(location, Bucket):
+        return [listed['name'] for listed in location.list()]
+    try:
+        return os.listdir(location)
+    except FileNotFoundError:
+        return []
+
+
+def sweep_wal(location, removed_names, dry_run=False):
+    """This function removes the WAL that none of the remaining base backups of a directory need"""
+    wal_path = wal_location(location)
+    result = {'path': wal_path.path if isinstance(wal_path, Bucket) else wal_path,
+              'removed': [], 'errors': [], 'keep_from': None}
+    names = list_names(wal_path)
+    if not names:
+        return result
+
+    # A marker goes once its base backup has left the backup directory. The volumes of a split
+    # copy count as the archive they make up.
+    archives = set(VOLUME_NAME.sub('', name) for name in list_names(location)) - \
+        set(VOLUME_NAME.sub('', name) for name in removed_names)
+    expired = []
+    starts = []
+    for name in names:
+        if not name.endswith(START_EXTENSION):
+            continue
+        archive_name, segment = name[:-len(START_EXTENSION)].rsplit('.', 1)
+        if archive_name in archives:
+            starts.append(segment)
+        else:
+            expired.extend([name, name + SIDECAR_EXTENSION])
+
+    # Without a base backup there is nothing to replay the WAL onto, but nothing is removed
+    # either, the base backup may just not have been copied here yet.
+    if starts:
+        result['keep_from'] = min(starts, key=lambda segment: segment[8:])
+        keep_from = result['keep_from'][8:]
+        for name in names:
+            match = SEGMENT_NAME.match(name)
+            # Timeline history files don't match, they are tiny and needed to follow a timeline.
+            if match and match.group('position') < keep_from:
+                expired.append(name)
+
+    expired = [name for name in expired if name in names]
+    if isinstance(wal_path, Bucket):
+        result['removed'] = [wal_path.url(name) for name in expired]
+        if not dry_run and expired:
+            result['errors'] = wal_path.delete(expired)
+        return result
+
+    for name in expired:
+        result['removed'].append(os.path.join(wal_path, name))
+        if not dry_run:
+            try:
+                os.remove(os.path.join(wal_path, name))
+            except OSError as err:
+                result['errors'].append((os.path.join(wal_path, name), str(err)))
+    return result
+
+
+def fetch_wal(locations, file_name, target_path):
+    """This function restores a WAL file from the first backup directory that has a copy of it"""
+    # Recovery asks for one file at a time, and for a few that were never archived, so the
+    # directories are simply tried in order instead of probed. The last segment may only
+    # have been copied while it was still being written.
+    extensions = sorted(set(settings['extension'] for settings in CODECS.values()))
+    names = [file_name + extension for extension in extensions] + \
+        [file_name + PARTIAL_EXTENSION + extension for extension in extensions]
+    for location in locations:
+        wal_path = wal_location(location)
+        for name in names:
+            try:
+                if isinstance(wal_path, Bucket):
+                    fileobj = io.BytesIO(wal_path.read(name))
+                else:
+                    fileobj = open(os.path.join(wal_path, name), 'rb')
+            except (OSError, SystemError):
+                continue
+            with fileobj:
+                decompress_wal(fileobj, name, target_path)
+            return wal_path.url(name) if isinstance(wal_path, Bucket) else \
+                os.path.join(wal_path, name)
+    return None
+
+
+def spool_files(spool_dir):
+    """This function lists the finished WAL files of a receiver spool in order, and the partial"""
+    finished = []
+    partial = None
+    for name in sorted(os.listdir(spool_dir)):
+        match = SEGMENT_NAME.match(name)
+        if match and name == match.group(0):
+            finished.append(name)
+        elif match and name == match.group(0) + PARTIAL_EXTENSION:
+            partial = name
+        elif HISTORY_NAME.match(name):
+            finished.append(name)
+    return finished, partial
+
+
+def receive_wal(receive_argv, spool_dir, ship, stop, partial_interval=PARTIAL_INTERVAL,
+                env=None, log=None):
+    """This function runs a WAL receiver and ships every WAL file it writes until it is stopped"""
+    if not os.path.isdir(spool_dir):
+        os.makedirs(spool_dir)
+    if env is not None:
+        env = dict(os.environ, **env)
+
+    receiver = None
+    shipped = set()
+    partial_state = None
+    partial_shipped = 0
+    restarts = 0
+    stats = {'shipped': 0, 'failed': 0, 'partials': 0}
+    try:
+        while True:
+            stopping = stop.is_set()
+            if stopping and receiver is not None and receiver.poll() is None:
+                # Let the receiver write out what it has before the last pass over the spool.
+                receiver.send_signal(signal.SIGINT)
+                receiver.wait()
+            # The receiver exits when the server goes away. What it wrote is shipped first, then
+            # it is started again after a pause.
+            if not stopping and receiver is not None and receiver.poll() is not None:
+                restarts += 1
+                if log is not None:
+                    log(receive_argv[0] + " exited with code " + str(receiver.returncode) +
+                        ", restarting it")
+                receiver = None
+            elif not stopping and receiver is None:
+                receiver = subprocess.Popen(receive_argv, env=env)
+
+            # Ship the finished files oldest first. The newest segment stays in the spool, the
+            # receiver works out where to carry on from the files it finds there.
+            finished, partial = spool_files(spool_dir)
+            segments = [name for name in finished if not HISTORY_NAME.match(name)]
+            for name in finished:
+                if name not in shipped:
+                    if ship(os.path.join(spool_dir, name)):
+                        shipped.add(name)
+                        stats['shipped'] += 1
+                    else:
+                        stats['failed'] += 1
+                        break
+                if name in shipped and (not segments or name != segments[-1]):
+                    os.remove(os.path.join(spool_dir, name))
+                    shipped.discard(name)
+
+            # The segment that is still being written is copied every so often as well, which
+            # is all a restore has of the last minutes before a crash. It is copied straight
+            # away once the receiver is gone, as nothing more is written to it.
+            if partial is not None:
+                try:
+                    stat = os.stat(os.path.join(spool_dir, partial))
+                except FileNotFoundError:
+                    stat = None
+                if stat is not None and (partial, stat.st_size, stat.st_mtime) != \
+                        partial_state and (stopping or receiver is None or
+                                           time.time() - partial_shipped >= partial_interval):
+                    partial_shipped = time.time()
+                    if ship(os.path.join(spool_dir, partial)):
+                        partial_state = (partial, stat.st_size, stat.st_mtime)
+                        stats['partials'] += 1
+
+            if stopping:
+                break
+            stop.wait(RESTART_BACKOFF if receiver is None else POLL_INTERVAL)
+    finally:
+        if receiver is not None and receiver.poll() is None:
+            receiver.terminate()
+            receiver.wait()
+
+    stats['restarts'] = restarts
+    return stats
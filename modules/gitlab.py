@@ -14,25 +14,104 @@ Description:            This Module will handle the actual gitlab backup.
 
 # Define all modules that this script will utilize
 import os  # Imported to allow run of popen to execute the command
+import datetime  # Imported to work out when the last full backup was taken
 import shutil  # Imported to allow easy copy operation
-import tarfile  # Imported to tar up the backup and move it to the local directory location.
-import json  # Imported to parse module arguments array
+import subprocess  # Imported to run the restore tasks
+
+# Import Nimbus class libraries
+from libs.compression import ArchiveWriter  # Used to write the archive with the set codec
+from libs.compression import archive_extension  # Used to name the archive
+from libs.filestate import load_manifest, save_manifest  # Used by the incremental mode
+from libs.filestate import scan_tree, diff_files  # Used to find the changed files
+from libs.restore import extract_member  # Used to unpack the archives for the restore
+from libs.metrics import phase, record, path_size  # Used to record the backup phases
+from libs.runner import run, failed, describe  # Used to run the backup task
+
+# Files that the incremental mode adds to each archive next to the backup files.
+DELETED_LIST = 'nimbus_deleted_files.txt'
+MANIFEST_COPY = 'nimbus_manifest.json'
+
+# Suffix of the backup tar written by gitlab-rake, the rest of its name is the BACKUP id.
+GITLAB_BACKUP_SUFFIX = '_gitlab_backup.tar'
+
+# gitlab-rake lists the components it skipped in here, and the restore skips them as well.
+BACKUP_INFORMATION = 'backup_information.yml'
+SKIPPED_KEY = ':skipped:'
+
+
+def keep_skipped(info_path, components):
+    """This function drops the components that only the full backups hold from the skipped list"""
+    # The incremental skipped them, but the restore still has to take them from the full.
+    try:
+        with open(info_path) as info_file:
+            lines = info_file.read().split("\n")
+    except FileNotFoundError:
+        return
+    for index, line in enumerate(lines):
+        if line.startswith(SKIPPED_KEY):
+            skipped = [component.strip() for component in line[len(SKIPPED_KEY):].split(',')
+                       if component.strip() and component.strip() not in components]
+            if skipped:
+                lines[index] = SKIPPED_KEY + " " + ",".join(skipped)
+            else:
+                del lines[index]
+            break
+    with open(info_path, 'w') as info_file:
+        info_file.write("\n".join(lines))
+
 
 # Define the function to pass back to the main backup module.
-def gitlab_backup_job(localdir, filedate, args):
+def gitlab_backup_job(localdir, filedate, args, compression=None, metrics=None,
+                      limiter=None, log=None):
     """The module will perform the actual gitlab backup"""
     # We don't need the config in this job so remove the variable to clear pylint errors
     # del args
 
-    # Load the module aregments and jsonify them
-    args = args.replace("'", "\"")
-    args = json.loads(args)
-
     if 'gitlab_backup_path' in args:
         gitlab_path = args['gitlab_backup_path']
     else:
         gitlab_path = '/var/opt/gitlab/backups'
 
+    if 'gitlab_rake' in args:
+        gitlab_rake = args['gitlab_rake']
+    else:
+        gitlab_rake = '/opt/gitlab/bin/gitlab-rake'
+
+    if 'gitlab_config' in args:
+        gitlab_config = args['gitlab_config']
+    else:
+        gitlab_config = '/etc/gitlab/gitlab.rb'
+
+    # Incremental mode only archives the files that changed since the previous run.
+    if 'incremental' in args:
+        incremental = bool(args['incremental'])
+    else:
+        incremental = False
+
+    if 'full_every_days' in args:
+        full_every_days = int(args['full_every_days'])
+    else:
+        full_every_days = 7
+
+    if 'manifest_path' in args:
+        manifest_path = args['manifest_path']
+    else:
+        manifest_path = '/var/lib/nimbus/gitlab_manifest.json'
+
+    # Components that the incremental runs leave to gitlab-rake SKIP=, so that their dump from
+    # the last full stays in place with its mtimes, and is neither hashed nor archived again.
+    # Changes to them are only backed up by the next full run.
+    if 'incremental_skip' in args:
+        incremental_skip = list(args['incremental_skip'])
+    else:
+        incremental_skip = []
+
+    # Stop the backup task if it runs for longer than this many seconds, by default it is not.
+    if 'command_timeout' in args:
+        command_timeout = float(args['command_timeout'])
+    else:
+        command_timeout = None
+
     # Print a warning to the user letting them know the location of the back up file settings.
     print('--------------------------------------------------------------------------------')
     print("This job assumes that the backup location set in your /etc/gitlab/gitlab.rb file")
@@ -41,6 +120,18 @@ def gitlab_backup_job(localdir, filedate, args):
     print("in the module_args section of the config")
     print('--------------------------------------------------------------------------------')
 
+    # Work out if this run needs to be a full backup.
+    run_date = filedate
+    manifest = None
+    full_backup = True
+    if incremental:
+        manifest = load_manifest(manifest_path)
+        if manifest.get('last_full') is not None:
+            last_full = datetime.datetime.strptime(manifest['last_full'], '%Y-%m-%d %H:%M:%S')
+            full_backup = (run_date - last_full).days >= full_every_days
+        print("Incremental mode: this run will be a " +
+              ("full" if full_backup else "incremental") + " backup.\n")
+
     # Set the file date (separate the timestamp and date portion)
     filedate = str(filedate).split(" ")
     timestamp = filedate[1]
@@ -48,8 +139,10 @@ def gitlab_backup_job(localdir, filedate, args):
     timestamp = str(timestamp[0]).replace(":", "-")
     filedate = filedate[0] + "_" + timestamp
 
-    # If any files currently exist in that directory then remove them all..
-    if os.path.isdir(gitlab_path):
+    # If any files currently exist in that directory then remove them all.. Incremental runs keep
+    # the unpacked tree of the previous run, so the files gitlab-rake leaves alone keep their
+    # mtimes and are not hashed again.
+    if os.path.isdir(gitlab_path) and not (incremental and not full_backup):
         for file_name in os.listdir(gitlab_path):
             try:
                 file_path = os.path.join(gitlab_path, file_name)
@@ -62,7 +155,7 @@ def gitlab_backup_job(localdir, filedate, args):
             except OSError as err:
                 print("OS error: {0}".format(err))
                 raise SystemError(" ERROR: " + file_name + " could not be removed.")
-    else:
+    elif not os.path.isdir(gitlab_path):
         try:
             os.makedirs(gitlab_path)
             shutil.chown(gitlab_path, user='git', group='git')
@@ -72,29 +165,64 @@ def gitlab_backup_job(localdir, filedate, args):
 
     print("Running backup job...")
     print("--------------------------------------\n")
-    execute_backup = os.popen('/opt/gitlab/bin/gitlab-rake gitlab:backup:create')
+    backup_argv = [gitlab_rake, 'gitlab:backup:create']
+    if incremental:
+        # Leave the backup unpacked so that the individual files can be compared.
+        skip = ['tar']
+        if not full_backup:
+            skip.extend(incremental_skip)
+        backup_argv.append('SKIP=' + ",".join(skip))
     # execute_backup = os.popen("echo 'ran the job' > /var/opt/gitlab/backups/gitlab_backup.file")
-    job_log = execute_backup.read()
-    execute_backup.close()
+    result = run(backup_argv, timeout=command_timeout, log=log, label='gitlab-rake')
+    record(metrics, 'dump', result['seconds'], result['cpu'], None, path_size(gitlab_path))
+    job_log = describe(result)
+    if failed(result):
+        raise SystemError(" ERROR: The gitlab backup task " + job_log)
 
     # Grab the gitlab settings file
     print("\n")
     print("Backing up configuration files...")
     print("---------------------------------\n")
-    shutil.copyfile('/etc/gitlab/gitlab.rb', gitlab_path + "/gitlab.rb")
+    shutil.copyfile(gitlab_config, gitlab_path + "/gitlab.rb")
 
     # Tar up the backup and move it to the local backup directory.
     print("Creating backup archive...")
     print("--------------------------\n")
     # Create the name of the tarball
-    tar_name = '/gitlab_' + str(filedate) + '.tar.gz'
+    tar_name = '/gitlab_' + str(filedate) + archive_extension(compression)
     tar_path = gitlab_path + tar_name
 
+    # Work out what changed since the previous run.
+    if incremental:
+        if not full_backup:
+            keep_skipped(gitlab_path + "/" + BACKUP_INFORMATION, incremental_skip)
+        files = scan_tree(gitlab_path, manifest['files'], exclude=(DELETED_LIST, MANIFEST_COPY))
+        changed, deleted = diff_files(manifest['files'], files)
+        if not full_backup:
+            tar_name = '/gitlab_' + str(filedate) + '_incr' + archive_extension(compression)
+            tar_path = gitlab_path + tar_name
+            job_log = job_log + "\nIncremental backup: " + str(len(changed)) + \
+                " changed or new files, " + str(len(deleted)) + " deleted files.\n"
+
+        # Record the deleted files and the new manifest inside the archive for the restore.
+        with open(gitlab_path + "/" + DELETED_LIST, 'w') as deleted_file:
+            deleted_file.write("\n".join(deleted))
+        manifest = {'last_full': manifest.get('last_full'), 'files': files}
+        if full_backup:
+            manifest['last_full'] = run_date.strftime('%Y-%m-%d %H:%M:%S')
+        save_manifest(gitlab_path + "/" + MANIFEST_COPY, manifest)
+
     # Tar the files
-    tar = tarfile.open(tar_path, 'w:gz')
-    for file_name in os.listdir(gitlab_path):
-        tar.add(gitlab_path + "/" + file_name)
-    tar.close()
+    with phase(metrics, 'archive') as measured:
+        tar = ArchiveWriter(tar_path, compression, limiter)
+        if full_backup:
+            for file_name in os.listdir(gitlab_path):
+                tar.add(gitlab_path + "/" + file_name)
+        else:
+            for file_name in changed + [DELETED_LIST, MANIFEST_COPY]:
+                tar.add(gitlab_path + "/" + file_name)
+        tar.close()
+        measured['bytes_out'] = os.path.getsize(tar_path)
 
     # Move the backup to the local directory
     print("Moving backup archive to " + localdir + "...")
@@ -105,6 +233,94 @@ def gitlab_backup_job(localdir, filedate, args):
         print("OS error: {0}".format(err))
         raise SystemError(" ERROR: Backup could not be moved!")
 
+    # Only remember this run once its archive is safely in the local directory.
+    if incremental:
+        save_manifest(manifest_path, manifest)
+
     print("Job backup module completed...")
     print("-----------------------------\n")
     return tar_name, job_log
+
+
+# Define the function to pass back to the restore script.
+def gitlab_restore_job(archives, args, jobs=1, databases=None):
+    """The module will restore a gitlab backup archive, replaying any incrementals on top"""
+    # The gitlab restore task restores everything in a single run.
+    del jobs, databases
+
+    if 'gitlab_backup_path' in args:
+        gitlab_path = args['gitlab_backup_path']
+    else:
+        gitlab_path = '/var/opt/gitlab/backups'
+
+    if 'gitlab_rake' in args:
+        gitlab_rake = args['gitlab_rake']
+    else:
+        gitlab_rake = '/opt/gitlab/bin/gitlab-rake'
+
+    # Start from an empty backup directory, just like the backup does.
+    if os.path.isdir(gitlab_path):
+        for file_name in os.listdir(gitlab_path):
+            try:
+                file_path = os.path.join(gitlab_path, file_name)
+                if os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+                else:
+                    os.unlink(file_path)
+            except OSError as err:
+                print("OS error: {0}".format(err))
+                raise SystemError(" ERROR: " + file_name + " could not be removed.")
+    else:
+        os.makedirs(gitlab_path)
+
+    # Unpack the full archive and then each incremental in order, straight from the archives.
+    print("Unpacking backup archives into " + gitlab_path + "...")
+    print("--------------------------------------------\n")
+    member_prefix = gitlab_path.strip('/') + '/'
+    for archive in archives:
+        for member in archive.members():
+            if not member.isfile():
+                continue
+            member_path = member.name
+            if member_path.startswith(member_prefix):
+                member_path = member_path[len(member_prefix):]
+            target_path = extract_member(archive.extractfile(member), gitlab_path, member_path)
+            try:
+                shutil.chown(target_path, user='git', group='git')
+            except (LookupError, PermissionError):
+                pass
+
+        # Drop the files that the incremental recorded as deleted.
+        deleted_path = gitlab_path + "/" + DELETED_LIST
+        if os.path.isfile(deleted_path):
+            with open(deleted_path) as deleted_file:
+                deleted = [file_name for file_name in deleted_file.read().split("\n") if file_name]
+            for file_name in deleted:
+                try:
+                    os.unlink(os.path.join(gitlab_path, file_name))
+                except FileNotFoundError:
+                    pass
+            os.unlink(deleted_path)
+
+    if os.path.isfile(gitlab_path + "/" + MANIFEST_COPY):
+        os.unlink(gitlab_path + "/" + MANIFEST_COPY)
+
+    # Full backups hold the tar that gitlab wrote, incrementals hold it unpacked.
+    print("Running restore job...")
+    print("--------------------------------------\n")
+    restore_argv = [gitlab_rake, 'gitlab:backup:restore', 'force=yes']
+    backups = sorted(file_name for file_name in os.listdir(gitlab_path)
+                     if file_name.endswith(GITLAB_BACKUP_SUFFIX))
+    if backups:
+        # The BACKUP id comes from a file name in the archive, so no shell gets to see it.
+        restore_argv.append('BACKUP=' + backups[-1][:-len(GITLAB_BACKUP_SUFFIX)])
+    return_code = subprocess.call(restore_argv)
+    if return_code != 0:
+        raise SystemExit(" ERROR: gitlab-rake gitlab:backup:restore failed with exit code " +
+                         str(return_code))
+
+    print("The gitlab.rb settings file was restored to " + gitlab_path + "/gitlab.rb,")
+    print("compare it with /etc/gitlab/gitlab.rb before running gitlab-ctl reconfigure.\n")
+    print("Job restore module completed...")
+    print("------------------------------\n")
+    return [("Restoring gitlab...", return_code)]
@@ -1,21 +1,261 @@
-#!/usr/bin/python3.4
-'''
+#!/usr/bin/python3
+"""
 ***************************************************************************
-Script:                 Universal Backup Script
-Module:				  	Postgres
-Authors/Maintainers:    Rich Nason (rnason@getnucleus.io)
-Description:            This script will perform Postgresql backup jobs.
+Script:                 Nimbus Intermixed Modular Back Up Script
+Module:					Jenkins Backup Module
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This Module will handle the actual jenkins backup. JENKINS_HOME is
+                        scanned with several directories read at once, leaving out the
+                        workspaces, build artifacts and caches, and archived in place.
 ***************************************************************************
-'''
+"""
 
 # Define all modules that this script will utilize
-import os  # Imported to allow run of popen to execute the command
-import shutil  # Imported to allow easy copy operation
-import tarfile  # Imported to tar up the backup and move it to the local directory location.
-import json  # This is loaded to parse the server_settings.ini file
+import os  # Imported to read the directories and files of JENKINS_HOME
+import json  # Imported to record the changed directories inside the archive
+import time  # Imported to time the scan of JENKINS_HOME
+import shutil  # Imported to clear out the directories that an incremental replaces
+import datetime  # Imported to work out when the last full backup was taken
+
+# Import Nimbus class libraries
+from libs.compression import ArchiveWriter  # Used to write the archive with the set codec
+from libs.compression import archive_extension  # Used to name the archive
+from libs.filestate import load_manifest, save_manifest  # Used by the incremental mode
+from libs.filestate import scan_dirs, diff_dirs  # Used to find the changed directories
+from libs.restore import extract_member  # Used to unpack the archives for the restore
+from libs.metrics import phase  # Used to record the backup phases
+
+# Paths left out of the backup by default. They are relative to JENKINS_HOME, a * also
+# matches across directories (so nested folder jobs are covered) and a trailing / only
+# matches directories. Workspaces, caches and unpacked plugins are rebuilt by Jenkins itself.
+DEFAULT_EXCLUDES = [
+    'workspace/',
+    'caches/',
+    'war/',
+    'logs/',
+    '.cache/',
+    '.m2/',
+    '.gradle/',
+    '.npm/',
+    'plugins/*/',
+    'jobs/*/workspace*/',
+    'jobs/*/builds/*/archive/',
+    '*.tmp',
+]
+
+# JENKINS_HOME is stored under ARCHIVE_ROOT, after a list of the directories in the archive.
+ARCHIVE_ROOT = 'jenkins_home'
+CHANGES_FILE = 'nimbus_changed_dirs.json'
 
 
 # Define the function to pass back to the main backup module.
-def jenkins_backup_job(localdir, filedate, config):
+def jenkins_backup_job(localdir, filedate, args, compression=None, metrics=None,
+                       limiter=None, log=None):
     """This is the actual backup action that will backup jenkins"""
-    print('mysql')
+    # The archive is written by nimbus itself, there are no commands whose output to log.
+    del log
+
+    if 'jenkins_home' in args:
+        jenkins_home = args['jenkins_home'].rstrip('/')
+    else:
+        jenkins_home = '/var/lib/jenkins'
+
+    if 'exclude' in args:
+        exclude = list(args['exclude'])
+    else:
+        exclude = DEFAULT_EXCLUDES
+
+    # How many directories are read at once, remote or busy disks like more.
+    if 'scan_workers' in args:
+        scan_workers = int(args['scan_workers'])
+    else:
+        scan_workers = 16
+
+    # Incremental mode only archives the job and build directories that changed.
+    if 'incremental' in args:
+        incremental = bool(args['incremental'])
+    else:
+        incremental = False
+
+    if 'full_every_days' in args:
+        full_every_days = int(args['full_every_days'])
+    else:
+        full_every_days = 7
+
+    if 'manifest_path' in args:
+        manifest_path = args['manifest_path']
+    else:
+        manifest_path = '/var/lib/nimbus/jenkins_manifest.json'
+
+    if not os.path.isdir(jenkins_home):
+        raise SystemError(" ERROR: " + jenkins_home + " was not found, please set 'jenkins_home' "
+                          "in the module_args section of the config")
+
+    # Work out if this run needs to be a full backup.
+    run_date = filedate
+    manifest = None
+    full_backup = True
+    if incremental:
+        manifest = load_manifest(manifest_path)
+        if manifest.get('last_full') is not None:
+            last_full = datetime.datetime.strptime(manifest['last_full'], '%Y-%m-%d %H:%M:%S')
+            full_backup = (run_date - last_full).days >= full_every_days
+        print("Incremental mode: this run will be a " +
+              ("full" if full_backup else "incremental") + " backup.\n")
+
+    # Set the file date (separate the timestamp and date portion)
+    filedate = str(filedate).split(" ")
+    timestamp = filedate[1]
+    timestamp = str(timestamp).split(".")
+    timestamp = str(timestamp[0]).replace(":", "-")
+    filedate = filedate[0] + "_" + timestamp
+
+    # Scan JENKINS_HOME, leaving out the excluded paths without even reading them.
+    print("Scanning " + jenkins_home + "...")
+    print("--------------------------------------\n")
+    scan_start = time.time()
+    with phase(metrics, 'scan') as measured:
+        dirs = scan_dirs(jenkins_home, exclude, scan_workers)
+        measured['bytes_in'] = sum(entry['signature'][2] for entry in dirs.values())
+    total_files = sum(len(entry['files']) for entry in dirs.values())
+    job_log = "Scanned " + str(len(dirs)) + " directories and " + str(total_files) + \
+        " files in " + "{0:.1f}".format(time.time() - scan_start) + " sec, leaving out " + \
+        ", ".join(exclude) + "\n"
+
+    # Work out which directories changed since the previous run.
+    changed = sorted(dirs)
+    deleted = []
+    if incremental and not full_backup:
+        changed, deleted = diff_dirs(manifest.get('dirs', {}), dirs)
+        job_log = job_log + "Incremental backup: " + str(len(changed)) + \
+            " changed or new directories, " + str(len(deleted)) + " deleted directories.\n"
+
+    # Archive straight out of JENKINS_HOME, there is nothing to stage.
+    print("Creating backup archive...")
+    print("--------------------------\n")
+    tar_name = '/jenkins_' + str(filedate) + archive_extension(compression)
+    if incremental and not full_backup:
+        tar_name = '/jenkins_' + str(filedate) + '_incr' + archive_extension(compression)
+    tar_path = localdir + tar_name
+    changes_path = tar_path + '.' + CHANGES_FILE
+    with open(changes_path, 'w') as changes_file:
+        json.dump({'full': full_backup, 'changed': changed, 'deleted': deleted}, changes_file)
+
+    vanished = 0
+    with phase(metrics, 'archive') as measured:
+        tar = ArchiveWriter(tar_path + '.part', compression, limiter)
+        try:
+            # The list of directories comes first, so a restore can clear them out beforehand.
+            tar.add(changes_path, CHANGES_FILE)
+            for rel_dir in changed:
+                dir_path = os.path.join(jenkins_home, rel_dir) if rel_dir else jenkins_home
+                arc_dir = os.path.join(ARCHIVE_ROOT, rel_dir) if rel_dir else ARCHIVE_ROOT
+                try:
+                    tar.add(dir_path, arc_dir, recursive=False)
+                except FileNotFoundError:
+                    vanished += 1
+                    continue
+                for file_name in dirs[rel_dir]['files']:
+                    try:
+                        tar.add(os.path.join(dir_path, file_name),
+                                os.path.join(arc_dir, file_name), recursive=False)
+                    except FileNotFoundError:
+                        # Builds come and go while the backup runs.
+                        vanished += 1
+        finally:
+            tar.close()
+            os.remove(changes_path)
+        os.replace(tar_path + '.part', tar_path)
+        measured['bytes_out'] = os.path.getsize(tar_path)
+    if vanished:
+        job_log = job_log + str(vanished) + " files were removed while the backup ran.\n"
+
+    # Only remember this run once its archive is safely in the local directory.
+    if incremental:
+        manifest = {'last_full': manifest.get('last_full'),
+                    'dirs': dict((rel_dir, entry['signature']) for rel_dir, entry in dirs.items())}
+        if full_backup:
+            manifest['last_full'] = run_date.strftime('%Y-%m-%d %H:%M:%S')
+        save_manifest(manifest_path, manifest)
+
+    print("Job backup module completed...")
+    print("-----------------------------\n")
+    return tar_name, job_log
+
+
+def clear_directory(dir_path):
+    """This function removes the files of a directory, leaving its sub directories alone"""
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    os.unlink(entry.path)
+    except FileNotFoundError:
+        pass
+
+
+# Define the function to pass back to the restore script.
+def jenkins_restore_job(archives, args, jobs=1, databases=None):
+    """The module will restore JENKINS_HOME from a jenkins backup archive and its incrementals"""
+    # The files are unpacked in a single pass over each archive.
+    del jobs, databases
+
+    if 'jenkins_home' in args:
+        jenkins_home = args['jenkins_home'].rstrip('/')
+    else:
+        jenkins_home = '/var/lib/jenkins'
+
+    print("Jenkins should be stopped while " + jenkins_home + " is restored.")
+    print("Unpacking backup archives into " + jenkins_home + "...")
+    print("--------------------------------------------\n")
+    restored = 0
+    member_prefix = ARCHIVE_ROOT + '/'
+    for archive in archives:
+        for member in archive.members():
+            if member.name == CHANGES_FILE:
+                # An incremental replaces the files of the directories that changed, and
+                # drops the directories that were deleted.
+                changes = json.loads(archive.extractfile(member).read().decode())
+                if not changes['full']:
+                    for rel_dir in changes['deleted']:
+                        shutil.rmtree(os.path.join(jenkins_home, rel_dir), ignore_errors=True)
+                    for rel_dir in changes['changed']:
+                        clear_directory(os.path.join(jenkins_home, rel_dir))
+                continue
+            if member.name == ARCHIVE_ROOT:
+                continue
+            if not member.name.startswith(member_prefix):
+                print("Skipping " + member.name + "...")
+                continue
+
+            member_path = member.name[len(member_prefix):]
+            if member.isdir():
+                target_path = os.path.join(jenkins_home, member_path)
+                os.makedirs(target_path, exist_ok=True)
+            elif member.issym():
+                target_path = os.path.normpath(os.path.join(jenkins_home, member_path))
+                if not target_path.startswith(os.path.abspath(jenkins_home) + os.sep):
+                    raise SystemError(" ERROR: " + member_path + " would be extracted outside "
+                                      "of " + jenkins_home)
+                if os.path.lexists(target_path):
+                    os.unlink(target_path)
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                os.symlink(member.linkname, target_path)
+                continue
+            elif member.isfile():
+                target_path = extract_member(archive.extractfile(member), jenkins_home,
+                                             member_path)
+                os.utime(target_path, (member.mtime, member.mtime))
+                restored += 1
+            else:
+                continue
+            os.chmod(target_path, member.mode)
+            try:
+                shutil.chown(target_path, user='jenkins', group='jenkins')
+            except (LookupError, PermissionError):
+                pass
+
+    print(str(restored) + " files were restored.\n")
+    print("Job restore module completed...")
+    print("------------------------------\n")
+    return [("Restoring " + jenkins_home + "...", 0)]
@@ -4,26 +4,138 @@
 Script:                 Nimbus Intermixed Modular Back Up Script
 Module:					MySQL Backup Module
 Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
-Description:            This Module will handle the actual mysql backup.
+Description:            This Module will handle the actual mysql backup. Between full
+                        dumps it can take incrementals that only hold the binary logs
+                        written since the last run, replayed on top of the dumps to restore.
 ***************************************************************************
 """
 
 # Define all modules that this script will utilize
 import os  # Imported to allow run of popen to execute the command
+import re  # Imported to read the binlog position out of the dumps
+import json  # Imported to record the binlog position of the dumps inside the archive
 import shutil  # Imported to allow easy copy operation
-import tarfile  # Imported to tar up the backup and move it to the local directory location.
-import json  # This is loaded to parse the server_settings.ini file
+import datetime  # Imported to work out when the last full backup was taken
+import tempfile  # Imported to create a unique tmp backup folder
+
+# Import Nimbus class libraries
+from libs.streamtar import StreamingTar, stream_dumps  # Used to stream dumps into the archive
+from libs.compression import ArchiveWriter  # Used to write the archive with the set codec
+from libs.compression import archive_extension, member_extension  # Used to name the archive
+from libs.restore import dump_member, pipe_member, extract_member  # Used to restore the dumps
+from libs.metrics import phase, record, path_size  # Used to record each dump
+from libs.runner import run, failed, describe  # Used to run the dump commands
+from libs.filestate import load_manifest, save_manifest  # Used by the incremental mode
+
+# Incremental archives hold the binary logs written since the last run. Each full archive
+# records the binlog position that every one of its dumps was taken at, and a restore replays
+# the binary logs into each database from its own position on.
+BINLOG_DIR = 'binlog'
+BINLOG_MEMBER = re.compile(r'(^|/)' + BINLOG_DIR + r'/(?P<file>[^/]+)$')
+POSITION_FILE = 'binlog_position.json'
+
+# mysqldump writes the position as a commented out CHANGE MASTER near the top of the dump.
+DUMP_POSITION = re.compile(r"CHANGE (?:MASTER|REPLICATION SOURCE) TO "
+                           r"(?:MASTER|SOURCE)_LOG_FILE='(?P<file>[^']+)', *"
+                           r"(?:MASTER|SOURCE)_LOG_POS=(?P<position>\d+)")
+POSITION_LINES = 100
+
+
+def dump_position(dump_path):
+    """This function reads the binlog position that a dump was taken at out of its header"""
+    with open(dump_path, errors='replace') as dump_file:
+        for _ in range(POSITION_LINES):
+            line = dump_file.readline()
+            if not line:
+                break
+            match = DUMP_POSITION.search(line)
+            if match:
+                return [match.group('file'), int(match.group('position'))]
+    return None
+
+
+def binary_logs(mysql_argv, timeout=None, log=None):
+    """This function closes the binary log being written and lists them all, oldest first"""
+    result = run(mysql_argv + ['-N', '-B', '-e', 'FLUSH BINARY LOGS; SHOW BINARY LOGS'],
+                 capture=True, timeout=timeout, log=log, label='mysql')
+    if failed(result):
+        raise SystemError(" ERROR: The binary logs could not be listed:\n" + describe(result))
+    return [line.split("\t")[0] for line in result['stdout'].split("\n") if line.strip()]
+
+
+def binlog_backup(localdir, filedate, connect, mysql, mysqlbinlog, next_binlog,
+                  compression=None, metrics=None, limiter=None, command_timeout=None, log=None):
+    """This function archives the binary logs written since the last run, None if it can't"""
+    binlogs = binary_logs([mysql] + connect, command_timeout, log)
+    if next_binlog not in binlogs:
+        return None
+
+    # The last binary log is the one the flush just started, the next run ships it.
+    shipped = binlogs[binlogs.index(next_binlog):-1]
+    try:
+        tmp_dir = tempfile.mkdtemp(prefix='mysql' + filedate + '_', dir='/tmp')
+    except OSError:
+        raise SystemExit(" ERROR: Failed to create tmp backup folder")
+    binlog_dir = tmp_dir + "/" + BINLOG_DIR
+    os.makedirs(binlog_dir)
+
+    print("Running binlog backup...")
+    print("--------------------------------------\n")
+    result = run([mysqlbinlog] + connect + ['--read-from-remote-server', '--raw',
+                                            '--result-file=' + binlog_dir + '/'] + shipped,
+                 timeout=command_timeout, log=log, label='mysqlbinlog')
+    record(metrics, 'dump', result['seconds'], result['cpu'], None, path_size(binlog_dir),
+           database=BINLOG_DIR)
+    job_log = "Shipping the binary logs " + shipped[0] + " to " + shipped[-1] + "...\n" + \
+        describe(result)
+    if failed(result):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise SystemError(" ERROR: The binary logs could not be read:\n" + job_log)
+
+    print("Creating backup archive...")
+    print("--------------------------\n")
+    tar_name = '/mysql_' + str(filedate) + '_incr' + archive_extension(compression)
+    tar_path = tmp_dir + tar_name
+    with phase(metrics, 'archive') as measured:
+        tar = ArchiveWriter(tar_path, compression, limiter)
+        for binlog in shipped:
+            tar.add(binlog_dir + "/" + binlog, 'mysql_' + filedate + "/" + BINLOG_DIR + "/" +
+                    binlog)
+        tar.close()
+        measured['bytes_in'] = path_size(binlog_dir)
+        measured['bytes_out'] = os.path.getsize(tar_path)
+
+    try:
+        shutil.move(tar_path, localdir + "/" + tar_name)
+        shutil.rmtree(tmp_dir)
+    except OSError as err:
+        print("OS error: {0}".format(err))
+        raise SystemError(" ERROR: Backup could not be moved!")
+    return tar_name, job_log, binlogs[-1]
 
 
 # Define the function to pass back to the main backup module.
-def mysql_backup_job(localdir, filedate, args):
+def mysql_backup_job(localdir, filedate, args, compression=None, metrics=None,
+                     limiter=None, log=None):
     """The module will perform the actual mysql / backup"""
     # Get the module arguments
     # del args
 
-    # Load the module aregments and jsonify them
-    args = args.replace("'", "\"")
-    args = json.loads(args)
+    # Get path of the dump tool
+    if 'mysqldump' in args:
+        mysqldump = args['mysqldump']
+    else:
+        mysqldump = 'mysqldump'
+
+    if 'mysql' in args:
+        mysql = args['mysql']
+    else:
+        mysql = 'mysql'
+
+    if 'mysqlbinlog' in args:
+        mysqlbinlog = args['mysqlbinlog']
+    else:
+        mysqlbinlog = 'mysqlbinlog'
 
     # Get credentials
     if 'mysql_user' in args:
@@ -31,13 +143,11 @@ def mysql_backup_job(localdir, filedate, args):
     else:
         mysql_user = 'root'
 
+    # The dump commands are not run through a shell, so an empty password needs no quoting.
     if 'mysql_password' in args:
         mysql_password = args['mysql_password']
-
-        if mysql_password == "":
-            mysql_password = "\"\""
     else:
-        mysql_password = "\"\""
+        mysql_password = ""
 
     # Get Host Info
     if 'mysql_host' in args:
@@ -54,7 +164,62 @@ def mysql_backup_job(localdir, filedate, args):
     if 'db_list' in args:
         db_list = args['db_list']
     else:
-        db_list = "mysql"
+        db_list = ["mysql"]
+
+    # Stream the dumps straight into the archive instead of staging them in /tmp.
+    if 'stream_dumps' in args:
+        stream = bool(args['stream_dumps'])
+    else:
+        stream = False
+
+    # Stop any command that runs for longer than this many seconds, by default none is stopped.
+    if 'command_timeout' in args:
+        command_timeout = float(args['command_timeout'])
+    else:
+        command_timeout = None
+
+    # Incremental mode ships the binary logs written since the last run between full dumps.
+    if 'incremental' in args:
+        incremental = bool(args['incremental'])
+    else:
+        incremental = False
+
+    if 'full_every_days' in args:
+        full_every_days = int(args['full_every_days'])
+    else:
+        full_every_days = 7
+
+    if 'manifest_path' in args:
+        manifest_path = args['manifest_path']
+    else:
+        manifest_path = '/var/lib/nimbus/mysql_manifest.json'
+
+    # How mysqldump records the binlog position, MySQL 8.0.26 and later call it --source-data.
+    if 'source_data' in args:
+        source_data = args['source_data']
+    else:
+        source_data = '--master-data=2'
+
+    # The binlog position is read out of the dumps, so they can't be streamed.
+    if incremental and stream:
+        print("WARNING: incremental mode reads the binlog position out of the dumps, staging "
+              "the dumps in /tmp.")
+        stream = False
+
+    connect = ['-h', mysql_host, '-P', str(mysql_port), '--user=' + mysql_user,
+               '--password=' + mysql_password]
+
+    # Work out if this run needs to be a full backup.
+    run_date = filedate
+    manifest = None
+    full_backup = True
+    if incremental:
+        manifest = load_manifest(manifest_path)
+        if manifest.get('last_full') is not None and manifest.get('next_binlog') is not None:
+            last_full = datetime.datetime.strptime(manifest['last_full'], '%Y-%m-%d %H:%M:%S')
+            full_backup = (run_date - last_full).days >= full_every_days
+        print("Incremental mode: this run will be a " +
+              ("full" if full_backup else "incremental") + " backup.\n")
 
     # Set the file date (separate the timestamp and date portion)
     filedate = str(filedate).split(" ")
@@ -63,48 +228,96 @@ def mysql_backup_job(localdir, filedate, args):
     timestamp = str(timestamp[0]).replace(":", "-")
     filedate = filedate[0] + "_" + timestamp
 
-    # Create a temp directory to store the backup files in
-    try:
-        tmp_dir = '/tmp/mysql' + filedate
-        if os.path.isdir(tmp_dir):
-            shutil.rmtree(tmp_dir)
-        os.makedirs(tmp_dir)
-    except:
-        raise SystemExit(" ERROR: Failed to create tmp backup folder")
+    if incremental and not full_backup:
+        shipped = binlog_backup(localdir, filedate, connect, mysql, mysqlbinlog,
+                                manifest['next_binlog'], compression, metrics, limiter,
+                                command_timeout, log)
+        if shipped is not None:
+            tar_name, job_log, manifest['next_binlog'] = shipped
+            save_manifest(manifest_path, manifest)
+            print("Job backup module completed...")
+            print("-----------------------------\n")
+            return tar_name, job_log
+        # The server already purged binary logs that were never shipped.
+        print("WARNING: " + manifest['next_binlog'] + " is no longer on the server, taking a "
+              "full backup instead.")
+
+    # Create a temp directory to store the backup files in (not needed when streaming)
+    tmp_dir = None
+    if not stream:
+        try:
+            # Unique per run, so jobs started in the same second never share a folder.
+            tmp_dir = tempfile.mkdtemp(prefix='mysql' + filedate + '_', dir='/tmp')
+        except:
+            raise SystemExit(" ERROR: Failed to create tmp backup folder")
 
     # Perform the backup of the databases
     print("Running backup job...")
     print("--------------------------------------\n")
-    job_log = None
+    dump_list = []
     for database in db_list:
-        # print(database)
-        db_dump_cmd = "mysqldump" + " -h " + mysql_host + " -P " + str(mysql_port) + " --user=" \
-        + mysql_user + " --password=" + mysql_password + " " + database + " > " + tmp_dir + "/" + database \
-        + "-" + filedate + ".sql"
-
-        # print(db_dump_cmd)
-
-        # Execute the Database Backups
-        # print(db_dump_cmd)
-        job_log_header = "Running " + database + " backup..."
-        print("Running " + database + " backup...")
-        execute_backup = os.popen(db_dump_cmd)
-        backup_log = execute_backup.read()
-        execute_backup.close()
-
-        # Concat all of the backup files
+        db_dump_argv = [mysqldump] + connect + [database]
+        if incremental:
+            # Record the binlog position each dump was consistently taken at.
+            db_dump_argv[1:1] = [source_data, '--single-transaction']
+        dump_list.append(("Running " + database + " backup...", db_dump_argv,
+                          database + "-" + filedate + ".sql"))
+
+    tar_name = '/mysql_' + str(filedate) + archive_extension(compression)
+    if stream:
+        # Each dump is compressed on the fly into its own member of an uncompressed tar.
+        tar_name = '/mysql_' + str(filedate) + '.tar'
+        archive = StreamingTar(localdir + "/" + tar_name, limiter)
+        member_ext = member_extension(compression)
+        results = stream_dumps(archive, [(job_log_header, db_dump_argv,
+                                          'mysql_' + filedate + "/" + sql_name + member_ext,
+                                          database)
+                                         for (job_log_header, db_dump_argv, sql_name), database
+                                         in zip(dump_list, db_list)],
+                               compression=compression, metrics=metrics,
+                               timeout=command_timeout, log=log)
+    else:
+        results = []
+        for (job_log_header, db_dump_argv, sql_name), database in zip(dump_list, db_list):
+            # Execute the Database Backups, one at a time like before
+            print(job_log_header)
+            result = run(db_dump_argv, stdout=tmp_dir + "/" + sql_name, timeout=command_timeout,
+                         log=log, label=database)
+            record(metrics, 'dump', result['seconds'], result['cpu'], None,
+                   os.path.getsize(tmp_dir + "/" + sql_name), database=database)
+            results.append((job_log_header, result))
+
+    # Concat all of the backup files
+    job_log = None
+    failed_dumps = []
+    for (job_log_header, result), database in zip(results, db_list):
+        backup_log = describe(result)
+        if failed(result):
+            failed_dumps.append(database)
         if job_log is None:
             job_log = job_log_header
             job_log = job_log + "\n" + backup_log
         else:
             job_log = job_log + "\n" + job_log_header + "\n" + backup_log
 
+    # A failed or stopped dump fails the job, without leaving a partial backup behind.
+    if failed_dumps:
+        if stream:
+            archive.close()
+            os.remove(localdir + "/" + tar_name)
+        else:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise SystemError(" ERROR: The dumps of " + ", ".join(failed_dumps) + " failed:\n" +
+                          job_log)
+
     # Copy the my.cnf config file
     print("\n")
     print("Backing up configuration files...")
     print("---------------------------------\n")
     try:
-        if os.path.isfile("/etc/my.cnf"):
+        if 'my_cnf' in args:
+            my_cnf = args['my_cnf']
+        elif os.path.isfile("/etc/my.cnf"):
             my_cnf = "/etc/my.cnf"
         elif os.path.isfile("/etc/mysql/my.cnf"):
             my_cnf = "/etc/mysql/my.cnf"
@@ -112,20 +325,46 @@ def mysql_backup_job(localdir, filedate, args):
         print("Error: File Not Found!")
         raise SystemError("ERROR: my.cnf not found, is mysql-server properly installed!")
 
+    # In streaming mode the archive is already in the local directory, so just finish it off.
+    if stream:
+        archive.add_file(my_cnf, 'mysql_' + filedate + "/my.cnf")
+        archive.close()
+
+        print("Job backup module completed...")
+        print("-----------------------------\n")
+        return tar_name, job_log
+
     shutil.copyfile(my_cnf, tmp_dir + "/my.cnf")
 
+    # Keep the binlog position of every dump in the archive, it is where the replay starts.
+    next_binlog = None
+    if incremental:
+        positions = {}
+        for (_, _, sql_name), database in zip(dump_list, db_list):
+            position = dump_position(tmp_dir + "/" + sql_name)
+            if position is None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise SystemError(" ERROR: The dump of " + database + " holds no binlog "
+                                  "position, is binary logging enabled on the server?")
+            positions[database] = position
+        with open(tmp_dir + "/" + POSITION_FILE, 'w') as position_file:
+            json.dump({'databases': positions}, position_file, indent=2, sort_keys=True)
+        next_binlog = min(binlog for binlog, _ in positions.values())
+
     # Tar up the backup and move it to the local backup directory.
     print("Creating backup archive...")
     print("--------------------------\n")
     # Create the name of the tarball
-    tar_name = '/mysql_' + str(filedate) + '.tar.gz'
     tar_path = tmp_dir + tar_name
 
     # Tar the files
-    tar = tarfile.open(tar_path, 'w:gz')
-    for file_name in os.listdir(tmp_dir):
-        tar.add(tmp_dir + "/" + file_name)
-    tar.close()
+    with phase(metrics, 'archive') as measured:
+        tar = ArchiveWriter(tar_path, compression, limiter)
+        for file_name in os.listdir(tmp_dir):
+            tar.add(tmp_dir + "/" + file_name)
+        tar.close()
+        measured['bytes_in'] = path_size(tmp_dir) - os.path.getsize(tar_path)
+        measured['bytes_out'] = os.path.getsize(tar_path)
 
     # Move the backup to the local directory
     print("Moving backup archive to " + localdir + "...")
@@ -145,6 +384,132 @@ def mysql_backup_job(localdir, filedate, args):
         print("OS error: {0}".format(err))
         raise SystemError(" ERROR: " + tmp_dir + " could not be removed.")
 
+    # Only move the manifest on once the full backup is safely in place.
+    if incremental:
+        save_manifest(manifest_path, {'last_full': run_date.strftime('%Y-%m-%d %H:%M:%S'),
+                                      'next_binlog': next_binlog})
+
     print("Job backup module completed...")
     print("-----------------------------\n")
     return tar_name, job_log
+
+
+# Define the function to pass back to the restore script.
+def mysql_restore_job(archives, args, jobs=1, databases=None):
+    """The module will restore the databases of a mysql backup archive"""
+    # Dumps are plain SQL that mysql reads in a single session, so jobs does not apply.
+    del jobs
+
+    # Get path of the client
+    if 'mysql' in args:
+        mysql = args['mysql']
+    else:
+        mysql = 'mysql'
+
+    if 'mysqlbinlog' in args:
+        mysqlbinlog = args['mysqlbinlog']
+    else:
+        mysqlbinlog = 'mysqlbinlog'
+
+    # Stop replaying the binary logs at this time, by default all of them are replayed.
+    if 'recovery_target_time' in args:
+        recovery_target_time = args['recovery_target_time']
+    else:
+        recovery_target_time = None
+
+    # Get credentials
+    if 'mysql_user' in args:
+        mysql_user = args['mysql_user']
+    else:
+        mysql_user = 'root'
+
+    # The restore commands are not run through a shell, so an empty password needs no quoting.
+    if 'mysql_password' in args:
+        mysql_password = args['mysql_password']
+    else:
+        mysql_password = ""
+
+    # Get Host Info
+    if 'mysql_host' in args:
+        mysql_host = args['mysql_host']
+    else:
+        mysql_host = 'localhost'
+
+    if 'mysql_port' in args:
+        mysql_port = args['mysql_port']
+    else:
+        mysql_port = 3306
+
+    # The database names come from the archive, so they are only ever passed as arguments.
+    connect = [mysql, '-h', mysql_host, '-P', str(mysql_port), '--user=' + mysql_user,
+               '--password=' + mysql_password]
+
+    # Pipe each dump straight out of the archive into the mysql client.
+    print("Running restore job...")
+    print("--------------------------------------\n")
+    results = []
+    positions = None
+    binlog_dir = tempfile.mkdtemp(prefix='mysql_binlog_', dir='/tmp')
+    for archive in archives:
+        for member in archive.members():
+            # The binlog position and the binary logs are kept for the replay below.
+            if member.isfile() and os.path.basename(member.name) == POSITION_FILE:
+                positions = json.loads(archive.extractfile(member).read().decode())['databases']
+                continue
+            binlog_match = BINLOG_MEMBER.search(member.name)
+            if member.isfile() and binlog_match:
+                extract_member(archive.extractfile(member), binlog_dir, binlog_match.group('file'))
+                continue
+
+            database, dump_format, _ = dump_member(member.name)
+            if not member.isfile() or dump_format != 'sql':
+                print("Skipping " + member.name + "...")
+                continue
+            if databases is not None and database not in databases:
+                continue
+
+            job_log_header = "Restoring " + database + "..."
+            print(job_log_header)
+            result = run(connect + ['-e', 'CREATE DATABASE IF NOT EXISTS `' +
+                                    database.replace('`', '``') + '`'], label=database)
+            if failed(result):
+                # There is nothing to load the dump into, so the restore of it has failed.
+                print(describe(result))
+                results.append((job_log_header, 1))
+                continue
+            results.append((job_log_header,
+                            pipe_member(archive.extractfile(member), member.name,
+                                        connect + ['--database=' + database])))
+
+    # Replay the binary logs into each database from the position its dump was taken at.
+    binlogs = sorted(os.listdir(binlog_dir))
+    if binlogs and positions is None:
+        shutil.rmtree(binlog_dir, ignore_errors=True)
+        raise SystemExit(" ERROR: The full backup holds no binlog position to replay from.")
+    for database, (start_binlog, start_position) in sorted((positions or {}).items()):
+        if databases is not None and database not in databases:
+            continue
+        replay = [binlog_dir + "/" + binlog for binlog in binlogs if binlog >= start_binlog]
+        if not replay:
+            continue
+        job_log_header = "Replaying the binary logs into " + database + "..."
+        print(job_log_header)
+        binlog_argv = [mysqlbinlog, '--skip-gtids', '--database=' + database,
+                       '--start-position=' + str(start_position)]
+        if recovery_target_time is not None:
+            binlog_argv.append('--stop-datetime=' + recovery_target_time)
+        result = run([binlog_argv + replay, connect + ['--database=' + database]],
+                     label=database)
+        if failed(result):
+            print(describe(result))
+        results.append((job_log_header, 1 if failed(result) else 0))
+    shutil.rmtree(binlog_dir, ignore_errors=True)
+
+    failed_restores = [job_log_header for job_log_header, return_code in results
+                       if return_code != 0]
+    if failed_restores:
+        raise SystemExit(" ERROR: The restore failed for: " + ", ".join(failed_restores))
+
+    print("Job restore module completed...")
+    print("------------------------------\n")
+    return results
@@ -4,27 +4,83 @@
 Script:                 Nimbus Intermixed Modular Back Up Script
 Module:					Postgres Backup Module
 Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
-Description:            This Module will handle the actual postgres backup.
+Description:            This Module will handle the actual postgres backup. Besides the
+                        logical dumps it can take base backups of the whole cluster, and
+                        stream its WAL for point in time recovery on top of them.
 ***************************************************************************
 """
 
 # Define all modules that this script will utilize
 import os  # Imported to allow run of popen to execute the command
+import re  # Imported to read the start of the WAL out of the backup_label
 import shutil  # Imported to allow easy copy operation
-import tarfile  # Imported to tar up the backup and move it to the local directory location.
-import json  # This is loaded to parse the server_settings.ini file
+import tarfile  # Imported to read and unpack the base backup tars
+import tempfile  # Imported to create a unique tmp backup folder
+import subprocess  # Imported to run the restore commands
+from concurrent.futures import ThreadPoolExecutor  # Used to run the database restores in parallel
+
+# Import Nimbus class libraries
+from libs.streamtar import StreamingTar, stream_dumps  # Used to stream dumps into the archive
+from libs.compression import ArchiveWriter  # Used to write the archive with the set codec
+from libs.compression import archive_extension, member_extension  # Used to name the archive
+from libs.restore import dump_member, pipe_member, pipe_file  # Used to restore the dumps
+from libs.metrics import phase, record, path_size  # Used to record each dump
+from libs.runner import run, run_many, failed, describe  # Used to run the dump commands
+from libs.restore import extract_member, run_command  # Used to restore the dumps
+from libs.walarchive import write_start_marker, receive_wal  # Used to archive the WAL
+from libs.walarchive import PARTIAL_INTERVAL  # Used to copy the segment being written
+
+# pg_dump output formats, with the options and file extension of each one. Custom and
+# directory format dumps are compressed by pg_dump and restored with pg_restore -j.
+DUMP_FORMATS = {
+    'plain': {'options': [], 'extension': '.sql'},
+    'custom': {'options': ['-Fc'], 'extension': '.dump'},
+    'directory': {'options': ['-Fd'], 'extension': '.dir'},
+}
+
+# Base backups are archived as the tars that pg_basebackup -Ft writes, under a base directory.
+# Their backup_label names the first WAL segment that a restore of them needs.
+BASE_DIR = 'base'
+BASE_MEMBER = re.compile(r'(^|/)' + BASE_DIR + r'/(?P<file>[^/]+)$')
+START_WAL = re.compile(r'^START WAL LOCATION: .*\(file (?P<segment>[0-9A-F]{24})\)', re.M)
+
+
+def pg_major(pg_ver):
+    """This function returns the major version of postgres, 9 for 9.4 and 12 for 12.3"""
+    return int(str(pg_ver).split('.')[0])
+
+
+def database_sizes(psql_argv, timeout=None, log=None, env=None):
+    """This function returns the size of every database, so the largest can be dumped first"""
+    result = run(psql_argv + ['-d', 'postgres', '-At', '-F', ' ', '-c',
+                              'SELECT datname, pg_database_size(datname) FROM pg_database'],
+                 capture=True, timeout=timeout, log=log, label='psql', env=env)
+    sizes = {}
+    if failed(result):
+        print("WARNING: The database sizes could not be read, dumping in db_list order.")
+        return sizes
+
+    for line in result['stdout'].split("\n"):
+        fields = line.split(" ")
+        if len(fields) == 2 and fields[1].isdigit():
+            sizes[fields[0]] = int(fields[1])
+    return sizes
+
+
+def dump_database(db_list, index):
+    """This function names the database of a dump, the roles dump comes after the databases"""
+    if index < len(db_list):
+        return db_list[index]
+    return 'pg_roles'
 
 
 # Define the function to pass back to the main backup module.
-def postgres_backup_job(localdir, filedate, args):
+def postgres_backup_job(localdir, filedate, args, compression=None, metrics=None,
+                        limiter=None, log=None):
     """The module will perform the actual postgres backup"""
     # Get the module arguments
     # del args
 
-    # Load the module aregments and jsonify them
-    args = args.replace("'", "\"")
-    args = json.loads(args)
-
     # Get postgres version
     if 'pg_ver' in args:
         pg_ver = args['pg_ver']
@@ -42,19 +98,25 @@ def postgres_backup_job(localdir, filedate, args):
     else:
         pg_dumpall = '/usr/pgsql-' + pg_ver + '/bin/pg_dumpall'
 
+    if 'psql' in args:
+        psql = args['psql']
+    else:
+        psql = '/usr/pgsql-' + pg_ver + '/bin/psql'
+
     # Get credentials
     if 'pg_user' in args:
         pg_user = args['pg_user']
     else:
         pg_user = 'postgres'
 
+    # The password is handed to the dump tools in their environment, never on the command line.
     if 'pg_password' in args:
         pg_password = args['pg_password']
-
-        if pg_password == "":
-            pg_password = "\"\""
     else:
-        pg_password = "\"\""
+        pg_password = ""
+    pg_env = None
+    if pg_password:
+        pg_env = {'PGPASSWORD': pg_password}
 
     # Get Host Info
     if 'pg_host' in args:
@@ -71,7 +133,69 @@ def postgres_backup_job(localdir, filedate, args):
     if 'db_list' in args:
         db_list = args['db_list']
     else:
-        db_list = "postgres"
+        db_list = ["postgres"]
+
+    # Get the number of dumps that are allowed to run at the same time.
+    if 'max_parallel_dumps' in args:
+        max_parallel_dumps = int(args['max_parallel_dumps'])
+        if max_parallel_dumps < 1:
+            max_parallel_dumps = 1
+    else:
+        max_parallel_dumps = 1
+
+    # Stream the dumps straight into the archive instead of staging them in /tmp.
+    if 'stream_dumps' in args:
+        stream = bool(args['stream_dumps'])
+    else:
+        stream = False
+
+    # Get the dump format, directory format dumps a single database with several jobs.
+    if 'pg_format' in args:
+        pg_format = str(args['pg_format']).lower()
+    else:
+        pg_format = 'plain'
+
+    if pg_format not in DUMP_FORMATS:
+        raise SystemExit(" ERROR: Unknown pg_format '" + pg_format + "', valid formats are: " +
+                         ", ".join(sorted(DUMP_FORMATS)))
+
+    if 'pg_dump_jobs' in args:
+        pg_dump_jobs = int(args['pg_dump_jobs'])
+        if pg_dump_jobs < 1:
+            pg_dump_jobs = 1
+    else:
+        pg_dump_jobs = 4
+
+    # Stop any command that runs for longer than this many seconds, by default none is stopped.
+    if 'command_timeout' in args:
+        command_timeout = float(args['command_timeout'])
+    else:
+        command_timeout = None
+
+    # A base backup copies the whole cluster with pg_basebackup instead of dumping databases,
+    # the archived WAL then replays it to any point in time after it.
+    if 'base_backup' in args:
+        base_backup = bool(args['base_backup'])
+    else:
+        base_backup = False
+
+    if 'pg_basebackup' in args:
+        pg_basebackup = args['pg_basebackup']
+    else:
+        pg_basebackup = '/usr/pgsql-' + pg_ver + '/bin/pg_basebackup'
+
+    # How the base backup takes the WAL written while it runs, tars can only stream since 10.
+    if 'wal_method' in args:
+        wal_method = str(args['wal_method']).lower()
+    elif pg_major(pg_ver) >= 10:
+        wal_method = 'stream'
+    else:
+        wal_method = 'fetch'
+
+    # A directory format dump is many files written by pg_dump itself, it can't be streamed.
+    if stream and pg_format == 'directory':
+        print("WARNING: pg_format 'directory' can not be streamed, staging the dumps in /tmp.")
+        stream = False
 
     # Print a warning to the user letting them know the location of the back up file settings.
     print('----------------------------------------------------------------------------')
@@ -89,57 +213,125 @@ def postgres_backup_job(localdir, filedate, args):
     timestamp = str(timestamp[0]).replace(":", "-")
     filedate = filedate[0] + "_" + timestamp
 
+    if base_backup:
+        basebackup_argv = [pg_basebackup, '-h', pg_host, '-p', str(pg_port), '-U', pg_user, '-w',
+                           '-Ft', '-X', wal_method, '-c', 'fast', '-l', 'nimbus ' + filedate]
+        return run_base_backup(localdir, filedate, basebackup_argv, compression, metrics,
+                               limiter, command_timeout, log, pg_env)
 
-    # Create a temp directory to store the backup files in
-    try:
-        tmp_dir = '/tmp/postgres_' + filedate
-        if os.path.isdir(tmp_dir):
-            shutil.rmtree(tmp_dir)
-        os.makedirs(tmp_dir)
-    except:
-        raise SystemExit(" ERROR: Failed to create tmp backup folder")
+    # Create a temp directory to store the backup files in (not needed when streaming)
+    tmp_dir = None
+    if not stream:
+        try:
+            # Unique per run, so jobs started in the same second never share a folder.
+            tmp_dir = tempfile.mkdtemp(prefix='postgres_' + filedate + '_', dir='/tmp')
+        except:
+            raise SystemExit(" ERROR: Failed to create tmp backup folder")
 
     # Perform the backup of the databases
     print("Running backup job...")
     print("--------------------------------------\n")
-    job_log = None
+    connect = ['-h', pg_host, '-p', str(pg_port), '-U', pg_user, '-w']
+    dump_list = []
     for database in db_list:
-        # print(database)
-        db_dump_cmd = pg_dump + " -h " + pg_host + " -p " + str(pg_port) + " -U " + pg_user + \
-        " -w " + " " + database + " > " + tmp_dir + "/" + database + "-" + filedate + ".sql"
-
-        # Execute the Database Backups
-        # print(db_dump_cmd)
-        job_log_header = "Running " + database + " backup..."
-        print("Running " + database + " backup...")
-        execute_backup = os.popen(db_dump_cmd)
-        backup_log = execute_backup.read()
-        execute_backup.close()
-
-        # Concat all of the backup files
-        if job_log is None:
+        db_dump_argv = [pg_dump] + connect + DUMP_FORMATS[pg_format]['options'] + [database]
+        if pg_format == 'directory':
+            db_dump_argv = db_dump_argv + ['-j', str(pg_dump_jobs)]
+        dump_list.append(("Running " + database + " backup...", db_dump_argv,
+                          database + "-" + filedate + DUMP_FORMATS[pg_format]['extension']))
+
+    # Backup the pg_roles
+    db_dumpall_argv = [pg_dumpall] + connect + ['-v', '--globals-only']
+    dump_list.append((None, db_dumpall_argv, "pg_roles-" + filedate + ".sql"))
+
+    # Start the largest databases first, so that the longest dump is not the last one to start.
+    # Within a database pg_dump -j already hands out the largest tables first.
+    schedule = list(range(len(dump_list)))
+    if max_parallel_dumps > 1:
+        sizes = database_sizes([psql] + connect, command_timeout, log, pg_env)
+        schedule.sort(key=lambda index: -sizes.get(db_list[index], 0)
+                      if index < len(db_list) else 0)
+
+    # Execute the Database Backups. The dumps run in a bounded worker pool, but the results
+    # are collected in db_list order so that each database keeps its own section in the log.
+    print("Running up to " + str(max_parallel_dumps) + " dumps at the same time...")
+    tar_name = '/postgres_' + str(filedate) + archive_extension(compression)
+    if stream:
+        # Each dump is compressed on the fly into its own member of an uncompressed tar.
+        tar_name = '/postgres_' + str(filedate) + '.tar'
+        archive = StreamingTar(localdir + "/" + tar_name, limiter)
+        # Custom format dumps are already compressed by pg_dump, so their members are not.
+        member_compression = compression
+        if pg_format == 'custom':
+            member_compression = 'none'
+        member_ext = member_extension(member_compression)
+        streamed = stream_dumps(archive, [(dump_list[index][0], dump_list[index][1],
+                                           'postgres_' + filedate + "/" + dump_list[index][2] +
+                                           member_ext, dump_database(db_list, index))
+                                          for index in schedule],
+                                max_parallel_dumps, member_compression, metrics, command_timeout,
+                                log, pg_env)
+        results = [streamed[schedule.index(index)] for index in range(len(dump_list))]
+    else:
+        dump_calls = []
+        for index in schedule:
+            job_log_header, dump_argv, sql_name = dump_list[index]
+            if job_log_header is not None:
+                print(job_log_header)
+            # Directory format dumps are written by pg_dump itself, the rest come out on stdout.
+            dump_call = {'commands': dump_argv, 'timeout': command_timeout, 'log': log,
+                         'label': dump_database(db_list, index), 'env': pg_env}
+            if sql_name.endswith('.dir'):
+                dump_call['commands'] = dump_argv + ['-f', tmp_dir + "/" + sql_name]
+            else:
+                dump_call['stdout'] = tmp_dir + "/" + sql_name
+            dump_calls.append(dump_call)
+        dumped = run_many(dump_calls, max_parallel_dumps)
+
+        results = []
+        for index, (job_log_header, _, sql_name) in enumerate(dump_list):
+            result = dumped[schedule.index(index)]
+            dump_path = tmp_dir + "/" + sql_name
+            record(metrics, 'dump', result['seconds'], result['cpu'], None,
+                   path_size(dump_path) if os.path.exists(dump_path) else None,
+                   database=dump_database(db_list, index))
+            results.append((job_log_header, result))
+
+    # Concat all of the backup logs, the roles log is appended last without a header.
+    job_log = None
+    failed_dumps = []
+    for index, (job_log_header, result) in enumerate(results):
+        backup_log = describe(result)
+        if failed(result):
+            failed_dumps.append(dump_database(db_list, index))
+        if job_log_header is None and job_log is not None:
+            job_log = job_log + "\n" + backup_log
+        elif job_log_header is None:
+            job_log = backup_log
+        elif job_log is None:
             job_log = job_log_header
             job_log = job_log + "\n" + backup_log
         else:
             job_log = job_log + "\n" + job_log_header + "\n" + backup_log
 
-    # Backup the pg_roles
-    db_dumpall_cmd = pg_dumpall + " -h " + pg_host + " -p " + str(pg_port) + " -U " + pg_user + \
-    " -w " + " -v --globals-only > " + tmp_dir + "/" + "pg_roles-" + filedate + ".sql"
-
-    execute_backup_roles = os.popen(db_dumpall_cmd)
-    job_log_roles = execute_backup_roles.read()
-    execute_backup_roles.close()
-
-    # Concat the logs
-    job_log = job_log + "\n" + job_log_roles
+    # A failed or stopped dump fails the job, without leaving a partial backup behind.
+    if failed_dumps:
+        if stream:
+            archive.close()
+            os.remove(localdir + "/" + tar_name)
+        else:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise SystemError(" ERROR: The dumps of " + ", ".join(failed_dumps) + " failed:\n" +
+                          job_log)
 
     # Copy the pg_hba and postgres config files
     print("\n")
     print("Backing up configuration files...")
     print("---------------------------------\n")
     try:
-        if os.path.isfile("/var/lib/pgsql/" + pg_ver + "/data/pg_hba.conf"):
+        if 'pg_hba' in args:
+            pg_hba = args['pg_hba']
+        elif os.path.isfile("/var/lib/pgsql/" + pg_ver + "/data/pg_hba.conf"):
             pg_hba = "/var/lib/pgsql/" + pg_ver + "/data/pg_hba.conf"
         elif os.path.isfile("/var/lib/pgsql/data/pg_hba.conf"):
             pg_hba = "/var/lib/pgsql/data/pg_hba.conf"
@@ -148,7 +340,9 @@ def postgres_backup_job(localdir, filedate, args):
         raise SystemError("ERROR: pg_hba not found, is postgres-server properly installed!")
 
     try:
-        if os.path.isfile("/var/lib/pgsql/" + pg_ver + "/data/postgresql.conf"):
+        if 'pg_conf' in args:
+            pg_conf = args['pg_conf']
+        elif os.path.isfile("/var/lib/pgsql/" + pg_ver + "/data/postgresql.conf"):
             pg_conf = "/var/lib/pgsql/" + pg_ver + "/data/postgresql.conf"
         elif os.path.isfile("/var/lib/pgsql/data/postgresql.conf"):
             pg_conf = "/var/lib/pgsql/data/postgresql.conf"
@@ -156,6 +350,16 @@ def postgres_backup_job(localdir, filedate, args):
         print("Error: File Not Found!")
         raise SystemError("ERROR: pg_hba not found, is postgres-server properly installed!")
 
+    # In streaming mode the archive is already in the local directory, so just finish it off.
+    if stream:
+        archive.add_file(pg_hba, 'postgres_' + filedate + "/pg_hba")
+        archive.add_file(pg_conf, 'postgres_' + filedate + "/postgres.conf")
+        archive.close()
+
+        print("Job backup module completed...")
+        print("-----------------------------\n")
+        return tar_name, job_log
+
     shutil.copyfile(pg_hba, tmp_dir + "/pg_hba")
     shutil.copyfile(pg_conf, tmp_dir + "/postgres.conf")
 
@@ -163,14 +367,16 @@ def postgres_backup_job(localdir, filedate, args):
     print("Creating backup archive...")
     print("--------------------------\n")
     # Create the name of the tarball
-    tar_name = '/postgres_' + str(filedate) + '.tar.gz'
     tar_path = tmp_dir + tar_name
 
     # Tar the files
-    tar = tarfile.open(tar_path, 'w:gz')
-    for file_name in os.listdir(tmp_dir):
-        tar.add(tmp_dir + "/" + file_name)
-    tar.close()
+    with phase(metrics, 'archive') as measured:
+        tar = ArchiveWriter(tar_path, compression, limiter)
+        for file_name in os.listdir(tmp_dir):
+            tar.add(tmp_dir + "/" + file_name)
+        tar.close()
+        measured['bytes_in'] = path_size(tmp_dir) - os.path.getsize(tar_path)
+        measured['bytes_out'] = os.path.getsize(tar_path)
 
     # Move the backup to the local directory
     print("Moving backup archive to " + localdir + "...")
@@ -193,3 +399,406 @@ def postgres_backup_job(localdir, filedate, args):
     print("Job backup module completed...")
     print("-----------------------------\n")
     return tar_name, job_log
+
+
+def basebackup_start(base_tar):
+    """This function reads the first WAL segment a base backup needs out of its backup_label"""
+    with tarfile.open(base_tar) as tar:
+        label = tar.extractfile('backup_label').read().decode()
+    match = START_WAL.search(label)
+    if match is None:
+        raise SystemError(" ERROR: The start of the WAL could not be read from the backup_label "
+                          "of " + base_tar)
+    return match.group('segment')
+
+
+def run_base_backup(localdir, filedate, basebackup_argv, compression=None, metrics=None,
+                    limiter=None, command_timeout=None, log=None, pg_env=None):
+    """This function takes a base backup of the whole cluster and archives it"""
+    try:
+        tmp_dir = tempfile.mkdtemp(prefix='postgres_' + filedate + '_', dir='/tmp')
+    except OSError:
+        raise SystemExit(" ERROR: Failed to create tmp backup folder")
+
+    print("Running base backup...")
+    print("--------------------------------------\n")
+    base_dir = tmp_dir + "/" + BASE_DIR
+    result = run(basebackup_argv + ['-D', base_dir], timeout=command_timeout, log=log,
+                 label='pg_basebackup', env=pg_env)
+    record(metrics, 'dump', result['seconds'], result['cpu'], None,
+           path_size(base_dir) if os.path.exists(base_dir) else None, database=BASE_DIR)
+    job_log = "Running base backup...\n" + describe(result)
+    if failed(result):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise SystemError(" ERROR: The base backup failed:\n" + job_log)
+    segment = basebackup_start(base_dir + "/base.tar")
+
+    # The tars of the cluster, its tablespaces and the WAL it needs are archived as they are.
+    print("Creating backup archive...")
+    print("--------------------------\n")
+    tar_name = '/postgres_' + str(filedate) + archive_extension(compression)
+    tar_path = tmp_dir + tar_name
+    with phase(metrics, 'archive') as measured:
+        tar = ArchiveWriter(tar_path, compression, limiter)
+        for file_name in sorted(os.listdir(base_dir)):
+            tar.add(base_dir + "/" + file_name, 'postgres_' + filedate + "/" + BASE_DIR + "/" +
+                    file_name)
+        tar.close()
+        measured['bytes_in'] = path_size(base_dir)
+        measured['bytes_out'] = os.path.getsize(tar_path)
+
+    try:
+        shutil.move(tar_path, localdir + "/" + tar_name)
+        shutil.rmtree(tmp_dir)
+    except OSError as err:
+        print("OS error: {0}".format(err))
+        raise SystemError(" ERROR: Backup could not be moved!")
+
+    # The WAL retention keeps every segment from this one on, for as long as the archive is kept.
+    write_start_marker(localdir, tar_name, segment)
+    job_log = job_log + "\nThe base backup needs the WAL from segment " + segment + " on.\n"
+
+    print("Job backup module completed...")
+    print("-----------------------------\n")
+    return tar_name, job_log
+
+
+# Define the function to pass back to the WAL archiver.
+def postgres_wal_job(localdir, args, ship, stop, log=None):
+    """The module will stream the WAL of the cluster with pg_receivewal until it is stopped"""
+    # The receiver writes to its own spool, ship puts the WAL in the backup directories.
+    del localdir
+
+    if 'pg_ver' in args:
+        pg_ver = args['pg_ver']
+    else:
+        pg_ver = "9.4"
+
+    # pg_receivewal was called pg_receivexlog before postgres 10.
+    if 'pg_receivewal' in args:
+        pg_receivewal = args['pg_receivewal']
+    elif pg_major(pg_ver) >= 10:
+        pg_receivewal = '/usr/pgsql-' + pg_ver + '/bin/pg_receivewal'
+    else:
+        pg_receivewal = '/usr/pgsql-' + pg_ver + '/bin/pg_receivexlog'
+
+    if 'pg_user' in args:
+        pg_user = args['pg_user']
+    else:
+        pg_user = 'postgres'
+
+    if 'pg_password' in args:
+        pg_password = args['pg_password']
+    else:
+        pg_password = ""
+    pg_env = None
+    if pg_password:
+        pg_env = {'PGPASSWORD': pg_password}
+
+    if 'pg_host' in args:
+        pg_host = args['pg_host']
+    else:
+        pg_host = 'localhost'
+
+    if 'pg_port' in args:
+        pg_port = args['pg_port']
+    else:
+        pg_port = 5432
+
+    # The replication slot keeps the server from recycling WAL that was not received yet.
+    if 'wal_slot' in args:
+        wal_slot = args['wal_slot']
+    else:
+        wal_slot = 'nimbus'
+
+    if 'wal_spool_dir' in args:
+        wal_spool_dir = args['wal_spool_dir']
+    else:
+        wal_spool_dir = '/var/lib/nimbus/postgres_wal'
+
+    # How often the segment that is still being written is copied out, in seconds.
+    if 'wal_partial_interval' in args:
+        wal_partial_interval = float(args['wal_partial_interval'])
+    else:
+        wal_partial_interval = PARTIAL_INTERVAL
+
+    connect = ['-h', pg_host, '-p', str(pg_port), '-U', pg_user, '-w']
+    receive_argv = [pg_receivewal] + connect + ['-D', wal_spool_dir, '--no-loop', '--synchronous']
+    if wal_slot:
+        result = run([pg_receivewal] + connect + ['-S', wal_slot, '--create-slot',
+                                                  '--if-not-exists'],
+                     log=log, label='pg_receivewal', env=pg_env)
+        if failed(result):
+            raise SystemError(" ERROR: The replication slot " + wal_slot + " could not be "
+                              "created:\n" + describe(result))
+        receive_argv = receive_argv + ['-S', wal_slot]
+
+    print("Streaming WAL into " + wal_spool_dir + "...")
+    print("--------------------------------------\n")
+    stats = receive_wal(receive_argv, wal_spool_dir, ship, stop, wal_partial_interval, pg_env,
+                        log)
+
+    print("Job WAL module completed...")
+    print("--------------------------\n")
+    return ("Archived " + str(stats['shipped']) + " WAL files and " + str(stats['partials']) +
+            " partial segments, " + str(stats['failed']) + " copies failed and were retried, " +
+            pg_receivewal + " was restarted " + str(stats['restarts']) + " times.\n")
+
+
+def unpack_tar(fileobj, target_dir):
+    """This function unpacks a tar of a base backup as it streams out of the archive"""
+    with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        # The tar filter keeps the file modes postgres insists on, but nothing outside target_dir.
+        if hasattr(tarfile, 'tar_filter'):
+            tar.extractall(target_dir, filter='tar')
+        else:
+            tar.extractall(target_dir)
+
+
+def check_empty(dir_path):
+    """This function makes sure that a base backup is never unpacked over an existing cluster"""
+    if os.path.isdir(dir_path) and os.listdir(dir_path):
+        raise SystemExit(" ERROR: " + dir_path + " is not empty, stop postgres and move it out "
+                         "of the way before restoring a base backup into it")
+    os.makedirs(dir_path, mode=0o700, exist_ok=True)
+
+
+def tablespace_map(pg_data):
+    """This function reads where each tablespace of a restored base backup belongs"""
+    locations = {}
+    try:
+        with open(os.path.join(pg_data, 'tablespace_map')) as map_file:
+            for line in map_file:
+                oid, _, location = line.rstrip("\n").partition(" ")
+                if oid:
+                    locations[oid] = location
+    except FileNotFoundError:
+        pass
+    return locations
+
+
+def recovery_settings(pg_data, pg_ver, restore_cmd, target_time=None):
+    """This function sets up a restored base backup to replay the archived WAL when it starts"""
+    settings = ["restore_command = '" + restore_cmd.replace("'", "''") + "'"]
+    if target_time:
+        settings.append("recovery_target_time = '" + str(target_time) + "'")
+        settings.append("recovery_target_action = 'promote'")
+    if pg_major(pg_ver) >= 12:
+        # Since postgres 12 the settings are ordinary settings and a signal file starts recovery.
+        with open(os.path.join(pg_data, 'postgresql.auto.conf'), 'a') as conf_file:
+            conf_file.write("\n".join(settings) + "\n")
+        open(os.path.join(pg_data, 'recovery.signal'), 'w').close()
+    else:
+        with open(os.path.join(pg_data, 'recovery.conf'), 'w') as conf_file:
+            conf_file.write("\n".join(settings) + "\n")
+
+
+def run_restore(job_log_header, create_argv, restore_task, *task_args):
+    """This function creates a database and runs a single restore task into it"""
+    print(job_log_header)
+    subprocess.call(create_argv, stderr=subprocess.DEVNULL)
+    return job_log_header, restore_task(*task_args)
+
+
+# Define the function to pass back to the restore script.
+def postgres_restore_job(archives, args, jobs=1, databases=None):
+    """The module will restore the databases of a postgres backup archive"""
+    # Get postgres version
+    if 'pg_ver' in args:
+        pg_ver = args['pg_ver']
+    else:
+        pg_ver = "9.4"
+
+    # Get path of binaries
+    if 'psql' in args:
+        psql = args['psql']
+    else:
+        psql = '/usr/pgsql-' + pg_ver + '/bin/psql'
+
+    if 'pg_restore' in args:
+        pg_restore = args['pg_restore']
+    else:
+        pg_restore = '/usr/pgsql-' + pg_ver + '/bin/pg_restore'
+
+    if 'createdb' in args:
+        createdb = args['createdb']
+    else:
+        createdb = '/usr/pgsql-' + pg_ver + '/bin/createdb'
+
+    # Get credentials and host info
+    if 'pg_user' in args:
+        pg_user = args['pg_user']
+    else:
+        pg_user = 'postgres'
+
+    if 'pg_host' in args:
+        pg_host = args['pg_host']
+    else:
+        pg_host = 'localhost'
+
+    if 'pg_port' in args:
+        pg_port = args['pg_port']
+    else:
+        pg_port = 5432
+
+    # Get the number of databases that are allowed to restore at the same time.
+    if 'max_parallel_restores' in args:
+        max_parallel_restores = int(args['max_parallel_restores'])
+        if max_parallel_restores < 1:
+            max_parallel_restores = 1
+    else:
+        max_parallel_restores = 1
+
+    # Base backups are unpacked into an empty data directory instead of restored through psql.
+    if 'pg_data' in args:
+        pg_data = args['pg_data']
+    else:
+        pg_data = '/var/lib/pgsql/' + pg_ver + '/data'
+
+    # The command postgres runs to fetch each archived WAL file, it fills in %f and %p itself.
+    if 'wal_restore_command' in args:
+        wal_restore_command = args['wal_restore_command']
+    else:
+        wal_restore_command = None
+
+    # Replay the WAL up to this time, by default all of the archived WAL is replayed.
+    if 'recovery_target_time' in args:
+        recovery_target_time = args['recovery_target_time']
+    else:
+        recovery_target_time = None
+
+    # Every command gets the database name as an argument of its own, never through a shell.
+    connect = ['-h', pg_host, '-p', str(pg_port), '-U', pg_user, '-w']
+
+    # Custom and directory format dumps need a real file for pg_restore -j, so only they are
+    # extracted to disk. Plain dumps are piped straight out of the archive into psql.
+    try:
+        tmp_dir = tempfile.mkdtemp(prefix='postgres_restore_', dir='/tmp')
+    except OSError:
+        raise SystemExit(" ERROR: Failed to create tmp restore folder")
+
+    print("Running restore job...")
+    print("--------------------------------------\n")
+    results = []
+    waiting = []
+    extracted = {}
+    tablespaces = {}
+    base_restored = False
+    roles_restored = False
+    with ThreadPoolExecutor(max_workers=max_parallel_restores) as executor:
+        futures = []
+
+        def submit(*restore):
+            """This function queues a restore, holding it back until the roles are restored"""
+            if roles_restored:
+                futures.append(executor.submit(run_restore, *restore))
+            else:
+                waiting.append(restore)
+
+        for archive in archives:
+            for member in archive.members():
+                # A base backup is the whole cluster, so it is restored whatever databases were
+                # asked for. The tablespaces come first but can only be placed after base.tar.
+                base_match = BASE_MEMBER.search(member.name)
+                if base_match is not None and member.isfile():
+                    base_file = base_match.group('file')
+                    if base_file == 'base.tar':
+                        print("Unpacking the base backup into " + pg_data + "...")
+                        check_empty(pg_data)
+                        unpack_tar(archive.extractfile(member), pg_data)
+                        base_restored = True
+                    elif base_file == 'pg_wal.tar':
+                        unpack_tar(archive.extractfile(member), os.path.join(pg_data, 'pg_wal'))
+                    elif base_file.endswith('.tar'):
+                        tablespaces[base_file[:-len('.tar')]] = extract_member(
+                            archive.extractfile(member), tmp_dir, base_file)
+                    continue
+
+                database, dump_format, entry = dump_member(member.name)
+                if not member.isfile() or database is None:
+                    print("Skipping " + member.name + "...")
+                    continue
+                if databases is not None and database not in databases + ['pg_roles']:
+                    continue
+                fileobj = archive.extractfile(member)
+                job_log_header = "Restoring " + database + "..."
+
+                if database == 'pg_roles':
+                    # The roles own the objects of every database, so they go in first.
+                    print("Restoring roles...")
+                    results.append(("Restoring roles...",
+                                    pipe_member(fileobj, member.name,
+                                                [psql] + connect + ['-q', '-d', 'postgres'])))
+                    roles_restored = True
+                    for restore in waiting:
+                        submit(*restore)
+                    del waiting[:]
+                elif dump_format == 'sql' and roles_restored:
+                    results.append(run_restore(job_log_header,
+                                               [createdb] + connect + ['--', database],
+                                               pipe_member, fileobj, member.name,
+                                               [psql] + connect + ['-q', '-d', database]))
+                elif dump_format == 'sql':
+                    # The roles are further on in the archive, keep the dump as it is until then.
+                    spool_path = extract_member(fileobj, tmp_dir, os.path.basename(member.name))
+                    submit(job_log_header, [createdb] + connect + ['--', database], pipe_file,
+                           spool_path, [psql] + connect + ['-q', '-d', database])
+                elif dump_format == 'dump':
+                    dump_path = extract_member(fileobj, tmp_dir, os.path.basename(member.name))
+                    submit(job_log_header, [createdb] + connect + ['--', database], run_command,
+                           [pg_restore] + connect + ['-j', str(jobs), '-d', database, '--',
+                                                     dump_path])
+                else:
+                    # Directory dumps are restored once all of their files are extracted.
+                    extracted[database] = tmp_dir + "/" + database + ".dir"
+                    extract_member(fileobj, extracted[database], entry)
+
+        # Directory format dumps can only be restored once the whole archive has been read.
+        for database, dump_dir in extracted.items():
+            submit("Restoring " + database + "...", [createdb] + connect + ['--', database],
+                   run_command, [pg_restore] + connect + ['-Fd', '-j', str(jobs), '-d', database,
+                                                          '--', dump_dir])
+
+        # Restore whatever was still waiting on a roles dump that was not in the archive.
+        roles_restored = True
+        for restore in waiting:
+            submit(*restore)
+        results.extend(future.result() for future in futures)
+
+    # Put the tablespaces back where the base backup says they were, and have postgres replay
+    # the archived WAL when it is started.
+    if base_restored:
+        locations = tablespace_map(pg_data)
+        for oid, tablespace_path in sorted(tablespaces.items()):
+            if oid not in locations:
+                raise SystemExit(" ERROR: Tablespace " + oid + " is not in the tablespace_map of "
+                                 "the base backup")
+            check_empty(locations[oid])
+            with open(tablespace_path, 'rb') as tablespace_file:
+                unpack_tar(tablespace_file, locations[oid])
+        os.chmod(pg_data, 0o700)
+        if wal_restore_command:
+            recovery_settings(pg_data, pg_ver, wal_restore_command, recovery_target_time)
+            print("Postgres will replay the archived WAL" +
+                  (" up to " + str(recovery_target_time) if recovery_target_time else "") +
+                  " when it is started.")
+        else:
+            print("WARNING: 'wal_restore_command' is not set, postgres will only replay the WAL "
+                  "that is in the base backup itself.")
+        results.append(("Restoring the base backup into " + pg_data + "...", 0))
+
+    # Remove the tmp directory.
+    try:
+        shutil.rmtree(tmp_dir)
+    except OSError as err:
+        print("OS error: {0}".format(err))
+        raise SystemError(" ERROR: " + tmp_dir + " could not be removed.")
+
+    failed_restores = [job_log_header for job_log_header, return_code in results
+                       if return_code != 0]
+    if failed_restores:
+        raise SystemExit(" ERROR: The restore failed for: " + ", ".join(failed_restores))
+
+    print("Job restore module completed...")
+    print("------------------------------\n")
+    return results
@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            This script will restore a backup archive taken by nimbus,
+                        reading it from the fastest copy in the backup directories. It also
+                        fetches the archived WAL for the restore_command of postgres.
+***************************************************************************
+"""
+# Define all modules that this script will require to function
+import argparse  # Get, and parse incoming arguments from the execution of the script
+import datetime  # Used to time the restore
+
+# Import Nimbus class libraries
+from libs.parseconf import ParseConf  # Class to parse the referenced config file.
+from libs.jobselect import restore_select  # FN to grab information about the restore module.
+from libs.restore import list_archives, restore_chain  # Used to find the archives to restore.
+from libs.restore import find_replicas, select_replica, read_archives  # Used to read them.
+from libs.walarchive import fetch_wal  # Used to fetch the archived WAL during a recovery.
+from libs.objectstore import OBJECT_STORE_TYPES, open_bucket  # Used to reach the object stores.
+
+'''
+***************************************************************************
+Get Passed Arguments and Build the Help feature.
+***************************************************************************
+'''
+# Gather Input Arugments:
+BACKUP_JOB_DESC = """
+The backup job module whose archive you want to restore.
+Available module options currently are:
+postgres, mysql, mariadb, gitlab
+"""
+CONFIG_FILE_DESC = """
+The full path location of the config file that was used to take
+the backup. Its backup directories are searched for the archive.
+(/root/backup/mygitserver.ini)
+"""
+ARCHIVE_DESC = """
+The name of the archive to restore (postgres_2017-01-31_02-00-00.tar.gz),
+or latest for the newest archive. Incremental archives are restored on
+top of the full archive they belong to.
+"""
+JOBS_DESC = """
+The number of parallel jobs each pg_restore may use for custom and
+directory format dumps.
+"""
+DATABASES_DESC = """
+A comma separated list of the databases to restore, all of the
+databases in the archive are restored by default.
+"""
+LIST_DESC = """
+List the archives found in the backup directories, and the copies of
+the selected archive with their probe times, without restoring anything.
+"""
+WAL_DESC = """
+Fetch a single archived WAL file into a path and exit, for the restore_command
+of postgres: restore.py -b postgres -c /etc/nimbus/postgres.ini --wal %%f %%p
+"""
+
+# Parse input arguments #
+PARSE = argparse.ArgumentParser(description='NIMBUS is a modular backup utility \
+                                designed to backup many different type of applications')
+PARSE.add_argument('-b', '--backup', help=BACKUP_JOB_DESC, required=True)
+PARSE.add_argument('-c', '--config', help=CONFIG_FILE_DESC, required=True)
+PARSE.add_argument('-a', '--archive', help=ARCHIVE_DESC, default='latest')
+PARSE.add_argument('-j', '--jobs', help=JOBS_DESC, type=int, default=4)
+PARSE.add_argument('-D', '--databases', help=DATABASES_DESC)
+PARSE.add_argument('-l', '--list', help=LIST_DESC, action='store_true')
+PARSE.add_argument('--wal', help=WAL_DESC, nargs=2, metavar=('WAL_FILE', 'PATH'))
+
+'''
+***************************************************************************
+Define the Restore Job Run.
+***************************************************************************
+'''
+
+
+def run_restore(backup_job, config_file, archive_name='latest', jobs=4, databases=None,
+                list_only=False):
+    """This function restores an archive of a backup job from the backup directories."""
+    app, job, archive_prefix = restore_select(backup_job.upper())
+    conf = ParseConf(config_file)
+    backup_dirs = conf.backup_dirs()
+
+    # Find the archive, and the full archive it builds on if it is an incremental.
+    archives = list_archives(backup_dirs, archive_prefix)
+    if not archives:
+        raise SystemExit(" ERROR: No " + app + " archives were found in the backup directories.")
+    if archive_name == 'latest':
+        archive_name = archives[-1]
+    archive_name = archive_name.lstrip('/')
+    chain = restore_chain(archives, archive_name, archive_prefix)
+
+    if list_only:
+        print("Archives:")
+        for name in archives:
+            print('\t' + name)
+        print("Copies of " + archive_name + ":")
+        replicas = find_replicas(backup_dirs, archive_name)
+        select_replica(replicas)
+        for replica in replicas:
+            probe = "unreachable"
+            if replica['seconds'] is not None:
+                probe = "{0:.1f}".format(replica['seconds'] * 1000) + " ms"
+            print('\t' + str(replica['label']) + ': ' + replica['path'] + ' (' + probe + ')')
+        return None
+
+    print('\n')
+    print("Restore Job: " + app)
+    print("Archives: " + ", ".join(chain))
+    print('\n')
+
+    restore_start = datetime.datetime.now()
+    results = job(read_archives(backup_dirs, chain), conf.module_args(), jobs=jobs,
+                  databases=databases)
+    print("Restore took: " + str(datetime.datetime.now() - restore_start) + "\n")
+    return results
+
+
+def run_fetch_wal(config_file, wal_file, target_path):
+    """This function fetches an archived WAL file, the local directory is tried first."""
+    conf = ParseConf(config_file)
+    backup_dirs = sorted((directory for directory in conf.backup_dirs()
+                          if directory.type != "chunkstore"),
+                         key=lambda directory: directory.type != "local")
+    copy_path = fetch_wal([open_bucket(directory) if directory.type in OBJECT_STORE_TYPES
+                           else directory.full_path for directory in backup_dirs], wal_file,
+                          target_path)
+    # Recovery asks for files that were never archived to find the end of the WAL, so a
+    # missing file only has to fail the command, quietly.
+    if copy_path is None:
+        raise SystemExit(1)
+    print("Restored " + wal_file + " from " + copy_path)
+    return copy_path
+
+
+def main():
+    """This function runs the restore given on the command line."""
+    args = PARSE.parse_args()
+    if args.wal:
+        run_fetch_wal(args.config, args.wal[0], args.wal[1])
+        return
+    databases = None
+    if args.databases:
+        databases = [database.strip() for database in args.databases.split(',')]
+    run_restore(args.backup, args.config, args.archive, args.jobs, databases, args.list)
+
+
+if __name__ == '__main__':
+    main()
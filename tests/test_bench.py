@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Benchmark:				Benchmark harness tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests run the stand-in dump tools and a small benchmark of
+                        every job, and check the comparison against earlier results.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to set the scale of the stand-in tools
+import copy  # Used to build the baseline results
+import zlib  # Used to read the custom format dumps back
+import shutil  # Used to clean up the test directories
+import argparse  # Used to pass the benchmark settings
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+from unittest import mock  # Used to see which archives are copied
+import subprocess  # Used to run the stand-in tools
+
+# Import Nimbus class libraries
+from bench import run_bench  # The harness under test
+import backup  # Used to see which archives are copied
+
+
+class BenchTest(unittest.TestCase):
+    """This class tests the benchmark harness and its stand-in tools"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_bench_')
+        self.bin_dir = os.path.join(self.work_dir, 'bin')
+        self.environ = dict(os.environ)
+        run_bench.install_stand_ins(self.bin_dir)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.work_dir)
+
+    def run_tool(self, tool, *argv):
+        """This function runs a stand-in tool and returns its output"""
+        return subprocess.check_output([os.path.join(self.bin_dir, tool)] + list(argv))
+
+    def test_stand_ins(self):
+        """The stand-in pg_dump writes the dataset scaled up in each of its formats"""
+        os.environ['NIMBUS_BENCH_SCALE'] = '1'
+        plain = self.run_tool('pg_dump', 'booktown')
+        os.environ['NIMBUS_BENCH_SCALE'] = '3'
+        scaled = self.run_tool('pg_dump', 'booktown')
+        self.assertEqual(scaled.count(b'-- nimbus benchmark copy '), 3)
+        self.assertEqual(len(scaled), 3 * len(plain))
+
+        custom = self.run_tool('pg_dump', '-Fc', 'booktown')
+        self.assertEqual(custom[:5], b'PGDMP')
+        self.assertEqual(zlib.decompress(custom[5:]), scaled)
+
+        dump_dir = os.path.join(self.work_dir, 'booktown.dir')
+        self.run_tool('pg_dump', '-Fd', '-f', dump_dir, 'booktown')
+        self.assertEqual(sorted(os.listdir(dump_dir)), ['3001.dat.gz', 'toc.dat'])
+        self.assertIn(b'CREATE ROLE', self.run_tool('pg_dumpall', '--globals-only'))
+
+    def test_run_bench(self):
+        """Every job runs end to end with an S3 copy, and a slower phase is a regression"""
+        args = argparse.Namespace(jobs='postgres,mysql,gitlab', scales='1', destinations='2',
+                                  codec='gz', repeat=1, module_args='{}', s3=True,
+                                  work_dir=os.path.join(self.work_dir, 'bench'))
+        copied = []
+        real_fan_out = backup.fan_out
+
+        def fan_out(source_path, *fan_out_args, **kwargs):
+            """This function records the archive before it is copied"""
+            copied.append(source_path)
+            return real_fan_out(source_path, *fan_out_args, **kwargs)
+
+        with mock.patch.object(backup, 'fan_out', fan_out):
+            results = run_bench.run_bench(args)
+        self.assertEqual([result['job'] for result in results], ['postgres', 'mysql', 'gitlab'])
+        self.assertEqual(len(copied), 3)
+        for source_path in copied:
+            self.assertNotIn('//', source_path)
+        for result in results:
+            self.assertGreater(result['archive_bytes'], 0)
+            self.assertEqual(sorted(result['phases']), sorted(run_bench.PHASES))
+
+        baseline = {'results': copy.deepcopy(results)}
+        self.assertEqual(run_bench.compare(results, baseline, 10.0), [])
+        for result in results:
+            result['phases']['copy'] = result['phases']['copy'] * 2 + 0.1
+        slower = run_bench.compare(results, baseline, 10.0)
+        self.assertEqual([(key[0], phase) for key, phase, _ in slower],
+                         [('postgres', 'copy'), ('mysql', 'copy'), ('gitlab', 'copy')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Module:					Chunk Store tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests store archives in a chunk store and read them back,
+                        and check that the garbage collection only removes the chunks that
+                        no manifest needs anymore.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import io  # Used to reassemble the archives in memory
+import os  # Used to write the test archives
+import random  # Used to make the same test archives on every run
+import time  # Used to give the garbage collection a chance to run
+import shutil  # Used to clean up the test directories
+import tempfile  # Used to create the test directories
+import threading  # Used to run the garbage collection next to a copy
+import unittest  # Used to run the tests
+
+# Import Nimbus class libraries
+from libs.chunkstore import ChunkStoreSink, collect_garbage, reassemble, manifest_path
+from libs.fanout import fan_out  # Used to copy the archives into the store
+
+# The archives are seeded, so that their chunk boundaries are the same on every run.
+ARCHIVE_SIZE = 4 * 1024 * 1024
+ARCHIVE_SEED = 2016
+INSERT = b'inserted' * 1000
+
+
+class ChunkStoreTest(unittest.TestCase):
+    """This class tests the chunk store destination type"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_chunkstore_')
+        self.store_path = os.path.join(self.work_dir, 'store')
+        os.makedirs(self.store_path)
+        self.data = random.Random(ARCHIVE_SEED).randbytes(ARCHIVE_SIZE)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_archive(self, archive_name, data):
+        """This function writes a test archive and returns its path"""
+        archive_path = os.path.join(self.work_dir, archive_name)
+        with open(archive_path, 'wb') as archive:
+            archive.write(data)
+        return archive_path
+
+    def store(self, archive_name, data):
+        """This function copies a test archive into the store and returns its result"""
+        archive_path = self.write_archive(archive_name, data)
+        _, results = fan_out(archive_path, [ChunkStoreSink('store', self.store_path,
+                                                           archive_name)])
+        self.assertIsNone(results[0]['error'])
+        return results[0]
+
+    def read_back(self, archive_name):
+        """This function reassembles an archive from the store"""
+        fileobj = io.BytesIO()
+        reassemble(self.store_path, archive_name, fileobj)
+        return fileobj.getvalue()
+
+    def test_round_trip_and_dedup(self):
+        """An archive comes back as it went in, and a similar one only stores what is new"""
+        first = self.store('first.tar', self.data)
+        self.assertEqual(first['stored_bytes'], ARCHIVE_SIZE)
+        # Content defined chunks realign after an insert, so most of the second archive is known.
+        second_data = INSERT + self.data
+        second = self.store('second.tar', second_data)
+        self.assertGreater(second['stored_bytes'], 0)
+        self.assertLess(second['stored_bytes'], ARCHIVE_SIZE)
+        self.assertEqual(self.read_back('first.tar'), self.data)
+        self.assertEqual(self.read_back('second.tar'), second_data)
+
+    def test_gc_keeps_the_chunks_still_referenced(self):
+        """The garbage collection removes the chunks of a dropped manifest and nothing else"""
+        self.store('first.tar', self.data)
+        self.store('second.tar', INSERT + self.data)
+        self.assertEqual(collect_garbage(self.store_path), (0, 0))
+
+        os.remove(manifest_path(self.store_path, 'first.tar'))
+        removed_chunks, removed_bytes = collect_garbage(self.store_path)
+        self.assertGreater(removed_chunks, 0)
+        self.assertLess(removed_bytes, ARCHIVE_SIZE)
+        self.assertEqual(self.read_back('second.tar'), INSERT + self.data)
+
+    def test_gc_waits_for_a_copy_in_progress(self):
+        """Chunks that a copy wrote but has no manifest for yet are never collected"""
+        archive_path = self.write_archive('first.tar', self.data)
+        sink = ChunkStoreSink('store', self.store_path, 'first.tar')
+        sink.open(archive_path)
+        sink.write(self.data)
+
+        collected = []
+        collector = threading.Thread(target=lambda: collected.append(
+            collect_garbage(self.store_path)))
+        collector.start()
+        time.sleep(0.2)
+        self.assertEqual(collected, [])
+
+        sink.close(archive_path, None)
+        collector.join()
+        self.assertEqual(collected, [(0, 0)])
+        self.assertEqual(self.read_back('first.tar'), self.data)
+
+    def test_aborted_copy_leaves_no_manifest(self):
+        """A failed copy writes no manifest and lets the garbage collection run"""
+        archive_path = self.write_archive('first.tar', self.data)
+        sink = ChunkStoreSink('store', self.store_path, 'first.tar')
+        sink.open(archive_path)
+        sink.write(self.data)
+        sink.abort()
+        self.assertFalse(os.path.exists(manifest_path(self.store_path, 'first.tar')))
+        removed_chunks, _ = collect_garbage(self.store_path)
+        self.assertGreater(removed_chunks, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
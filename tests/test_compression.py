@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Compression tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests write archives and members with every codec and read
+                        them back, and check the validation of the compression setting.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import io  # Used to hold the compressed members
+import os  # Used to write the test files
+import bz2  # Used to read the bz2 members back
+import gzip  # Used to read the gz members back
+import lzma  # Used to read the xz members back
+import shutil  # Used to find the external compressors and clean up
+import tarfile  # Used to read the archives back
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+import subprocess  # Used to decompress with the external compressors
+
+# Import Nimbus class libraries
+from libs.compression import CODECS, ArchiveWriter, get_codec  # The library under test
+from libs.compression import archive_extension, member_writer  # The library under test
+from libs.compression import ParallelGzipFile, get_threads, get_volume_size  # Under test
+
+PAYLOAD = b"".join(b"row " + str(row).encode() + b"\n" for row in range(5000))
+READERS = {'gz': gzip.decompress, 'bz2': bz2.decompress, 'xz': lzma.decompress,
+           'none': lambda data: data}
+
+
+def installed(codec):
+    """This function checks whether the external compressor of a codec is on the path"""
+    return shutil.which(CODECS[codec]['command'].split()[0]) is not None
+
+
+class CompressionTest(unittest.TestCase):
+    """This class tests the compression codecs"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_compression_')
+        self.source_dir = os.path.join(self.work_dir, 'source')
+        os.makedirs(self.source_dir)
+        with open(os.path.join(self.source_dir, 'dump.sql'), 'wb') as dump_file:
+            dump_file.write(PAYLOAD)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_archive(self, codec):
+        """This function archives the source directory with a codec and returns the path"""
+        tar_path = os.path.join(self.work_dir, 'backup' + archive_extension(codec))
+        archive = ArchiveWriter(tar_path, {'codec': codec})
+        archive.add(self.source_dir, arcname='source')
+        archive.close()
+        return tar_path
+
+    def read_member(self, tar_path):
+        """This function reads the dump back out of a plain or builtin codec archive"""
+        with tarfile.open(tar_path) as tar:
+            return tar.extractfile('source/dump.sql').read()
+
+    def test_builtin_archives_round_trip(self):
+        """Archives written with the tarfile codecs read back to the same contents"""
+        for codec in ['gz', 'bz2', 'xz', 'none']:
+            with self.subTest(codec=codec):
+                self.assertEqual(self.read_member(self.write_archive(codec)), PAYLOAD)
+
+    def test_external_archives_round_trip(self):
+        """Archives piped through zstd and lz4 decompress back to a readable tar"""
+        for codec in ['zstd', 'lz4']:
+            with self.subTest(codec=codec):
+                if not installed(codec):
+                    self.skipTest(codec + " is not installed")
+                tar_path = self.write_archive(codec)
+                tar_data = subprocess.check_output([CODECS[codec]['command'].split()[0],
+                                                    '-d', '-c', tar_path])
+                with tarfile.open(fileobj=io.BytesIO(tar_data)) as tar:
+                    self.assertEqual(tar.extractfile('source/dump.sql').read(), PAYLOAD)
+
+    def test_members_round_trip(self):
+        """Members compressed by the builtin codecs decompress back to what was written"""
+        for codec, reader in READERS.items():
+            with self.subTest(codec=codec):
+                fileobj = io.BytesIO()
+                with member_writer(fileobj, 'dump.sql', codec) as member:
+                    member.write(PAYLOAD)
+                self.assertFalse(fileobj.closed)
+                self.assertEqual(reader(fileobj.getvalue()), PAYLOAD)
+
+    def test_archive_skips_itself(self):
+        """An archive written inside the directory it archives does not add itself"""
+        tar_path = os.path.join(self.source_dir, 'backup.tar.gz')
+        archive = ArchiveWriter(tar_path, 'gz')
+        archive.add(self.source_dir, arcname='source')
+        archive.close()
+        with tarfile.open(tar_path) as tar:
+            self.assertEqual(sorted(tar.getnames()), ['source', 'source/dump.sql'])
+
+    def test_get_codec(self):
+        """The compression setting falls back to gz and rejects bad codecs and levels"""
+        self.assertEqual(get_codec(), ('gz', 6))
+        self.assertEqual(get_codec('XZ'), ('xz', 6))
+        self.assertEqual(get_codec({'codec': 'zstd', 'level': '19'}), ('zstd', 19))
+        self.assertEqual(archive_extension({'codec': 'lz4'}), '.tar.lz4')
+        self.assertEqual(archive_extension('none'), '.tar')
+        # A level left over from another codec means nothing to none.
+        self.assertEqual(get_codec({'codec': 'none', 'level': 9}), ('none', None))
+        for compression in ['rar', {'codec': 'gz', 'level': 10}, {'codec': 'bz2', 'level': 0}]:
+            with self.subTest(compression=compression):
+                with self.assertRaises(SystemExit):
+                    get_codec(compression)
+
+    def test_parallel_gzip(self):
+        """Blocks compressed on several threads join into one ordinary gzip stream"""
+        data = PAYLOAD + os.urandom(50000) + PAYLOAD
+        fileobj = io.BytesIO()
+        with ParallelGzipFile(fileobj, 6, 4, block_size=8192) as compressor:
+            for offset in range(0, len(data), 5000):
+                compressor.write(data[offset:offset + 5000])
+        self.assertEqual(gzip.decompress(fileobj.getvalue()), data)
+        if shutil.which('gzip') is not None:
+            self.assertEqual(subprocess.run(['gzip', '-t'], input=fileobj.getvalue()).returncode,
+                             0)
+
+        # An archive on several threads reads back like any other, and one thread is plain gzip.
+        for threads in [1, 4]:
+            with self.subTest(threads=threads):
+                tar_path = os.path.join(self.work_dir, 'backup.tar.gz')
+                archive = ArchiveWriter(tar_path, {'codec': 'gz', 'threads': threads})
+                archive.add(self.source_dir, arcname='source')
+                archive.close()
+                self.assertEqual(self.read_member(tar_path), PAYLOAD)
+
+    def test_threads_and_volume_size(self):
+        """The thread count defaults to the usable CPUs and volume sizes take suffixes"""
+        self.assertEqual(get_threads({'threads': 3}), 3)
+        self.assertEqual(get_threads('gz'), len(os.sched_getaffinity(0)))
+        self.assertIsNone(get_volume_size({'codec': 'gz'}))
+        self.assertEqual(get_volume_size({'volume_size': '2G'}), 2 * 1024 ** 3)
+        self.assertEqual(get_volume_size({'volume_size': '512kb'}), 512 * 1024)
+        self.assertEqual(get_volume_size({'volume_size': 4096}), 4096)
+        with self.assertRaises(SystemExit):
+            get_threads({'threads': -1})
+        for volume_size in ['big', '0M']:
+            with self.subTest(volume_size=volume_size):
+                with self.assertRaises(SystemExit):
+                    get_volume_size({'volume_size': volume_size})
+
+
+if __name__ == '__main__':
+    unittest.main()
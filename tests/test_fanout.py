@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Fan Out tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests fan an archive out to several destinations at once and
+                        check the copies, their sidecars and the handling of failed copies.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to write the test archive
+import shutil  # Used to clean up the test directories
+import hashlib  # Used to checksum the test archive
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+from unittest import mock  # Used to shrink the checkpoints and break the reads
+
+# Import Nimbus class libraries
+from libs import fanout  # Used to shrink the checkpoints and break the reads
+from libs.fanout import FileSink, fan_out, pending_copies  # The library under test
+from libs.fanout import CHECKPOINT_EXTENSION  # Used to find the checkpoints
+from libs.fanout import split_volumes, fan_out_volumes  # The library under test
+from libs.parseconf import BackupDir  # Used to look for the split copy
+from libs.restore import find_replicas, open_replica  # Used to read the split copy back
+from libs.verify import SIDECAR_EXTENSION, read_sidecar  # Used to check the sidecars
+
+BLOCK_SIZE = 64 * 1024
+ARCHIVE_SIZE = 40 * BLOCK_SIZE + 123
+CHECKPOINT_SIZE = 4 * BLOCK_SIZE
+
+
+class FailingWriteSink(FileSink):
+    """This class is a destination that stops taking writes at a given size"""
+
+    def __init__(self, label, dest_path, fail_after, failures=None):
+        FileSink.__init__(self, label, dest_path)
+        self.fail_after = fail_after
+        self.failures = failures
+
+    def write_piece(self, piece):
+        if self.position >= self.fail_after and self.failures != 0:
+            if self.failures is not None:
+                self.failures -= 1
+            raise OSError("write failed")
+        FileSink.write_piece(self, piece)
+
+
+class FailingCloseSink(FileSink):
+    """This class is a destination that fails when the copy is finished"""
+
+    def close(self, source_path, checksum):
+        raise OSError("close failed")
+
+
+class BrokenReader(object):
+    """This class reads a file until the read that is set to fail"""
+
+    def __init__(self, fileobj, fail_at):
+        self.fileobj = fileobj
+        self.reads = 0
+        self.fail_at = fail_at
+
+    def read(self, size):
+        """This function reads a block, or fails"""
+        self.reads += 1
+        if self.reads == self.fail_at:
+            raise OSError("read failed")
+        return self.fileobj.read(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fileobj.close()
+
+
+class FanOutTest(unittest.TestCase):
+    """This class tests the single-read fan out of the archive"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_fanout_')
+        self.source_path = os.path.join(self.work_dir, 'backup.tar.gz')
+        self.data = os.urandom(ARCHIVE_SIZE)
+        with open(self.source_path, 'wb') as source:
+            source.write(self.data)
+        os.utime(self.source_path, (1460000000, 1460000000))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def destination(self, name):
+        """This function creates a destination directory and returns the copy path in it"""
+        dest_dir = os.path.join(self.work_dir, name)
+        os.makedirs(dest_dir)
+        return os.path.join(dest_dir, 'backup.tar.gz')
+
+    def test_every_destination_gets_the_archive(self):
+        """Every destination gets a whole copy, its mtime and a sidecar, from a single read"""
+        sinks = [FileSink(name, self.destination(name)) for name in ['nfs', 'usb', 'san']]
+        digest, results = fan_out(self.source_path, sinks, BLOCK_SIZE)
+
+        self.assertEqual(digest, hashlib.sha256(self.data).hexdigest())
+        for sink, result in zip(sinks, results):
+            self.assertIsNone(result['error'])
+            self.assertEqual(result['bytes'], ARCHIVE_SIZE)
+            with open(sink.dest_path, 'rb') as copy:
+                self.assertEqual(copy.read(), self.data)
+            self.assertEqual(os.stat(sink.dest_path).st_mtime, 1460000000)
+            self.assertFalse(os.path.exists(sink.part_path))
+            self.assertEqual(read_sidecar(sink.dest_path + SIDECAR_EXTENSION), digest)
+
+    def test_failed_destination_does_not_stall_the_others(self):
+        """A destination that cannot be written is reported while the others complete"""
+        missing_path = os.path.join(self.work_dir, 'unmounted', 'backup.tar.gz')
+        sinks = [FileSink('nfs', self.destination('nfs')), FileSink('usb', missing_path)]
+        digest, results = fan_out(self.source_path, sinks, BLOCK_SIZE)
+
+        self.assertEqual(digest, hashlib.sha256(self.data).hexdigest())
+        self.assertIsNone(results[0]['error'])
+        self.assertEqual(results[0]['bytes'], ARCHIVE_SIZE)
+        self.assertIsNotNone(results[1]['error'])
+        self.assertFalse(os.path.exists(missing_path))
+        self.assertFalse(os.path.exists(missing_path + SIDECAR_EXTENSION))
+
+    def test_read_error_publishes_nothing(self):
+        """A copy of an archive that failed to read is never moved into place"""
+        real_open = open
+
+        def broken_open(path, mode='r', *args, **kwargs):
+            """This function opens the archive with a reader that fails part of the way in"""
+            fileobj = real_open(path, mode, *args, **kwargs)
+            if path == self.source_path and mode == 'rb':
+                return BrokenReader(fileobj, 3)
+            return fileobj
+
+        sinks = [FileSink(name, self.destination(name)) for name in ['nfs', 'usb']]
+        with mock.patch.object(fanout, 'open', broken_open, create=True):
+            with self.assertRaises(OSError):
+                fan_out(self.source_path, sinks, BLOCK_SIZE)
+        for sink in sinks:
+            self.assertFalse(os.path.exists(sink.dest_path))
+            self.assertFalse(os.path.exists(sink.dest_path + SIDECAR_EXTENSION))
+            self.assertFalse(os.path.exists(sink.part_path))
+
+    def test_close_error_fails_only_that_destination(self):
+        """A destination that fails to finish does not hold up or fail the others"""
+        sinks = [FailingCloseSink('nfs', self.destination('nfs')),
+                 FileSink('usb', self.destination('usb'))]
+        digest, results = fan_out(self.source_path, sinks, BLOCK_SIZE)
+        self.assertEqual(digest, hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(results[0]['error'], "close failed")
+        self.assertFalse(os.path.exists(sinks[0].dest_path))
+        self.assertIsNone(results[1]['error'])
+        with open(sinks[1].dest_path, 'rb') as copy:
+            self.assertEqual(copy.read(), self.data)
+
+    @mock.patch.object(fanout, 'CHECKPOINT_SIZE', CHECKPOINT_SIZE)
+    @mock.patch.object(fanout, 'RETRY_BACKOFF', 0)
+    def test_write_retried_from_the_checkpoint(self):
+        """A write that fails for a moment is retried, refilling what was lost since"""
+        sink = FailingWriteSink('nfs', self.destination('nfs'), 11 * BLOCK_SIZE, failures=2)
+        _, results = fan_out(self.source_path, [sink], BLOCK_SIZE)
+        self.assertIsNone(results[0]['error'])
+        with open(sink.dest_path, 'rb') as copy:
+            self.assertEqual(copy.read(), self.data)
+        self.assertFalse(os.path.exists(sink.part_path + CHECKPOINT_EXTENSION))
+
+    @mock.patch.object(fanout, 'CHECKPOINT_SIZE', CHECKPOINT_SIZE)
+    @mock.patch.object(fanout, 'RETRY_BACKOFF', 0)
+    def test_broken_off_copy_is_resumed(self):
+        """A copy that broke off is kept and resumed from its last checkpoint next time"""
+        dest_path = self.destination('nfs')
+        sink = FailingWriteSink('nfs', dest_path, 11 * BLOCK_SIZE)
+        _, results = fan_out(self.source_path, [sink], BLOCK_SIZE)
+        self.assertEqual(results[0]['error'], "write failed")
+        self.assertFalse(os.path.exists(dest_path))
+        self.assertEqual(pending_copies(os.path.dirname(dest_path)), ['backup.tar.gz'])
+
+        _, results = fan_out(self.source_path, [FileSink('nfs', dest_path)], BLOCK_SIZE)
+        self.assertIsNone(results[0]['error'])
+        # The writes failed at 11 blocks, after the second checkpoint at 8.
+        self.assertEqual(results[0]['resumed_bytes'], 2 * CHECKPOINT_SIZE)
+        with open(dest_path, 'rb') as copy:
+            self.assertEqual(copy.read(), self.data)
+        self.assertEqual(pending_copies(os.path.dirname(dest_path)), [])
+
+    @mock.patch.object(fanout, 'CHECKPOINT_SIZE', CHECKPOINT_SIZE)
+    @mock.patch.object(fanout, 'RETRY_BACKOFF', 0)
+    def test_changed_archive_is_not_resumed_past_the_change(self):
+        """Chunks of the resumed copy that no longer match the archive are written again"""
+        dest_path = self.destination('nfs')
+        fan_out(self.source_path, [FailingWriteSink('nfs', dest_path, 11 * BLOCK_SIZE)],
+                BLOCK_SIZE)
+        # Same name, size and date, but the second chunk of the archive changed.
+        self.data = self.data[:CHECKPOINT_SIZE] + b'\0' * 16 + self.data[CHECKPOINT_SIZE + 16:]
+        with open(self.source_path, 'wb') as source:
+            source.write(self.data)
+        os.utime(self.source_path, (1460000000, 1460000000))
+
+        _, results = fan_out(self.source_path, [FileSink('nfs', dest_path)], BLOCK_SIZE)
+        self.assertIsNone(results[0]['error'])
+        self.assertEqual(results[0]['resumed_bytes'], CHECKPOINT_SIZE)
+        with open(dest_path, 'rb') as copy:
+            self.assertEqual(copy.read(), self.data)
+
+    def test_volumes_are_copied_and_read_back(self):
+        """Volumes are copied side by side with their sidecars and read back as one archive"""
+        volume_paths = split_volumes(self.source_path, 16 * BLOCK_SIZE)
+        self.assertEqual([os.path.basename(path) for path in volume_paths],
+                         ['backup.tar.gz.001', 'backup.tar.gz.002', 'backup.tar.gz.003'])
+        self.destination('usb')
+        digest, results = fan_out_volumes(
+            self.source_path, volume_paths, [FileSink('nfs', self.destination('nfs'))],
+            lambda name: [FileSink('usb', os.path.join(self.work_dir, 'usb', name))], 2)
+
+        self.assertEqual(digest, hashlib.sha256(self.data).hexdigest())
+        self.assertEqual([result['error'] for result in results], [None] * 4)
+        # The local volumes are gone once every copy of them is done.
+        self.assertEqual(sorted(os.listdir(self.work_dir)), ['backup.tar.gz', 'nfs', 'usb'])
+        volumes = sorted(name for name in os.listdir(os.path.join(self.work_dir, 'usb'))
+                         if not name.endswith(SIDECAR_EXTENSION))
+        self.assertEqual(volumes, [os.path.basename(path) for path in volume_paths])
+        for name in volumes:
+            volume = os.path.join(self.work_dir, 'usb', name)
+            with open(volume, 'rb') as volume_file:
+                self.assertEqual(read_sidecar(volume + SIDECAR_EXTENSION),
+                                 hashlib.sha256(volume_file.read()).hexdigest())
+
+        replicas = find_replicas([BackupDir('usb', '/usb', self.work_dir, 3, 'mount', {})],
+                                 'backup.tar.gz')
+        self.assertEqual(len(replicas[0]['volumes']), 3)
+        reader = open_replica(replicas[0], 'backup.tar.gz')
+        try:
+            self.assertEqual(reader.read(), self.data)
+        finally:
+            reader.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
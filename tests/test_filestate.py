@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				File State tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests scan a directory tree twice and check the changed and
+                        deleted files worked out from the two manifests.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to write the test tree
+import shutil  # Used to clean up the test directories
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+from unittest import mock  # Used to count the files that get hashed
+
+# Import Nimbus class libraries
+from libs import filestate  # The library under test
+from libs.filestate import scan_tree, diff_files, load_manifest, save_manifest
+
+
+class FileStateTest(unittest.TestCase):
+    """This class tests the manifests of the incremental backups"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_filestate_')
+        self.tree = os.path.join(self.work_dir, 'tree')
+        for rel_path in ['repositories/one.bundle', 'repositories/two.bundle', 'db.sql']:
+            self.write(rel_path, rel_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write(self, rel_path, contents):
+        """This function writes a file of the test tree"""
+        file_path = os.path.join(self.tree, rel_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w') as tree_file:
+            tree_file.write(contents)
+
+    def test_manifest_diff(self):
+        """Changed, new and deleted files are found, and touched files with the same data are not"""
+        previous = scan_tree(self.tree)
+        self.assertEqual(diff_files({}, previous), (sorted(previous), []))
+
+        self.write('repositories/one.bundle', 'one changed')
+        self.write('uploads/new.png', 'new')
+        os.remove(os.path.join(self.tree, 'repositories/two.bundle'))
+        os.utime(os.path.join(self.tree, 'db.sql'), (1460000000, 1460000000))
+
+        current = scan_tree(self.tree, previous)
+        self.assertEqual(diff_files(previous, current),
+                         (['repositories/one.bundle', 'uploads/new.png'],
+                          ['repositories/two.bundle']))
+
+    def test_unmoved_files_are_not_hashed_again(self):
+        """Files whose size and mtime did not move reuse the hash of the previous run"""
+        previous = scan_tree(self.tree)
+        self.write('db.sql', 'db.sql and more')
+        with mock.patch.object(filestate, 'hash_file', wraps=filestate.hash_file) as hashed:
+            scan_tree(self.tree, previous, exclude=('repositories/one.bundle',))
+        self.assertEqual(hashed.call_args_list, [mock.call(os.path.join(self.tree, 'db.sql'))])
+
+    def test_manifest_round_trip(self):
+        """A saved manifest loads back, and an unreadable one asks for a full backup"""
+        manifest_path = os.path.join(self.work_dir, 'state', 'manifest.json')
+        self.assertEqual(load_manifest(manifest_path), {'last_full': None, 'files': {}})
+
+        manifest = {'last_full': '2016-04-07 01:00:00', 'files': scan_tree(self.tree)}
+        save_manifest(manifest_path, manifest)
+        self.assertEqual(load_manifest(manifest_path), manifest)
+
+        with open(manifest_path, 'w') as manifest_file:
+            manifest_file.write('{"last_full": ')
+        self.assertEqual(load_manifest(manifest_path), {'last_full': None, 'files': {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
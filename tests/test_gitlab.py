@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Module:					Gitlab module tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests run the gitlab backup job against a stand-in for
+                        gitlab-rake, and check the full and incremental archives it takes.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to write the stand-in backup files
+import json  # Used to write the stand-in gitlab-rake settings
+import shutil  # Used to clean up the test directories
+import tarfile  # Used to read the archives
+import datetime  # Used to date the backups
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+
+# Import Nimbus class libraries
+from modules.gitlab import gitlab_backup_job  # The module under test
+from modules.gitlab import DELETED_LIST, MANIFEST_COPY  # Used to find the incremental lists
+from tests.tools import make_tool  # Used to write the stand-in gitlab-rake
+
+FIRST_RUN = datetime.datetime(2016, 4, 7, 1, 0, 0, 123456)
+
+# The stand-in gitlab-rake unpacks the files listed in rake.json into the backup path. Like the
+# real one, it dumps each component it does not skip again from scratch.
+GITLAB_RAKE = """
+import json, shutil
+with open(os.path.join(os.path.dirname(sys.argv[0]), 'rake.json')) as settings_file:
+    settings = json.load(settings_file)
+settings['commands'].append(sys.argv[1:])
+skip = []
+for arg in sys.argv[1:]:
+    if arg.startswith('SKIP='):
+        skip = arg[len('SKIP='):].split(',')
+components = set(rel_path.split('/')[0] for rel_path in settings['files'])
+for component in components - set(skip):
+    shutil.rmtree(os.path.join(settings['gitlab_path'], component), ignore_errors=True)
+for rel_path, contents in settings['files'].items():
+    if rel_path.split('/')[0] in skip:
+        continue
+    file_path = os.path.join(settings['gitlab_path'], rel_path)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'w') as backup_file:
+        backup_file.write(contents)
+with open(os.path.join(settings['gitlab_path'], 'backup_information.yml'), 'w') as information:
+    information.write(":db_version: 20160407\\n")
+    skipped = [component for component in skip if component != 'tar']
+    if skipped:
+        information.write(":skipped: " + ",".join(skipped) + "\\n")
+with open(os.path.join(os.path.dirname(sys.argv[0]), 'rake.json'), 'w') as settings_file:
+    json.dump(settings, settings_file)
+print("Creating backup archive: done")
+"""
+
+
+class GitlabBackupTest(unittest.TestCase):
+    """This class tests the gitlab backup job"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_gitlab_')
+        self.local_dir = os.path.join(self.work_dir, 'local')
+        self.gitlab_path = os.path.join(self.work_dir, 'backups')
+        os.makedirs(self.local_dir)
+        os.makedirs(self.gitlab_path)
+        gitlab_config = os.path.join(self.work_dir, 'gitlab.rb')
+        with open(gitlab_config, 'w') as config_file:
+            config_file.write("external_url 'https://gitlab.example.com'\n")
+        self.args = {'gitlab_backup_path': self.gitlab_path, 'incremental': True,
+                     'manifest_path': os.path.join(self.work_dir, 'state', 'manifest.json'),
+                     'gitlab_rake': make_tool(self.work_dir, 'gitlab-rake', GITLAB_RAKE),
+                     'gitlab_config': gitlab_config}
+        # What gitlab-rake unpacks into the backup path on each run.
+        self.backup_files = {'repositories/one.bundle': 'one', 'repositories/two.bundle': 'two',
+                             'db/database.sql.gz': 'database'}
+        self.commands = []
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def run_job(self, run_date):
+        """This function runs the backup job and returns the files in its archive"""
+        settings_path = os.path.join(self.work_dir, 'rake.json')
+        with open(settings_path, 'w') as settings_file:
+            json.dump({'gitlab_path': self.gitlab_path, 'files': self.backup_files,
+                       'commands': []}, settings_file)
+        tar_name, _ = gitlab_backup_job(self.local_dir, run_date, self.args)
+        with open(settings_path) as settings_file:
+            self.commands.extend(json.load(settings_file)['commands'])
+
+        prefix = self.gitlab_path.lstrip('/') + '/'
+        with tarfile.open(self.local_dir + tar_name) as tar:
+            return tar_name, {member.name[len(prefix):]: tar.extractfile(member).read()
+                              for member in tar.getmembers() if member.isfile()}
+
+    def test_incremental_holds_only_the_changes(self):
+        """An incremental run archives the changed files and lists the deleted ones"""
+        tar_name, files = self.run_job(FIRST_RUN)
+        self.assertNotIn('_incr', tar_name)
+        self.assertIn('repositories/two.bundle', files)
+        self.assertEqual(self.commands[0], ['gitlab:backup:create', 'SKIP=tar'])
+        self.assertEqual(files['gitlab.rb'], b"external_url 'https://gitlab.example.com'\n")
+
+        self.backup_files['repositories/one.bundle'] = 'one changed'
+        del self.backup_files['repositories/two.bundle']
+        tar_name, files = self.run_job(FIRST_RUN + datetime.timedelta(days=1))
+        self.assertIn('_incr', tar_name)
+        self.assertEqual(sorted(files), [DELETED_LIST, MANIFEST_COPY, 'repositories/one.bundle'])
+        self.assertEqual(files['repositories/one.bundle'], b'one changed')
+        self.assertEqual(files[DELETED_LIST], b'repositories/two.bundle')
+
+    def test_skipped_components_keep_the_full_dump(self):
+        """The incremental_skip components keep the dump of the full, and are not archived"""
+        self.args['incremental_skip'] = ['repositories']
+        self.run_job(FIRST_RUN)
+        bundle_path = os.path.join(self.gitlab_path, 'repositories', 'one.bundle')
+        bundle_mtime = os.stat(bundle_path).st_mtime
+
+        self.backup_files['repositories/one.bundle'] = 'one changed'
+        self.backup_files['db/database.sql.gz'] = 'database changed'
+        tar_name, files = self.run_job(FIRST_RUN + datetime.timedelta(days=1))
+        self.assertIn('_incr', tar_name)
+        self.assertEqual(self.commands[1], ['gitlab:backup:create', 'SKIP=tar,repositories'])
+        self.assertEqual(sorted(files), ['db/database.sql.gz', DELETED_LIST, MANIFEST_COPY])
+        self.assertEqual(files[DELETED_LIST], b'')
+        with open(bundle_path) as bundle:
+            self.assertEqual(bundle.read(), 'one')
+        self.assertEqual(os.stat(bundle_path).st_mtime, bundle_mtime)
+        # The restore takes the skipped components from the full archive.
+        with open(os.path.join(self.gitlab_path, 'backup_information.yml')) as information:
+            self.assertNotIn(':skipped:', information.read())
+
+    def test_full_after_full_every_days(self):
+        """A full archive is taken again once the last full is full_every_days old"""
+        self.args['full_every_days'] = 3
+        self.run_job(FIRST_RUN)
+        tar_name, _ = self.run_job(FIRST_RUN + datetime.timedelta(days=2))
+        self.assertIn('_incr', tar_name)
+        tar_name, files = self.run_job(FIRST_RUN + datetime.timedelta(days=3))
+        self.assertNotIn('_incr', tar_name)
+        self.assertIn('repositories/two.bundle', files)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				History tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests write run histories and check the estimates made from
+                        them, and the order the scheduler starts jobs in because of them.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to build the history paths
+import json  # Used to write the job configs
+import shutil  # Used to clean up the test directories
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+
+# Import Nimbus class libraries
+from libs.history import run_record, append_history, load_history  # The library under test
+from libs.history import trend, estimate, window_seconds, history_path  # Under test
+from libs.scheduler import load_jobs  # Used to check the order that the jobs start in
+
+
+class HistoryTest(unittest.TestCase):
+    """This class tests the run history and the estimates"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_history_')
+        self.history = os.path.join(self.work_dir, 'history', 'postgres_history.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def add_run(self, path, seconds, archive_bytes, kind='full', success=True):
+        """This function appends a run with a dump and a copy to a history"""
+        records = [{'phase': 'dump', 'wall_seconds': seconds / 2.0, 'bytes_out': archive_bytes,
+                    'database': 'shop'},
+                   {'phase': 'archive', 'wall_seconds': 1.0, 'bytes_out': archive_bytes},
+                   {'phase': 'copy', 'wall_seconds': 2.0, 'bytes_out': archive_bytes // 4,
+                    'destination': 'store'}]
+        archive_name = '/postgres_2016-04-07_01-00-00' + ('_incr' if kind != 'full' else '')
+        append_history(path, run_record('postgres', archive_name + '.tar.gz', seconds,
+                                        archive_bytes, records, success))
+
+    def test_history_round_trip(self):
+        """Runs are appended and read back, skipping failed, other kinds and cut off lines"""
+        for seconds in [10, 20, 30]:
+            self.add_run(self.history, seconds, seconds * 100)
+        self.add_run(self.history, 99, 9900, success=False)
+        self.add_run(self.history, 5, 50, kind='incremental')
+        with open(self.history, 'a') as history:
+            history.write('{"job": "postgres", "succ')
+
+        history = load_history(self.history, kind='full')
+        self.assertEqual([record['seconds'] for record in history], [10, 20, 30])
+        self.assertEqual(history[0]['archive'], 'postgres_2016-04-07_01-00-00.tar.gz')
+        self.assertEqual(history[0]['phases'], {'archive': 1.0})
+        self.assertEqual(history[0]['databases'], {'shop': {'seconds': 5.0, 'bytes': 1000}})
+        self.assertEqual(history[0]['destinations'],
+                         {'store': {'seconds': 2.0, 'stored_bytes': 250}})
+        self.assertEqual(len(load_history(self.history, runs=2)), 2)
+        self.assertEqual(load_history(os.path.join(self.work_dir, 'missing.jsonl')), [])
+
+    def test_estimate(self):
+        """The next run follows the trend of the last runs, never below the smallest"""
+        self.assertEqual(trend([10, 20, 30]), 40)
+        self.assertEqual(trend([30, 20, 10]), 10)
+        self.assertEqual(trend([None, 7, 12]), 12)
+        self.assertIsNone(trend([]))
+        for seconds in [10, 20, 30]:
+            self.add_run(self.history, seconds, seconds * 100)
+        job_estimate = estimate(load_history(self.history))
+        self.assertEqual((job_estimate['runs'], job_estimate['seconds'],
+                          job_estimate['archive_bytes']), (3, 40, 4000))
+        self.assertEqual(job_estimate['databases']['shop'], {'seconds': 20, 'bytes': 4000})
+        self.assertEqual(job_estimate['destinations'], {'store': 0.25})
+        self.assertIsNone(estimate([]))
+
+    def test_backup_window(self):
+        """Backup windows may wrap around midnight, and bad ones are refused"""
+        self.assertEqual(window_seconds('01:00-05:30'), 4.5 * 3600)
+        self.assertEqual(window_seconds('22:00-02:00'), 4 * 3600)
+        self.assertEqual(window_seconds('00:00-00:00'), 24 * 3600)
+        for backup_window in ['nightly', '01:00', '1-2']:
+            with self.subTest(backup_window=backup_window):
+                with self.assertRaises(SystemExit):
+                    window_seconds(backup_window)
+
+    def test_longest_job_starts_first(self):
+        """Jobs of the same priority start longest first, going by their history"""
+        config_dir = os.path.join(self.work_dir, 'conf')
+        os.makedirs(config_dir)
+        for name, seconds in [('alpha', 10), ('bravo', 300), ('charlie', None)]:
+            path = os.path.join(self.work_dir, name + '_history.jsonl')
+            if seconds is not None:
+                self.add_run(path, seconds, 100)
+            with open(os.path.join(config_dir, name + '.ini'), 'w') as config_file:
+                json.dump({'backup_job': 'postgres', 'metrics': {'history': path}}, config_file)
+        self.assertEqual(history_path('alpha'), '/var/log/nimbus/alpha_history.jsonl')
+        self.assertEqual([job['name'] for job in load_jobs(config_dir)],
+                         ['bravo', 'alpha', 'charlie'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Inventory tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests build the inventory of backup directories and check the
+                        report table against what ls -lah would show.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to write the test files
+import time  # Used to date the test files
+import shutil  # Used to clean up the test directories
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+
+# Import Nimbus class libraries
+from libs.inventory import human_size, display_date  # The library under test
+from libs.inventory import inventory, format_inventory  # The library under test
+
+
+class InventoryTest(unittest.TestCase):
+    """This class tests the files inventory of the report"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_inventory_')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def backup_dir(self, name, files):
+        """This function creates a backup directory holding files of the given sizes"""
+        dir_path = os.path.join(self.work_dir, name)
+        os.makedirs(dir_path)
+        for file_name, size in files.items():
+            with open(os.path.join(dir_path, file_name), 'wb') as backup_file:
+                backup_file.write(b'x' * size)
+        return dir_path
+
+    def test_human_size(self):
+        """Sizes are rounded up the way ls -h rounds them"""
+        self.assertEqual(human_size(0), '0')
+        self.assertEqual(human_size(1023), '1023')
+        self.assertEqual(human_size(1024), '1.0K')
+        self.assertEqual(human_size(1025), '1.1K')
+        self.assertEqual(human_size(10 * 1024), '10K')
+        self.assertEqual(human_size(1536 * 1024), '1.5M')
+        self.assertEqual(human_size(3 * 1024 ** 3 + 1), '3.1G')
+
+    def test_display_date(self):
+        """Recent files show the time and files older than six months show the year"""
+        now = time.mktime((2016, 4, 30, 12, 0, 0, 0, 0, -1))
+        recent = time.mktime((2016, 4, 7, 1, 5, 0, 0, 0, -1))
+        old = time.mktime((2015, 4, 7, 1, 5, 0, 0, 0, -1))
+        self.assertEqual(display_date(recent, now), 'Apr  7 01:05')
+        self.assertEqual(display_date(old, now), 'Apr  7  2015')
+
+    def test_inventory_of_each_directory(self):
+        """Each directory is listed on its own, and names that contain others are kept apart"""
+        nfs = self.backup_dir('nfs', {'backup.tar.gz': 2048, 'backup.tar.gz.sha256': 64})
+        usb = self.backup_dir('usb', {})
+        nfs_inventory, usb_inventory = inventory([nfs, usb])
+
+        self.assertEqual([(file_info['name'], file_info['size'])
+                          for file_info in nfs_inventory['files']],
+                         [('backup.tar.gz', 2048), ('backup.tar.gz.sha256', 64)])
+        self.assertEqual((nfs_inventory['total_files'], nfs_inventory['total_bytes']), (2, 2112))
+        self.assertEqual(usb_inventory['total_files'], 0)
+
+        report = format_inventory(nfs_inventory).splitlines()
+        self.assertEqual([line.split("\t")[:2] for line in report[:2]],
+                         [['backup.tar.gz', '2.0K'], ['backup.tar.gz.sha256', '64']])
+        self.assertEqual(report[2], '2 files, 2.1K total')
+
+
+if __name__ == '__main__':
+    unittest.main()
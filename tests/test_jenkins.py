@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Module:					Jenkins backup tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests back up a small JENKINS_HOME, full and incremental, and
+                        restore it, checking the excluded paths and the replayed changes.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to build the test JENKINS_HOME
+import shutil  # Used to clean up the test directories
+import tarfile  # Used to read the archives
+import datetime  # Used to date the backups
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+
+# Import Nimbus class libraries
+from modules.jenkins import jenkins_backup_job, jenkins_restore_job  # The module under test
+from libs.compression import ArchiveReader  # Used to read the archives for the restore
+
+FIRST_RUN = datetime.datetime(2016, 4, 7, 1, 0, 0)
+HOME_FILES = {
+    'config.xml': 'main config',
+    'plugins/git.jpi': 'plugin',
+    'plugins/git/META-INF/MANIFEST.MF': 'unpacked plugin',
+    'workspace/big.iso': 'scratch',
+    'jobs/shop/config.xml': 'shop job',
+    'jobs/shop/workspace/target/shop.jar': 'build output',
+    'jobs/shop/builds/1/log': 'build 1',
+    'jobs/shop/builds/1/archive/shop.jar': 'artifact',
+    'jobs/crm/config.xml': 'crm job',
+    'jobs/crm/builds/1/log': 'crm build 1',
+    'jobs/crm/notes.tmp': 'temporary',
+}
+EXCLUDED = ['plugins/git/META-INF/MANIFEST.MF', 'workspace/big.iso',
+            'jobs/shop/workspace/target/shop.jar', 'jobs/shop/builds/1/archive/shop.jar',
+            'jobs/crm/notes.tmp']
+
+
+class JenkinsBackupTest(unittest.TestCase):
+    """This class tests the jenkins backup and restore"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_jenkins_')
+        self.home = os.path.join(self.work_dir, 'jenkins')
+        self.local_dir = os.path.join(self.work_dir, 'local')
+        os.makedirs(self.local_dir)
+        for rel_path, content in HOME_FILES.items():
+            self.write_file(rel_path, content, 1460000000)
+        os.symlink('builds/1', os.path.join(self.home, 'jobs', 'shop', 'lastSuccessfulBuild'))
+        self.args = {'jenkins_home': self.home, 'incremental': True,
+                     'manifest_path': os.path.join(self.work_dir, 'state', 'manifest.json')}
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_file(self, rel_path, content, mtime):
+        """This function writes a file into JENKINS_HOME with a given date"""
+        file_path = os.path.join(self.home, rel_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w') as home_file:
+            home_file.write(content)
+        os.utime(file_path, (mtime, mtime))
+        os.utime(os.path.dirname(file_path), (mtime, mtime))
+
+    def read_home(self, home):
+        """This function returns the files and links of a JENKINS_HOME"""
+        tree = {}
+        for dir_path, dir_names, file_names in os.walk(home):
+            for name in dir_names + file_names:
+                path = os.path.join(dir_path, name)
+                rel_path = os.path.relpath(path, home)
+                if os.path.islink(path):
+                    tree[rel_path] = '-> ' + os.readlink(path)
+                elif os.path.isfile(path):
+                    with open(path) as home_file:
+                        tree[rel_path] = home_file.read()
+        return tree
+
+    def run_job(self, run_date):
+        """This function runs the backup job and returns the archive name and its file members"""
+        tar_name, _ = jenkins_backup_job(self.local_dir, run_date, self.args)
+        with tarfile.open(self.local_dir + tar_name) as tar:
+            return tar_name, sorted(member.name for member in tar.getmembers()
+                                    if member.isfile())
+
+    def test_excluded_paths_are_left_out(self):
+        """Workspaces, artifacts, unpacked plugins and temporary files are not archived"""
+        _, members = self.run_job(FIRST_RUN)
+        archived = [name[len('jenkins_home/'):] for name in members
+                    if name.startswith('jenkins_home/')]
+        self.assertEqual(sorted(archived), sorted(rel_path for rel_path in HOME_FILES
+                                                  if rel_path not in EXCLUDED))
+
+    def test_incremental_restore(self):
+        """A full archive and its incremental restore the latest JENKINS_HOME"""
+        full_name, _ = self.run_job(FIRST_RUN)
+        self.write_file('jobs/shop/builds/2/log', 'build 2', 1460090000)
+        self.write_file('jobs/shop/config.xml', 'shop job changed', 1460090000)
+        shutil.rmtree(os.path.join(self.home, 'jobs', 'crm'))
+        os.utime(os.path.join(self.home, 'jobs'), (1460090000, 1460090000))
+        incr_name, members = self.run_job(FIRST_RUN + datetime.timedelta(days=1))
+        self.assertIn('_incr', incr_name)
+        self.assertNotIn('jenkins_home/config.xml', members)
+        self.assertIn('jenkins_home/jobs/shop/builds/2/log', members)
+
+        restored_home = os.path.join(self.work_dir, 'restored')
+        # An old file in a changed directory is cleared out by the incremental.
+        os.makedirs(os.path.join(restored_home, 'jobs', 'shop'))
+        with open(os.path.join(restored_home, 'jobs', 'shop', 'stale.xml'), 'w') as stale:
+            stale.write('stale')
+        sources = [open(self.local_dir + name, 'rb') for name in [full_name, incr_name]]
+        try:
+            jenkins_restore_job([ArchiveReader(source, name) for source, name
+                                 in zip(sources, [full_name, incr_name])],
+                                {'jenkins_home': restored_home})
+        finally:
+            for source in sources:
+                source.close()
+
+        expected = dict((rel_path, content) for rel_path, content
+                        in self.read_home(self.home).items() if rel_path not in EXCLUDED)
+        self.assertEqual(self.read_home(restored_home), expected)
+        self.assertEqual(os.stat(os.path.join(restored_home, 'config.xml')).st_mtime,
+                         1460000000)
+
+
+if __name__ == '__main__':
+    unittest.main()
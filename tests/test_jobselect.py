@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Job selector tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests check that jobs are looked up in the registry and that
+                        only the module of the selected job is imported.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to build the path of the stand-in module
+import sys  # Used to put the stand-in module on the import path
+import shutil  # Used to clean up the test directories
+import tempfile  # Used to create the test directories
+import subprocess  # Used to import the selector in a fresh interpreter
+import unittest  # Used to run the tests
+
+# Import Nimbus class libraries
+from libs import jobselect  # The library under test
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+EXTRA_MODULE = """
+def extra_backup_job(args):
+    return 'extra ' + args
+"""
+
+
+class JobSelectTest(unittest.TestCase):
+    """This class tests the job registry"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_jobselect_')
+        self.registry = dict(jobselect.MODULES)
+
+    def tearDown(self):
+        jobselect.MODULES.clear()
+        jobselect.MODULES.update(self.registry)
+        if self.work_dir in sys.path:
+            sys.path.remove(self.work_dir)
+        sys.modules.pop('nimbus_extra', None)
+        shutil.rmtree(self.work_dir)
+
+    def test_only_the_selected_module_is_imported(self):
+        """Selecting a job imports its module and none of the others"""
+        script = ("import sys; from libs.jobselect import module_select; "
+                  "name, job = module_select('JENKINS'); "
+                  "print(name, job.__name__, sorted(m for m in sys.modules "
+                  "if m.startswith('modules.')))")
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=ROOT)
+        self.assertEqual(output.decode().split(), ['Jenkins', 'jenkins_backup_job',
+                                                   "['modules.jenkins']"])
+
+    def test_bundled_jobs(self):
+        """The bundled jobs map to their backup and restore functions"""
+        name, run_module = jobselect.module_select('MARIADB')
+        self.assertEqual((name, run_module.__name__), ('MySQL', 'mysql_backup_job'))
+        name, run_module, prefix = jobselect.restore_select('POSTGRES')
+        self.assertEqual((name, run_module.__name__, prefix),
+                         ('PostgreSQL', 'postgres_restore_job', 'postgres_'))
+        with self.assertRaises(SystemExit):
+            jobselect.module_select('NOSUCHJOB')
+
+    def test_registered_module(self):
+        """A registered module is found, and one without a restore is refused"""
+        with open(os.path.join(self.work_dir, 'nimbus_extra.py'), 'w') as module_file:
+            module_file.write(EXTRA_MODULE)
+        sys.path.insert(0, self.work_dir)
+        jobselect.register_module('extra', 'Extra', 'nimbus_extra')
+        name, run_module = jobselect.module_select('EXTRA')
+        self.assertEqual((name, run_module('job')), ('Extra', 'extra job'))
+        with self.assertRaises(SystemExit):
+            jobselect.restore_select('EXTRA')
+
+        jobselect.register_module('BROKEN', 'Broken', 'nimbus_missing')
+        with self.assertRaises(SystemExit):
+            jobselect.module_select('BROKEN')
+
+
+if __name__ == '__main__':
+    unittest.main()
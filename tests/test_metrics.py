@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Metrics tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests record the phases of a run and check the JSON lines
+                        log and the Prometheus textfile written from them.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to find the written files
+import json  # Used to read the JSON lines log
+import shutil  # Used to clean up the test directories
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+
+# Import Nimbus class libraries
+from libs.metrics import Metrics, phase, record, path_size  # The library under test
+
+
+class MetricsTest(unittest.TestCase):
+    """This class tests the metrics of the backup runs"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_metrics_')
+        self.log_path = os.path.join(self.work_dir, 'metrics.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_phases_are_logged(self):
+        """Each phase is appended to the log as a line of its own, once the run is closed"""
+        metrics = Metrics('gitserver', self.log_path)
+        with metrics.phase('dump', database='shop') as measured:
+            measured['bytes_in'] = 4096
+            measured['bytes_out'] = 1024
+        with phase(metrics, 'copy', destination='nfs'):
+            pass
+        with phase(None, 'copy'):
+            pass
+        self.assertFalse(os.path.exists(self.log_path))
+
+        metrics.close()
+        Metrics('gitserver', self.log_path).close()
+        with open(self.log_path) as log:
+            records = [json.loads(line) for line in log]
+        self.assertEqual([(record['phase'], record.get('database'), record.get('destination'))
+                          for record in records], [('dump', 'shop', None), ('copy', None, 'nfs')])
+        self.assertEqual((records[0]['bytes_in'], records[0]['bytes_out']), (4096, 1024))
+        self.assertGreaterEqual(records[0]['wall_seconds'], 0)
+        self.assertIsNone(records[1]['bytes_in'])
+
+    def test_textfile(self):
+        """The textfile holds a sample per phase, with the job exported as the backup label"""
+        metrics = Metrics('git"server', textfile_dir=self.work_dir)
+        metrics.record('dump', 1.5, 0.5, 4096, 1024, database='shop')
+        metrics.close(success=False)
+
+        with open(os.path.join(self.work_dir, 'nimbus_git"server.prom')) as prom:
+            lines = prom.read().splitlines()
+        labels = '{backup="git\\"server",database="shop",phase="dump"}'
+        self.assertIn('nimbus_phase_wall_seconds' + labels + ' 1.5', lines)
+        self.assertIn('nimbus_phase_bytes_out' + labels + ' 1024', lines)
+        self.assertIn('nimbus_backup_success{backup="git\\"server"} 0', lines)
+        self.assertEqual(os.listdir(self.work_dir), ['nimbus_git"server.prom'])
+
+        # A textfile directory that does not exist is reported, not created.
+        Metrics('gitserver', textfile_dir=os.path.join(self.work_dir, 'missing')).close()
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, 'missing')))
+
+    def test_record(self):
+        """A finished phase is recorded when the module was given metrics, and skipped if not"""
+        metrics = Metrics('gitserver', self.log_path)
+        record(metrics, 'dump', 2.0, 0.25, None, 512, database='shop')
+        record(None, 'dump', 2.0)
+        metrics.close()
+        with open(self.log_path) as log:
+            records = [json.loads(line) for line in log]
+        self.assertEqual([(entry['phase'], entry['database'], entry['cpu_seconds'],
+                           entry['bytes_out']) for entry in records],
+                         [('dump', 'shop', 0.25, 512)])
+
+    def test_path_size(self):
+        """The size of a directory dump is the size of every file in it"""
+        dump_dir = os.path.join(self.work_dir, 'shop.dir')
+        os.makedirs(os.path.join(dump_dir, 'blobs'))
+        for rel_path, size in [('toc.dat', 100), ('blobs/3001.dat.gz', 250)]:
+            with open(os.path.join(dump_dir, rel_path), 'wb') as dump_file:
+                dump_file.write(b'x' * size)
+        self.assertEqual(path_size(dump_dir), 350)
+        self.assertEqual(path_size(os.path.join(dump_dir, 'toc.dat')), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
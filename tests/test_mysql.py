@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Module:					Mysql module tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests run the mysql incremental mode against stand-in tools
+                        that keep their binary logs in a directory, and replay the shipped
+                        binary logs on top of the full dumps.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to write the binary logs of the stand-in server
+import json  # Used to read the tool log and the binlog position
+import shutil  # Used to clean up the test directories
+import tarfile  # Used to read the archives
+import datetime  # Used to date the backups
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+
+# Import Nimbus class libraries
+from modules.mysql import mysql_backup_job, mysql_restore_job  # The module under test
+from libs.compression import ArchiveReader  # Used to read the archives back
+from tests.tools import make_tool  # Used to write the stand-in mysql tools
+
+DATABASES = ['blog', 'shop']
+
+# The server's binary logs are the mysql-bin.* files in NIMBUS_TEST_SERVER. A flush starts a
+# new one, any other call is logged along with what it read.
+MYSQL = """
+import json
+server = os.environ['NIMBUS_TEST_SERVER']
+args = sys.argv[1:]
+if '-e' in args and args[args.index('-e') + 1].startswith('FLUSH BINARY LOGS'):
+    binlogs = sorted(name for name in os.listdir(server) if name.startswith('mysql-bin.'))
+    number = int(binlogs[-1].split('.')[1]) + 1 if binlogs else 1
+    binlogs.append('mysql-bin.%06d' % number)
+    open(os.path.join(server, binlogs[-1]), 'w').close()
+    for name in binlogs:
+        print(name + "\\t" + str(os.path.getsize(os.path.join(server, name))))
+    sys.exit(0)
+data = '' if '-e' in args else sys.stdin.read()
+with open(os.environ['NIMBUS_TEST_LOG'], 'a') as log:
+    log.write(json.dumps({'tool': 'mysql', 'argv': args, 'stdin': data}) + "\\n")
+"""
+MYSQLDUMP = """
+server = os.environ['NIMBUS_TEST_SERVER']
+binlog = sorted(name for name in os.listdir(server) if name.startswith('mysql-bin.'))[-1]
+if '--master-data=2' in sys.argv:
+    print("-- CHANGE MASTER TO MASTER_LOG_FILE='" + binlog + "', MASTER_LOG_POS=" +
+          str(os.path.getsize(os.path.join(server, binlog))) + ";")
+print("-- dump of " + sys.argv[-1])
+"""
+MYSQLBINLOG = """
+import json, shutil
+server = os.environ['NIMBUS_TEST_SERVER']
+args = sys.argv[1:]
+if '--read-from-remote-server' in args:
+    result_file = [arg for arg in args if arg.startswith('--result-file=')][0].split('=', 1)[1]
+    for name in [arg for arg in args if arg.startswith('mysql-bin.')]:
+        shutil.copyfile(os.path.join(server, name), result_file + name)
+    sys.exit(0)
+with open(os.environ['NIMBUS_TEST_LOG'], 'a') as log:
+    log.write(json.dumps({'tool': 'mysqlbinlog', 'argv': args, 'stdin': ''}) + "\\n")
+start = [int(arg.split('=')[1]) for arg in args if arg.startswith('--start-position=')]
+for index, file_path in enumerate([arg for arg in args if not arg.startswith('-')]):
+    with open(file_path) as binlog:
+        sys.stdout.write(binlog.read()[start[0] if start and index == 0 else 0:])
+"""
+
+
+class MysqlIncrementalTest(unittest.TestCase):
+    """This class tests the binary log incrementals of the mysql module"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_mysql_')
+        self.local_dir = os.path.join(self.work_dir, 'local')
+        self.server_dir = os.path.join(self.work_dir, 'server')
+        os.makedirs(self.local_dir)
+        os.makedirs(self.server_dir)
+        self.log_path = os.path.join(self.work_dir, 'tools.log')
+        os.environ['NIMBUS_TEST_SERVER'] = self.server_dir
+        os.environ['NIMBUS_TEST_LOG'] = self.log_path
+        my_cnf = os.path.join(self.work_dir, 'my.cnf')
+        with open(my_cnf, 'w') as config_file:
+            config_file.write("[mysqld]\nlog_bin = mysql-bin\n")
+        self.manifest_path = os.path.join(self.work_dir, 'mysql_manifest.json')
+        self.args = {'mysql': make_tool(self.work_dir, 'mysql', MYSQL),
+                     'mysqldump': make_tool(self.work_dir, 'mysqldump', MYSQLDUMP),
+                     'mysqlbinlog': make_tool(self.work_dir, 'mysqlbinlog', MYSQLBINLOG),
+                     'my_cnf': my_cnf, 'db_list': DATABASES, 'incremental': True,
+                     'full_every_days': 7, 'manifest_path': self.manifest_path}
+        self.write_events('mysql-bin.000001', "event 1\n")
+
+    def tearDown(self):
+        for name in ['NIMBUS_TEST_SERVER', 'NIMBUS_TEST_LOG']:
+            os.environ.pop(name, None)
+        shutil.rmtree(self.work_dir)
+
+    def write_events(self, binlog, events):
+        """This function writes events into a binary log of the stand-in server"""
+        with open(os.path.join(self.server_dir, binlog), 'a') as binlog_file:
+            binlog_file.write(events)
+
+    def run_job(self, day):
+        """This function runs the backup job on a day of April 2016 and returns the archive"""
+        tar_name, _ = mysql_backup_job(self.local_dir, datetime.datetime(2016, 4, day, 1),
+                                       self.args)
+        return tar_name.lstrip('/')
+
+    def manifest(self):
+        """This function returns the manifest the last run left behind"""
+        with open(self.manifest_path) as manifest_file:
+            return json.load(manifest_file)
+
+    def test_full_then_binlog_incrementals(self):
+        """The closed binary logs are shipped between full dumps, which record their position"""
+        full_name = self.run_job(1)
+        self.assertEqual(full_name, 'mysql_2016-04-01_01-00-00.tar.gz')
+        with tarfile.open(os.path.join(self.local_dir, full_name)) as tar:
+            position = [name for name in tar.getnames()
+                        if name.endswith('binlog_position.json')]
+            self.assertEqual(len(position), 1)
+            self.assertEqual(json.load(tar.extractfile(position[0])), {'databases': {
+                database: ['mysql-bin.000001', 8] for database in DATABASES}})
+        self.assertEqual(self.manifest(), {'last_full': '2016-04-01 01:00:00',
+                                           'next_binlog': 'mysql-bin.000001'})
+
+        # Each incremental ships the binary logs closed since the last run.
+        self.write_events('mysql-bin.000001', "event 2\n")
+        incr_name = self.run_job(2)
+        self.assertEqual(incr_name, 'mysql_2016-04-02_01-00-00_incr.tar.gz')
+        with tarfile.open(os.path.join(self.local_dir, incr_name)) as tar:
+            self.assertEqual(tar.getnames(), ['mysql_2016-04-02_01-00-00/binlog/mysql-bin.000001'])
+        self.assertEqual(self.manifest()['next_binlog'], 'mysql-bin.000002')
+
+        self.write_events('mysql-bin.000002', "event 3\n")
+        self.assertTrue(self.run_job(3).endswith('_incr.tar.gz'))
+        self.assertEqual(self.manifest()['next_binlog'], 'mysql-bin.000003')
+
+        # Once full_every_days have gone by, the next run dumps the databases again.
+        self.assertEqual(self.run_job(8), 'mysql_2016-04-08_01-00-00.tar.gz')
+        self.assertEqual(self.manifest()['last_full'], '2016-04-08 01:00:00')
+
+    def test_purged_binlog_falls_back_to_a_full_backup(self):
+        """A binary log the server purged before it was shipped makes the run a full one"""
+        self.run_job(1)
+        self.write_events('mysql-bin.000002', "event 2\n")
+        os.remove(os.path.join(self.server_dir, 'mysql-bin.000001'))
+        self.assertEqual(self.run_job(2), 'mysql_2016-04-02_01-00-00.tar.gz')
+        self.assertEqual(self.manifest(), {'last_full': '2016-04-02 01:00:00',
+                                           'next_binlog': 'mysql-bin.000003'})
+
+    def test_restore_replays_the_binary_logs(self):
+        """The dumps are loaded, then the binary logs replayed from each dump's position"""
+        archive_names = [self.run_job(1)]
+        self.write_events('mysql-bin.000001', "event 2\n")
+        archive_names.append(self.run_job(2))
+        self.write_events('mysql-bin.000002', "event 3\n")
+        archive_names.append(self.run_job(3))
+
+        args = dict(self.args, recovery_target_time='2016-04-03 00:30:00')
+        sources = [open(os.path.join(self.local_dir, name), 'rb') for name in archive_names]
+        try:
+            results = mysql_restore_job([ArchiveReader(source, name) for source, name
+                                         in zip(sources, archive_names)], args,
+                                        databases=['shop'])
+        finally:
+            for source in sources:
+                source.close()
+
+        self.assertEqual(results, [("Restoring shop...", 0),
+                                   ("Replaying the binary logs into shop...", 0)])
+        dump = "-- CHANGE MASTER TO MASTER_LOG_FILE='mysql-bin.000001', MASTER_LOG_POS=8;\n" \
+            "-- dump of shop\n"
+        with open(self.log_path) as log:
+            calls = [json.loads(line) for line in log]
+        self.assertEqual([(call['tool'], call['stdin']) for call in calls],
+                         [('mysql', ''), ('mysql', dump), ('mysqlbinlog', ''),
+                          ('mysql', "event 2\nevent 3\n")])
+        replay = calls[2]['argv']
+        self.assertEqual(replay[:4], ['--skip-gtids', '--database=shop', '--start-position=8',
+                                      '--stop-datetime=2016-04-03 00:30:00'])
+        self.assertEqual([os.path.basename(path) for path in replay[4:]],
+                         ['mysql-bin.000001', 'mysql-bin.000002'])
+        self.assertEqual(calls[3]['argv'][-1], '--database=shop')
+
+
+if __name__ == '__main__':
+    unittest.main()
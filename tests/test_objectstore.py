@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Object store tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests upload archives to the stand-in S3 object store and check
+                        the multipart uploads, the retries, retention and verify on buckets.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to write the test archives and age the stored objects
+import time  # Used to age the stored objects
+import shutil  # Used to clean up the test directories
+import hashlib  # Used to checksum the test archives
+import datetime  # Used to date the retention sweep
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+
+# Import Nimbus class libraries
+from libs.objectstore import open_bucket, parse_location, MIN_PART_SIZE  # Under test
+from libs.parseconf import BackupDir  # Used to describe the test buckets
+from libs.fanout import fan_out  # Used to upload the archives
+from libs.retention import sweep  # Used to sweep the bucket
+from libs.verify import verify  # Used to verify the copies in the bucket
+from bench.s3standin import S3StandIn, ACCESS_KEY, SECRET_KEY  # Stands in for the object store
+
+
+class ObjectStoreTest(unittest.TestCase):
+    """This class tests the S3 backup directories"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_objectstore_')
+        self.root = os.path.join(self.work_dir, 's3')
+        self.server = S3StandIn(self.root).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_dir)
+
+    def bucket(self, **options):
+        """This function opens the gitlab directory of the test bucket"""
+        settings = {'endpoint': self.server.endpoint, 'access_key_id': ACCESS_KEY,
+                    'secret_access_key': SECRET_KEY, 'part_size': MIN_PART_SIZE,
+                    'max_parallel_parts': 3}
+        settings.update(options)
+        return open_bucket(BackupDir('s3', 'gitlab', 's3://backups/nimbus/', 7, 's3', settings))
+
+    def write_archive(self, archive_name, size):
+        """This function writes a test archive and returns its path and data"""
+        archive_path = os.path.join(self.work_dir, archive_name)
+        data = os.urandom(size)
+        with open(archive_path, 'wb') as archive:
+            archive.write(data)
+        return archive_path, data
+
+    def stored(self, archive_name):
+        """This function reads an object back from the files of the stand-in"""
+        with open(os.path.join(self.root, 'backups', 'nimbus', 'gitlab', archive_name),
+                  'rb') as stored_file:
+            return stored_file.read()
+
+    def test_multipart_upload_with_retries(self):
+        """A large archive goes up in parts, retried through server errors, and verifies"""
+        self.server.fail_every = 4
+        archive_path, data = self.write_archive('gitlab_2016-04-07_01-00-00.tar.gz',
+                                                MIN_PART_SIZE * 2 + 4321)
+        bucket = self.bucket()
+        digest, results = fan_out(archive_path, [bucket.sink('s3', '/' + os.path.basename(
+            archive_path))])
+        self.assertIsNone(results[0]['error'])
+        self.assertEqual(results[0]['path'],
+                         's3://backups/nimbus/gitlab/gitlab_2016-04-07_01-00-00.tar.gz')
+        self.assertEqual(self.stored('gitlab_2016-04-07_01-00-00.tar.gz'), data)
+        self.assertEqual(self.stored('gitlab_2016-04-07_01-00-00.tar.gz.sha256').split()[0],
+                         digest.encode())
+        # The parts of the finished upload are gone, and the six requests it took were retried.
+        self.assertEqual(os.listdir(os.path.join(self.root, '.uploads')), [])
+        self.assertGreater(self.server.requests, 6)
+
+        self.server.fail_every = 0
+        self.assertEqual(bucket.hash('gitlab_2016-04-07_01-00-00.tar.gz'),
+                         hashlib.sha256(data).hexdigest())
+        checks = verify([bucket])
+        self.assertEqual([(check['path'], check['status']) for check in checks],
+                         [(results[0]['path'], 'ok')])
+
+    def test_retention_and_listing(self):
+        """Old objects are deleted from the bucket in a batch, the new ones are kept"""
+        bucket = self.bucket()
+        for day in [1, 5, 9]:
+            archive_name = 'gitlab_2016-04-0' + str(day) + '_01-00-00.tar.gz'
+            archive_path, _ = self.write_archive(archive_name, 1024)
+            fan_out(archive_path, [bucket.sink('s3', archive_name)])
+            stored_time = time.time() - (10 - day) * 86400
+            for name in [archive_name, archive_name + '.sha256']:
+                os.utime(os.path.join(self.root, 'backups', 'nimbus', 'gitlab', name),
+                         (stored_time, stored_time))
+        self.assertEqual(len(bucket.list()), 6)
+
+        results = sweep([(bucket, 7, 's3')], datetime.datetime.now())
+        self.assertEqual(sorted(path for path, _ in results[0]['removed']),
+                         sorted(bucket.url(name) for name in [
+                             'gitlab_2016-04-01_01-00-00.tar.gz',
+                             'gitlab_2016-04-01_01-00-00.tar.gz.sha256']))
+        self.assertEqual((results[0]['kept'], results[0]['errors']), (4, []))
+        self.assertEqual(sorted(listed['name'] for listed in bucket.list()), [
+            'gitlab_2016-04-05_01-00-00.tar.gz', 'gitlab_2016-04-05_01-00-00.tar.gz.sha256',
+            'gitlab_2016-04-09_01-00-00.tar.gz', 'gitlab_2016-04-09_01-00-00.tar.gz.sha256'])
+
+    def test_rejected_requests(self):
+        """Bad credentials are refused by the store, and bad settings are refused up front"""
+        bucket = self.bucket(secret_access_key='wrong')
+        with self.assertRaises(SystemError) as raised:
+            bucket.list()
+        self.assertIn("403", str(raised.exception))
+        self.assertEqual(parse_location('s3://backups'), ('backups', ''))
+        for location in ['/mnt/s3', 's3:///nimbus']:
+            with self.assertRaises(SystemExit):
+                parse_location(location)
+        with self.assertRaises(SystemExit):
+            self.bucket(endpoint='ftp://127.0.0.1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Settings parser tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests check that the settings file is validated once, that every
+                        mistake is reported together and that the parsed settings are read only.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to build the backup directory paths
+import io  # Used to capture the printed warnings
+import json  # Used to write the test settings files
+import shutil  # Used to clean up the test directories
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+import contextlib  # Used to capture the printed warnings
+
+# Import Nimbus class libraries
+from libs.parseconf import ParseConf, BackupDir  # The library under test
+
+
+class ParseConfTest(unittest.TestCase):
+    """This class tests the settings file parser"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_parseconf_')
+        self.config_path = os.path.join(self.work_dir, 'job.ini')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_config(self, server_config):
+        """This function writes the test settings file"""
+        with open(self.config_path, 'w') as config_file:
+            json.dump(server_config, config_file)
+
+    def test_settings_are_parsed_once(self):
+        """Directories are normalized and created, and the settings can not be changed"""
+        self.write_config({'backup_directories': [
+            {'label': 'local', 'directory': 'backups', 'path': self.work_dir,
+             'retention_days': "2"},
+            {'directory': 'nfs', 'path': self.work_dir + '/', 'type': 'chunkstore',
+             'chunk_size': 4096},
+            {'label': 's3', 'directory': 'gitlab', 'path': 's3://backups/nimbus', 'type': 's3',
+             'endpoint': 'http://127.0.0.1:9000'}],
+                           'compression': 'zstd',
+                           'module_args': {'pg_host': 'db1', 'db_list': ['shop', 'crm']}})
+        config = ParseConf(self.config_path)
+
+        self.assertEqual(config.backup_dirs(), (
+            BackupDir('local', 'backups', self.work_dir + '/', 2, 'filesystem', {}),
+            BackupDir('nfs', 'nfs', self.work_dir + '/', 3, 'chunkstore', {'chunk_size': 4096}),
+            BackupDir('s3', 'gitlab', 's3://backups/nimbus/', 3, 's3',
+                      {'endpoint': 'http://127.0.0.1:9000'})))
+        for directory in config.backup_dirs()[:2]:
+            self.assertTrue(os.path.isdir(directory.full_path))
+        self.assertEqual((config.mail_sender(), config.mail_recipients()), ('root', 'root'))
+        self.assertEqual(dict(config.compression()), {'codec': 'zstd'})
+
+        args = config.module_args()
+        self.assertEqual(args['db_list'], ('shop', 'crm'))
+        with self.assertRaises(TypeError):
+            args['pg_host'] = 'db2'
+        with self.assertRaises(AttributeError):
+            config.mail_sender_address = 'nobody'
+
+    def test_mail_recipients_list(self):
+        """A list of mail recipients is joined into the To header"""
+        self.write_config({'backup_directories': [{'directory': 'nfs', 'path': self.work_dir}],
+                           'mail_recipients': ['ops@example.com', 'dba@example.com']})
+        self.assertEqual(ParseConf(self.config_path).mail_recipients(),
+                         'ops@example.com, dba@example.com')
+
+    def test_every_mistake_is_reported(self):
+        """All of the problems in a settings file are listed in one error"""
+        self.write_config({'backup_directories': [
+            {'directory': 'backups'},
+            {'directory': 'nfs', 'path': self.work_dir, 'retention_days': 'weekly'},
+            {'directory': 'usb', 'path': self.work_dir, 'retention_days': -1},
+            'usb', {'directory': 'gitlab', 'path': '/mnt/s3', 'type': 's3'}],
+                           'mail_sender': 5, 'mail_recipients': ['ops@example.com', 7],
+                           'module_args': [], 'compression': 6})
+        with self.assertRaises(SystemExit) as raised:
+            ParseConf(self.config_path)
+        message = str(raised.exception)
+        for error in ["backup_directories[0] is missing path",
+                      "backup_directories[1] retention_days must be a number of days",
+                      "backup_directories[2] retention_days can not be negative",
+                      "backup_directories[3] must be an object",
+                      "backup_directories[4] path must be a s3://bucket/prefix location",
+                      "mail_sender must be a string",
+                      "mail_recipients must be a string or a list of strings",
+                      "module_args must be an object",
+                      "compression must be a codec name or an object"]:
+            self.assertIn(error, message)
+
+        for server_config in ['{"backup_directories": ', '[]', '{}']:
+            with open(self.config_path, 'w') as config_file:
+                config_file.write(server_config)
+            with self.assertRaises(SystemExit):
+                ParseConf(self.config_path)
+        with self.assertRaises(SystemExit), contextlib.redirect_stdout(io.StringIO()):
+            ParseConf(os.path.join(self.work_dir, 'missing.ini'))
+
+    def test_empty_directory_is_the_root_of_the_path(self):
+        """An empty directory is the path itself, but an empty path is a mistake"""
+        self.write_config({'backup_directories': [{'directory': '', 'path': self.work_dir}]})
+        self.assertEqual(ParseConf(self.config_path).backup_dirs()[0].full_path,
+                         self.work_dir + '/')
+
+        self.write_config({'backup_directories': [{'directory': 'nfs', 'path': ''}]})
+        with self.assertRaises(SystemExit) as raised:
+            ParseConf(self.config_path)
+        self.assertIn("backup_directories[0] is missing path", str(raised.exception))
+
+    def test_directory_that_can_not_be_created(self):
+        """A backup directory that can not be created is a warning, not an error"""
+        blocker = os.path.join(self.work_dir, 'blocker')
+        with open(blocker, 'w') as blocker_file:
+            blocker_file.write('not a directory')
+        self.write_config({'backup_directories': [{'directory': 'nfs', 'path': blocker}]})
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            config = ParseConf(self.config_path)
+        self.assertEqual(len(config.backup_dirs()), 1)
+        self.assertIn("WARNING: " + blocker + "/nfs could not be created", output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
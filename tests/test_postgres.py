@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Module:					Postgres module tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests run the postgres backup job against stand-in dump
+                        tools, and check that the dumps run side by side and all end up
+                        in the archive with their log sections in order.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to check the archive
+import glob  # Used to check that the temp directories are cleaned up
+import json  # Used to pass the database sizes to the stand-in psql
+import lzma  # Used to read the streamed members back
+import time  # Used to time the dumps
+import shutil  # Used to clean up the test directories
+import tarfile  # Used to read the archive
+import datetime  # Used to date the backup
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+
+# Import Nimbus class libraries
+from modules.postgres import postgres_backup_job  # The module under test
+from libs.metrics import Metrics  # Used to check what the dumps record
+from tests.tools import make_tool  # Used to write the stand-in dump tools
+
+DATABASES = ['alpha', 'bravo', 'charlie', 'delta']
+DUMP_SECONDS = 0.5
+
+PG_DUMP = """
+args = sys.argv[1:]
+database, target, dump_format = None, None, 'p'
+while args:
+    arg = args.pop(0)
+    if arg in ('-h', '-p', '-U', '-j'):
+        args.pop(0)
+    elif arg == '-f':
+        target = args.pop(0)
+    elif arg.startswith('-F'):
+        dump_format = arg[2:]
+    elif not arg.startswith('-'):
+        database = arg
+if 'NIMBUS_TEST_STARTED' in os.environ:
+    with open(os.environ['NIMBUS_TEST_STARTED'], 'a') as started:
+        started.write(database + "\\n")
+if database == os.environ.get('NIMBUS_TEST_FAIL'):
+    sys.stderr.write("password authentication failed: " + os.environ.get('PGPASSWORD', '') + "\\n")
+    sys.exit(1)
+time.sleep(float(os.environ.get('NIMBUS_TEST_DUMP_SECONDS', '0')))
+dump = "-- dump of " + database + "\\n"
+if dump_format == 'd':
+    os.makedirs(target)
+    with open(os.path.join(target, 'toc.dat'), 'w') as toc:
+        toc.write(dump)
+elif dump_format == 'c':
+    sys.stdout.write("PGDMP " + dump)
+else:
+    sys.stdout.write(dump)
+"""
+PSQL = """
+import json
+for database, size in sorted(json.loads(os.environ.get('NIMBUS_TEST_SIZES', '{}')).items()):
+    print(database + " " + str(size))
+"""
+PG_DUMPALL = """
+print("CREATE ROLE manager;")
+"""
+
+
+class PostgresBackupTest(unittest.TestCase):
+    """This class tests the postgres backup job"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_postgres_')
+        self.local_dir = os.path.join(self.work_dir, 'local')
+        os.makedirs(self.local_dir)
+        pg_conf = os.path.join(self.work_dir, 'postgresql.conf')
+        with open(pg_conf, 'w') as config_file:
+            config_file.write("max_connections = 100\n")
+        self.args = {'pg_hba': pg_conf, 'pg_conf': pg_conf,
+                     'pg_dump': make_tool(self.work_dir, 'pg_dump', PG_DUMP),
+                     'pg_dumpall': make_tool(self.work_dir, 'pg_dumpall', PG_DUMPALL),
+                     'psql': make_tool(self.work_dir, 'psql', PSQL),
+                     'db_list': DATABASES, 'max_parallel_dumps': len(DATABASES)}
+        os.environ['NIMBUS_TEST_DUMP_SECONDS'] = str(DUMP_SECONDS)
+
+    def tearDown(self):
+        for name in ['NIMBUS_TEST_DUMP_SECONDS', 'NIMBUS_TEST_STARTED', 'NIMBUS_TEST_SIZES',
+                     'NIMBUS_TEST_FAIL']:
+            os.environ.pop(name, None)
+        shutil.rmtree(self.work_dir)
+
+    def run_job(self, compression=None, metrics=None):
+        """This function runs the backup job and returns the archive name and job log"""
+        return postgres_backup_job(self.local_dir, datetime.datetime.now(),
+                                   self.args, compression, metrics)
+
+    def test_dumps_run_side_by_side(self):
+        """The dumps run in parallel, and the archive holds every one of them"""
+        metrics = Metrics('postgres')
+        start = time.time()
+        tar_name, job_log = self.run_job(metrics=metrics)
+        self.assertLess(time.time() - start, DUMP_SECONDS * len(DATABASES) * 0.75)
+
+        # Each dump is recorded on its own, as is the archive.
+        dumps = {record['database']: record for record in metrics.records
+                 if record['phase'] == 'dump'}
+        self.assertEqual(sorted(dumps), DATABASES + ['pg_roles'])
+        for database in DATABASES:
+            self.assertEqual(dumps[database]['bytes_out'], len("-- dump of " + database + "\n"))
+        self.assertEqual([record['phase'] for record in metrics.records].count('archive'), 1)
+
+        with tarfile.open(self.local_dir + tar_name) as tar:
+            names = [os.path.basename(name) for name in tar.getnames()]
+        for database in DATABASES + ['pg_roles']:
+            self.assertTrue(any(name.startswith(database + '-') for name in names), database)
+
+        # Every database keeps its own section of the log, in db_list order.
+        headers = [job_log.index("Running " + database + " backup...")
+                   for database in DATABASES]
+        self.assertEqual(headers, sorted(headers))
+
+    def test_streamed_dumps_use_the_codec(self):
+        """Streamed dumps are compressed into their members with the configured codec"""
+        self.args['stream_dumps'] = True
+        tar_name, _ = self.run_job({'codec': 'xz'})
+        self.assertTrue(tar_name.endswith('.tar'))
+
+        with tarfile.open(self.local_dir + tar_name) as tar:
+            for database in DATABASES:
+                member = [name for name in tar.getnames()
+                          if os.path.basename(name).startswith(database + '-')]
+                self.assertEqual(len(member), 1, database)
+                self.assertTrue(member[0].endswith('.xz'))
+                dump = lzma.decompress(tar.extractfile(member[0]).read())
+                self.assertEqual(dump, b"-- dump of " + database.encode() + b"\n")
+
+    def read_archive(self, tar_name):
+        """This function returns the contents of the dump files in an archive by database"""
+        dumps = {}
+        with tarfile.open(self.local_dir + tar_name) as tar:
+            for member in tar.getmembers():
+                # Directory format dumps are a directory named after the database.
+                for part in member.name.split('/')[1:]:
+                    database = part.split('-')[0]
+                    if member.isfile() and database in DATABASES:
+                        dumps[database] = (member.name, tar.extractfile(member).read())
+        return dumps
+
+    def test_custom_format(self):
+        """Custom format dumps are archived as pg_dump wrote them, staged or streamed"""
+        os.environ['NIMBUS_TEST_DUMP_SECONDS'] = '0'
+        self.args['pg_format'] = 'custom'
+        for stream in [False, True]:
+            with self.subTest(stream=stream):
+                self.args['stream_dumps'] = stream
+                tar_name, _ = self.run_job()
+                for database, (name, dump) in self.read_archive(tar_name).items():
+                    self.assertTrue(name.endswith('.dump'))
+                    self.assertEqual(dump, b"PGDMP -- dump of " + database.encode() + b"\n")
+
+    def test_directory_format(self):
+        """Directory format dumps are always staged, with pg_dump writing the directory"""
+        os.environ['NIMBUS_TEST_DUMP_SECONDS'] = '0'
+        self.args.update({'pg_format': 'directory', 'stream_dumps': True})
+        tar_name, _ = self.run_job()
+        self.assertTrue(tar_name.endswith('.tar.gz'))
+        dumps = self.read_archive(tar_name)
+        self.assertEqual(sorted(dumps), DATABASES)
+        for database, (name, dump) in dumps.items():
+            self.assertTrue(name.endswith('.dir/toc.dat'))
+            self.assertEqual(dump, b"-- dump of " + database.encode() + b"\n")
+
+        self.args['pg_format'] = 'tar'
+        with self.assertRaises(SystemExit):
+            self.run_job()
+
+    def test_largest_database_starts_first(self):
+        """With several dumps at once, the databases are started largest first"""
+        started_path = os.path.join(self.work_dir, 'started')
+        os.environ['NIMBUS_TEST_STARTED'] = started_path
+        os.environ['NIMBUS_TEST_SIZES'] = json.dumps({'alpha': 10, 'bravo': 400,
+                                                      'charlie': 30, 'delta': 2000})
+        os.environ['NIMBUS_TEST_DUMP_SECONDS'] = '0.3'
+        self.args['max_parallel_dumps'] = 2
+        _, job_log = self.run_job()
+
+        with open(started_path) as started:
+            order = started.read().split()
+        self.assertEqual(sorted(order[:2]), ['bravo', 'delta'])
+        self.assertEqual(sorted(order[2:]), ['alpha', 'charlie'])
+        # The log keeps db_list order whatever order the dumps ran in.
+        headers = [job_log.index("Running " + database + " backup...")
+                   for database in DATABASES]
+        self.assertEqual(headers, sorted(headers))
+
+    def test_failed_dump_fails_the_job(self):
+        """A failed dump fails the job and leaves no partial backup behind"""
+        os.environ.update({'NIMBUS_TEST_DUMP_SECONDS': '0', 'NIMBUS_TEST_FAIL': 'charlie'})
+        self.args['pg_password'] = 's3cret'
+        for stream in [False, True]:
+            with self.subTest(stream=stream):
+                self.args['stream_dumps'] = stream
+                tmp_dirs = set(glob.glob('/tmp/postgres_*'))
+                with self.assertRaises(SystemError) as raised:
+                    self.run_job()
+                # The password reaches pg_dump through the environment, not the command line.
+                self.assertIn("The dumps of charlie failed", str(raised.exception))
+                self.assertIn("password authentication failed: s3cret", str(raised.exception))
+                self.assertEqual(str(raised.exception).count("s3cret"), 1)
+                self.assertEqual(os.listdir(self.local_dir), [])
+                self.assertEqual(set(glob.glob('/tmp/postgres_*')), tmp_dirs)
+
+
+if __name__ == '__main__':
+    unittest.main()
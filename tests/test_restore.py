@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Restore tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests find and read archives across backup directories and
+                        restore them into stand-in database tools, checking that the names
+                        read out of an archive only ever reach the tools as arguments.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import io  # Used to build the test archives in memory
+import os  # Used to write the test archives
+import gzip  # Used to compress the test dumps
+import json  # Used to read the tool logs
+import shutil  # Used to find zstd and clean up the test directories
+import tarfile  # Used to write the test archives
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+import subprocess  # Used to compress a test dump with zstd
+
+# Import Nimbus class libraries
+from libs.restore import list_archives, restore_chain  # The library under test
+from libs.restore import find_replicas, select_replica, pipe_member  # The library under test
+from libs.compression import ArchiveReader  # Used to read the test archives
+from modules.postgres import postgres_restore_job  # Used to restore a postgres archive
+from modules.mysql import mysql_restore_job  # Used to restore a mysql archive
+from libs.parseconf import BackupDir  # Used to describe the test backup directories
+from tests.tools import make_tool  # Used to write the stand-in database tools
+
+DATE = '2016-04-07_01-00-00'
+HOSTILE = 'shop;touch pwned;$(touch pwned)'
+
+# The stand-in tools log their arguments, and what they read when they are fed a dump.
+RESTORE_TOOL = """
+import json
+data = ''
+if os.environ.get('NIMBUS_TEST_STDIN') == sys.argv[0].rsplit('/', 1)[-1] and '-e' not in sys.argv:
+    data = sys.stdin.buffer.read().decode()
+with open(os.environ['NIMBUS_TEST_LOG'], 'a') as log:
+    log.write(json.dumps({'tool': sys.argv[0].rsplit('/', 1)[-1], 'argv': sys.argv[1:],
+                          'stdin': data}) + "\\n")
+if '-e' in sys.argv and 'NIMBUS_TEST_FAIL_QUERY' in os.environ:
+    sys.exit(1)
+sys.exit(int(os.environ.get('NIMBUS_TEST_EXIT', '0')))
+"""
+
+
+class RestoreTest(unittest.TestCase):
+    """This class tests the restore of the backup archives"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_restore_')
+        self.cwd = os.getcwd()
+        os.chdir(self.work_dir)
+        self.log_path = os.path.join(self.work_dir, 'tools.log')
+        os.environ['NIMBUS_TEST_LOG'] = self.log_path
+        self.tools = {name: make_tool(self.work_dir, name, RESTORE_TOOL)
+                      for name in ['psql', 'createdb', 'pg_restore', 'mysql']}
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        for name in ['NIMBUS_TEST_LOG', 'NIMBUS_TEST_STDIN', 'NIMBUS_TEST_EXIT',
+                     'NIMBUS_TEST_FAIL_QUERY']:
+            os.environ.pop(name, None)
+        shutil.rmtree(self.work_dir)
+
+    def tool_log(self):
+        """This function returns the calls that the stand-in tools logged"""
+        if not os.path.isfile(self.log_path):
+            return []
+        with open(self.log_path) as log:
+            return [json.loads(line) for line in log]
+
+    def write_archive(self, dir_path, archive_name, members):
+        """This function writes an archive of gzipped dumps and returns its path"""
+        os.makedirs(dir_path, exist_ok=True)
+        archive_path = os.path.join(dir_path, archive_name)
+        with tarfile.open(archive_path, 'w') as tar:
+            for member_name, dump in members.items():
+                data = gzip.compress(dump.encode())
+                info = tarfile.TarInfo(member_name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        return archive_path
+
+    def test_restore_chain(self):
+        """An incremental is restored on top of the last full archive before it"""
+        directory = BackupDir('nfs', '/nfs', self.work_dir, None, 'mount', {})
+        for day, suffix in [(1, ''), (2, '_incr'), (3, ''), (4, '_incr'), (5, '_incr')]:
+            self.write_archive(os.path.join(self.work_dir, 'nfs'),
+                               'gitlab_2016-04-0' + str(day) + '_01-00-00' + suffix + '.tar.gz',
+                               {})
+        archives = list_archives([directory], 'gitlab_')
+        self.assertEqual(len(archives), 5)
+        self.assertEqual(restore_chain(archives, archives[-1], 'gitlab_'), archives[2:])
+        self.assertEqual(restore_chain(archives, archives[1], 'gitlab_'), archives[:2])
+        with self.assertRaises(SystemExit):
+            restore_chain(archives[1:], archives[1], 'gitlab_')
+        with self.assertRaises(SystemExit):
+            restore_chain(archives, 'gitlab_2016-04-09_01-00-00.tar.gz', 'gitlab_')
+
+    def test_select_replica(self):
+        """The reachable copy is read, and an archive that cannot be read is an error"""
+        archive_name = 'postgres_' + DATE + '.tar'
+        directories = [BackupDir(label, '/' + label, self.work_dir, None, 'mount', {})
+                       for label in ['nfs', 'usb']]
+        for label in ['nfs', 'usb']:
+            self.write_archive(os.path.join(self.work_dir, label), archive_name, {})
+        replicas = find_replicas(directories, archive_name)
+        self.assertEqual([replica['label'] for replica in replicas], ['nfs', 'usb'])
+
+        os.remove(replicas[0]['path'])
+        self.assertEqual(select_replica(replicas)['label'], 'usb')
+        self.assertIsNone(replicas[0]['seconds'])
+        os.remove(replicas[1]['path'])
+        with self.assertRaises(SystemExit):
+            select_replica(replicas)
+
+    def test_pipe_member(self):
+        """A member is decompressed into the restore command, which never sees a shell"""
+        os.environ['NIMBUS_TEST_STDIN'] = 'psql'
+        dump = gzip.compress(b"CREATE TABLE orders ();\n")
+        return_code = pipe_member(io.BytesIO(dump), HOSTILE + '.sql.gz',
+                                  [self.tools['psql'], '-d', HOSTILE])
+        self.assertEqual(return_code, 0)
+        self.assertEqual(self.tool_log(), [{'tool': 'psql', 'argv': ['-d', HOSTILE],
+                                            'stdin': "CREATE TABLE orders ();\n"}])
+        self.assertFalse(os.path.exists('pwned'))
+
+        os.environ['NIMBUS_TEST_EXIT'] = '3'
+        self.assertEqual(pipe_member(io.BytesIO(dump), 'shop.sql.gz', [self.tools['psql']]), 3)
+
+    def test_pipe_member_through_zstd(self):
+        """A member of an external codec goes through its decompressor first"""
+        if shutil.which('zstd') is None:
+            self.skipTest("zstd is not installed")
+        os.environ['NIMBUS_TEST_STDIN'] = 'psql'
+        dump = subprocess.run(['zstd', '-q', '-c'], input=b"CREATE TABLE orders ();\n",
+                              stdout=subprocess.PIPE, check=True).stdout
+        self.assertEqual(pipe_member(io.BytesIO(dump), 'shop.sql.zst', [self.tools['psql']]), 0)
+        self.assertEqual(self.tool_log()[0]['stdin'], "CREATE TABLE orders ();\n")
+
+    def test_postgres_restore(self):
+        """Roles go in first, and every database name reaches the tools as its own argument"""
+        os.environ['NIMBUS_TEST_STDIN'] = 'psql'
+        prefix = 'postgres_' + DATE + '/'
+        archive_name = 'postgres_' + DATE + '.tar'
+        archive_path = self.write_archive(self.work_dir, archive_name, {
+            prefix + HOSTILE + '-' + DATE + '.sql.gz': "-- dump of the shop\n",
+            prefix + 'pg_roles-' + DATE + '.sql.gz': "CREATE ROLE manager;\n"})
+        args = {'psql': self.tools['psql'], 'createdb': self.tools['createdb'],
+                'pg_restore': self.tools['pg_restore'], 'pg_host': 'db1'}
+
+        with open(archive_path, 'rb') as source:
+            postgres_restore_job([ArchiveReader(source, archive_name)], args)
+
+        calls = [(call['tool'], call['argv'][-1], call['stdin']) for call in self.tool_log()]
+        self.assertEqual(calls, [('psql', 'postgres', "CREATE ROLE manager;\n"),
+                                 ('createdb', HOSTILE, ''),
+                                 ('psql', HOSTILE, "-- dump of the shop\n")])
+        self.assertEqual(self.tool_log()[1]['argv'][-2], '--')
+        self.assertFalse(os.path.exists('pwned'))
+
+    def test_mysql_restore(self):
+        """The mysql databases are created and fed their dumps without a shell"""
+        os.environ['NIMBUS_TEST_STDIN'] = 'mysql'
+        prefix = 'mysql_' + DATE + '/'
+        archive_name = 'mysql_' + DATE + '.tar'
+        hostile = HOSTILE + '`'
+        archive_path = self.write_archive(self.work_dir, archive_name, {
+            prefix + hostile + '-' + DATE + '.sql.gz': "-- dump of the shop\n"})
+
+        with open(archive_path, 'rb') as source:
+            results = mysql_restore_job([ArchiveReader(source, archive_name)],
+                                        {'mysql': self.tools['mysql']})
+
+        self.assertEqual(results, [("Restoring " + hostile + "...", 0)])
+        create, restore = self.tool_log()
+        self.assertEqual(create['argv'][-2:],
+                         ['-e', 'CREATE DATABASE IF NOT EXISTS `' + HOSTILE + '```'])
+        self.assertEqual(create['argv'][-3], '--password=')
+        self.assertEqual((restore['argv'][-1], restore['stdin']),
+                         ('--database=' + hostile, "-- dump of the shop\n"))
+        self.assertFalse(os.path.exists('pwned'))
+
+        os.environ['NIMBUS_TEST_EXIT'] = '1'
+        with open(archive_path, 'rb') as source:
+            with self.assertRaises(SystemExit):
+                mysql_restore_job([ArchiveReader(source, archive_name)],
+                                  {'mysql': self.tools['mysql']})
+
+    def test_mysql_create_database_failure(self):
+        """A database that can not be created fails the restore, and gets no dump fed in"""
+        os.environ['NIMBUS_TEST_STDIN'] = 'mysql'
+        os.environ['NIMBUS_TEST_FAIL_QUERY'] = '1'
+        archive_name = 'mysql_' + DATE + '.tar'
+        archive_path = self.write_archive(self.work_dir, archive_name, {
+            'mysql_' + DATE + '/shop-' + DATE + '.sql.gz': "-- dump of the shop\n"})
+
+        with open(archive_path, 'rb') as source:
+            with self.assertRaises(SystemExit) as raised:
+                mysql_restore_job([ArchiveReader(source, archive_name)],
+                                  {'mysql': self.tools['mysql']})
+        self.assertIn("Restoring shop...", str(raised.exception))
+        self.assertEqual([call['argv'][-2] for call in self.tool_log()], ['-e'])
+
+
+if __name__ == '__main__':
+    unittest.main()
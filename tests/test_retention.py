@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Retention tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests sweep backup directories with files of different ages
+                        and check which ones the retention sweep removes.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to write and age the test files
+import shutil  # Used to clean up the test directories
+import datetime  # Used to age the test files
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+
+# Import Nimbus class libraries
+from libs.retention import sweep  # The library under test
+from libs.chunkstore import ChunkStoreSink, manifest_path  # Used to fill a chunk store
+from libs.fanout import fan_out  # Used to copy an archive into the chunk store
+
+NOW = datetime.datetime(2016, 4, 30, 1, 0, 0)
+
+
+class RetentionTest(unittest.TestCase):
+    """This class tests the retention sweep of the backup directories"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_retention_')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def age(self, file_path, days):
+        """This function sets the mtime of a file to a number of days before the sweep"""
+        mtime = (NOW - datetime.timedelta(days=days, hours=1)).timestamp()
+        os.utime(file_path, (mtime, mtime))
+
+    def backup_dir(self, name, ages):
+        """This function creates a backup directory with a file of each of the given ages"""
+        dir_path = os.path.join(self.work_dir, name)
+        os.makedirs(dir_path)
+        for days in ages:
+            file_path = os.path.join(dir_path, 'backup_' + str(days) + '.tar.gz')
+            with open(file_path, 'w') as backup_file:
+                backup_file.write(str(days))
+            self.age(file_path, days)
+        return dir_path
+
+    def test_expired_files_are_removed(self):
+        """Each directory keeps the files within its own retention period"""
+        nfs = self.backup_dir('nfs', [0, 3, 8, 30])
+        usb = self.backup_dir('usb', [0, 3, 8, 30])
+        results = sweep([(nfs, 7, 'mount'), (usb, 20, 'mount')], NOW)
+
+        self.assertEqual(sorted(os.listdir(nfs)), ['backup_0.tar.gz', 'backup_3.tar.gz'])
+        self.assertEqual(sorted(os.listdir(usb)), ['backup_0.tar.gz', 'backup_3.tar.gz',
+                                                   'backup_8.tar.gz'])
+        self.assertEqual([(len(result['removed']), result['kept']) for result in results],
+                         [(2, 2), (1, 3)])
+        self.assertEqual([result['errors'] for result in results], [[], []])
+
+    def test_dry_run_removes_nothing(self):
+        """A dry run reports the expired files but leaves them in place"""
+        nfs = self.backup_dir('nfs', [0, 30])
+        results = sweep([(nfs, 7, 'mount')], NOW, dry_run=True)
+        self.assertEqual([age for _, age in results[0]['removed']], [30])
+        self.assertEqual(len(os.listdir(nfs)), 2)
+
+    def test_chunkstore_chunks_are_collected(self):
+        """The chunks of an expired chunk store manifest are collected after the sweep"""
+        store_path = os.path.join(self.work_dir, 'store')
+        os.makedirs(store_path)
+        archive_path = os.path.join(self.work_dir, 'backup.tar')
+        with open(archive_path, 'wb') as archive:
+            archive.write(os.urandom(256 * 1024))
+        fan_out(archive_path, [ChunkStoreSink('store', store_path, 'backup.tar')])
+        self.age(manifest_path(store_path, 'backup.tar'), 30)
+
+        results = sweep([(store_path, 7, 'chunkstore')], NOW)
+        self.assertEqual(len(results[0]['removed']), 1)
+        removed_chunks, removed_bytes = results[0]['chunks']
+        self.assertGreater(removed_chunks, 0)
+        self.assertEqual(removed_bytes, 256 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
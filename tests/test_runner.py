@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Command runner tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests run stand-in commands through the runner and check the
+                        pipelines, the output handling, the timeouts and the CPU times.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to read the files the commands write
+import time  # Used to time the commands
+import shutil  # Used to clean up the test directories
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+
+# Import Nimbus class libraries
+from libs.runner import run, run_many, failed, describe  # The library under test
+from tests.tools import make_tool  # Used to write the stand-in commands
+
+# Prints its arguments, then the lines of its stdin upper cased, and exits with NIMBUS_TEST_EXIT.
+ECHO = """
+sys.stderr.write("started " + " ".join(sys.argv[1:]) + "\\n")
+if sys.argv[1:2] == ['--stdin']:
+    sys.stdout.write(sys.stdin.read().upper())
+else:
+    print(" ".join(sys.argv[1:]))
+sys.exit(int(os.environ.get('NIMBUS_TEST_EXIT', '0')))
+"""
+# Burns some CPU and then sleeps for the number of seconds it is given.
+SLOW = """
+sum(range(2000000))
+if os.fork() == 0:
+    # A child left behind in the process group is stopped along with the command.
+    time.sleep(float(sys.argv[1]))
+    with open(sys.argv[2], 'w') as marker:
+        marker.write('child lived')
+    sys.exit(0)
+time.sleep(float(sys.argv[1]))
+"""
+
+
+class RunnerTest(unittest.TestCase):
+    """This class tests the runner of the external commands"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_runner_')
+        self.echo = make_tool(self.work_dir, 'echo', ECHO)
+        self.slow = make_tool(self.work_dir, 'slow', SLOW)
+        self.logged = []
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_arguments_are_not_run_through_a_shell(self):
+        """Every argument reaches the command as is, and the output is captured or logged"""
+        hostile = "shop; touch pwned $(touch pwned)"
+        result = run([self.echo, hostile], capture=True, log=self.logged.append, label='shop',
+                     cwd=self.work_dir)
+        self.assertEqual(result['stdout'], hostile + "\n")
+        self.assertEqual(self.logged, ['shop: started ' + hostile])
+        self.assertEqual(result['command'], self.echo + " 'shop; touch pwned $(touch pwned)'")
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, 'pwned')))
+        self.assertFalse(failed(result))
+        self.assertTrue(describe(result).startswith("completed in "))
+
+    def test_pipeline_fails_like_pipefail(self):
+        """The stdout of a pipeline goes to a file, and a failure anywhere fails the pipeline"""
+        out_path = os.path.join(self.work_dir, 'out')
+        result = run([[self.echo, 'dump'], [self.echo, '--stdin']], stdout=out_path,
+                     log=self.logged.append, env={'NIMBUS_TEST_EXIT': '0'})
+        self.assertEqual(result['returncode'], 0)
+        with open(out_path) as out_file:
+            self.assertEqual(out_file.read(), "DUMP\n")
+        self.assertEqual(sorted(self.logged), ['started --stdin', 'started dump'])
+
+        result = run([[self.echo, 'dump'], [self.echo, '--stdin']], stdout=out_path,
+                     log=self.logged.append, env={'NIMBUS_TEST_EXIT': '3'})
+        self.assertEqual(result['returncode'], 3)
+        self.assertTrue(failed(result))
+        self.assertTrue(describe(result).startswith("failed with exit code 3: "))
+        with self.assertRaises(SystemError):
+            run([os.path.join(self.work_dir, 'missing')])
+
+    def test_timeout_stops_the_process_group(self):
+        """A command that runs too long is stopped with every process it started"""
+        marker = os.path.join(self.work_dir, 'marker')
+        start = time.monotonic()
+        result = run([self.slow, '2', marker], timeout=0.5, log=self.logged.append)
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertTrue(result['timed_out'])
+        self.assertTrue(failed(result))
+        self.assertTrue(describe(result).startswith("timed out after "))
+        time.sleep(2)
+        self.assertFalse(os.path.exists(marker))
+
+    def test_run_many(self):
+        """Commands run max_parallel at a time, with their results in the order given"""
+        marker = os.path.join(self.work_dir, 'marker')
+        start = time.monotonic()
+        results = run_many([{'commands': [self.slow, '0.5', marker], 'log': self.logged.append}
+                            for _ in range(4)], max_parallel=2)
+        elapsed = time.monotonic() - start
+        self.assertGreater(elapsed, 0.9)
+        self.assertLess(elapsed, 1.9)
+        self.assertEqual([result['returncode'] for result in results], [0, 0, 0, 0])
+        # The CPU time is that of the command itself, not of the test process.
+        for result in results:
+            self.assertGreater(result['cpu'], 0)
+            self.assertLess(result['cpu'], result['seconds'])
+
+
+if __name__ == '__main__':
+    unittest.main()
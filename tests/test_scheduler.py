@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Scheduler tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests load a directory of job configs and run them, and check
+                        the priorities, the concurrency caps and the job locks.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import io  # Used to capture the warnings and argument errors
+import os  # Used to write the test configs
+import json  # Used to write the test configs
+import time  # Used to keep the test jobs running for a moment
+import shutil  # Used to clean up the test directories
+import tempfile  # Used to create the test directories
+import threading  # Used to count the jobs running at once
+import unittest  # Used to run the tests
+import contextlib  # Used to capture the warnings and argument errors
+
+# Import Nimbus class libraries
+from libs.scheduler import load_jobs, run_all, job_lock  # The library under test
+import backup  # Used to parse the concurrency caps
+
+
+class SchedulerTest(unittest.TestCase):
+    """This class tests the scheduler of the config directory mode"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_scheduler_')
+        self.config_dir = os.path.join(self.work_dir, 'conf')
+        os.makedirs(self.config_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_config(self, file_name, server_config):
+        """This function writes a job config into the config directory"""
+        with open(os.path.join(self.config_dir, file_name), 'w') as config_file:
+            if isinstance(server_config, str):
+                config_file.write(server_config)
+            else:
+                json.dump(server_config, config_file)
+
+    def test_load_jobs(self):
+        """Jobs load highest priority first, and configs that are not jobs are skipped"""
+        self.write_config('alpha.ini', {'backup_job': 'postgres',
+                                        'module_args': {'pg_host': 'db1'}})
+        self.write_config('bravo.json', {'backup_job': 'mysql', 'priority': 5,
+                                         'module_args': {'mysql_host': 'db2'}})
+        self.write_config('charlie.conf', {'backup_job': 'gitlab', 'host': 'git1'})
+        self.write_config('delta.ini', {'backup_job': 'gitlab'})
+        self.write_config('broken.ini', '{"backup_job": ')
+        self.write_config('nojob.ini', {'module_args': {}})
+        self.write_config('echo.ini', {'backup_job': 'mysql', 'priority': 'high'})
+        self.write_config('foxtrot.ini', {'backup_job': 'mysql', 'priority': None})
+        self.write_config('notes.txt', {'backup_job': 'gitlab'})
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            jobs = load_jobs(self.config_dir)
+        self.assertEqual([(job['name'], job['host'], job['priority']) for job in jobs],
+                         [('bravo', 'db2', 5), ('alpha', 'db1', 0), ('charlie', 'git1', 0),
+                          ('delta', 'localhost', 0)])
+        for file_name in ['echo.ini', 'foxtrot.ini']:
+            self.assertIn(os.path.join(self.config_dir, file_name) + " skipped, its 'priority' "
+                          "is not a number", output.getvalue())
+
+    def test_run_all_honours_the_caps(self):
+        """No more jobs run at once than the global cap, nor per host than the host cap"""
+        jobs = [{'name': 'job' + str(index), 'backup_job': 'postgres', 'priority': 0,
+                 'host': 'db' + str(index % 2)} for index in range(6)]
+        lock = threading.Lock()
+        running = {'total': 0, 'db0': 0, 'db1': 0}
+        peaks = {'total': 0, 'db0': 0, 'db1': 0}
+
+        def run_job(job):
+            with lock:
+                for key in ('total', job['host']):
+                    running[key] += 1
+                    peaks[key] = max(peaks[key], running[key])
+            time.sleep(0.05)
+            with lock:
+                for key in ('total', job['host']):
+                    running[key] -= 1
+            if job['name'] == 'job3':
+                raise SystemExit(" ERROR: job3 failed")
+            return job['name']
+
+        results = run_all(jobs, run_job, max_parallel=3, max_per_host=1)
+        self.assertEqual(peaks, {'total': 2, 'db0': 1, 'db1': 1})
+        self.assertEqual(results['job0'], {'status': 'ok', 'result': 'job0'})
+        self.assertEqual(results['job3']['status'], 'failed')
+        self.assertEqual(len(results), 6)
+
+        peaks.update({'total': 0, 'db0': 0, 'db1': 0})
+        run_all(jobs, run_job, max_parallel=3, max_per_host=3)
+        self.assertEqual(peaks['total'], 3)
+
+    def test_caps_below_one_are_rejected(self):
+        """A cap of 0 is refused up front instead of leaving every job waiting"""
+        jobs = [{'name': 'job0', 'backup_job': 'postgres', 'priority': 0, 'host': 'db0'}]
+        for caps in [(0, 1), (4, 0)]:
+            with self.subTest(caps=caps):
+                with self.assertRaises(SystemExit):
+                    run_all(jobs, lambda job: job['name'], *caps)
+        for option in ['--max-parallel', '--max-per-host']:
+            with self.subTest(option=option), contextlib.redirect_stderr(io.StringIO()):
+                with self.assertRaises(SystemExit):
+                    backup.PARSE.parse_args([option, '0'])
+        self.assertEqual(backup.PARSE.parse_args(['--max-parallel', '2']).max_parallel, 2)
+
+    def test_job_lock(self):
+        """A job that is still running is skipped instead of run twice"""
+        lock_dir = os.path.join(self.work_dir, 'run')
+        jobs = [{'name': 'alpha', 'backup_job': 'postgres', 'priority': 0, 'host': 'db1'}]
+
+        def run_job(job):
+            with job_lock(job['name'], lock_dir):
+                return job['name']
+
+        with job_lock('alpha', lock_dir) as lock_path:
+            with open(lock_path) as lock_file:
+                self.assertEqual(lock_file.read(), str(os.getpid()) + "\n")
+            results = run_all(jobs, run_job)
+        self.assertEqual(results['alpha']['status'], 'skipped')
+        self.assertEqual(run_all(jobs, run_job)['alpha']['status'], 'ok')
+
+
+if __name__ == '__main__':
+    unittest.main()
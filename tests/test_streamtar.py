@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Module:					Streaming Tar tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests stream the output of several dump commands at once into
+                        a single archive, and read the members back with tarfile.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to write the test files
+import gzip  # Used to read the members back
+import shutil  # Used to clean up the test directories
+import tarfile  # Used to read the archive back
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+
+# Import Nimbus class libraries
+from libs.streamtar import StreamingTar, stream_dumps  # The library under test
+from libs.metrics import Metrics  # Used to check what the dumps record
+from tests.tools import make_tool  # Used to write the stand-in dump tool
+
+DUMP_TOOL = """
+if sys.argv[1] == 'broken':
+    sys.stderr.write("connection refused\\n")
+    sys.exit(2)
+for line in range(int(sys.argv[2])):
+    print(sys.argv[1] + " " + str(line))
+"""
+DUMP_LINES = 20000
+
+
+class StreamingTarTest(unittest.TestCase):
+    """This class tests the archive that the dumps are streamed into"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_streamtar_')
+        self.dump_tool = make_tool(self.work_dir, 'dump', DUMP_TOOL)
+        self.tar_path = os.path.join(self.work_dir, 'backup.tar')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def dump_command(self, database):
+        """This function returns the command that dumps a test database"""
+        return [self.dump_tool, database, str(DUMP_LINES)]
+
+    def expected(self, database):
+        """This function returns what the dump of a test database holds"""
+        return "".join(database + " " + str(line) + "\n" for line in range(DUMP_LINES)).encode()
+
+    def test_parallel_dumps_round_trip(self):
+        """Dumps streamed side by side all come back whole, along with the added files"""
+        databases = ['alpha', 'bravo', 'charlie', 'delta']
+        config_path = os.path.join(self.work_dir, 'my.cnf')
+        with open(config_path, 'w') as config_file:
+            config_file.write("[mysqld]\n")
+
+        metrics = Metrics('streamtar')
+        archive = StreamingTar(self.tar_path)
+        results = stream_dumps(archive, [(None, self.dump_command(database),
+                                          database + '.sql.gz', database)
+                                         for database in databases],
+                               max_parallel_dumps=len(databases), metrics=metrics)
+        self.assertEqual([result['returncode'] for _, result in results], [0, 0, 0, 0])
+        archive.add_file(config_path, 'my.cnf')
+        archive.close()
+
+        with tarfile.open(self.tar_path) as tar:
+            self.assertEqual(sorted(tar.getnames()),
+                             sorted([database + '.sql.gz' for database in databases] +
+                                    ['my.cnf']))
+            for database in databases:
+                member = tar.extractfile(database + '.sql.gz')
+                self.assertEqual(gzip.decompress(member.read()), self.expected(database))
+            self.assertEqual(tar.extractfile('my.cnf').read(), b"[mysqld]\n")
+        # Every dump is recorded with what it read from the dump tool and wrote to the archive.
+        records = {record['database']: record for record in metrics.records}
+        self.assertEqual(sorted(records), sorted(databases))
+        for database in databases:
+            self.assertEqual(records[database]['phase'], 'dump')
+            self.assertEqual(records[database]['bytes_in'], len(self.expected(database)))
+            self.assertGreater(records[database]['bytes_out'], 0)
+            self.assertLess(records[database]['bytes_out'], records[database]['bytes_in'])
+            self.assertGreater(records[database]['cpu_seconds'], 0)
+        # The spool files of the dumps that had to wait are cleaned up.
+        self.assertEqual(sorted(os.listdir(self.work_dir)), ['backup.tar', 'dump', 'my.cnf'])
+
+    def test_failed_dump_is_reported(self):
+        """A dump that fails is reported with its exit code and its last lines of output"""
+        logged = []
+        archive = StreamingTar(self.tar_path)
+        results = stream_dumps(archive, [('Backing up broken...', self.dump_command('broken'),
+                                          'broken.sql.gz', 'broken')], log=logged.append)
+        archive.close()
+        self.assertEqual(results[0][0], 'Backing up broken...')
+        self.assertEqual((results[0][1]['returncode'], results[0][1]['output']),
+                         (2, ['connection refused']))
+        self.assertEqual(logged, ['broken: connection refused'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Throttle tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests check the rate limit of the resource policy and the
+                        latency governor that backs it off while a probe query is slow.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import io  # Used to stand in for the archive
+import os  # Used to set the speed of the stand-in probe
+import time  # Used to time the throttled writes
+import shutil  # Used to clean up the test directories
+import tempfile  # Used to create the test directories
+import threading  # Used to check the nice value of a job thread
+import unittest  # Used to run the tests
+
+# Import Nimbus class libraries
+from libs.throttle import parse_rate, parse_cpus, RateLimiter, throttled  # Under test
+from libs.throttle import LatencyGovernor, ResourcePolicy  # The library under test
+from tests.tools import make_tool  # Used to write the stand-in probe
+
+PROBE = """
+time.sleep(float(os.environ.get('NIMBUS_TEST_PROBE_SECONDS', '0')))
+sys.exit(int(os.environ.get('NIMBUS_TEST_PROBE_EXIT', '0')))
+"""
+
+
+class ThrottleTest(unittest.TestCase):
+    """This class tests the resource policy of the backup jobs"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_throttle_')
+        self.probe = make_tool(self.work_dir, 'probe', PROBE)
+
+    def tearDown(self):
+        for name in ['NIMBUS_TEST_PROBE_SECONDS', 'NIMBUS_TEST_PROBE_EXIT']:
+            os.environ.pop(name, None)
+        shutil.rmtree(self.work_dir)
+
+    def test_parse_settings(self):
+        """Rates take K, M and G suffixes and CPU lists take ranges"""
+        self.assertEqual(parse_rate('50M'), 50 * 1024 * 1024)
+        self.assertEqual(parse_rate('1.5kb'), 1536)
+        self.assertEqual(parse_rate(4096), 4096)
+        self.assertIsNone(parse_rate(None))
+        for rate in ['fast', '0', '-1M']:
+            with self.subTest(rate=rate):
+                with self.assertRaises(SystemExit):
+                    parse_rate(rate)
+        self.assertEqual(parse_cpus("0-3,6"), {0, 1, 2, 3, 6})
+        self.assertEqual(parse_cpus([1, '2']), {1, 2})
+        self.assertEqual(parse_cpus(5), {5})
+
+    def test_rate_limit(self):
+        """Writes through the limiter take as long as the rate says they should"""
+        limiter = RateLimiter(parse_rate('4M'))
+        archive = io.BytesIO()
+        fileobj = throttled(archive, limiter)
+        start = time.monotonic()
+        for _ in range(4):
+            fileobj.write(b'x' * 512 * 1024)
+        elapsed = time.monotonic() - start
+        self.assertGreater(elapsed, 0.4)
+        self.assertLess(elapsed, 1.5)
+        self.assertEqual((fileobj.tell(), limiter.bytes_total), (2 * 1024 * 1024, 2 * 1024 * 1024))
+        self.assertIs(throttled(archive, None), archive)
+
+    def test_probe_runs_without_a_shell(self):
+        """The probe is split like a shell would, but never run through one"""
+        governor = LatencyGovernor(RateLimiter(), self.probe + " -c 'SELECT 1'; touch pwned",
+                                   threshold_ms=100, interval=0.5)
+        self.assertEqual(governor.probe_command[1:], ['-c', 'SELECT 1;', 'touch', 'pwned'])
+        self.assertLess(governor.probe(), 0.5)
+        self.assertFalse(os.path.exists('pwned'))
+
+        os.environ['NIMBUS_TEST_PROBE_EXIT'] = '2'
+        self.assertIsNone(governor.probe())
+        self.assertIsNone(LatencyGovernor(RateLimiter(), [self.work_dir + '/missing']).probe())
+        with self.assertRaises(SystemExit):
+            LatencyGovernor(RateLimiter(), "")
+
+    def test_hung_probe_is_slow(self):
+        """A probe that does not come back in time is killed and counts as slow"""
+        os.environ['NIMBUS_TEST_PROBE_SECONDS'] = '30'
+        governor = LatencyGovernor(RateLimiter(), [self.probe], threshold_ms=100, interval=0.3)
+        start = time.monotonic()
+        latency = governor.probe()
+        self.assertGreater(latency, governor.threshold)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_governor_backs_off_and_recovers(self):
+        """The rate is halved while the probe is slow and raised again once it is fast"""
+        limiter = RateLimiter(parse_rate('64M'))
+        governor = LatencyGovernor(limiter, [self.probe], threshold_ms=100, interval=0.05,
+                                   min_rate=parse_rate('1M'), max_rate=parse_rate('64M'))
+        os.environ['NIMBUS_TEST_PROBE_SECONDS'] = '0.15'
+        governor.start()
+        try:
+            deadline = time.monotonic() + 10
+            while limiter.rate > parse_rate('16M') and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertLessEqual(limiter.rate, parse_rate('16M'))
+            self.assertGreater(governor.backoffs, 0)
+
+            os.environ['NIMBUS_TEST_PROBE_SECONDS'] = '0'
+            deadline = time.monotonic() + 10
+            while limiter.rate < parse_rate('64M') and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(limiter.rate, parse_rate('64M'))
+        finally:
+            governor.stop()
+
+    def test_policy_applies_to_the_job_thread(self):
+        """The nice value is set on the thread that runs the job"""
+        applied = []
+        policy = ResourcePolicy({'nice': 10, 'rate_limit': '10M'})
+        self.assertEqual(policy.limiter.rate, 10 * 1024 * 1024)
+        self.assertIsNone(policy.governor)
+
+        def job():
+            applied.extend(policy.apply())
+            applied.append(os.getpriority(os.PRIO_PROCESS, 0))
+
+        before = os.getpriority(os.PRIO_PROCESS, 0)
+        thread = threading.Thread(target=job)
+        thread.start()
+        thread.join()
+        self.assertEqual(applied, ['nice 10', 'rate limit 10485760 bytes/s', 10])
+        self.assertEqual(os.getpriority(os.PRIO_PROCESS, 0), before)
+        with self.assertRaises(SystemExit):
+            ResourcePolicy({'adaptive': {'threshold_ms': 50}})
+
+
+if __name__ == '__main__':
+    unittest.main()
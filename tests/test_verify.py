@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				Verify tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests copy archives to backup directories, damage some of the
+                        copies and check what the verify mode reports for each of them.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to write and damage the test copies
+import json  # Used to find a chunk of a chunk store manifest
+import shutil  # Used to clean up the test directories
+import hashlib  # Used to checksum the test archives
+import tempfile  # Used to create the test directories
+import unittest  # Used to run the tests
+
+# Import Nimbus class libraries
+from libs.verify import verify, hash_archive  # The library under test
+from libs.fanout import FileSink, fan_out  # Used to copy the archives with their sidecars
+from libs.chunkstore import ChunkStoreSink, chunk_path, manifest_path  # Used for chunk stores
+
+
+class VerifyTest(unittest.TestCase):
+    """This class tests the verify mode of the backup directories"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_verify_')
+        self.nfs = os.path.join(self.work_dir, 'nfs')
+        self.store = os.path.join(self.work_dir, 'store')
+        os.makedirs(self.nfs)
+        os.makedirs(self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def backup(self, archive_name, data):
+        """This function copies a test archive to the nfs directory and the chunk store"""
+        archive_path = os.path.join(self.work_dir, archive_name)
+        with open(archive_path, 'wb') as archive:
+            archive.write(data)
+        digest, results = fan_out(archive_path,
+                                  [FileSink('nfs', os.path.join(self.nfs, archive_name)),
+                                   ChunkStoreSink('store', self.store, archive_name)])
+        self.assertEqual([result['error'] for result in results], [None, None])
+        return digest
+
+    def statuses(self):
+        """This function verifies both directories and returns the status of each copy"""
+        return {os.path.relpath(result['path'], self.work_dir): result['status']
+                for result in verify([self.nfs, self.store])}
+
+    def test_hash_archive(self):
+        """The memory mapped hash matches hashlib, including for an empty archive"""
+        for data in [b'', os.urandom(300 * 1024)]:
+            archive_path = os.path.join(self.work_dir, 'archive')
+            with open(archive_path, 'wb') as archive:
+                archive.write(data)
+            self.assertEqual(hash_archive(archive_path), hashlib.sha256(data).hexdigest())
+
+    def test_verify_reports_each_copy(self):
+        """Intact copies are ok, and damaged, missing and broken chunk store copies are not"""
+        self.backup('first.tar', os.urandom(200 * 1024))
+        self.backup('second.tar', os.urandom(200 * 1024))
+        self.backup('third.tar', os.urandom(200 * 1024))
+        self.assertEqual(set(self.statuses().values()), {'ok'})
+
+        with open(os.path.join(self.nfs, 'first.tar'), 'r+b') as copy:
+            copy.write(b'damaged')
+        os.remove(os.path.join(self.nfs, 'second.tar'))
+        with open(manifest_path(self.store, 'third.tar')) as manifest_file:
+            chunk_id = json.load(manifest_file)['chunks'][0][0]
+        with open(chunk_path(self.store, chunk_id), 'r+b') as chunk:
+            chunk.write(b'damaged')
+
+        statuses = self.statuses()
+        self.assertEqual(statuses['nfs/first.tar'], 'mismatch')
+        self.assertEqual(statuses['nfs/second.tar'], 'missing')
+        self.assertEqual(statuses['nfs/third.tar'], 'ok')
+        self.assertEqual(statuses['store/first.tar.chunks.json'], 'ok')
+        self.assertTrue(statuses['store/third.tar.chunks.json'].startswith('error: '))
+
+
+if __name__ == '__main__':
+    unittest.main()
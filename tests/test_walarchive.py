@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Library:				WAL archive tests
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These tests ship WAL files to the backup directories and fetch them
+                        back, expire them with their base backups and run a stand-in receiver.
+***************************************************************************
+"""
+
+# Define all modules that these tests will utilize
+import os  # Used to write the test WAL files
+import shutil  # Used to clean up the test directories
+import tempfile  # Used to create the test directories
+import threading  # Used to stop the WAL receiver
+import unittest  # Used to run the tests
+import subprocess  # Used to count the receivers that are started
+from unittest import mock  # Used to shorten the pauses and count the receivers
+
+# Import Nimbus class libraries
+from libs.walarchive import ship_wal, fetch_wal, sweep_wal, write_start_marker  # Under test
+from libs import walarchive  # Used to shorten the pauses and count the receivers
+from libs.walarchive import receive_wal, spool_files  # The library under test
+from libs.parseconf import BackupDir  # Used to describe the test backup directories
+from libs.verify import SIDECAR_EXTENSION, read_sidecar  # Used to check the local WAL copies
+from tests.tools import make_tool  # Used to write the stand-in WAL receiver
+
+SEGMENTS = ['000000010000000000000001', '000000010000000000000002', '000000010000000000000003']
+
+# Writes the WAL segments of its launch (launches are split by ;) into the spool (-D). Every
+# launch but the last exits as the server went away, the last one waits for SIGINT.
+RECEIVER = """
+import signal
+spool = sys.argv[sys.argv.index('-D') + 1]
+launches_path = os.path.join(os.path.dirname(sys.argv[0]), 'launches')
+launch = os.path.getsize(launches_path) if os.path.exists(launches_path) else 0
+with open(launches_path, 'a') as launches:
+    launches.write('x')
+groups = os.environ['NIMBUS_TEST_SEGMENTS'].split(';')
+for name in groups[launch].split(','):
+    with open(os.path.join(spool, name + '.partial'), 'w') as segment:
+        segment.write('wal ' + name)
+    os.rename(os.path.join(spool, name + '.partial'), os.path.join(spool, name))
+with open(os.path.join(spool, '000000010000000000000009.partial'), 'w') as segment:
+    segment.write('wal in progress ' + str(launch))
+if launch < len(groups) - 1:
+    sys.exit(1)
+signal.signal(signal.SIGINT, lambda *_: sys.exit(0))
+time.sleep(60)
+"""
+
+
+class WalArchiveTest(unittest.TestCase):
+    """This class tests the continuous WAL archiving"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='nimbus_walarchive_')
+        self.localdir = os.path.join(self.work_dir, 'local')
+        self.backup_dirs = [BackupDir('local', 'local', self.work_dir + '/', 3, 'local', {}),
+                            BackupDir('nfs', 'nfs', self.work_dir + '/', 7, 'nfs', {}),
+                            BackupDir('store', 'store', self.work_dir + '/', 7, 'chunkstore', {})]
+        self.locations = [directory.full_path for directory in self.backup_dirs]
+        for location in self.locations:
+            os.makedirs(location)
+        self.pg_wal = os.path.join(self.work_dir, 'pg_wal')
+        os.makedirs(self.pg_wal)
+
+    def tearDown(self):
+        os.environ.pop('NIMBUS_TEST_SEGMENTS', None)
+        shutil.rmtree(self.work_dir)
+
+    def write_wal(self, name, content=None):
+        """This function writes a WAL file the way postgres would hand it to the archiver"""
+        wal_path = os.path.join(self.pg_wal, name)
+        with open(wal_path, 'wb') as wal_file:
+            wal_file.write(content or ('wal ' + name).encode() * 4096)
+        return wal_path
+
+    def ship(self, wal_path):
+        """This function ships a WAL file to the test backup directories"""
+        return ship_wal(wal_path, self.localdir, self.backup_dirs, self.locations, 'gz')
+
+    def test_ship_and_fetch(self):
+        """A shipped WAL file is compressed, copied to the remote directories and fetched back"""
+        wal_path = self.write_wal(SEGMENTS[0])
+        local_path, results = self.ship(wal_path)
+        self.assertEqual(local_path, os.path.join(self.localdir, 'wal', SEGMENTS[0] + '.gz'))
+        self.assertEqual([(result['label'], result['error']) for result in results],
+                         [('nfs', None)])
+        self.assertTrue(read_sidecar(local_path + SIDECAR_EXTENSION))
+        self.assertTrue(os.path.isfile(os.path.join(self.locations[1], 'wal',
+                                                    SEGMENTS[0] + '.gz')))
+        self.assertFalse(os.path.exists(os.path.join(self.locations[2], 'wal')))
+
+        target_path = os.path.join(self.work_dir, 'RECOVERYXLOG')
+        fetched = fetch_wal(self.locations[1:], SEGMENTS[0], target_path)
+        self.assertEqual(fetched, os.path.join(self.locations[1], 'wal', SEGMENTS[0] + '.gz'))
+        with open(wal_path, 'rb') as wal_file, open(target_path, 'rb') as restored:
+            self.assertEqual(restored.read(), wal_file.read())
+        self.assertIsNone(fetch_wal(self.locations[1:], SEGMENTS[1], target_path))
+
+    def test_partial_is_replaced_by_the_finished_segment(self):
+        """The local copy of a segment in progress goes once the finished one is shipped"""
+        self.ship(self.write_wal(SEGMENTS[1] + '.partial', b'half a segment'))
+        wal_dir = os.path.join(self.localdir, 'wal')
+        self.assertEqual(sorted(os.listdir(wal_dir)),
+                         [SEGMENTS[1] + '.partial.gz', SEGMENTS[1] + '.partial.gz.sha256'])
+        # Before the segment is finished, the last copy of it is what a restore gets.
+        target_path = os.path.join(self.work_dir, 'RECOVERYXLOG')
+        fetch_wal([self.locations[1]], SEGMENTS[1], target_path)
+        with open(target_path, 'rb') as restored:
+            self.assertEqual(restored.read(), b'half a segment')
+
+        self.ship(self.write_wal(SEGMENTS[1]))
+        self.assertEqual(sorted(os.listdir(wal_dir)),
+                         [SEGMENTS[1] + '.gz', SEGMENTS[1] + '.gz.sha256'])
+
+    def test_sweep_keeps_the_wal_of_kept_base_backups(self):
+        """WAL is removed up to the first segment of the oldest base backup that is kept"""
+        nfs = self.locations[1]
+        for name in SEGMENTS + ['00000002.history']:
+            self.ship(self.write_wal(name))
+        for archive_name, segment in [('postgres_2016-04-01_01-00-00.tar.gz', SEGMENTS[1]),
+                                      ('postgres_2016-04-02_01-00-00.tar.gz', SEGMENTS[2])]:
+            open(os.path.join(nfs, archive_name), 'w').close()
+            write_start_marker(nfs, archive_name, segment)
+
+        result = sweep_wal(nfs, [], dry_run=True)
+        self.assertEqual(result['keep_from'], SEGMENTS[1])
+        first = os.path.join(nfs, 'wal', SEGMENTS[0] + '.gz')
+        self.assertEqual(sorted(result['removed']), [first, first + SIDECAR_EXTENSION])
+        self.assertTrue(os.path.exists(first))
+
+        # Once the older base backup is swept, its marker and the WAL before the newer go too.
+        os.remove(os.path.join(nfs, 'postgres_2016-04-01_01-00-00.tar.gz'))
+        result = sweep_wal(nfs, ['postgres_2016-04-01_01-00-00.tar.gz'])
+        self.assertEqual(result['keep_from'], SEGMENTS[2])
+        self.assertEqual(sorted(os.listdir(os.path.join(nfs, 'wal'))), [
+            SEGMENTS[2] + '.gz', SEGMENTS[2] + '.gz' + SIDECAR_EXTENSION,
+            '00000002.history.gz', '00000002.history.gz' + SIDECAR_EXTENSION,
+            'postgres_2016-04-02_01-00-00.tar.gz.' + SEGMENTS[2] + '.start'])
+
+    def receive(self, launches):
+        """This function runs the stand-in receiver until the last segment is shipped"""
+        spool_dir = os.path.join(self.work_dir, 'spool')
+        receiver = make_tool(self.work_dir, 'pg_receivewal', RECEIVER)
+        os.environ['NIMBUS_TEST_SEGMENTS'] = ";".join(",".join(names) for names in launches)
+        stop = threading.Event()
+        shipped = []
+        launched = []
+        real_popen = subprocess.Popen
+
+        def popen(*args, **kwargs):
+            """This function counts the receivers started before starting one"""
+            launched.append(args[0])
+            return real_popen(*args, **kwargs)
+
+        def ship(file_path):
+            """This function records the WAL file and stops once the receiver is done"""
+            with open(file_path) as wal_file:
+                shipped.append((os.path.basename(file_path), wal_file.read(), len(launched)))
+            if os.path.basename(file_path) == SEGMENTS[-1]:
+                stop.set()
+            return True
+
+        # A receiver that is never started again would keep the loop going for good.
+        timeout = threading.Timer(10, stop.set)
+        timeout.start()
+        try:
+            with mock.patch.object(walarchive.subprocess, 'Popen', popen):
+                stats = receive_wal([receiver, '-D', spool_dir], spool_dir, ship, stop,
+                                    partial_interval=3600)
+        finally:
+            timeout.cancel()
+        return spool_dir, shipped, stats
+
+    def test_receive_wal(self):
+        """Every finished segment the receiver writes is shipped, and the partial on the way out"""
+        spool_dir, shipped, stats = self.receive([SEGMENTS])
+        self.assertEqual(shipped[:3], [(name, 'wal ' + name, 1) for name in SEGMENTS])
+        self.assertEqual(shipped[3:], [('000000010000000000000009.partial',
+                                        'wal in progress 0', 1)])
+        self.assertEqual(stats, {'shipped': 3, 'failed': 0, 'partials': 1, 'restarts': 0})
+        # The newest segment stays in the spool for the receiver to carry on from.
+        self.assertEqual(spool_files(spool_dir),
+                         ([SEGMENTS[-1]], '000000010000000000000009.partial'))
+
+    @mock.patch.object(walarchive, 'POLL_INTERVAL', 0.1)
+    @mock.patch.object(walarchive, 'RESTART_BACKOFF', 0.5)
+    def test_receiver_is_restarted(self):
+        """A receiver that exits is started again, and what both of them wrote is shipped"""
+        _, shipped, stats = self.receive([SEGMENTS[:2], SEGMENTS[2:]])
+        # What the first receiver left behind is shipped before the pause and the restart.
+        self.assertEqual(shipped[:3], [(SEGMENTS[0], 'wal ' + SEGMENTS[0], 1),
+                                       (SEGMENTS[1], 'wal ' + SEGMENTS[1], 1),
+                                       ('000000010000000000000009.partial',
+                                        'wal in progress 0', 1)])
+        self.assertEqual(shipped[3], (SEGMENTS[2], 'wal ' + SEGMENTS[2], 2))
+        self.assertEqual(stats['shipped'], 3)
+        self.assertEqual(stats['restarts'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
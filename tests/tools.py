@@ -0,0 +1,23 @@
+#!/usr/bin/python3
+"""
+***************************************************************************
+Script:                 Nimbus Intermixed Modular Back Up Script
+Module:					Test tools
+Authors/Maintainers:    Rich Nason (rnason@clusterfrak.com)
+Description:            These helpers write stand-in command line tools for the tests, so
+                        that the backup modules can be run without the real servers.
+***************************************************************************
+"""
+
+# Define all modules that these helpers will utilize
+import os  # Used to write the stand-in tools
+import sys  # Used to run the stand-in tools with the same python
+
+
+def make_tool(bin_dir, name, body):
+    """This function writes a stand-in tool as a python script and returns its path"""
+    tool_path = os.path.join(bin_dir, name)
+    with open(tool_path, 'w') as tool:
+        tool.write("#!" + sys.executable + "\nimport os, sys, time\n" + body)
+    os.chmod(tool_path, 0o755)
+    return tool_path